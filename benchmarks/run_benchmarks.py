@@ -0,0 +1,277 @@
+# ------------------------------------------------------------------------------
+# Offline benchmarks of the orchestrator and worker hot paths, run against the
+# in-process S3 stand-in (lambdas/utils/local_s3.py) so no AWS account is needed.
+# Synthetic buckets with a realistic mix of file sizes (small images, medium
+# files, large videos) are listed, routed, split into works and serialized, and
+# the worker's per-file path copies files with injected S3 latency/bandwidth,
+# with each copy engine (threads, asyncio) since small files are bound by the
+# request latency and by how many of them are in flight.
+# The streaming relay (GET-range to UploadPart, see lambdas/utils/s3_relay.py)
+# is timed on a large file between two clients, its throughput in MB/sec.
+# Throughput and peak memory (tracemalloc, in a separate pass) are reported per
+# phase. Cold starts are timed in fresh interpreters: the import of each Lambda
+# function module and the creation of its first S3 client (median of runs). Results
+# can be saved and compared against a baseline to catch
+# regressions before deploying.
+#
+# Sample invoke (from the project root):
+# python benchmarks/run_benchmarks.py --num-objects 1000 100000 1000000 --output results.json
+# python benchmarks/run_benchmarks.py --baseline results.json
+# python benchmarks/run_benchmarks.py --num-objects --worker-request-latency-in-sec --startup-runs 20
+# ------------------------------------------------------------------------------
+
+import argparse
+import gc
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+lambdas_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas')
+sys.path.insert(0, lambdas_dir)
+
+from utils.local_s3 import LocalS3Client, LocalS3Object
+from utils.s3_routing import S3RoutingTable
+from utils.s3_listing import list_s3_objects_sharded
+from utils.s3_manifest import S3ManifestWriter
+from utils.s3_relay import RelayBufferPool, S3StreamingRelay
+from utils import s3_utils
+from s3_copy_orchestrator import S3CopyOrchestrator, s3_objects_to_catalog, s3_work_to_json
+import s3_copy_worker
+
+src_s3_bucket = 'benchmark-source'
+trg_s3_bucket = 'benchmark-target'
+src_s3_path = 'source/'
+s3_copy_config = {
+    'source_s3_config': {'s3_bucket': src_s3_bucket, 's3_path': src_s3_path},
+    'target_s3_config': [
+        {'file_types': ['jpg'], 's3_bucket': trg_s3_bucket, 's3_path': 'images/'},
+        {'file_types': ['mp4', 'zip'], 's3_bucket': trg_s3_bucket, 's3_path': 'videos/'}
+    ]
+}
+startup_modules = ['s3_copy_orchestrator', 's3_copy_worker']
+# run in a fresh interpreter: argv = [lambdas directory, module of a Lambda function]
+startup_script = '''
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+start_time = time.perf_counter()
+__import__(sys.argv[2])
+import_time = time.perf_counter()
+from utils.s3_clients import get_s3_client
+get_s3_client().meta
+print(json.dumps({'import_time_in_sec': import_time - start_time, 'first_client_time_in_sec': time.perf_counter() - import_time}))
+'''
+
+
+class BenchmarkResult:
+
+    def __init__(self, name, num_items, elapsed_time_in_sec, peak_memory_in_mb=None):
+        self.name = name
+        self.num_items = num_items
+        self.elapsed_time_in_sec = elapsed_time_in_sec
+        self.peak_memory_in_mb = peak_memory_in_mb
+
+    @property
+    def items_per_sec(self):
+        return self.num_items / self.elapsed_time_in_sec if self.elapsed_time_in_sec > 0 else float('inf')
+
+    def to_json(self):
+        return {
+            'name': self.name,
+            'num_items': self.num_items,
+            'elapsed_time_in_sec': self.elapsed_time_in_sec,
+            'items_per_sec': self.items_per_sec,
+            'peak_memory_in_mb': self.peak_memory_in_mb
+        }
+
+    def __repr__(self):
+        return f'BenchmarkResult({self.name!r}, {self.num_items!r}, {self.elapsed_time_in_sec!r}, {self.peak_memory_in_mb!r})'
+
+
+# Runs a phase (a function of the previous phase output) and returns its output and timing
+def run_phase(phase, phase_input):
+    gc.collect()
+    start_time = time.perf_counter()
+    phase_output = phase(phase_input)
+    return phase_output, time.perf_counter() - start_time
+
+
+# Peak memory allocated while running a phase (tracemalloc slows the phase down, so it
+# is measured separately from its timing)
+def measure_phase_peak_memory_in_mb(phase, phase_input):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        phase(phase_input)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+
+def orchestrator_phases(s3_client, num_works, max_payload_size_in_mb):
+    routing_table = S3RoutingTable(s3_copy_config['target_s3_config'])
+    # works written into manifests (large plans), the works are passed on to the next phase
+    def write_manifests(s3_works):
+        s3_work_to_json(s3_works, manifest_writer=S3ManifestWriter(s3_client, trg_s3_bucket, 'manifests/'))
+        return s3_works
+    return [
+        ('listing', lambda _: list(list_s3_objects_sharded(s3_client, src_s3_bucket, src_s3_path))),
+        ('routing', lambda s3_objects: s3_objects_to_catalog(s3_objects, src_s3_bucket, src_s3_path, routing_table)),
+        ('split_work', lambda catalog: S3CopyOrchestrator().split_work(catalog, num_works, max_payload_size_in_mb)),
+        ('s3_work_to_manifests', write_manifests),
+        ('s3_work_to_json', lambda s3_works: s3_work_to_json(s3_works))
+    ]
+
+
+def benchmark_orchestrator(num_objects, num_works, max_payload_size_in_mb, trace_memory):
+    s3_client = LocalS3Client()
+    s3_client.create_synthetic_bucket(Bucket=src_s3_bucket, num_objects=num_objects, prefix=src_s3_path)
+    s3_client.create_bucket(Bucket=trg_s3_bucket)
+    results = []
+    phase_output = None
+    for phase_name, phase in orchestrator_phases(s3_client, num_works, max_payload_size_in_mb):
+        phase_input = phase_output
+        phase_output, elapsed_time = run_phase(phase, phase_input)
+        peak_memory_in_mb = measure_phase_peak_memory_in_mb(phase, phase_input) if trace_memory else None
+        results.append(BenchmarkResult('{}[{}]'.format(phase_name, num_objects), num_objects, elapsed_time, peak_memory_in_mb))
+    return results
+
+
+def benchmark_worker(num_files, request_latency_in_sec, bandwidth_in_mb_per_sec, trace_memory, copy_engine='threads'):
+    file_size = 64 * 1024
+    def new_payload_files():
+        s3_client = LocalS3Client(request_latency_in_sec=request_latency_in_sec, bandwidth_in_mb_per_sec=bandwidth_in_mb_per_sec)
+        s3_client.create_bucket(Bucket=src_s3_bucket)
+        s3_client.create_bucket(Bucket=trg_s3_bucket)
+        # source files are added directly to the bucket (no injected latency)
+        s3_object = LocalS3Object(b'0' * file_size)
+        for idx in range(num_files):
+            s3_client.buckets[src_s3_bucket].put('{}{}.jpg'.format(src_s3_path, idx), s3_object)
+        s3_utils.s3 = s3_client
+        return [{'source_s3_bucket': src_s3_bucket, 'source_s3_path': '{}{}.jpg'.format(src_s3_path, idx),
+                 'target_s3_bucket': trg_s3_bucket, 'target_s3_path': 'images/{}.jpg'.format(idx),
+                 'file_size_in_mb': file_size / (1024 * 1024)} for idx in range(num_files)]
+    def copy_payload(payload_files):
+        return s3_copy_worker.new_copy_engine('copy-files').run(payload_files)
+    name = 'worker_copy{}[{}, {}s latency]'.format('' if copy_engine == 'threads' else '_' + copy_engine, num_files, request_latency_in_sec)
+    os.environ['CopyEngine'] = copy_engine
+    try:
+        results, elapsed_time = run_phase(copy_payload, new_payload_files())
+        if not all(result.succeeded for result in results):
+            raise Exception('Worker benchmark failed to copy {} files'.format(sum(1 for result in results if not result.succeeded)))
+        peak_memory_in_mb = measure_phase_peak_memory_in_mb(copy_payload, new_payload_files()) if trace_memory else None
+    finally:
+        del os.environ['CopyEngine']
+    return [BenchmarkResult(name, num_files, elapsed_time, peak_memory_in_mb)]
+
+
+def benchmark_relay(file_size_in_mb, request_latency_in_sec, bandwidth_in_mb_per_sec, buffer_size_in_mb, num_buffers, trace_memory):
+    file_size = file_size_in_mb * 1024 * 1024
+    # the buffers are allocated once per container, not per relayed file
+    relay = S3StreamingRelay(RelayBufferPool(num_buffers, buffer_size_in_mb * 1024 * 1024))
+    def new_s3_clients():
+        source_s3_client = LocalS3Client(request_latency_in_sec=request_latency_in_sec, bandwidth_in_mb_per_sec=bandwidth_in_mb_per_sec)
+        source_s3_client.create_bucket(Bucket=src_s3_bucket)
+        source_s3_client.buckets[src_s3_bucket].put('{}large.mp4'.format(src_s3_path), LocalS3Object(bytes(file_size)))
+        target_s3_client = LocalS3Client(request_latency_in_sec=request_latency_in_sec, bandwidth_in_mb_per_sec=bandwidth_in_mb_per_sec)
+        target_s3_client.create_bucket(Bucket=trg_s3_bucket)
+        return source_s3_client, target_s3_client
+    def relay_file(s3_clients):
+        source_s3_client, target_s3_client = s3_clients
+        relay.relay(source_s3_client, src_s3_bucket, '{}large.mp4'.format(src_s3_path), target_s3_client, trg_s3_bucket, 'videos/large.mp4', file_size)
+    name = 'relay[{} MB, {}s latency]'.format(file_size_in_mb, request_latency_in_sec)
+    _, elapsed_time = run_phase(relay_file, new_s3_clients())
+    # the in-process S3 keeps the parts in memory, so the peak includes the relayed file
+    peak_memory_in_mb = measure_phase_peak_memory_in_mb(relay_file, new_s3_clients()) if trace_memory else None
+    return [BenchmarkResult(name, file_size_in_mb, elapsed_time, peak_memory_in_mb)]
+
+
+# Cold start of a Lambda function module: time to import it and time to create its first S3
+# client afterwards (median of num_runs fresh interpreters). The AWS config files are ignored
+# so that timings do not depend on the local AWS profile.
+def benchmark_startup(module_name, num_runs):
+    env = dict(os.environ, AWS_DEFAULT_REGION='us-east-1', AWS_CONFIG_FILE=os.devnull, AWS_SHARED_CREDENTIALS_FILE=os.devnull,
+               AWS_EC2_METADATA_DISABLED='true')
+    timings = []
+    # the first run compiles the modules (.pyc files) and is not counted
+    for _ in range(num_runs + 1):
+        output = subprocess.run([sys.executable, '-c', startup_script, lambdas_dir, module_name], env=env, stdout=subprocess.PIPE, check=True)
+        timings.append(json.loads(output.stdout.decode('utf-8')))
+    timings = timings[1:]
+    return [
+        BenchmarkResult('startup_import[{}]'.format(module_name), 1, statistics.median(timing['import_time_in_sec'] for timing in timings)),
+        BenchmarkResult('startup_first_client[{}]'.format(module_name), 1, statistics.median(timing['first_client_time_in_sec'] for timing in timings))
+    ]
+
+
+def print_results(results, baseline=None):
+    print('{:<44} {:>12} {:>14} {:>14} {:>10}'.format('benchmark', 'time (secs)', 'items/sec', 'peak mem (MB)', 'vs base'))
+    for result in results:
+        baseline_result = (baseline or {}).get(result.name)
+        speedup = '{:.2f}x'.format(result.items_per_sec / baseline_result['items_per_sec']) if baseline_result else '-'
+        peak_memory = '{:.1f}'.format(result.peak_memory_in_mb) if result.peak_memory_in_mb is not None else '-'
+        print('{:<44} {:>12.3f} {:>14.0f} {:>14} {:>10}'.format(result.name, result.elapsed_time_in_sec, result.items_per_sec, peak_memory, speedup))
+
+
+# Benchmarks whose throughput dropped by more than max_slowdown (eg, 0.2 = 20%) compared to the baseline
+def find_regressions(results, baseline, max_slowdown):
+    regressions = []
+    for result in results:
+        baseline_result = baseline.get(result.name)
+        if baseline_result and result.items_per_sec < baseline_result['items_per_sec'] * (1 - max_slowdown):
+            regressions.append(result.name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the S3 copy orchestrator and worker')
+    parser.add_argument('--num-objects', type=int, nargs='*', default=[1000, 10000, 100000], help='sizes of the synthetic source listings (up to 10M, none to skip)')
+    parser.add_argument('--num-works', type=int, default=10)
+    parser.add_argument('--max-payload-size-in-mb', type=int, default=1024)
+    parser.add_argument('--worker-num-files', type=int, default=2000)
+    parser.add_argument('--worker-request-latency-in-sec', type=float, nargs='*', default=[0, 0.005], help='none to skip the worker benchmarks')
+    parser.add_argument('--worker-bandwidth-in-mb-per-sec', type=float, default=None)
+    parser.add_argument('--worker-copy-engines', nargs='+', default=['threads', 'asyncio'], choices=s3_copy_worker.copy_engine_valid_types)
+    parser.add_argument('--relay-file-size-in-mb', type=int, default=256)
+    parser.add_argument('--relay-buffer-size-in-mb', type=int, default=8)
+    parser.add_argument('--relay-num-buffers', type=int, default=16)
+    parser.add_argument('--startup-runs', type=int, default=10, help='fresh interpreters timed per Lambda function module (0 to skip)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory (tracemalloc) pass')
+    parser.add_argument('--output', help='JSON file where results are saved')
+    parser.add_argument('--baseline', help='JSON file with the results of a previous run to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=0.2)
+    args = parser.parse_args()
+
+    trace_memory = not args.no_memory
+    results = []
+    for num_objects in args.num_objects:
+        results.extend(benchmark_orchestrator(num_objects, args.num_works, args.max_payload_size_in_mb, trace_memory))
+    for request_latency_in_sec in args.worker_request_latency_in_sec:
+        for copy_engine in args.worker_copy_engines:
+            results.extend(benchmark_worker(args.worker_num_files, request_latency_in_sec, args.worker_bandwidth_in_mb_per_sec, trace_memory, copy_engine))
+        results.extend(benchmark_relay(args.relay_file_size_in_mb, request_latency_in_sec, args.worker_bandwidth_in_mb_per_sec,
+            args.relay_buffer_size_in_mb, args.relay_num_buffers, trace_memory))
+    if args.startup_runs > 0:
+        for module_name in startup_modules:
+            results.extend(benchmark_startup(module_name, args.startup_runs))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {result['name']: result for result in json.load(f)['results']}
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': [result.to_json() for result in results]}, f, indent=2)
+    if baseline:
+        regressions = find_regressions(results, baseline, args.max_slowdown)
+        if regressions:
+            print('Throughput regressions (more than {:.0%} slower than the baseline): {}'.format(args.max_slowdown, regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# ------------------------------------------------------------------------------
+# Fixtures shared by the tests: a local S3 client (see utils/local_s3.py) with
+# the source and target buckets, serving the requests of the Lambda functions,
+# and the context of a Lambda execution. Test modules add their own buckets,
+# files and settings by overriding s3_client (eg, def s3_client(s3_client)).
+# ------------------------------------------------------------------------------
+
+from utils.local_s3 import LocalS3Client
+from utils import s3_utils
+import s3_copy_orchestrator
+import s3_copy_worker
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    s3_client = LocalS3Client()
+    s3_client.create_bucket(Bucket=s3_src_bucket)
+    s3_client.create_bucket(Bucket=s3_trg_bucket)
+    monkeypatch.setattr(s3_copy_orchestrator, 's3', s3_client)
+    monkeypatch.setattr(s3_utils, 's3', s3_client)
+    # manifests are read again by every test
+    monkeypatch.setattr(s3_copy_worker, 'manifest_payloads_cache', {})
+    return s3_client
+
+
+class FakeLambdaContext:
+
+    def __init__(self, remaining_time_in_millis=300000):
+        self.remaining_time_in_millis = remaining_time_in_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_time_in_millis
+
+
+# Context of a Lambda execution with remaining_time_in_millis left (5 minutes by default)
+@pytest.fixture
+def lambda_context():
+    return FakeLambdaContext
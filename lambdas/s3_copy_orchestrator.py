@@ -6,67 +6,153 @@
 # of 5 min.
 # ------------------------------------------------------------------------------
 
-import boto3
 import logging
 import json
 import os
+import time
+import uuid
+from array import array
+from itertools import islice
+from botocore.exceptions import ClientError
+from utils.s3_listing import list_s3_objects_sharded, list_s3_sources_concurrently, default_listing_concurrency
+from utils.s3_inventory import list_s3_objects_from_inventory
+from utils.s3_routing import S3RoutingTable, get_source_s3_configs
+from utils.s3_file_catalog import S3FileCatalog
+from utils.progress_journal import get_journal_store, load_completed_files
+from utils.speculation import S3ProgressBoard, get_work_progress, default_speculation_s3_path
+from utils.s3_sync import new_s3_target_index, S3SyncFilter, SYNC_ACTION_DELETE
+from utils.s3_manifest import S3ManifestWriter
+from utils.s3_work_scheduler import S3CopyCostModel, LptScheduler, new_work_scheduler, get_predicted_makespan, default_throughput_in_mb_per_sec
+from utils.work_queue import get_work_queue
+from utils.s3_clients import LazyS3Client, get_s3_client_for_bucket
+from utils.throughput_model import get_copy_route, load_throughput_model, save_throughput_model, merge_throughput_stats
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3')
+s3 = LazyS3Client()
 A_MB = 1024 * 1024
 A_GB = 1024 * A_MB
+# S3 multipart upload limits
+MIN_PART_SIZE = 5 * A_MB
+MAX_PART_SIZE = 5 * A_GB
+MAX_NUM_PARTS = 10000
+# 'static': each worker processes its own work, 'queue': workers pull payloads from a work queue
+execution_valid_modes = ['static', 'queue']
+default_execution_mode = 'static'
+default_s3_operation = 'move-files'
+# queue messages with inline payload files are capped by number of files and by the encoded size of
+# the files, leaving room for the rest of the message within the SQS message size limit (256KB)
+max_files_per_queue_message = 500
+max_queue_message_files_size = 200 * 1024
+# predicted duration of a payload when payloads are sized by the throughput model (Lambda timeout: 300 secs)
+default_target_payload_duration_in_sec = 180
+default_throughput_model_s3_path = 'throughput-model/throughput_model.json'
+# listed S3 objects routed at once
+default_routing_batch_size = 1000
 
 class S3FileInfo:
 
-    def __init__(self, source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size):
+    def __init__(self, source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size, sync_action=None):
         self.source_s3_bucket = source_s3_bucket
         self.source_s3_path = source_s3_path
         self.target_s3_bucket = target_s3_bucket
         self.target_s3_path = target_s3_path
         self.file_size = file_size
+        self.sync_action = sync_action
 
     def __repr__(self):
-        return f'S3FileInfo({self.source_s3_bucket!r}, {self.source_s3_path!r}, {self.target_s3_bucket!r}, {self.target_s3_path!r}, {self.file_size!r})'
+        return f'S3FileInfo({self.source_s3_bucket!r}, {self.source_s3_path!r}, {self.target_s3_bucket!r}, {self.target_s3_path!r}, {self.file_size!r}, {self.sync_action!r})'
 
 
+# A byte range of a large S3 file copied as one part of a multipart upload
+class S3FilePartInfo(S3FileInfo):
+
+    def __init__(self, source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size, upload_id, part_number, byte_range):
+        super().__init__(source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size, None)
+        self.upload_id = upload_id
+        self.part_number = part_number
+        self.byte_range = byte_range
+
+    def __repr__(self):
+        return f'S3FilePartInfo({self.source_s3_bucket!r}, {self.source_s3_path!r}, {self.target_s3_bucket!r}, {self.target_s3_path!r}, {self.file_size!r}, {self.upload_id!r}, {self.part_number!r}, {self.byte_range!r})'
+
+
+# Files of a catalog (see S3FileCatalog) by the catalog file (row) indexes
+def catalog_file(catalog, file_idx):
+    file_dict = catalog.file_to_json(file_idx)
+    if 'upload_id' in file_dict:
+        return S3FilePartInfo(file_dict['source_s3_bucket'], file_dict['source_s3_path'], file_dict['target_s3_bucket'], file_dict['target_s3_path'],
+            file_dict['file_size_in_mb'], file_dict['upload_id'], file_dict['part_number'], file_dict['byte_range'])
+    return S3FileInfo(file_dict['source_s3_bucket'], file_dict['source_s3_path'], file_dict['target_s3_bucket'], file_dict['target_s3_path'],
+        file_dict['file_size_in_mb'], file_dict.get('sync_action'))
+
+
+def new_s3_file_catalog(s3_files):
+    catalog = S3FileCatalog()
+    for s3_file in s3_files:
+        file_idx = catalog.add_file(s3_file.source_s3_bucket, s3_file.source_s3_path, s3_file.target_s3_bucket, s3_file.target_s3_path,
+            s3_file.file_size, s3_file.sync_action)
+        if isinstance(s3_file, S3FilePartInfo):
+            catalog.parts[file_idx] = (s3_file.upload_id, s3_file.part_number, s3_file.byte_range)
+    return catalog
+
+
+# A payload holds the indexes of its files in the catalog of the execution
 class S3FilePayload:
 
-    def __init__(self, max_paylod_size_in_mb):
-        self.s3_file_list = []
+    # max_payload_duration: max predicted time (in secs) it takes to copy the payload (None: no limit)
+    def __init__(self, max_paylod_size_in_mb, max_payload_duration=None, catalog=None):
+        self.file_indexes = array('I')
+        self.catalog = catalog
         self.max_paylod_size_in_mb = max_paylod_size_in_mb
+        self.max_payload_duration = max_payload_duration
         self.cur_payload_size = 0
+        self.predicted_duration = 0
 
-    def has_capacity(self, s3_file_size):
+    @property
+    def s3_file_list(self):
+        return [catalog_file(self.catalog, file_idx) for file_idx in self.file_indexes]
+
+    def has_capacity(self, s3_file_size, file_cost=0):
+        if not self.file_indexes:
+            return True
+        if self.max_payload_duration is not None and self.predicted_duration + file_cost > self.max_payload_duration:
+            return False
         return self.cur_payload_size == 0 or self.cur_payload_size + s3_file_size <= self.max_paylod_size_in_mb
 
-    def add_file(self, s3_file_info):
-        self.s3_file_list.append(s3_file_info)
-        self.cur_payload_size += s3_file_info.file_size
+    def add_file(self, file_idx, s3_file_size, file_cost=0):
+        self.file_indexes.append(file_idx)
+        self.cur_payload_size += s3_file_size
+        self.predicted_duration += file_cost
 
     def __repr__(self):
-        return f'S3FilePayload({self.s3_file_list!r})'
+        return f'S3FilePayload({list(self.file_indexes)!r})'
 
 
 class S3CopyWork:
 
-    def __init__(self, name, max_paylod_size_per_work_in_mb):
+    def __init__(self, name, max_paylod_size_per_work_in_mb, max_payload_duration=None, catalog=None):
         self.name = name
-        self.cur_payload = S3FilePayload(max_paylod_size_per_work_in_mb)
+        self.catalog = catalog
+        self.cur_payload = S3FilePayload(max_paylod_size_per_work_in_mb, max_payload_duration, catalog)
         self.max_paylod_size_per_work_in_mb = max_paylod_size_per_work_in_mb
+        self.max_payload_duration = max_payload_duration
         self.work_list = [self.cur_payload]
         self.cur_work_size = 0
+        self.predicted_duration = 0
 
     def _new_payload(self):
-        self.cur_payload = S3FilePayload(self.max_paylod_size_per_work_in_mb)
+        self.cur_payload = S3FilePayload(self.max_paylod_size_per_work_in_mb, self.max_payload_duration, self.catalog)
         self.work_list.append(self.cur_payload)
         return self
 
-    def add_payload(self, s3_file_info):
-        if (not self.cur_payload.has_capacity(s3_file_info.file_size)):
+    # file_cost: predicted time (in secs) it takes to copy the file
+    def add_payload(self, file_idx, s3_file_size, file_cost=0):
+        if (not self.cur_payload.has_capacity(s3_file_size, file_cost)):
             self._new_payload()
-        self.cur_payload.add_file(s3_file_info)
-        self.cur_work_size += s3_file_info.file_size
+        self.cur_payload.add_file(file_idx, s3_file_size, file_cost)
+        self.cur_work_size += s3_file_size
+        self.predicted_duration += file_cost
         return self
 
     def __repr__(self):
@@ -75,154 +161,504 @@ class S3CopyWork:
 
 class S3CopyOrchestrator:
 
-    def _tune_min_heap(self, works_min_heap):
-        heap_size = len(works_min_heap)
-        idx = 0
-        while True:
-            chd1_idx = 2*idx + 1
-            chd2_idx = 2*idx + 2
-            # search for a child node in the min heap
-            if (chd1_idx < heap_size):
-                min_chd_idx = chd1_idx
-                # find out the min child node
-                if (chd2_idx < heap_size and works_min_heap[chd2_idx].cur_work_size < works_min_heap[chd1_idx].cur_work_size):
-                    min_chd_idx = chd2_idx
-                # check if child node needs to be swapped with parent
-                if (works_min_heap[min_chd_idx].cur_work_size < works_min_heap[idx].cur_work_size):
-                    tmp = works_min_heap[min_chd_idx]
-                    works_min_heap[min_chd_idx] = works_min_heap[idx]
-                    works_min_heap[idx] = tmp
-                    idx = min_chd_idx
-                else:
-                    break  # no swaps required, min heap is tuned
-            else:
-                break  # node has no children, min heap is tuned
+    def __init__(self, work_scheduler=None, cost_model=None):
+        self.work_scheduler = work_scheduler or LptScheduler()
+        self.cost_model = cost_model or S3CopyCostModel()
 
-    def split_work(self, s3_files_list, num_available_works, max_paylod_size_per_work_in_mb):
+    # s3_files_list is a catalog (S3FileCatalog) or any iterable of files (eg, a generator), given
+    # file_indexes only those files of the catalog are planned. Given a max payload duration,
+    # payloads are also closed once their predicted copy time reaches it.
+    def split_work(self, s3_files_list, num_available_works, max_paylod_size_per_work_in_mb, max_payload_duration=None, file_indexes=None):
         assert s3_files_list != None and num_available_works > 0 and max_paylod_size_per_work_in_mb > 0
-        works_min_heap = [S3CopyWork('s3_copy_work_{}'.format(index), max_paylod_size_per_work_in_mb)
-                            for index in range(1, num_available_works+1)]
-        if len(s3_files_list) > 0:
-            # distributes payload evenly (greedy) across available works
-            sorted_file_list = sorted(
-                s3_files_list, key=lambda e: e.file_size, reverse=True)
-            for s3_file in sorted_file_list:
-                works_min_heap[0].add_payload(s3_file)
-                self._tune_min_heap(works_min_heap)
-        return works_min_heap
-
-class S3CopyFileTypeInfo:
-
-    def __init__(self, s3_copy_config):
-        self.file_types = {}
-        for file_type_config in s3_copy_config['target_s3_config']:
-            dest_s3_bucket = file_type_config['s3_bucket']
-            dest_s3_path = file_type_config['s3_path']
-            for file_type in file_type_config['file_types']:
-                self.file_types['{}_s3_bucket'.format(file_type)] = dest_s3_bucket
-                self.file_types['{}_s3_path'.format(file_type)] = dest_s3_path
-
-    def get_s3_bucket_for_file_type(self, file_format):
-        if not self.has_info_for_file_type(file_format):
-            raise ValueError('Could not find S3 bucket name for file type: \'{}\''.format(file_format))
-        key = '{}_s3_bucket'.format(file_format)
-        return self.file_types[key]
-
-    def get_s3_path_for_file_type(self, file_format):
-        if not self.has_info_for_file_type(file_format):
-            raise ValueError('Could not find S3 file path for file type: \'{}\''.format(file_format))
-        key = '{}_s3_path'.format(file_format)
-        return self.file_types[key]
-
-    def has_info_for_file_type(self, file_format):
-        key = '{}_s3_path'.format(file_format)
-        return key in self.file_types
+        catalog = s3_files_list if isinstance(s3_files_list, S3FileCatalog) else new_s3_file_catalog(s3_files_list)
+        if file_indexes is None:
+            file_indexes = range(len(catalog))
+        works = [S3CopyWork('s3_copy_work_{}'.format(index), max_paylod_size_per_work_in_mb, max_payload_duration, catalog)
+                    for index in range(1, num_available_works+1)]
+        # distributes payload evenly across available works based on their predicted copy time
+        file_sizes = catalog.file_sizes
+        file_cost = self.cost_model.file_cost
+        costs = array('d', (file_cost(file_sizes[file_idx]) for file_idx in file_indexes))
+        assignment = self.work_scheduler.assign(costs, num_available_works)
+        for work, cost_indexes in zip(works, assignment):
+            # larger files first within a work
+            for idx in sorted(cost_indexes, key=lambda idx: file_sizes[file_indexes[idx]], reverse=True):
+                work.add_payload(file_indexes[idx], file_sizes[file_indexes[idx]], costs[idx])
+        logger.info('Split {} files into {} works (predicted makespan: {:.2f} secs)'.format(
+            len(costs), num_available_works, get_predicted_makespan(costs, assignment)))
+        return works
+
+# Splits files larger than a payload into byte ranges (multipart upload parts) so that they
+# can be spread across works like any other file. The multipart uploads are created here and
+# completed once all works are done.
+class S3MultipartCopyPlanner:
+
+    def __init__(self, s3_client, max_paylod_size_in_mb):
+        self.s3_client = s3_client
+        self.max_paylod_size_in_mb = max_paylod_size_in_mb
+        self.multipart_uploads = []
+
+    def _get_part_size(self, file_size):
+        part_size = min(max(int(self.max_paylod_size_in_mb * A_MB), MIN_PART_SIZE), MAX_PART_SIZE)
+        # grow parts if needed to stay within the max number of parts
+        return max(part_size, -(-file_size // MAX_NUM_PARTS))
+
+    def _get_file_size(self, s3_bucket, s3_path):
+        try:
+            return get_s3_client_for_bucket(s3_bucket, self.s3_client).head_object(Bucket=s3_bucket, Key=s3_path)['ContentLength']
+        except ClientError:
+            return -1
+
+    def split_file(self, s3_file):
+        file_size = round(s3_file.file_size * A_MB)
+        # file already in destination, let the worker skip it (or delete it from source)
+        if s3_file.sync_action is None and self._get_file_size(s3_file.target_s3_bucket, s3_file.target_s3_path) == file_size:
+            return [s3_file]
+        part_size = self._get_part_size(file_size)
+        upload_id = get_s3_client_for_bucket(s3_file.target_s3_bucket, self.s3_client).create_multipart_upload(Bucket=s3_file.target_s3_bucket, Key=s3_file.target_s3_path)['UploadId']
+        parts = []
+        for part_idx, first_byte in enumerate(range(0, file_size, part_size)):
+            last_byte = min(first_byte + part_size, file_size) - 1
+            parts.append(S3FilePartInfo(s3_file.source_s3_bucket, s3_file.source_s3_path, s3_file.target_s3_bucket, s3_file.target_s3_path,
+                (last_byte - first_byte + 1)/A_MB, upload_id, part_idx + 1, 'bytes={}-{}'.format(first_byte, last_byte)))
+        self.multipart_uploads.append({
+            'source_s3_bucket': s3_file.source_s3_bucket,
+            'source_s3_path': s3_file.source_s3_path,
+            'target_s3_bucket': s3_file.target_s3_bucket,
+            'target_s3_path': s3_file.target_s3_path,
+            'file_size_in_mb': s3_file.file_size,
+            'upload_id': upload_id,
+            'num_parts': len(parts)
+        })
+        logger.info('S3 file s3://{}/{} ({} MB) will be copied in {} parts'.format(s3_file.source_s3_bucket, s3_file.source_s3_path, s3_file.file_size, len(parts)))
+        return parts
+
+    # Aborts the multipart uploads created so far, the plan they belong to is not carried out
+    # (eg, the orchestrator failed after splitting files). Errors are logged, not raised.
+    def abort(self):
+        for multipart_upload in self.multipart_uploads:
+            try:
+                get_s3_client_for_bucket(multipart_upload['target_s3_bucket'], self.s3_client).abort_multipart_upload(
+                    Bucket=multipart_upload['target_s3_bucket'], Key=multipart_upload['target_s3_path'], UploadId=multipart_upload['upload_id'])
+            except ClientError as e:
+                logger.warning('Failed to abort the multipart copy into s3://{}/{}: {}'.format(multipart_upload['target_s3_bucket'],
+                    multipart_upload['target_s3_path'], e))
+        logger.info('Aborted {} multipart copies'.format(len(self.multipart_uploads)))
+        self.multipart_uploads = []
+
+    def _needs_split(self, file_size):
+        return file_size > self.max_paylod_size_in_mb and file_size * A_MB > MIN_PART_SIZE
+
+    def split(self, s3_files):
+        for s3_file in s3_files:
+            if self._needs_split(s3_file.file_size):
+                yield from self.split_file(s3_file)
+            else:
+                yield s3_file
+
+    # Splits the large files of a catalog, parts are added to the catalog. Returns the indexes of
+    # the files and parts to copy.
+    def split_catalog(self, catalog):
+        file_indexes = array('I')
+        for file_idx in range(len(catalog)):
+            if not self._needs_split(catalog.file_sizes[file_idx]):
+                file_indexes.append(file_idx)
+                continue
+            parts = self.split_file(catalog_file(catalog, file_idx))
+            if not isinstance(parts[0], S3FilePartInfo):
+                file_indexes.append(file_idx)
+                continue
+            for part in parts:
+                file_indexes.append(catalog.add_part(file_idx, part.file_size, part.upload_id, part.part_number, part.byte_range))
+        return file_indexes
 
     def __repr__(self):
-        return f'S3CopyFileTypeInfo({self.file_types!r})'
+        return f'S3MultipartCopyPlanner({self.max_paylod_size_in_mb!r}, {self.multipart_uploads!r})'
+
+# Adds a batch of listed S3 objects of a source that must be copied to a catalog of files (routed by
+# the routing table of the source, a file routed to several targets is added once per target). With
+# a sync filter, only files missing or changed in the target are copied. Files completed by previous
+# executions of the job (completed_files, see utils/progress_journal.py) are left out, or only deleted
+# if moved and still in the source. Returns the number of completed files.
+def add_s3_objects_to_catalog(catalog, s3_objects, src_s3_bucket_name, src_s3_path, routing_table, sync_filter=None, completed_files=None,
+        s3_operation_type=default_s3_operation):
+    # Skip path objects
+    batch = [s3_object for s3_object in s3_objects if not s3_object['Key'].endswith('/')]
+    src_s3_path_len = len(src_s3_path)
+    num_completed_files = 0
+    relative_keys = [s3_object['Key'][src_s3_path_len:] for s3_object in batch]
+    file_sizes_in_mb = [s3_object['Size']/A_MB for s3_object in batch]
+    rules = routing_table.classify(relative_keys, file_sizes_in_mb)
+    for s3_object, relative_key, src_s3_file_size_in_mb, rule in zip(batch, relative_keys, file_sizes_in_mb, rules):
+        if rule is None:
+            continue
+        for target_s3_bucket, target_s3_path in rule.targets:
+            if completed_files is not None and completed_files.is_completed(src_s3_bucket_name, s3_object['Key'], target_s3_bucket, target_s3_path + relative_key, src_s3_file_size_in_mb):
+                num_completed_files += 1
+                if s3_operation_type == 'move-files':
+                    catalog.add(src_s3_bucket_name, src_s3_path, target_s3_bucket, target_s3_path, relative_key, 0, SYNC_ACTION_DELETE)
+                continue
+            if sync_filter is None:
+                catalog.add(src_s3_bucket_name, src_s3_path, target_s3_bucket, target_s3_path, relative_key, src_s3_file_size_in_mb)
+                continue
+            sync_action = sync_filter.get_sync_action(s3_object, target_s3_bucket, target_s3_path + relative_key)
+            if sync_action is not None:
+                # deleting a file costs the same regardless of its size
+                file_size_in_mb = 0 if sync_action == SYNC_ACTION_DELETE else src_s3_file_size_in_mb
+                catalog.add(src_s3_bucket_name, src_s3_path, target_s3_bucket, target_s3_path, relative_key, file_size_in_mb, sync_action)
+    return num_completed_files
+
+def log_routing(routing_table, src_s3_bucket_name, src_s3_path):
+    routing = routing_table.to_json()
+    logger.info('Routed files of s3://{}/{} per target: {}'.format(src_s3_bucket_name, src_s3_path, routing['num_files_per_target']))
+    # Files that no target config references are ignored
+    if routing['num_unmatched_files'] > 0:
+        logger.warning('{} S3 files from S3 bucket: \'{}\' are not referenced by the S3 input configuration and are being ignored (eg, {})'.format(
+            routing['num_unmatched_files'], src_s3_bucket_name, routing['unmatched_samples']))
 
-def s3_work_to_json(s3_work_list):
+def log_catalog(catalog, completed_files, num_completed_files):
+    if completed_files is not None:
+        logger.info('Resuming job: {} files already completed by previous executions'.format(num_completed_files))
+    logger.info('Cataloged {} files ({} bytes)'.format(len(catalog), catalog.get_size_in_bytes()))
+
+# Adds the listed S3 objects of a source to a catalog of files, routed in batches as objects are
+# listed (see add_s3_objects_to_catalog)
+def s3_objects_to_catalog(s3_objects, src_s3_bucket_name, src_s3_path, routing_table, sync_filter=None, completed_files=None,
+        s3_operation_type=default_s3_operation, catalog=None, batch_size=default_routing_batch_size):
+    catalog = catalog if catalog is not None else S3FileCatalog()
+    s3_objects = iter(s3_objects)
+    num_completed_files = 0
+    while True:
+        batch = list(islice(s3_objects, batch_size))
+        if not batch:
+            break
+        num_completed_files += add_s3_objects_to_catalog(catalog, batch, src_s3_bucket_name, src_s3_path, routing_table, sync_filter,
+            completed_files, s3_operation_type)
+    log_routing(routing_table, src_s3_bucket_name, src_s3_path)
+    log_catalog(catalog, completed_files, num_completed_files)
+    return catalog
+
+# Lists the sources of a copy (see get_source_s3_configs) concurrently, from their S3 Inventory if
+# given one, into a single catalog of files so that the copy is planned as a whole. The listing
+# threads are shared out between the sources.
+def s3_sources_to_catalog(s3_client, sources, routing_tables, sync_filter=None, completed_files=None, s3_operation_type=default_s3_operation,
+        listing_concurrency=default_listing_concurrency):
+    source_listing_concurrency = max(listing_concurrency // min(len(sources), listing_concurrency), 1)
+    def new_listing_factory(source):
+        inventory_manifest = source.get('inventory_manifest')
+        if inventory_manifest:
+            return lambda: list_s3_objects_from_inventory(get_s3_client_for_bucket(inventory_manifest['s3_bucket'], s3_client), inventory_manifest['s3_bucket'],
+                inventory_manifest['s3_path'], source['s3_bucket'], source['s3_path'], max_workers=source_listing_concurrency)
+        return lambda: list_s3_objects_sharded(get_s3_client_for_bucket(source['s3_bucket'], s3_client), source['s3_bucket'], source['s3_path'],
+            max_workers=source_listing_concurrency)
+    for source in sources:
+        logger.info('Inspecting s3_file files uploaded to s3://{}/{}...'.format(source['s3_bucket'], source['s3_path']))
+    catalog = S3FileCatalog()
+    num_completed_files = 0
+    for source_idx, batch in list_s3_sources_concurrently([new_listing_factory(source) for source in sources], listing_concurrency,
+            default_routing_batch_size):
+        source = sources[source_idx]
+        num_completed_files += add_s3_objects_to_catalog(catalog, batch, source['s3_bucket'], source['s3_path'], routing_tables[source_idx],
+            sync_filter, completed_files, s3_operation_type)
+    for source, routing_table in zip(sources, routing_tables):
+        log_routing(routing_table, source['s3_bucket'], source['s3_path'])
+    log_catalog(catalog, completed_files, num_completed_files)
+    return catalog
+
+# Given a manifest writer, the payload files are written into a manifest (one per work) and
+# the works only carry a reference to it instead of the payload files. Given get_route, each
+# payload carries the copy route (see get_copy_route) of its largest file, workers record
+# their copy times per route. Given a job_id, workers journal the files they complete.
+def s3_work_to_json(s3_work_list, multipart_uploads=None, manifest_writer=None, get_route=None, job_id=None):
     work_set_dict = {}
     for work_idx, work in enumerate(s3_work_list):
         work_id = 's3_work_'+str(work_idx+1)
         work_dict = {
             'work_id': work_id,
             'cur_payload': 0,
-            'work_size_in_mb': work.cur_work_size
+            'work_size_in_mb': work.cur_work_size,
+            'predicted_duration_in_sec': work.predicted_duration
         }
+        if job_id is not None:
+            work_dict['job_id'] = job_id
         work_payloads = []
+        work_payloads_files = []
         for payload in work.work_list:
-            payload_files = []
-            for file in payload.s3_file_list:
-                payload_files.append({
-                    'source_s3_bucket': file.source_s3_bucket,
-                    'source_s3_path': file.source_s3_path,
-                    'target_s3_bucket': file.target_s3_bucket,
-                    'target_s3_path': file.target_s3_path,
-                    'file_size_in_mb': file.file_size
-                })
             payload_dict = {
                 'payload_size_in_mb': payload.cur_payload_size,
-                'payload_files': payload_files
+                'predicted_duration_in_sec': payload.predicted_duration,
+                'num_files': len(payload.file_indexes)
             }
+            if get_route is not None and payload.file_indexes:
+                payload_dict['route'] = get_route(catalog_file(payload.catalog, payload.file_indexes[0]))
+            if manifest_writer is None:
+                payload_dict['payload_files'] = [payload.catalog.file_to_json(file_idx) for file_idx in payload.file_indexes]
+            else:
+                # payload files are built as the manifest is encoded, a payload at a time
+                work_payloads_files.append(map(payload.catalog.file_to_json, payload.file_indexes))
             work_payloads.append(payload_dict)
+        if manifest_writer is not None:
+            work_dict['manifest'], payload_ranges = manifest_writer.write_work(work_id, work_payloads_files)
+            for payload_dict, payload_range in zip(work_payloads, payload_ranges):
+                payload_dict['manifest_range'] = payload_range
         work_dict['num_payloads'] = len(work_payloads)
         work_dict['payloads'] = work_payloads
         work_set_dict[work_id] = work_dict
+    # multipart copies to be completed once all works are done
+    work_set_dict['multipart_uploads'] = [dict(multipart_upload, job_id=job_id) for multipart_upload in multipart_uploads or []] \
+        if job_id is not None else multipart_uploads or []
+    work_set_dict['predicted_makespan_in_sec'] = max((work.predicted_duration for work in s3_work_list), default=0)
+    return work_set_dict
+
+# Chunks of payload files that each fit in a queue message
+def _chunk_queued_payload_files(payload_files):
+    chunks = [[]]
+    chunk_size = 0
+    for file in payload_files:
+        # encoded file plus its separator in the files list
+        file_size = len(json.dumps(file)) + 2
+        if chunks[-1] and (len(chunks[-1]) >= max_files_per_queue_message or chunk_size + file_size > max_queue_message_files_size):
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(file)
+        chunk_size += file_size
+    return chunks
+
+def _split_queued_payload(queued_payload, payload_files):
+    chunks = _chunk_queued_payload_files(payload_files)
+    if len(chunks) == 1:
+        queued_payload['payload_files'] = payload_files
+        return [queued_payload]
+    queued_payloads = []
+    for chunk_files in chunks:
+        queued_payloads.append({
+            'work_id': '{}_{}'.format(queued_payload['work_id'], len(queued_payloads) + 1),
+            'payload_size_in_mb': sum(file['file_size_in_mb'] for file in chunk_files),
+            'predicted_duration_in_sec': queued_payload['predicted_duration_in_sec'] * len(chunk_files) / len(payload_files),
+            'num_files': len(chunk_files),
+            'payload_files': chunk_files
+        })
+        for attribute in ['route', 'job_id']:
+            if attribute in queued_payload:
+                queued_payloads[-1][attribute] = queued_payload[attribute]
+    return queued_payloads
+
+# Puts the works on the progress board of the execution, along with their initial progress, and
+# points them to it
+def publish_works(work_set_dict, board):
+    started_at = time.time()
+    for work_id in sorted(work_id for work_id in work_set_dict if work_id.startswith('s3_work_')):
+        work_dict = work_set_dict[work_id]
+        work_dict['progress_board'] = {'s3_bucket': board.s3_bucket, 's3_path': board.s3_path, 'claims_table': board.claims_table, 'started_at': started_at}
+        board.put_work(work_dict)
+        board.put_progress(work_id, work_id, get_work_progress(work_dict))
     return work_set_dict
 
+# Turns the payloads of all works into work queue messages, longest predicted payloads first
+# so that the queue drains like a largest-first schedule (no worker ends with a long payload)
+def s3_work_to_queue_messages(work_set_dict):
+    queued_payloads = []
+    for work_dict in work_set_dict.values():
+        if not isinstance(work_dict, dict) or 'work_id' not in work_dict:
+            continue
+        for payload_idx, payload_dict in enumerate(work_dict['payloads']):
+            if payload_dict['num_files'] == 0:
+                continue
+            queued_payload = {
+                'work_id': '{}_payload_{}'.format(work_dict['work_id'], payload_idx + 1),
+                'payload_size_in_mb': payload_dict['payload_size_in_mb'],
+                'predicted_duration_in_sec': payload_dict['predicted_duration_in_sec'],
+                'num_files': payload_dict['num_files']
+            }
+            if 'route' in payload_dict:
+                queued_payload['route'] = payload_dict['route']
+            if 'job_id' in work_dict:
+                queued_payload['job_id'] = work_dict['job_id']
+            if 'manifest' in work_dict:
+                queued_payload['manifest'] = work_dict['manifest']
+                queued_payload['manifest_range'] = payload_dict['manifest_range']
+                queued_payloads.append(queued_payload)
+            else:
+                queued_payloads.extend(_split_queued_payload(queued_payload, payload_dict['payload_files']))
+    queued_payloads.sort(key=lambda queued_payload: queued_payload['predicted_duration_in_sec'], reverse=True)
+    return queued_payloads
+
+# Enqueues the payloads, tagged with the execution id, and returns the (initial) state of the
+# workers that will pull them
+def enqueue_work(work_set_dict, work_queue, num_workers, execution_id):
+    queued_payloads = [dict(queued_payload, execution_id=execution_id) for queued_payload in s3_work_to_queue_messages(work_set_dict)]
+    work_queue.send_messages(queued_payloads)
+    logger.info('Enqueued {} payloads of execution \'{}\' for {} workers'.format(len(queued_payloads), execution_id, num_workers))
+    return {
+        'execution_id': execution_id,
+        'queue_workers': [{'worker_id': 's3_queue_worker_{}'.format(worker_idx + 1), 'execution_id': execution_id, 'status': 'processing'}
+                          for worker_idx in range(num_workers)],
+        'num_queued_payloads': len(queued_payloads),
+        'multipart_uploads': work_set_dict['multipart_uploads'],
+        'predicted_makespan_in_sec': work_set_dict['predicted_makespan_in_sec']
+    }
+
+def get_throughput_model_s3_path():
+    return os.environ['ThroughputModelS3Path'] if 'ThroughputModelS3Path' in os.environ else default_throughput_model_s3_path
+
 # Sample Lambda Input
 # { 
 #     "s3_copy_config": {
 #         "source_s3_config": {
 #             "s3_bucket": "aws-s3-serverless-parallel-copy",
-#             "s3_path": "source/"
+#             "s3_path": "source/",
+#             "inventory_manifest": {
+#                 "s3_bucket": "aws-s3-serverless-parallel-copy-inventory",
+#                 "s3_path": "aws-s3-serverless-parallel-copy/daily/2018-08-01T00-00Z/manifest.json"
+#             }
 #         },
 #         "target_s3_config": [
 #             {
 #                 "file_types" : ["mp4", "jpg", "zip"],
 #                 "s3_bucket": "aws-s3-serverless-parallel-copy",
 #                 "s3_path": "target/"
+#             },
+#             {
+#                 "key_patterns": ["raw/*"],
+#                 "min_size_in_mb": 100,
+#                 "s3_bucket": "aws-s3-serverless-parallel-copy",
+#                 "s3_path": "large-raw/"
 #             }
-#         ]
+#         ],
+#         "incremental_sync": true,
+#         "job_id": "2018-08-01-archive-move",
+#         "num_workers": 10
 #     }
 # }
+# "num_workers" sets the number of workers of the execution in the queue-driven execution mode
+# (ExecutionMode), defaulting to NumCopyLambdaWorkers. Given an "inventory_manifest" (optional), the
+# source files are read from an S3 Inventory of the source bucket instead of being listed.
+# Target configs are routing rules (see utils/s3_routing.py) tried in order, files go to the first match.
+# "source_s3_config" can also be a list of sources, listed concurrently and planned together, eg:
+#     "source_s3_config": [
+#         {"s3_bucket": "aws-s3-serverless-parallel-copy", "s3_path": "2018/"},
+#         {"s3_bucket": "aws-s3-serverless-parallel-copy", "s3_path": "2019/",
+#          "target_s3_config": [{"s3_bucket": "aws-s3-serverless-parallel-copy", "s3_path": "archive/2019/"}]}
+#     ]
+# where a source without a "target_s3_config" is routed by that of the copy. A target config can copy
+# its files to several targets ("targets": [{"s3_bucket": ..., "s3_path": ...}, ...], copy-files only).
+# Given a "job_id" (optional) and a journal store (JournalS3Bucket), workers journal the files they
+# complete and re-running the job (same input) leaves them out. Given a SpeculationS3Bucket and a
+# SpeculationClaimsTable (static execution mode), works are put on a progress board so that idle
+# workers can duplicate stragglers.
 def handler(event, context):
+    multipart_copy_planner = None
     try:
         # logger.info('{} Lambda triggered by event: {}'.format(context.function_name, event))
         s3_copy_config = event['s3_copy_config']
 
-        s3_destination_info = S3CopyFileTypeInfo(s3_copy_config)
-
-        src_s3_bucket_name = s3_copy_config['source_s3_config']['s3_bucket']
-        src_s3_path = s3_copy_config['source_s3_config']['s3_path']
-        logger.info('Inspecting s3_file files uploaded to s3://{}/{}...'.format(src_s3_bucket_name, src_s3_path))
-        full_list_of_files = []
-        # Search all file objects in the S3 bucket for the given payload (prefixed by src_s3_path)
-        for s3_object in s3.list_objects(Bucket=src_s3_bucket_name, Prefix=src_s3_path)['Contents']:
-            # Skip path objects
-            if not s3_object['Key'].endswith('/'):
-                s3_file_name = s3_object['Key'].replace(src_s3_path, '', 1)
-                src_s3_filename = s3_object['Key']
-                src_s3_file_size_in_mb = s3_object['Size']/A_MB
-                # If the S3 file object has an extension (eg, mp4, jpg)
-                if '.' in src_s3_filename:
-                    file_extension = src_s3_filename.rsplit('.', 1)[-1]
-                    # If the extension appears in the MRSS file, grab the S3 bucket destination info for it
-                    if s3_destination_info.has_info_for_file_type(file_extension):
-                        dest_s3_bucket_name = s3_destination_info.get_s3_bucket_for_file_type(file_extension)
-                        dest_s3_filename = '{}{}'.format(s3_destination_info.get_s3_path_for_file_type(file_extension), s3_file_name)
-                        s3_file = S3FileInfo(src_s3_bucket_name, src_s3_filename, dest_s3_bucket_name, dest_s3_filename, src_s3_file_size_in_mb)
-                        full_list_of_files.append(s3_file)
-                    # If the extension is not mentioned in MRSS file (and is not the .mrss file itself) log a 'warning'
-                    elif file_extension != 'mrss':
-                        logger.warning('S3 file: \'{}\' from S3 bucket: \'{}\'is not referenced by the S3 input configuration and is being ignored'.format(src_s3_filename, src_s3_bucket_name))
+        # Sources are listed and routed together, into a single plan
+        sources = get_source_s3_configs(s3_copy_config)
+        routing_tables = [S3RoutingTable(source['target_s3_config']) for source in sources]
+        listing_concurrency = int(os.environ['ListingConcurrency']) if 'ListingConcurrency' in os.environ else default_listing_concurrency
+        s3_operation_type = os.environ['S3OperationType'] if 'S3OperationType' in os.environ else default_s3_operation
+        # a moved file is deleted from the source once copied to one of its targets
+        if s3_operation_type == 'move-files' and any(routing_table.has_fan_out for routing_table in routing_tables):
+            raise ValueError('Invalid target_s3_config: files cannot be moved to several targets, use copy-files')
+        # Incremental sync: index the target files so that only missing/changed files are planned
+        sync_filter = None
+        if s3_copy_config.get('incremental_sync', False):
+            sync_filter = S3SyncFilter(new_s3_target_index(s3, s3_copy_config, listing_concurrency), s3_operation_type)
+        # Resumed job: leave out the files its previous executions completed (progress journal)
+        job_id = s3_copy_config.get('job_id')
+        journal_store = get_journal_store(s3) if job_id else None
+        completed_files = load_completed_files(journal_store, job_id, listing_concurrency) if journal_store is not None else None
+        # Search all file objects of the sources (prefixed by their s3_path), listed by the bucket's S3 Inventory if given one
+        catalog = s3_sources_to_catalog(s3, sources, routing_tables, sync_filter, completed_files, s3_operation_type, listing_concurrency)
         # This is the S3 file move orchestrator that will split the move work evently among available workers (Lambda functions)
         num_lambda_workers = int(os.environ['NumCopyLambdaWorkers']) if 'NumCopyLambdaWorkers' in os.environ != None else 2 # default: 2 workers
+        execution_mode = os.environ['ExecutionMode'] if 'ExecutionMode' in os.environ else default_execution_mode
+        if not execution_mode in execution_valid_modes:
+            raise ValueError('Invalid execution mode: {}. Expecting one of {}.'.format(execution_mode, execution_valid_modes))
+        if execution_mode == 'queue':
+            num_lambda_workers = int(s3_copy_config.get('num_workers', num_lambda_workers))
         max_payload_size_per_lambda_execution = int(os.environ['MaxPayloadSizePerLambdaExecutionInMB']) if 'MaxPayloadSizePerLambdaExecutionInMB' in os.environ != None else 1024 # default: 1GB
-        s3_file_move_orchestrator = S3CopyOrchestrator()
-        s3_work_list = s3_file_move_orchestrator.split_work(full_list_of_files, num_lambda_workers, max_payload_size_per_lambda_execution)
-        return s3_work_to_json(s3_work_list)
+        work_scheduler = new_work_scheduler(os.environ['WorkScheduler'] if 'WorkScheduler' in os.environ else 'lpt')
+        cost_model = S3CopyCostModel(
+            float(os.environ['PerFileLatencyInSec']) if 'PerFileLatencyInSec' in os.environ else 0.0,
+            float(os.environ['ThroughputInMBPerSec']) if 'ThroughputInMBPerSec' in os.environ else default_throughput_in_mb_per_sec,
+            int(os.environ['CopyConcurrency']) if 'CopyConcurrency' in os.environ else 1
+        )
+        # Once the throughput model has learnt the copy times of the routes, payloads are sized to a target duration
+        max_payload_duration = None
+        get_route = None
+        if os.environ.get('ThroughputModelS3Bucket'):
+            get_route = lambda s3_file: get_copy_route(s3, s3_file.source_s3_bucket, s3_file.target_s3_bucket)
+            throughput_model = load_throughput_model(s3, os.environ['ThroughputModelS3Bucket'], get_throughput_model_s3_path())
+            routes = {get_copy_route(s3, source['s3_bucket'], target_s3_bucket) for source, routing_table in zip(sources, routing_tables)
+                      for rule in routing_table.rules for target_s3_bucket, _ in rule.targets}
+            learned_cost_model = throughput_model.new_cost_model(routes, cost_model)
+            target_payload_duration = float(os.environ['TargetPayloadDurationInSec']) if 'TargetPayloadDurationInSec' in os.environ else default_target_payload_duration_in_sec
+            if learned_cost_model.is_fitted:
+                cost_model = learned_cost_model
+                learned_payload_size = learned_cost_model.max_payload_size_in_mb(target_payload_duration) if target_payload_duration > 0 else None
+                if learned_payload_size is not None:
+                    max_payload_duration = target_payload_duration
+                    max_payload_size_per_lambda_execution = max(int(learned_payload_size), 1)
+                logger.info('Throughput model of routes {}: {} (max payload size: {} MB)'.format(sorted(routes), learned_cost_model, max_payload_size_per_lambda_execution))
+        # Files larger than a payload are copied in parts, spread across workers
+        multipart_copy_planner = S3MultipartCopyPlanner(s3, max_payload_size_per_lambda_execution)
+        s3_file_move_orchestrator = S3CopyOrchestrator(work_scheduler, cost_model)
+        file_indexes = multipart_copy_planner.split_catalog(catalog)
+        s3_work_list = s3_file_move_orchestrator.split_work(catalog, num_lambda_workers, max_payload_size_per_lambda_execution,
+            max_payload_duration, file_indexes)
+        if sync_filter is not None:
+            logger.info('Incremental sync: {} files to copy, {} files already up to date'.format(sync_filter.num_files_to_copy, sync_filter.num_files_up_to_date))
+        # Large plans are written into S3 manifests to keep the state machine state small
+        execution_id = context.aws_request_id if context is not None else uuid.uuid4().hex
+        manifest_writer = None
+        if os.environ.get('ManifestS3Bucket'):
+            manifest_s3_path = '{}{}/'.format(os.environ['ManifestS3Path'] if 'ManifestS3Path' in os.environ else 'manifests/', execution_id)
+            manifest_writer = S3ManifestWriter(s3, os.environ['ManifestS3Bucket'], manifest_s3_path)
+        work_set_dict = s3_work_to_json(s3_work_list, multipart_copy_planner.multipart_uploads, manifest_writer, get_route,
+            job_id if journal_store is not None else None)
+        if execution_mode == 'queue':
+            return enqueue_work(work_set_dict, get_work_queue(), num_lambda_workers, execution_id)
+        # Static works can be duplicated by idle workers once they straggle (see utils/speculation.py)
+        if os.environ.get('SpeculationS3Bucket'):
+            if not os.environ.get('SpeculationClaimsTable'):
+                raise ValueError('Speculative execution requires a claims table (SpeculationClaimsTable)')
+            speculation_s3_path = '{}{}/'.format(os.environ['SpeculationS3Path'] if 'SpeculationS3Path' in os.environ else default_speculation_s3_path, execution_id)
+            publish_works(work_set_dict, S3ProgressBoard(get_s3_client_for_bucket(os.environ['SpeculationS3Bucket'], s3), os.environ['SpeculationS3Bucket'], speculation_s3_path,
+                os.environ['SpeculationClaimsTable']))
+        return work_set_dict
+    except Exception as e:
+        logger.error(str(e))
+        # the state machine never gets the multipart uploads created so far
+        if multipart_copy_planner is not None:
+            multipart_copy_planner.abort()
+        raise
+
+
+# Records the copy times of an execution (throughput statistics of its workers, see
+# utils/throughput_model.py) into the throughput model used to size the next payloads.
+# Sample Lambda Input (one entry per worker):
+# [
+#   {
+#     "us-east-1>eu-west-1": {
+#       "16MB-256MB": {"weight": 2, "files_files": 200, "files_size": 6400, "size_size": 204800, "files_time": 3000, "size_time": 96000}
+#     }
+#   }
+# ]
+def record_throughput_handler(event, context):
+    try:
+        if not os.environ.get('ThroughputModelS3Bucket'):
+            return {'status': 'skipped'}
+        throughput_stats = {}
+        for worker_throughput_stats in event or []:
+            throughput_stats = merge_throughput_stats(throughput_stats, worker_throughput_stats)
+        if not throughput_stats:
+            return {'status': 'skipped'}
+        throughput_model = load_throughput_model(s3, os.environ['ThroughputModelS3Bucket'], get_throughput_model_s3_path())
+        throughput_model.record(throughput_stats)
+        save_throughput_model(s3, os.environ['ThroughputModelS3Bucket'], get_throughput_model_s3_path(), throughput_model)
+        logger.info('Recorded the copy times of routes {} into the throughput model'.format(sorted(throughput_stats)))
+        return {'status': 'done', 'routes': sorted(throughput_stats)}
     except Exception as e:
         logger.error(str(e))
         raise
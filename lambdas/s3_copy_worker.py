@@ -1,103 +1,282 @@
 # ------------------------------------------------------------------------------
 # This Lambda function copies a list of files (payload) from a source to a target
 # S3 bucket. Multiple payloads can be handled but only one per execution to prevent
-# timeouts. Upon completing the processing of a payload the Lambda function will 
-# update the last processed payload index and return as JSON result. 
+# timeouts. Upon completing the processing of a payload the Lambda function will
+# update the last processed payload (and file) index and return as JSON result.
 # This Lambda function is called by a AWS Step Functions state machine.
 # ------------------------------------------------------------------------------
 
-import boto3
 import logging
 import json
 import time
 import os
+from botocore.exceptions import ClientError
+from utils.s3_utils import get_s3_file_size, s3_copy_if_not_in_destination, s3_move_if_not_in_destination, \
+    s3_copy, s3_copy_part, s3_complete_multipart_copy, s3_abort_multipart_copy, s3_delete_now_or_later, S3DeleteBatcher
+from utils.s3_sync import SYNC_ACTION_COPY, SYNC_ACTION_DELETE
+from utils.copy_engine import S3CopyEngine, default_copy_concurrency
+from utils.time_budget import LambdaTimeBudget, default_safety_margin_in_sec
+from utils.s3_manifest import read_manifest_payload_files
+from utils.s3_relay import get_s3_relay
+from utils.work_queue import get_work_queue, get_max_receive_count
+from utils.s3_metrics import reset_metrics_recorder, merge_metrics
+from utils.s3_rate_control import reset_rate_controllers, get_rate_controllers
+from utils.s3_clients import get_bucket_role_arns
+from utils.throughput_model import add_observation
+from utils.progress_journal import new_progress_journal
+from utils.speculation import new_progress_board, get_work_progress, claim_straggler
+from utils import s3_utils
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3 = boto3.client('s3')
 s3_valid_operations = ['move-files', 'copy-files']
 default_s3_operation = 'move-files'
+# 'payload': one payload per execution, 'time-budget': as many files as the execution time allows
+worker_valid_modes = ['payload', 'time-budget']
+default_worker_mode = 'payload'
+# 'server-side': CopyObject / UploadPartCopy, 'relay': GET and upload through the worker (see utils/s3_relay.py)
+transfer_valid_modes = ['server-side', 'relay']
+default_transfer_mode = 'server-side'
+# 'threads': files in flight on a pool of threads, 'asyncio': as coroutines (see utils/async_copy_engine.py)
+copy_engine_valid_types = ['threads', 'asyncio']
+default_copy_engine = 'threads'
+# payload files read from manifests, kept across (warm) executions of the same work
+manifest_payloads_cache = {}
+max_cached_manifest_payloads = 4
+default_transfer_concurrency = 4
 
-def get_file_size(s3_location):
-    try:
-        response = s3.head_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
-        if 'DeleteMarker' in response and response['DeleteMarker']:
-            return -1
-        return response['ContentLength']
-    except:
-        return -1
-
-def s3_copy(source_s3_location, target_s3_location):
-    copy_source = {
-        'Bucket': source_s3_location['bucket'],
-        'Key': source_s3_location['key']
-    }
-    logger.info('Copying S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
-        source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
-    start_time = time.time()
-    s3.copy(copy_source, target_s3_location['bucket'], target_s3_location['key'])
-    elapsed_time = time.time() - start_time
-    logger.info('It took {} secs to copy S3 file s3://{}/{} into s3://{}/{}'.format(elapsed_time, source_s3_location['bucket'],
-        source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
-
-# Copy if file not in destination
-def s3_copy_if_not_in_destination(source_s3_location, target_s3_location):
-    src_file_size = get_file_size(source_s3_location)
-    file_copied = False
-    # file exists in source
-    if src_file_size >= 0:
-        trg_file_size = get_file_size(target_s3_location)
-        # files differ, trigger the copy
-        if src_file_size != trg_file_size:
-            s3_copy(source_s3_location, target_s3_location)
-            file_copied = True
+def run_s3_operation(s3_operation_type, source_s3_location, target_s3_location, transfer_config=None, delete_batcher=None, relay=None):
+    if s3_operation_type == 'move-files':
+        return s3_move_if_not_in_destination(source_s3_location, target_s3_location, transfer_config, delete_batcher, relay)
+
+    if s3_operation_type == 'copy-files':
+        return s3_copy_if_not_in_destination(source_s3_location, target_s3_location, transfer_config, relay)
+    
+    raise ValueError('Invalid S3 operation type: {}. Expecting one of \'move-files\' or \'copy-files\'.'.format(s3_operation_type))
+
+def process_payload_file(s3_operation_type, file, transfer_config=None, delete_batcher=None, relay=None):
+    source_s3_location = {'bucket': file['source_s3_bucket'], 'key': file['source_s3_path']}
+    target_s3_location = {'bucket': file['target_s3_bucket'], 'key': file['target_s3_path']}
+    # byte range of a large file (the source is deleted, if moving, once the multipart copy is complete)
+    if 'upload_id' in file:
+        s3_copy_part(source_s3_location, target_s3_location, file['upload_id'], file['part_number'], file['byte_range'], relay)
+        return True
+    # the orchestrator already compared source and target (incremental sync), no need to HEAD them
+    if file.get('sync_action') == SYNC_ACTION_COPY:
+        s3_copy(source_s3_location, target_s3_location, transfer_config, round(file['file_size_in_mb'] * 1024 * 1024), relay)
+        if s3_operation_type == 'move-files':
+            s3_delete_now_or_later(source_s3_location, delete_batcher)
+        return True
+    if file.get('sync_action') == SYNC_ACTION_DELETE:
+        s3_delete_now_or_later(source_s3_location, delete_batcher)
+        return False
+    return run_s3_operation(s3_operation_type, source_s3_location, target_s3_location, transfer_config, delete_batcher, relay)
+
+# Coroutine version of process_payload_file (asyncio copy engine). The asyncio copy engine (and
+# asyncio) is only imported by the workers that use it.
+async def process_payload_file_async(s3_operation_type, s3_clients, file, delete_batcher=None):
+    from utils import s3_async_utils
+    source_s3_location = {'bucket': file['source_s3_bucket'], 'key': file['source_s3_path']}
+    target_s3_location = {'bucket': file['target_s3_bucket'], 'key': file['target_s3_path']}
+    if 'upload_id' in file:
+        await s3_async_utils.s3_copy_part(s3_clients, source_s3_location, target_s3_location, file['upload_id'], file['part_number'], file['byte_range'])
+        return True
+    if file.get('sync_action') == SYNC_ACTION_COPY:
+        await s3_async_utils.s3_copy(s3_clients, source_s3_location, target_s3_location, round(file['file_size_in_mb'] * 1024 * 1024))
+        if s3_operation_type == 'move-files':
+            await s3_async_utils.s3_delete_now_or_later(s3_clients, source_s3_location, delete_batcher)
+        return True
+    if file.get('sync_action') == SYNC_ACTION_DELETE:
+        await s3_async_utils.s3_delete_now_or_later(s3_clients, source_s3_location, delete_batcher)
+        return False
+    if s3_operation_type == 'move-files':
+        return await s3_async_utils.s3_move_if_not_in_destination(s3_clients, source_s3_location, target_s3_location, delete_batcher)
+    if s3_operation_type == 'copy-files':
+        return await s3_async_utils.s3_copy_if_not_in_destination(s3_clients, source_s3_location, target_s3_location)
+    raise ValueError('Invalid S3 operation type: {}. Expecting one of \'move-files\' or \'copy-files\'.'.format(s3_operation_type))
+
+def get_s3_operation_type():
+    s3_operation_type = os.environ['S3OperationType'] if 'S3OperationType' in os.environ else default_s3_operation
+    if not s3_operation_type in s3_valid_operations:
+        raise ValueError('Invalid S3 operation type: {}. Expecting one of {}.'.format(s3_operation_type, s3_valid_operations))
+    return s3_operation_type
+
+def get_transfer_mode():
+    transfer_mode = os.environ['TransferMode'] if 'TransferMode' in os.environ else default_transfer_mode
+    if not transfer_mode in transfer_valid_modes:
+        raise ValueError('Invalid transfer mode: {}. Expecting one of {}.'.format(transfer_mode, transfer_valid_modes))
+    return transfer_mode
+
+def get_copy_engine_type():
+    copy_engine_type = os.environ['CopyEngine'] if 'CopyEngine' in os.environ else default_copy_engine
+    if not copy_engine_type in copy_engine_valid_types:
+        raise ValueError('Invalid copy engine: {}. Expecting one of {}.'.format(copy_engine_type, copy_engine_valid_types))
+    return copy_engine_type
+
+# Number of files in flight, per copy engine
+def get_copy_concurrency():
+    if get_copy_engine_type() == 'asyncio':
+        from utils.async_copy_engine import default_async_copy_concurrency
+        return int(os.environ['AsyncCopyConcurrency']) if 'AsyncCopyConcurrency' in os.environ else default_async_copy_concurrency
+    return int(os.environ['CopyConcurrency']) if 'CopyConcurrency' in os.environ else default_copy_concurrency
+
+def record_completed_file(file, time_budget=None, journal=None):
+    if journal is not None and 'upload_id' not in file:
+        journal.record(file)
+    if time_budget is not None:
+        time_budget.record_copied(file['file_size_in_mb'])
+
+# Files are copied concurrently by a bounded pool of CopyConcurrency threads. Given a progress
+# journal, the files completed are journaled (parts are journaled as a whole file once their
+# multipart copy is complete)
+def new_copy_engine(s3_operation_type, time_budget=None, journal=None):
+    if get_copy_engine_type() == 'asyncio':
+        return new_async_copy_engine(s3_operation_type, time_budget, journal)
+    copy_concurrency = get_copy_concurrency()
+    transfer_concurrency = int(os.environ['TransferConcurrency']) if 'TransferConcurrency' in os.environ else default_transfer_concurrency
+    # a single transfer config is shared by all copies of the execution (s3transfer is only
+    # imported by the workers that copy files with threads)
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(max_concurrency=transfer_concurrency)
+    # source files of moves are deleted in batches (DeleteObjects) once copied
+    delete_batcher = S3DeleteBatcher() if s3_operation_type == 'move-files' else None
+    # relayed files share the buffers of the container's relay
+    relay = get_s3_relay() if get_transfer_mode() == 'relay' else None
+    def s3_operation(file):
+        copied = process_payload_file(s3_operation_type, file, transfer_config, delete_batcher, relay)
+        record_completed_file(file, time_budget, journal)
+        return copied
+    return S3CopyEngine(s3_operation, copy_concurrency, delete_batcher)
+
+# The asyncio engine only copies server-side with the Lambda function's credentials, and its
+# requests are not rate controlled (see utils/s3_rate_control.py, which blocks threads)
+def new_async_copy_engine(s3_operation_type, time_budget=None, journal=None):
+    if get_transfer_mode() != 'server-side':
+        raise ValueError('Invalid transfer mode for the asyncio copy engine: {}. Expecting \'server-side\'.'.format(get_transfer_mode()))
+    if get_bucket_role_arns():
+        raise ValueError('S3 bucket roles (S3BucketRoleArns) are not supported by the asyncio copy engine')
+    from utils.async_copy_engine import S3AsyncCopyEngine
+    async def s3_operation(s3_clients, file, delete_batcher):
+        copied = await process_payload_file_async(s3_operation_type, s3_clients, file, delete_batcher)
+        record_completed_file(file, time_budget, journal)
+        return copied
+    return S3AsyncCopyEngine(s3_operation, get_copy_concurrency(), s3_utils.s3, batch_deletes=s3_operation_type == 'move-files')
+
+def raise_on_failed_results(work, results):
+    failed_results = [result for result in results if not result.succeeded]
+    if failed_results:
+        raise Exception('Failed to process {} out of {} S3 files of work {} (eg, s3://{}/{}: {})'.format(
+            len(failed_results), len(results), work['work_id'],
+            failed_results[0].file['source_s3_bucket'], failed_results[0].file['source_s3_path'], failed_results[0].error))
+
+# Starts recording the S3 metrics of an execution and controlling the rate of its S3 requests
+def start_execution_metrics():
+    reset_rate_controllers(get_copy_concurrency())
+    return reset_metrics_recorder()
+
+# Emits the S3 metrics of the execution (a single EMF line) and adds them to the metrics of
+# the work (or queue worker) accumulated across executions. The request rates settled on by
+# the throttled prefixes are those of the last execution.
+def record_execution_metrics(work, metrics_recorder, s3_operation_type, work_id):
+    print(metrics_recorder.to_emf({'S3OperationType': s3_operation_type}, {'work_id': work_id}))
+    work['metrics'] = merge_metrics(work.get('metrics'), metrics_recorder.to_json())
+    rate_control = get_rate_controllers().to_json()
+    if rate_control:
+        logger.info('S3 request rates settled on by throttled prefixes: {}'.format(json.dumps(rate_control)))
+        work['rate_control'] = rate_control
+    else:
+        work.pop('rate_control', None)
+
+# Journals the files completed by the execution, including those of a work that failed
+def flush_journal(journal):
+    if journal is not None:
+        journal.flush()
+        logger.info('Journaled {} completed files of job \'{}\' in {} segments'.format(journal.num_records, journal.job_id, journal.num_segments))
+
+def work_result(work):
+    result = {}
+    result[work['work_id']] = work
+    result['status'] = 'done' if work['cur_payload'] >= work['num_payloads'] else 'processing'
+    return result
+
+def read_cached_manifest_payload_files(manifest, payload_range):
+    cache_key = (manifest['s3_bucket'], manifest['s3_path'], payload_range[0])
+    if cache_key not in manifest_payloads_cache:
+        if len(manifest_payloads_cache) >= max_cached_manifest_payloads:
+            manifest_payloads_cache.pop(next(iter(manifest_payloads_cache)))
+        manifest_payloads_cache[cache_key] = read_manifest_payload_files(s3_utils.s3, manifest, payload_range)
+    return manifest_payloads_cache[cache_key]
+
+# Payload files are either part of the work or stored in its manifest (S3)
+def get_payload_files(work, payload_idx):
+    payload = work['payloads'][payload_idx]
+    if 'manifest' not in work:
+        payload_files = payload['payload_files']
     else:
-        raise Exception('File {}/{} does not exist and cannot be copied to {}/{}'.format(
-            source_s3_location['bucket'], source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
-    return file_copied
+        payload_files = read_cached_manifest_payload_files(work['manifest'], payload['manifest_range'])
+    # files of a work that may be duplicated (speculative execution) can be moved by the other runner
+    # first, the copies planned by an incremental sync check again the source and target instead
+    if 'progress_board' in work and get_s3_operation_type() == 'move-files':
+        payload_files = [dict(file, sync_action=None) if file.get('sync_action') == SYNC_ACTION_COPY else file for file in payload_files]
+    return payload_files
+
+def get_num_payload_files(payload):
+    return payload['num_files'] if 'num_files' in payload else len(payload['payload_files'])
+
+# Files of the work from its cursor (cur_payload, cur_file) onwards, across payloads
+def iterate_work_files(work):
+    for payload_idx in range(work['cur_payload'], work['num_payloads']):
+        payload_files = get_payload_files(work, payload_idx)
+        first_file_idx = work.get('cur_file', 0) if payload_idx == work['cur_payload'] else 0
+        yield from payload_files[first_file_idx:]
+
+def advance_work_cursor(work, num_files):
+    cur_file = work.get('cur_file', 0) + num_files
+    while work['cur_payload'] < work['num_payloads'] and cur_file >= get_num_payload_files(work['payloads'][work['cur_payload']]):
+        cur_file -= get_num_payload_files(work['payloads'][work['cur_payload']])
+        work['cur_payload'] += 1
+    work['cur_file'] = cur_file if work['cur_payload'] < work['num_payloads'] else 0
+
+# Keeps taking files from the work (across payload boundaries) until the Lambda deadline,
+# minus a safety margin, gets close. The work cursor is advanced at file granularity.
+def process_work_until_deadline(work, s3_operation_type, context):
+    safety_margin_in_sec = float(os.environ['TimeBudgetSafetyMarginInSec']) if 'TimeBudgetSafetyMarginInSec' in os.environ else default_safety_margin_in_sec
+    time_budget = LambdaTimeBudget(context, safety_margin_in_sec, get_copy_concurrency())
+    metrics_recorder = start_execution_metrics()
+    logger.info('S3 Worker \'{}\' is processing a \'{}\' operation from payload {} (file {}) with {} secs left'.format(
+        work['work_id'], s3_operation_type, work['cur_payload'], work.get('cur_file', 0), time_budget.get_remaining_time_in_sec()))
 
-def s3_delete(s3_location):
-    logger.info('Deleting S3 file s3://{}/{}'.format(s3_location['bucket'], s3_location['key']))
     start_time = time.time()
-    s3.delete_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+    route = work['payloads'][work['cur_payload']].get('route') if work['cur_payload'] < work['num_payloads'] else None
+    journal = new_progress_journal(s3_utils.s3, work.get('job_id'), work['work_id'])
+    results = new_copy_engine(s3_operation_type, time_budget, journal).run(
+        iterate_work_files(work), lambda file: time_budget.can_start(file['file_size_in_mb']))
     elapsed_time = time.time() - start_time
-    logger.info('It took {} secs to delete S3 file s3://{}/{}'.format(elapsed_time, s3_location['bucket'],
-        s3_location['key']))
-
-def s3_move_if_not_in_destination(source_s3_location, target_s3_location):
-    src_file_size = get_file_size(source_s3_location)
-    trg_file_size = get_file_size(target_s3_location)
-    file_moved = False
-    # file exists in source
-    if src_file_size >= 0:
-        # file not in target or files differ, trigger the copy
-        if src_file_size != trg_file_size:
-            s3_copy(source_s3_location, target_s3_location)
-            s3_moved = True
-        # delete from source in either case
-        s3_delete(source_s3_location)
-    # trying to move a file that neither exist in the source nor the target
-    elif trg_file_size == -1:
-        raise Exception('File {}/{} does not exist and cannot be moved to {}/{}'
-            .format(
-                source_s3_location['bucket'], source_s3_location['key'], 
-                target_s3_location['bucket'], target_s3_location['key'])
-            )
-    return file_moved
-
-def run_s3_operation(s3_operation_type, source_s3_location, target_s3_location):
-    if s3_operation_type == 'move-files':
-        return s3_move_if_not_in_destination(source_s3_location, target_s3_location)
+    flush_journal(journal)
+    raise_on_failed_results(work, results)
+    copied_size_in_mb = sum(result.file['file_size_in_mb'] for result in results)
+    add_observation(work.setdefault('throughput_stats', {}), route, len(results), copied_size_in_mb, elapsed_time)
+    logger.info('It took {} secs to process a \'{}\' operation on {} S3 files ({} MB)'.format(elapsed_time, s3_operation_type, len(results), copied_size_in_mb))
 
-    if s3_operation_type == 'copy-files':
-        return s3_copy_if_not_in_destination(source_s3_location, target_s3_location)
-    
-    raise ValueError('Invalid S3 operation type: {}. Expecting one of \'move-files\' or \'copy-files\'.')
+    # Update values and generate Lambda output
+    advance_work_cursor(work, len(results))
+    work['num_executions'] = work.get('num_executions', 0) + 1
+    work['copy_time_in_sec'] = work.get('copy_time_in_sec', 0) + elapsed_time
+    work['copied_size_in_mb'] = work.get('copied_size_in_mb', 0) + copied_size_in_mb
+    record_execution_metrics(work, metrics_recorder, s3_operation_type, work['work_id'])
+    return work_result(work)
 
 
-# Sample Lambda Input:
+# Sample Lambda Input ("cur_file" is only used by the 'time-budget' worker mode). When the
+# orchestrator writes manifests, the work has a "manifest" ({"s3_bucket", "s3_path"}) and its
+# payloads a "manifest_range" ([offset, length]) instead of "payload_files". Payloads may carry
+# the "route" (eg, "us-east-1>eu-west-1") their copy time is recorded under ("throughput_stats").
+# Works of a journaled job carry its "job_id", the files completed are journaled under it.
+# Works of a speculative execution carry its "progress_board" ({"s3_bucket", "s3_path", "claims_table", "started_at"})
+# and, while duplicating a straggler, its "speculative_work".
 # {
 #   "cur_payload": 0,
+#   "cur_file": 0,
 #   "work_size_in_mb": 1024,
 #   "num_payloads": 1,
 #   "payloads": [
@@ -110,6 +289,16 @@ def run_s3_operation(s3_operation_type, source_s3_location, target_s3_location):
 #           "target_s3_bucket": "aws-copy-destination",
 #           "target_s3_path": "target/1GB.mp4",
 #           "file_size_in_mb": 1024
+#         },
+#         {
+#           "source_s3_bucket": "aws-copy-source",
+#           "source_s3_path": "source/100GB.mp4",
+#           "target_s3_bucket": "aws-copy-destination",
+#           "target_s3_path": "target/100GB.mp4",
+#           "file_size_in_mb": 1024,
+#           "upload_id": "VXBsb2FkIElE...",
+#           "part_number": 1,
+#           "byte_range": "bytes=0-1073741823"
 #         }
 #       ]
 #     }
@@ -120,30 +309,244 @@ def handler(event, context):
 
         # grab input values
         work = event[0]
-        payload = work['payloads'][work['cur_payload']]
-        s3_operation_type = os.environ['S3OperationType'] if 'S3OperationType' in os.environ else default_s3_operation
-        if not s3_operation_type in s3_valid_operations:
-            raise ValueError('Invalid S3 operation type: {}. Expecting one of {}.'.format(s3_operation_type, s3_valid_operations))
-        logger.info('S3 Worker \'{}\' is processing a \'{}\' operation on payload: {}'.format(work['work_id'], s3_operation_type, payload))
+        s3_operation_type = get_s3_operation_type()
+        worker_mode = os.environ['WorkerMode'] if 'WorkerMode' in os.environ else default_worker_mode
+        if not worker_mode in worker_valid_modes:
+            raise ValueError('Invalid worker mode: {}. Expecting one of {}.'.format(worker_mode, worker_valid_modes))
+        # speculative execution (see utils/speculation.py): the worker reports its progress and,
+        # once done with its work, duplicates the remaining files of a straggler
+        board = new_progress_board(s3_utils.s3, work)
+        if board is None:
+            return process_work(work, s3_operation_type, worker_mode, context)
+        if 'speculative_work' in work:
+            return process_speculative_work(work, board, s3_operation_type, worker_mode, context)
+        if board.is_done_by_another_runner(work['work_id'], work['work_id']):
+            logger.info('S3 Worker \'{}\' stops, its remaining files were copied by a speculative duplicate'.format(work['work_id']))
+            advance_work_cursor(work, sum(get_num_payload_files(payload) for payload in work['payloads'][work['cur_payload']:]))
+            return start_speculative_work(work, board)
+        result = process_work(work, s3_operation_type, worker_mode, context)
+        board.put_progress(work['work_id'], work['work_id'], get_work_progress(work))
+        return start_speculative_work(work, board) if result['status'] == 'done' else result
+
+    except Exception as e:
+        logger.error(str(e))
+        raise
+
+def process_work(work, s3_operation_type, worker_mode, context):
+    if worker_mode == 'time-budget':
+        return process_work_until_deadline(work, s3_operation_type, context)
+    return process_next_payload(work, s3_operation_type)
+
+def process_next_payload(work, s3_operation_type):
+    payload = work['payloads'][work['cur_payload']]
+    metrics_recorder = start_execution_metrics()
+    logger.info('S3 Worker \'{}\' is processing a \'{}\' operation on payload {} ({} files, {} MB)'.format(
+        work['work_id'], s3_operation_type, work['cur_payload'], get_num_payload_files(payload), payload['payload_size_in_mb']))
+
+    # Process the next work payload (multiple files in flight)
+    start_time = time.time()
+    journal = new_progress_journal(s3_utils.s3, work.get('job_id'), work['work_id'])
+    results = new_copy_engine(s3_operation_type, journal=journal).run(get_payload_files(work, work['cur_payload']))
+    elapsed_time = time.time() - start_time
+    flush_journal(journal)
+    logger.info('It took {} secs to process a \'{}\' operation on payload {} of work \'{}\''.format(elapsed_time, s3_operation_type, work['cur_payload'], work['work_id']))
+    raise_on_failed_results(work, results)
+
+    # Update values and generate Lambda output
+    payload['copy_time_in_sec'] = elapsed_time
+    payload['num_files_copied'] = sum(1 for result in results if result.copied)
+    add_observation(work.setdefault('throughput_stats', {}), payload.get('route'), len(results), payload['payload_size_in_mb'], elapsed_time)
+    work['cur_payload'] = work['cur_payload'] + 1
+    work['num_executions'] = work.get('num_executions', 0) + 1
+    work['copy_time_in_sec'] = work.get('copy_time_in_sec', 0) + elapsed_time
+    record_execution_metrics(work, metrics_recorder, s3_operation_type, work['work_id'])
+    return work_result(work)
+
+# Once done with its own work, a worker claims the duplicate of a straggler, if any. The duplicate
+# is processed by the worker's next executions ('processing') and records its copy times and
+# metrics into the worker's work.
+def start_speculative_work(work, board):
+    speculative_work = claim_straggler(board, work['work_id'], work['progress_board']['started_at'])
+    if speculative_work is None:
+        return work_result(work)
+    speculative_work['throughput_stats'] = work.get('throughput_stats', {})
+    speculative_work['metrics'] = work.get('metrics')
+    work['speculative_work'] = speculative_work
+    return {work['work_id']: work, 'status': 'processing'}
+
+def stop_speculative_work(work, board):
+    speculative_work = work.pop('speculative_work')
+    work['throughput_stats'] = speculative_work['throughput_stats']
+    work['metrics'] = speculative_work['metrics']
+    work['speculative_work_ids'] = work.get('speculative_work_ids', []) + [speculative_work['work_id']]
+    return start_speculative_work(work, board)
 
-        # Process the next work payload
+# The first runner (worker or duplicate) to finish a work wins
+def process_speculative_work(work, board, s3_operation_type, worker_mode, context):
+    speculative_work = work['speculative_work']
+    if board.is_done_by_another_runner(speculative_work['work_id'], work['work_id']):
+        logger.info('S3 Worker \'{}\' stops duplicating work \'{}\', finished by its worker'.format(work['work_id'], speculative_work['work_id']))
+        return stop_speculative_work(work, board)
+    result = process_work(speculative_work, s3_operation_type, worker_mode, context)
+    board.put_progress(speculative_work['work_id'], work['work_id'], get_work_progress(speculative_work))
+    if result['status'] == 'done':
+        logger.info('S3 Worker \'{}\' finished work \'{}\' first'.format(work['work_id'], speculative_work['work_id']))
+        return stop_speculative_work(work, board)
+    return {work['work_id']: work, 'status': 'processing'}
+
+
+# Queued payloads carry their files or a reference to them in a work manifest
+def get_queued_payload_files(queued_payload):
+    if 'manifest' not in queued_payload:
+        return queued_payload['payload_files']
+    return read_cached_manifest_payload_files(queued_payload['manifest'], queued_payload['manifest_range'])
+
+# Queue-driven execution mode: the worker keeps pulling payloads from the work queue until
+# it is drained or the Lambda deadline gets close, in which case the payload it just pulled
+# is put back into the queue and the state machine invokes the worker again ('processing').
+# A payload is removed from the queue only once all its files have been processed. Payloads
+# left in the queue by a failed execution (eg, in flight when it failed) are dropped.
+# Sample Lambda Input:
+# {
+#   "worker_id": "s3_queue_worker_1",
+#   "execution_id": "c0ffee00-...",
+#   "status": "processing"
+# }
+def queue_handler(event, context):
+    try:
+        worker = event
+        s3_operation_type = get_s3_operation_type()
+        work_queue = get_work_queue()
+        safety_margin_in_sec = float(os.environ['TimeBudgetSafetyMarginInSec']) if 'TimeBudgetSafetyMarginInSec' in os.environ else default_safety_margin_in_sec
+        # payloads are started one at a time (the copy throughput observed already accounts for concurrent copies)
+        time_budget = LambdaTimeBudget(context, safety_margin_in_sec)
+        metrics_recorder = start_execution_metrics()
+        worker['status'] = 'done'
+        worker.setdefault('throughput_stats', {})
+        num_payloads = 0
         start_time = time.time()
-        for file in payload['payload_files']:
-            run_s3_operation(
-                s3_operation_type, 
-                {'bucket': file['source_s3_bucket'], 'key': file['source_s3_path']},
-                {'bucket': 'corus-media-vms', 'key': file['target_s3_path']}
-            )
+        while True:
+            message = work_queue.receive_message()
+            if message is None:
+                break
+            queued_payload = message.body
+            if queued_payload.get('execution_id') != worker.get('execution_id'):
+                logger.warning('S3 Worker \'{}\' drops payload \'{}\' of execution \'{}\''.format(worker['worker_id'], queued_payload['work_id'],
+                    queued_payload.get('execution_id')))
+                work_queue.delete_message(message)
+                continue
+            if not time_budget.can_start(queued_payload['payload_size_in_mb']):
+                # received once more, the queue would move the payload to its dead-letter queue and
+                # the execution would miss it: fail the execution instead
+                if message.receive_count >= get_max_receive_count():
+                    raise Exception('Payload \'{}\' was received {} times and not processed'.format(queued_payload['work_id'], message.receive_count))
+                work_queue.release_message(message)
+                worker['status'] = 'processing'
+                break
+            logger.info('S3 Worker \'{}\' is processing a \'{}\' operation on payload \'{}\' ({} files, {} MB)'.format(
+                worker['worker_id'], s3_operation_type, queued_payload['work_id'], queued_payload['num_files'], queued_payload['payload_size_in_mb']))
+            payload_start_time = time.time()
+            journal = new_progress_journal(s3_utils.s3, queued_payload.get('job_id'), worker['worker_id'])
+            results = new_copy_engine(s3_operation_type, journal=journal).run(get_queued_payload_files(queued_payload))
+            flush_journal(journal)
+            raise_on_failed_results(queued_payload, results)
+            add_observation(worker['throughput_stats'], queued_payload.get('route'), len(results), queued_payload['payload_size_in_mb'], time.time() - payload_start_time)
+            work_queue.delete_message(message)
+            time_budget.record_copied(queued_payload['payload_size_in_mb'])
+            num_payloads += 1
+            worker['num_files_copied'] = worker.get('num_files_copied', 0) + sum(1 for result in results if result.copied)
+            worker['copied_size_in_mb'] = worker.get('copied_size_in_mb', 0) + queued_payload['payload_size_in_mb']
         elapsed_time = time.time() - start_time
-        logger.info('It took {} secs to process a \'{}\' operation on S3 payload: {}'.format(elapsed_time, s3_operation_type, payload))
+        logger.info('S3 Worker \'{}\' processed {} payloads in {} secs (status: {})'.format(worker['worker_id'], num_payloads, elapsed_time, worker['status']))
 
         # Update values and generate Lambda output
-        payload['copy_time_in_sec'] = elapsed_time
-        work['cur_payload'] = work['cur_payload'] + 1
-        result = {}
-        result[work['work_id']] = work
-        result['status'] = 'done' if work['cur_payload'] >= work['num_payloads'] else 'processing'
-        return result
+        worker['num_executions'] = worker.get('num_executions', 0) + 1
+        worker['num_payloads'] = worker.get('num_payloads', 0) + num_payloads
+        worker['copy_time_in_sec'] = worker.get('copy_time_in_sec', 0) + elapsed_time
+        record_execution_metrics(worker, metrics_recorder, s3_operation_type, worker['worker_id'])
+        return worker
+
+    except Exception as e:
+        logger.error(str(e))
+        raise
+
+
+# Completes the multipart copies of large files once all workers are done copying their parts.
+# Sample Lambda Input:
+# [
+#   {
+#     "source_s3_bucket": "aws-copy-source",
+#     "source_s3_path": "source/100GB.mp4",
+#     "target_s3_bucket": "aws-copy-destination",
+#     "target_s3_path": "target/100GB.mp4",
+#     "file_size_in_mb": 102400,
+#     "upload_id": "VXBsb2FkIElE...",
+#     "num_parts": 100,
+#     "job_id": "2018-08-01-archive-move"
+#   }
+# ]
+def complete_multipart_handler(event, context):
+    try:
+        s3_operation_type = os.environ['S3OperationType'] if 'S3OperationType' in os.environ else default_s3_operation
+        delete_batcher = S3DeleteBatcher()
+        journals = {}
+        for multipart_upload in event:
+            source_s3_location = {'bucket': multipart_upload['source_s3_bucket'], 'key': multipart_upload['source_s3_path']}
+            target_s3_location = {'bucket': multipart_upload['target_s3_bucket'], 'key': multipart_upload['target_s3_path']}
+            try:
+                s3_complete_multipart_copy(target_s3_location, multipart_upload['upload_id'], multipart_upload['num_parts'])
+            except ClientError as e:
+                # the upload may have been completed by a previous (retried) execution
+                file_size = round(multipart_upload['file_size_in_mb'] * 1024 * 1024)
+                if e.response['Error']['Code'] != 'NoSuchUpload' or get_s3_file_size(target_s3_location) != file_size:
+                    raise
+            if s3_operation_type == 'move-files':
+                delete_batcher.add(source_s3_location)
+            job_id = multipart_upload.get('job_id')
+            if job_id not in journals:
+                journals[job_id] = new_progress_journal(s3_utils.s3, job_id, 'multipart')
+            if journals[job_id] is not None:
+                journals[job_id].record(multipart_upload)
+        delete_batcher.flush()
+        for journal in journals.values():
+            flush_journal(journal)
+        if delete_batcher.errors:
+            raise Exception('Failed to delete {} source S3 files of completed multipart copies: {}'.format(len(delete_batcher.errors), delete_batcher.errors))
+        return {'status': 'done', 'num_multipart_uploads': len(event)}
+
+    except Exception as e:
+        logger.error(str(e))
+        raise
+
+
+# Aborts the multipart copies of an execution that failed before completing them (caught by the
+# state machine), so that the parts copied so far are not left behind in the target buckets.
+# Uploads completed before the failure are left as they are. Parts still being copied by a
+# worker when the upload is aborted may be stored anyway, the target buckets should also have
+# a lifecycle rule that aborts incomplete multipart uploads (see README).
+# Sample Lambda Input: the multipart uploads of the execution (see complete_multipart_handler)
+def abort_multipart_handler(event, context):
+    try:
+        num_aborted = 0
+        for multipart_upload in event:
+            target_s3_location = {'bucket': multipart_upload['target_s3_bucket'], 'key': multipart_upload['target_s3_path']}
+            if s3_abort_multipart_copy(target_s3_location, multipart_upload['upload_id']):
+                num_aborted += 1
+        logger.info('Aborted {} out of {} multipart copies'.format(num_aborted, len(event)))
+        return {'status': 'aborted', 'num_multipart_uploads': num_aborted}
+
+    except Exception as e:
+        logger.error(str(e))
+        raise
+
+
+# Purges the work queue of a failed queue-mode execution (caught by the state machine), so that
+# the next execution does not pull its payloads, including the parts of aborted multipart copies.
+def purge_queue_handler(event, context):
+    try:
+        purged = get_work_queue().purge()
+        logger.info('Work queue purged' if purged else 'Work queue purged less than a minute ago, its remaining payloads are dropped by the next workers')
+        return {'status': 'purged' if purged else 'purge skipped'}
 
     except Exception as e:
         logger.error(str(e))
@@ -0,0 +1,137 @@
+from utils.async_copy_engine import S3AsyncCopyEngine
+from utils.s3_async_utils import S3AsyncClients, s3_copy
+from utils import s3_async_utils
+import s3_copy_worker
+import threading
+import asyncio
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+file_content = b'1234567890'
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    monkeypatch.setenv('CopyEngine', 'asyncio')
+    return s3_client
+
+def payload_file(idx):
+    return {
+        'source_s3_bucket': s3_src_bucket,
+        'source_s3_path': 'source/{}.mp4'.format(idx),
+        'target_s3_bucket': s3_trg_bucket,
+        'target_s3_path': 'target/{}.mp4'.format(idx),
+        'file_size_in_mb': len(file_content) / (1024 * 1024)
+    }
+
+def test_async_copy_engine_keeps_files_in_flight_on_one_thread(s3_client):
+
+    # setup
+    in_flight = [0, 0]  # current, max
+    async def slow_operation(s3_clients, file, delete_batcher):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.02)
+        in_flight[0] -= 1
+        if file['source_s3_path'].endswith('3.mp4'):
+            raise Exception('boom')
+        return True
+
+    # test
+    results = S3AsyncCopyEngine(slow_operation, 50, s3_client).run(payload_file(idx) for idx in range(200))
+    assert in_flight[1] == 50
+    assert [result.file['source_s3_path'] for result in results] == ['source/{}.mp4'.format(idx) for idx in range(200)]
+    assert sum(1 for result in results if not result.succeeded) == 20 and results[3].error == 'boom'
+    results = S3AsyncCopyEngine(slow_operation, 4, s3_client).run(
+        (payload_file(idx) for idx in range(10)), lambda file: not file['source_s3_path'].endswith('6.mp4'))
+    assert len(results) == 6
+
+def test_async_worker_copies_and_moves_payload_files(s3_client, monkeypatch):
+
+    # setup
+    for idx in range(10):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+    s3_client.put_object(Bucket=s3_trg_bucket, Key='target/0.mp4', Body=file_content)
+    new_work = lambda: {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1,
+                        'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(idx) for idx in range(10)]}]}
+
+    # test: copy (a file already in the target is skipped), then move
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    result = s3_copy_worker.handler([new_work()], None)
+    assert result['s3_work_1']['payloads'][0]['num_files_copied'] == 9
+    assert s3_client.request_counts['CopyObject'] == 9 and len(s3_client.buckets[s3_trg_bucket].objects) == 10
+    monkeypatch.setenv('S3OperationType', 'move-files')
+    result = s3_copy_worker.handler([new_work()], None)
+    assert result['s3_work_1']['payloads'][0]['num_files_copied'] == 0
+    assert s3_client.request_counts['DeleteObjects'] == 1 and 'DeleteObject' not in s3_client.request_counts
+    assert s3_client.buckets[s3_src_bucket].objects == {}
+
+def test_async_worker_fails_payload_when_a_file_is_missing(s3_client, monkeypatch):
+
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(0)]}]}
+
+    with pytest.raises(Exception):
+        s3_copy_worker.handler([work], None)
+
+def test_async_worker_copies_parts_of_large_files(s3_client, monkeypatch):
+
+    # setup: files larger than a CopyObject allows are copied in parts as well
+    monkeypatch.setattr(s3_async_utils, 'MAX_COPY_OBJECT_SIZE', 15)
+    monkeypatch.setattr(s3_async_utils, 'multipart_copy_part_size', 10)
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/large.mp4', Body=file_content * 3)
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/split.mp4', Body=file_content * 3)
+    async def copy_large_file():
+        async with S3AsyncClients(s3_client) as s3_clients:
+            await s3_copy(s3_clients, {'bucket': s3_src_bucket, 'key': 'source/large.mp4'}, {'bucket': s3_trg_bucket, 'key': 'target/large.mp4'}, 30)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(copy_large_file())
+    finally:
+        loop.close()
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    upload_id = s3_client.create_multipart_upload(Bucket=s3_trg_bucket, Key='target/split.mp4')['UploadId']
+    parts = [dict(payload_file('split'), upload_id=upload_id, part_number=part_number, byte_range=byte_range)
+             for part_number, byte_range in [(1, 'bytes=0-19'), (2, 'bytes=20-29')]]
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1, 'payloads': [{'payload_size_in_mb': 1, 'payload_files': parts}]}
+    multipart_uploads = [dict(payload_file('split'), upload_id=upload_id, num_parts=2)]
+
+    # test
+    s3_copy_worker.handler([work], None)
+    s3_copy_worker.complete_multipart_handler(multipart_uploads, None)
+    assert s3_client.buckets[s3_trg_bucket].objects['target/large.mp4'].body == file_content * 3
+    assert s3_client.buckets[s3_trg_bucket].objects['target/split.mp4'].body == file_content * 3
+    assert s3_client.request_counts['UploadPartCopy'] == 5 and 'CopyObject' not in s3_client.request_counts
+
+def test_async_engine_rejects_relay_transfer_mode(s3_client, monkeypatch):
+
+    monkeypatch.setenv('TransferMode', 'relay')
+    with pytest.raises(ValueError):
+        s3_copy_worker.new_copy_engine('copy-files')
+
+# Sync client of a region, records the threads its bucket regions are looked up on
+class RegionalS3Client:
+
+    def __init__(self):
+        self.lookup_threads = []
+
+    def head_bucket(self, Bucket):
+        self.lookup_threads.append(threading.current_thread())
+        return {'ResponseMetadata': {'HTTPHeaders': {'x-amz-bucket-region': 'eu-west-1'}}}
+
+def test_async_clients_look_up_bucket_regions_off_the_event_loop():
+
+    # setup
+    s3_client = RegionalS3Client()
+    async def look_up_regions():
+        async with S3AsyncClients(s3_client) as s3_clients:
+            return [await s3_clients.region_for('s3-serverless-parallel-copy-eu-bucket') for _ in range(3)]
+    loop = asyncio.new_event_loop()
+
+    # test
+    try:
+        assert loop.run_until_complete(look_up_regions()) == ['eu-west-1'] * 3
+    finally:
+        loop.close()
+    assert len(s3_client.lookup_threads) == 1 and s3_client.lookup_threads[0] is not threading.current_thread()
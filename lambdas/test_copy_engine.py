@@ -0,0 +1,154 @@
+from utils.copy_engine import S3CopyEngine
+from utils.s3_utils import S3DeleteBatcher
+import s3_copy_worker
+import threading
+import time
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+file_content = b'1234567890'
+
+def payload_file(idx):
+    return {
+        'source_s3_bucket': s3_src_bucket,
+        'source_s3_path': 'source/{}.mp4'.format(idx),
+        'target_s3_bucket': s3_trg_bucket,
+        'target_s3_path': 'target/{}.mp4'.format(idx),
+        'file_size_in_mb': len(file_content) / (1024 * 1024)
+    }
+
+def test_copy_engine_keeps_multiple_files_in_flight():
+
+    # setup
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, max
+    def slow_operation(file):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return True
+
+    # test
+    results = S3CopyEngine(slow_operation, max_concurrency=4).run([payload_file(idx) for idx in range(20)])
+    assert all(result.copied for result in results)
+    assert in_flight[1] == 4
+
+def test_copy_engine_collects_errors_per_file():
+
+    def failing_operation(file):
+        if file['source_s3_path'].endswith('3.mp4'):
+            raise Exception('boom')
+        return True
+
+    results = S3CopyEngine(failing_operation, max_concurrency=2).run([payload_file(idx) for idx in range(5)])
+    assert [result.succeeded for result in results] == [True, True, True, False, True]
+    assert results[3].error == 'boom'
+
+def test_worker_copies_payload_files_concurrently(s3_client, monkeypatch):
+
+    # setup
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    for idx in range(10):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(idx) for idx in range(10)]}]}
+
+    # test
+    result = s3_copy_worker.handler([work], None)
+    assert result['status'] == 'done'
+    assert result['s3_work_1']['payloads'][0]['num_files_copied'] == 10
+    assert s3_client.head_object(Bucket=s3_trg_bucket, Key='target/9.mp4')['ContentLength'] == len(file_content)
+
+def test_worker_fails_payload_when_a_file_is_missing(s3_client, monkeypatch):
+
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(0)]}]}
+
+    with pytest.raises(Exception):
+        s3_copy_worker.handler([work], None)
+
+def test_delete_batcher_sends_full_batches_and_remainder(s3_client):
+
+    # setup
+    for idx in range(25):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+
+    # test
+    delete_batcher = S3DeleteBatcher(batch_size=10)
+    for idx in range(25):
+        delete_batcher.add({'bucket': s3_src_bucket, 'key': 'source/{}.mp4'.format(idx)})
+    assert s3_client.request_counts['DeleteObjects'] == 2
+    delete_batcher.flush()
+    assert s3_client.request_counts['DeleteObjects'] == 3
+    assert delete_batcher.num_deleted == 25
+    assert s3_client.buckets[s3_src_bucket].objects == {}
+
+def test_delete_batcher_reports_errors_per_file(s3_client):
+
+    delete_batcher = S3DeleteBatcher()
+    delete_batcher.add({'bucket': 'no-such-bucket', 'key': 'source/0.mp4'})
+    delete_batcher.flush()
+    assert delete_batcher.get_error({'bucket': 'no-such-bucket', 'key': 'source/0.mp4'}) is not None
+
+def test_worker_moves_payload_with_batched_deletes(s3_client, monkeypatch):
+
+    # setup
+    monkeypatch.setenv('S3OperationType', 'move-files')
+    for idx in range(10):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(idx) for idx in range(10)]}]}
+
+    # test
+    s3_copy_worker.handler([work], None)
+    assert s3_client.request_counts['DeleteObjects'] == 1
+    assert 'DeleteObject' not in s3_client.request_counts
+    assert s3_client.buckets[s3_src_bucket].objects == {}
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 10
+
+def test_copy_engine_stops_submitting_when_told_to():
+
+    results = S3CopyEngine(lambda file: True, max_concurrency=2).run(
+        (payload_file(idx) for idx in range(10)), lambda file: not file['source_s3_path'].endswith('6.mp4'))
+    assert len(results) == 6
+
+def test_time_budget_worker_processes_files_across_payloads(s3_client, lambda_context, monkeypatch):
+
+    # setup
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    monkeypatch.setenv('WorkerMode', 'time-budget')
+    for idx in range(9):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 3,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(idx) for idx in range(start, start + 3)]} for start in [0, 3, 6]]}
+
+    # test
+    result = s3_copy_worker.handler([work], lambda_context(300000))
+    assert result['status'] == 'done'
+    assert result['s3_work_1']['num_executions'] == 1
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 9
+
+def test_time_budget_worker_returns_file_cursor_near_deadline(s3_client, lambda_context, monkeypatch):
+
+    # setup: past the safety margin, only one file per execution is started
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    monkeypatch.setenv('WorkerMode', 'time-budget')
+    monkeypatch.setenv('CopyConcurrency', '1')
+    for idx in range(4):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=file_content)
+    work = {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 2,
+            'payloads': [{'payload_size_in_mb': 1, 'payload_files': [payload_file(idx) for idx in range(start, start + 2)]} for start in [0, 2]]}
+
+    # test
+    cursors = []
+    result = {'status': 'processing', 's3_work_1': work}
+    while result['status'] == 'processing':
+        result = s3_copy_worker.handler([result['s3_work_1']], lambda_context(10000))
+        cursors.append((result['s3_work_1']['cur_payload'], result['s3_work_1']['cur_file']))
+    assert cursors == [(0, 1), (1, 0), (1, 1), (2, 0)]
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 4
@@ -0,0 +1,61 @@
+from utils.s3_file_catalog import S3FileCatalog
+from utils.copy_simulator import CopySimulator, CopySimulationConfig
+from s3_copy_orchestrator import S3CopyOrchestrator
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+
+def new_catalog(file_sizes_in_mb):
+    catalog = S3FileCatalog()
+    for idx, file_size_in_mb in enumerate(file_sizes_in_mb):
+        catalog.add(s3_src_bucket, 'source/', s3_trg_bucket, 'target/', '{}.zip'.format(idx), file_size_in_mb)
+    return catalog
+
+def test_static_execution_follows_the_state_machine():
+
+    # setup: 2 files of 2 secs each copied at once
+    config = CopySimulationConfig(request_latency_in_sec=0.5, requests_per_file=2, bandwidth_in_mb_per_sec=10, copy_concurrency=2,
+                                  cold_start_in_sec=1, state_transition_in_sec=0.1)
+    works = S3CopyOrchestrator(cost_model=config.new_cost_model()).split_work(new_catalog([10, 10]), 1, 1024)
+
+    # test: orchestrator (1.2 secs), worker task, execution and choice (3.3 secs), helpers (2.2 secs)
+    result = CopySimulator(config).simulate(works)
+    assert result.makespan_in_sec == pytest.approx(6.7)
+    assert result.copy_duration_in_sec == pytest.approx(3.3)
+    assert result.num_executions == 4 and result.num_cold_starts == 4 and result.num_state_transitions == 7
+    assert result.get_thread_utilisation(config) == pytest.approx(4 / 6)
+    assert result.busy_workers == [(pytest.approx(1.3), 1), (pytest.approx(4.3), 0)]
+
+def test_more_workers_and_smaller_payloads_trade_makespan_for_cost():
+
+    # setup
+    config = CopySimulationConfig(copy_concurrency=4)
+    catalog = new_catalog([(idx % 10) + 1 for idx in range(2000)])
+    orchestrator = S3CopyOrchestrator(cost_model=config.new_cost_model())
+    simulator = CopySimulator(config)
+
+    # test
+    results = {(num_workers, max_payload_size_in_mb): simulator.simulate(orchestrator.split_work(catalog, num_workers, max_payload_size_in_mb))
+               for num_workers in [2, 8] for max_payload_size_in_mb in [100, 1000]}
+    assert results[(8, 1000)].makespan_in_sec < results[(2, 1000)].makespan_in_sec
+    assert results[(8, 100)].num_executions > results[(8, 1000)].num_executions
+    assert results[(8, 100)].num_state_transitions > results[(8, 1000)].num_state_transitions
+    assert results[(8, 100)].get_cost(config) > results[(8, 1000)].get_cost(config)
+    assert all(result.num_timeouts == 0 and 0 < result.worker_utilisation <= 1 for result in results.values())
+
+def test_queue_workers_stop_before_their_timeout():
+
+    # setup: 40 payloads of 20 secs, executions can copy 3 of them within their time budget
+    config = CopySimulationConfig(request_latency_in_sec=0, bandwidth_in_mb_per_sec=10, copy_concurrency=1,
+                                  cold_start_in_sec=0, lambda_timeout_in_sec=90, safety_margin_in_sec=10)
+    works = S3CopyOrchestrator(cost_model=config.new_cost_model()).split_work(new_catalog([200] * 40), 4, 200)
+
+    # test
+    result = CopySimulator(config).simulate(works, 'queue', num_workers=2)
+    assert result.num_payloads == 40 and result.num_timeouts == 0
+    # 2 workers, 7 executions each (3 payloads, last one 2) and the orchestrator and helpers
+    assert result.num_executions == 2 * 7 + 3
+    assert result.copy_duration_in_sec == pytest.approx(20 * 20, rel=0.01)
+    with pytest.raises(ValueError):
+        CopySimulator(config).simulate(works, 'eager')
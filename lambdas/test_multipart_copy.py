@@ -0,0 +1,97 @@
+from s3_copy_orchestrator import S3CopyOrchestrator, S3FileInfo, S3MultipartCopyPlanner, s3_work_to_json, A_MB
+import s3_copy_orchestrator
+import s3_copy_worker
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+large_file_size = 23 * A_MB + 17
+
+@pytest.fixture
+def s3_client(s3_client):
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/large.mp4', Body=bytes(range(256)) * (large_file_size // 256) + b'x' * (large_file_size % 256))
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/small.mp4', Body=b'1234567890')
+    return s3_client
+
+def s3_files():
+    return [
+        S3FileInfo(s3_src_bucket, 'source/large.mp4', s3_trg_bucket, 'target/large.mp4', large_file_size/A_MB),
+        S3FileInfo(s3_src_bucket, 'source/small.mp4', s3_trg_bucket, 'target/small.mp4', 10/A_MB)
+    ]
+
+def test_large_file_is_split_into_byte_ranges(s3_client):
+
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+    files = list(planner.split(s3_files()))
+    parts = files[:-1]
+    assert len(parts) == 4
+    assert [part.byte_range for part in parts] == ['bytes=0-6291455', 'bytes=6291456-12582911', 'bytes=12582912-18874367', 'bytes=18874368-24117264']
+    assert sum(part.file_size for part in parts) == large_file_size/A_MB
+    assert files[-1].source_s3_path == 'source/small.mp4'
+    assert planner.multipart_uploads[0]['num_parts'] == 4
+
+def test_large_file_already_in_destination_is_not_split(s3_client):
+
+    s3_client.copy({'Bucket': s3_src_bucket, 'Key': 'source/large.mp4'}, s3_trg_bucket, 'target/large.mp4')
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+    assert len(list(planner.split(s3_files()))) == 2
+    assert planner.multipart_uploads == []
+
+@pytest.mark.parametrize('s3_operation_type', ['copy-files', 'move-files'])
+def test_parts_copied_by_multiple_workers_are_completed(s3_client, monkeypatch, s3_operation_type):
+
+    # setup
+    monkeypatch.setenv('S3OperationType', s3_operation_type)
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+    works = S3CopyOrchestrator().split_work(planner.split(s3_files()), 3, 6)
+    work_config = s3_work_to_json(works, planner.multipart_uploads)
+
+    # test
+    for work_id in ['s3_work_1', 's3_work_2', 's3_work_3']:
+        result = {'status': 'processing', work_id: work_config[work_id]}
+        while result['status'] == 'processing':
+            result = s3_copy_worker.handler([result[work_id]], None)
+    s3_copy_worker.complete_multipart_handler(work_config['multipart_uploads'], None)
+    source_body = s3_client.buckets[s3_src_bucket].objects.get('source/large.mp4')
+    target_body = s3_client.buckets[s3_trg_bucket].objects['target/large.mp4'].body
+    assert len(target_body) == large_file_size
+    if s3_operation_type == 'move-files':
+        assert source_body is None
+    else:
+        assert target_body == source_body.body
+
+def test_complete_multipart_handler_fails_on_missing_parts(s3_client):
+
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+    list(planner.split(s3_files()))
+    with pytest.raises(Exception):
+        s3_copy_worker.complete_multipart_handler(planner.multipart_uploads, None)
+
+def test_abort_multipart_handler_aborts_uploads_left_incomplete(s3_client):
+
+    # setup: a worker copied one part before the execution failed
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+    parts = list(planner.split(s3_files()))[:-1]
+    s3_client.upload_part_copy(Bucket=s3_trg_bucket, Key='target/large.mp4', UploadId=parts[0].upload_id, PartNumber=1,
+        CopySource={'Bucket': s3_src_bucket, 'Key': 'source/large.mp4'}, CopySourceRange=parts[0].byte_range)
+
+    # test: aborting again (retried execution) is not an error
+    assert s3_copy_worker.abort_multipart_handler(planner.multipart_uploads, None)['num_multipart_uploads'] == 1
+    assert s3_client.multipart_uploads == {}
+    assert s3_copy_worker.abort_multipart_handler(planner.multipart_uploads, None)['num_multipart_uploads'] == 0
+    assert 'target/large.mp4' not in s3_client.buckets[s3_trg_bucket].objects
+
+def test_orchestrator_aborts_its_multipart_uploads_when_it_fails(s3_client, monkeypatch):
+
+    # setup: the orchestrator fails once the large file is split
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '6')
+    def fail(*args, **kwargs):
+        raise Exception('Failed to write the manifests')
+    monkeypatch.setattr(s3_copy_orchestrator, 's3_work_to_json', fail)
+
+    # test
+    with pytest.raises(Exception):
+        s3_copy_orchestrator.handler({'s3_copy_config': {'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+            'target_s3_config': [{'file_types': ['mp4'], 's3_bucket': s3_trg_bucket, 's3_path': 'target/'}]}}, None)
+    assert s3_client.request_counts['CreateMultipartUpload'] == 1
+    assert s3_client.multipart_uploads == {}
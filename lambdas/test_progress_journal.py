@@ -0,0 +1,127 @@
+from utils.progress_journal import ProgressJournal, LocalJournalStore, encode_segment, decode_segment, load_completed_files
+import s3_copy_orchestrator
+import s3_copy_worker
+import threading
+import gzip
+import os
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_journal_bucket = 's3-serverless-parallel-copy-journal'
+job_id = 'archive-move'
+
+def s3_copy_config():
+    return {
+        'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+        'target_s3_config': [{'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'}],
+        'job_id': job_id
+    }
+
+def payload_file(idx):
+    return {'source_s3_bucket': s3_src_bucket, 'source_s3_path': 'source/{}.jpg'.format(idx),
+            'target_s3_bucket': s3_trg_bucket, 'target_s3_path': 'images/{}.jpg'.format(idx), 'file_size_in_mb': 1}
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    s3_client.create_bucket(Bucket=s3_journal_bucket)
+    for idx in range(30):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.jpg'.format(idx), Body=b'0' * 100000)
+    monkeypatch.setenv('JournalS3Bucket', s3_journal_bucket)
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '1')
+    monkeypatch.setenv('NumCopyLambdaWorkers', '1')
+    return s3_client
+
+def planned_files(work_config):
+    return [file for payload in work_config['s3_work_1']['payloads'] for file in payload['payload_files']]
+
+def test_journal_is_flushed_in_complete_segments(tmp_path):
+
+    # setup
+    store = LocalJournalStore(str(tmp_path))
+    journal = ProgressJournal(store, job_id, 's3_work_1', flush_size=4)
+
+    # test
+    for idx in range(10):
+        journal.record(payload_file(idx))
+    assert len(store.list_segments(job_id)) == 2
+    journal.flush()
+    assert journal.num_records == 10 and len(store.list_segments(job_id)) == 3
+    assert sorted(os.listdir(os.path.join(str(tmp_path), job_id))) == store.list_segments(job_id)
+    completed_files = load_completed_files(store, job_id)
+    assert len(completed_files) == 10
+    assert completed_files.is_completed(s3_src_bucket, 'source/3.jpg', s3_trg_bucket, 'images/3.jpg', 1)
+    assert not completed_files.is_completed(s3_src_bucket, 'source/3.jpg', s3_trg_bucket, 'images/3.jpg', 2)
+
+# Store whose segment writes wait until released (slow PUT)
+class BlockingJournalStore(LocalJournalStore):
+
+    def __init__(self, journal_path):
+        super().__init__(journal_path)
+        self.writing = threading.Event()
+        self.released = threading.Event()
+
+    def put_segment(self, job_id, segment_name, body):
+        self.writing.set()
+        self.released.wait(5)
+        super().put_segment(job_id, segment_name, body)
+
+def test_records_are_not_held_up_by_segment_writes(tmp_path):
+
+    # setup: the first segment write blocks
+    store = BlockingJournalStore(str(tmp_path))
+    journal = ProgressJournal(store, job_id, 's3_work_1', flush_size=2)
+    journal.record(payload_file(0))
+    writer = threading.Thread(target=journal.record, args=(payload_file(1),))
+    writer.start()
+    assert store.writing.wait(5)
+
+    # test: other threads keep recording while the segment is written
+    recorder = threading.Thread(target=journal.record, args=(payload_file(2),))
+    recorder.start()
+    recorder.join(1)
+    assert not recorder.is_alive() and journal.records == [[s3_src_bucket, 'source/2.jpg', s3_trg_bucket, 'images/2.jpg', 1]]
+    store.released.set()
+    writer.join()
+    journal.flush()
+    assert journal.num_records == 3 and journal.num_segments == 2
+
+def test_truncated_segment_is_rejected():
+
+    # setup
+    records = [[s3_src_bucket, 'source/{}.jpg'.format(idx), s3_trg_bucket, 'images/{}.jpg'.format(idx), 1] for idx in range(3)]
+    assert decode_segment(encode_segment(records)) == records
+    lines = gzip.decompress(encode_segment(records)).split(b'\n')
+
+    # test
+    with pytest.raises(ValueError):
+        decode_segment(gzip.compress(b'\n'.join(lines[:-1])))
+
+@pytest.mark.parametrize('s3_operation_type', ['copy-files', 'move-files'])
+def test_resumed_job_only_plans_what_is_left(s3_client, monkeypatch, s3_operation_type):
+
+    # setup: the first execution fails after copying 2 payloads
+    monkeypatch.setenv('S3OperationType', s3_operation_type)
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config()}, None)
+    work = work_config['s3_work_1']
+    assert work['job_id'] == job_id and len(planned_files(work_config)) == 30
+    copied_files = []
+    for _ in range(2):
+        copied_files.extend(work['payloads'][work['cur_payload']]['payload_files'])
+        work = s3_copy_worker.handler([work], None)['s3_work_1']
+    # the source of a moved file was not deleted before the failure
+    if s3_operation_type == 'move-files':
+        s3_client.put_object(Bucket=s3_src_bucket, Key=copied_files[0]['source_s3_path'], Body=b'0' * 100000)
+
+    # test
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config()}, None)
+    copied_paths = {file['source_s3_path'] for file in copied_files}
+    files_left = [file for file in planned_files(work_config) if 'sync_action' not in file]
+    assert len(files_left) == 30 - len(copied_files)
+    assert not copied_paths & {file['source_s3_path'] for file in files_left}
+    deleted_files = [file for file in planned_files(work_config) if file.get('sync_action') == 'delete']
+    if s3_operation_type == 'move-files':
+        assert [file['source_s3_path'] for file in deleted_files] == [copied_files[0]['source_s3_path']]
+        assert deleted_files[0]['file_size_in_mb'] == 0
+    else:
+        assert deleted_files == []
@@ -0,0 +1,101 @@
+from utils.local_s3 import LocalS3Client
+from utils import s3_clients
+from botocore.exceptions import ClientError
+import os
+import subprocess
+import sys
+import types
+import pytest
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    monkeypatch.setattr(s3_clients, '_s3_clients', {})
+    monkeypatch.setattr(s3_clients, '_bucket_regions', {})
+
+class FakeRegionalS3Client:
+
+    def __init__(self, region_name, bucket_regions):
+        self.meta = types.SimpleNamespace(region_name=region_name)
+        self.bucket_regions = bucket_regions
+        self.num_head_bucket_requests = 0
+
+    def head_bucket(self, Bucket):
+        self.num_head_bucket_requests += 1
+        headers = {'x-amz-bucket-region': self.bucket_regions[Bucket]}
+        if self.bucket_regions[Bucket] != self.meta.region_name:
+            raise ClientError({'Error': {'Code': '301', 'Message': 'Moved Permanently'},
+                               'ResponseMetadata': {'HTTPStatusCode': 301, 'HTTPHeaders': headers}}, 'HeadBucket')
+        return {'ResponseMetadata': {'HTTPStatusCode': 200, 'HTTPHeaders': headers}}
+
+def test_client_config_is_tunable(monkeypatch):
+
+    # setup
+    monkeypatch.setenv('S3MaxPoolConnections', '128')
+    monkeypatch.setenv('S3RetryMode', 'standard')
+    monkeypatch.setenv('S3ReadTimeoutInSec', '30')
+
+    # test
+    config = s3_clients.new_s3_client_config()
+    assert config.max_pool_connections == 128
+    assert config.retries == {'mode': 'standard', 'max_attempts': s3_clients.default_max_attempts}
+    assert config.read_timeout == 30
+
+def test_default_client_config_uses_adaptive_retries():
+
+    config = s3_clients.new_s3_client_config()
+    assert config.retries['mode'] == 'adaptive'
+    assert config.max_pool_connections == s3_clients.default_max_pool_connections
+
+def test_clients_are_cached_per_region():
+
+    assert s3_clients.get_s3_client('eu-west-1') is s3_clients.get_s3_client('eu-west-1')
+    assert s3_clients.get_s3_client('eu-west-1') is not s3_clients.get_s3_client('us-west-2')
+    assert s3_clients.get_s3_client('us-west-2').meta.region_name == 'us-west-2'
+
+def test_bucket_region_is_looked_up_once():
+
+    # setup
+    s3_client = FakeRegionalS3Client('us-east-1', {'source': 'us-east-1', 'target': 'eu-west-1'})
+
+    # test
+    for _ in range(3):
+        assert s3_clients.get_bucket_region('target', s3_client) == 'eu-west-1'
+    assert s3_client.num_head_bucket_requests == 1
+
+def test_requests_are_sent_to_the_bucket_region():
+
+    # setup
+    s3_client = FakeRegionalS3Client('us-east-1', {'source': 'us-east-1', 'target': 'eu-west-1'})
+
+    # test
+    assert s3_clients.get_s3_client_for_bucket('source', s3_client) is s3_client
+    target_s3_client = s3_clients.get_s3_client_for_bucket('target', s3_client)
+    assert target_s3_client.meta.region_name == 'eu-west-1'
+    assert s3_clients.get_s3_client_for_bucket('target', s3_client) is target_s3_client
+
+def test_local_s3_client_serves_every_bucket():
+
+    s3_client = LocalS3Client()
+    assert s3_clients.get_s3_client_for_bucket('any-bucket', s3_client) is s3_client
+
+def test_lazy_client_is_created_on_first_use(monkeypatch):
+
+    # setup
+    s3_client = FakeRegionalS3Client('eu-west-1', {})
+    created_clients = []
+    monkeypatch.setattr(s3_clients, 'get_s3_client', lambda region_name=None: created_clients.append(region_name) or s3_client)
+    lazy_s3_client = s3_clients.LazyS3Client('eu-west-1')
+    assert created_clients == []
+
+    # test
+    assert lazy_s3_client.meta.region_name == 'eu-west-1'
+    assert lazy_s3_client.head_bucket == s3_client.head_bucket
+    assert created_clients == ['eu-west-1']
+
+@pytest.mark.parametrize('module_name', ['s3_copy_orchestrator', 's3_copy_worker'])
+def test_lambda_modules_do_not_import_boto3(module_name):
+
+    # a fresh interpreter, the modules of this one are already imported
+    script = 'import sys; import {}; print(sorted(m for m in ("boto3", "botocore.client", "s3transfer", "asyncio") if m in sys.modules))'.format(module_name)
+    output = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, check=True)
+    assert output.stdout.decode('utf-8').strip() == '[]'
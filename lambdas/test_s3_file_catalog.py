@@ -0,0 +1,57 @@
+from utils.local_s3 import LocalS3Client
+from utils.s3_file_catalog import S3FileCatalog
+from s3_copy_orchestrator import S3CopyOrchestrator, S3MultipartCopyPlanner, s3_work_to_json, A_MB
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+
+def test_files_share_locations_and_keep_their_paths():
+
+    # setup
+    catalog = S3FileCatalog()
+    for idx in range(100):
+        catalog.add(s3_src_bucket, 'source/', s3_trg_bucket, 'videos/', 'día {}/{}.mp4'.format(idx % 3, idx), idx / 10)
+    catalog.add_file(s3_src_bucket, 'a/b.jpg', s3_trg_bucket, 'images/c.jpg', 1, 'delete')
+
+    # test
+    assert len(catalog) == 101 and len(catalog.locations.values) == 2
+    assert catalog.file_to_json(42) == {'source_s3_bucket': s3_src_bucket, 'source_s3_path': 'source/día 0/42.mp4',
+                                        'target_s3_bucket': s3_trg_bucket, 'target_s3_path': 'videos/día 0/42.mp4', 'file_size_in_mb': 4.2}
+    assert catalog.file_to_json(100)['source_s3_path'] == 'a/b.jpg' and catalog.file_to_json(100)['target_s3_path'] == 'images/c.jpg'
+    assert catalog.sync_action(100) == 'delete' and catalog.sync_action(0) is None
+    # a few dozen bytes per file
+    assert catalog.get_size_in_bytes() < 101 * 40
+
+def test_large_files_of_a_catalog_are_replaced_by_their_parts():
+
+    # setup
+    s3_client = LocalS3Client()
+    s3_client.create_bucket(Bucket=s3_trg_bucket)
+    catalog = S3FileCatalog()
+    catalog.add(s3_src_bucket, 'source/', s3_trg_bucket, 'target/', 'small.mp4', 1)
+    catalog.add(s3_src_bucket, 'source/', s3_trg_bucket, 'target/', 'large.mp4', 20)
+    planner = S3MultipartCopyPlanner(s3_client, 6)
+
+    # test
+    file_indexes = planner.split_catalog(catalog)
+    assert list(file_indexes) == [0, 2, 3, 4, 5]
+    parts = [catalog.file_to_json(file_idx) for file_idx in file_indexes[1:]]
+    assert [part['part_number'] for part in parts] == [1, 2, 3, 4]
+    assert {part['target_s3_path'] for part in parts} == {'target/large.mp4'}
+    assert sum(part['file_size_in_mb'] for part in parts) == pytest.approx(20)
+
+def test_works_are_planned_on_catalog_indexes():
+
+    # setup
+    catalog = S3FileCatalog()
+    for idx in range(1000):
+        catalog.add(s3_src_bucket, 'source/', s3_trg_bucket, 'target/', '{}.jpg'.format(idx), (idx % 10) / A_MB * 1024)
+
+    # test
+    works = S3CopyOrchestrator().split_work(catalog, 3, 1, file_indexes=range(0, 1000, 2))
+    work_config = s3_work_to_json(works)
+    planned_paths = [file['source_s3_path'] for work_id in ['s3_work_1', 's3_work_2', 's3_work_3']
+                     for payload in work_config[work_id]['payloads'] for file in payload['payload_files']]
+    assert sorted(planned_paths) == sorted('source/{}.jpg'.format(idx) for idx in range(0, 1000, 2))
+    assert works[0].work_list[0].s3_file_list[0].source_s3_bucket == s3_src_bucket
@@ -0,0 +1,109 @@
+from utils.s3_inventory import list_s3_objects_from_inventory
+from urllib.parse import quote_plus
+import s3_copy_orchestrator
+import datetime
+import gzip
+import io
+import json
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_inventory_bucket = 's3-serverless-parallel-copy-inventory'
+manifest_s3_path = '{}/daily/2018-08-01T00-00Z/manifest.json'.format(s3_src_bucket)
+last_modified = datetime.datetime(2018, 8, 1, tzinfo=datetime.timezone.utc)
+
+def s3_copy_config(inventory_manifest=True):
+    s3_copy_config = {
+        'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+        'target_s3_config': [{'file_types': ['mp4', 'jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'target/'}]
+    }
+    if inventory_manifest:
+        s3_copy_config['source_s3_config']['inventory_manifest'] = {'s3_bucket': s3_inventory_bucket, 's3_path': manifest_s3_path}
+    return s3_copy_config
+
+def csv_data_file(rows):
+    lines = ['"{}","{}","{}","{}","{}","{}"'.format(s3_src_bucket, quote_plus(key), size, '2018-08-01T00:00:00.000Z', 'etag-{}'.format(size), is_delete_marker)
+             for key, size, is_delete_marker in rows]
+    return gzip.compress('\n'.join(lines).encode('utf-8'))
+
+# Writes an inventory of the source bucket as a manifest and one CSV.gz data file per group of rows
+def put_csv_inventory(s3_client, rows_per_data_file):
+    data_files = []
+    for data_file_idx, rows in enumerate(rows_per_data_file):
+        data_file_key = '{}/daily/data/{}.csv.gz'.format(s3_src_bucket, data_file_idx)
+        s3_client.put_object(Bucket=s3_inventory_bucket, Key=data_file_key, Body=csv_data_file(rows))
+        data_files.append({'key': data_file_key, 'size': 0, 'MD5checksum': ''})
+    manifest = {
+        'sourceBucket': s3_src_bucket,
+        'destinationBucket': 'arn:aws:s3:::{}'.format(s3_inventory_bucket),
+        'version': '2016-11-30',
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, Size, LastModifiedDate, ETag, IsDeleteMarker',
+        'files': data_files
+    }
+    s3_client.put_object(Bucket=s3_inventory_bucket, Key=manifest_s3_path, Body=json.dumps(manifest).encode('utf-8'))
+
+@pytest.fixture
+def s3_client(s3_client):
+    s3_client.create_bucket(Bucket=s3_inventory_bucket)
+    return s3_client
+
+def test_inventory_rows_are_decoded_and_filtered(s3_client):
+
+    # setup
+    put_csv_inventory(s3_client, [
+        [('source/day 1/a+b.mp4', 100, 'false'), ('other/c.mp4', 200, 'false')],
+        [('source/día/d.jpg', 300, 'false'), ('source/deleted.jpg', 0, 'true')]
+    ])
+
+    # test
+    s3_objects = list(list_s3_objects_from_inventory(s3_client, s3_inventory_bucket, manifest_s3_path, s3_src_bucket, 'source/'))
+    assert sorted(s3_object['Key'] for s3_object in s3_objects) == ['source/day 1/a+b.mp4', 'source/día/d.jpg']
+    s3_object = next(s3_object for s3_object in s3_objects if s3_object['Size'] == 100)
+    assert s3_object['ETag'] == '"etag-100"' and s3_object['LastModified'] == last_modified
+
+def test_inventory_of_another_bucket_is_rejected(s3_client):
+
+    # setup
+    put_csv_inventory(s3_client, [[('source/a.mp4', 100, 'false')]])
+
+    # test
+    with pytest.raises(ValueError):
+        list(list_s3_objects_from_inventory(s3_client, s3_inventory_bucket, manifest_s3_path, s3_trg_bucket))
+
+def test_orchestrator_plans_the_same_files_from_inventory_as_from_listing(s3_client):
+
+    # setup: 4 data files of 250 rows
+    rows = [('source/{}/{}.{}'.format(idx % 7, idx, 'mp4' if idx % 3 else 'jpg'), 1024 * (idx + 1), 'false') for idx in range(1000)]
+    for key, size, _ in rows:
+        s3_client.put_object(Bucket=s3_src_bucket, Key=key, Body=b'0' * size)
+    put_csv_inventory(s3_client, [rows[idx:idx + 250] for idx in range(0, len(rows), 250)])
+
+    # test
+    planned_files = []
+    for inventory_manifest in [False, True]:
+        work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config(inventory_manifest)}, None)
+        planned_files.append(sorted((file['source_s3_path'], file['target_s3_path'], file['file_size_in_mb'])
+                                    for work_id in ['s3_work_1', 's3_work_2'] for payload in work_config[work_id]['payloads']
+                                    for file in payload['payload_files']))
+    assert len(planned_files[0]) == 1000
+    assert planned_files[0] == planned_files[1]
+
+def test_parquet_inventory_is_read_in_batches(s3_client):
+
+    # setup
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    table = pyarrow.table({'bucket': [s3_src_bucket] * 3, 'key': ['source/a b.mp4', 'source/c.mp4', 'other/d.mp4'],
+                           'size': [1, 2, 3], 'last_modified_date': [last_modified] * 3, 'e_tag': ['1', '2', '3']})
+    data_file = io.BytesIO()
+    pyarrow.parquet.write_table(table, data_file)
+    s3_client.put_object(Bucket=s3_inventory_bucket, Key='data/0.parquet', Body=data_file.getvalue())
+    manifest = {'sourceBucket': s3_src_bucket, 'destinationBucket': 'arn:aws:s3:::{}'.format(s3_inventory_bucket),
+                'fileFormat': 'Parquet', 'fileSchema': 'message s3.inventory {}', 'files': [{'key': 'data/0.parquet'}]}
+    s3_client.put_object(Bucket=s3_inventory_bucket, Key=manifest_s3_path, Body=json.dumps(manifest).encode('utf-8'))
+
+    # test
+    s3_objects = list(list_s3_objects_from_inventory(s3_client, s3_inventory_bucket, manifest_s3_path, s3_src_bucket, 'source/'))
+    assert [(s3_object['Key'], s3_object['Size']) for s3_object in s3_objects] == [('source/a b.mp4', 1), ('source/c.mp4', 2)]
@@ -0,0 +1,111 @@
+from utils.local_s3 import LocalS3Client
+from utils.s3_routing import S3RoutingTable
+from utils.s3_listing import list_s3_objects, list_s3_objects_sharded, find_s3_shards
+from s3_copy_orchestrator import S3CopyOrchestrator, s3_objects_to_catalog
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_copy_config = {
+    'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+    'target_s3_config': [
+        {'file_types': ['mp4'], 's3_bucket': 'target-bucket', 's3_path': 'videos/'},
+        {'file_types': ['jpg'], 's3_bucket': 'target-bucket', 's3_path': 'images/'}
+    ]
+}
+
+@pytest.fixture
+def s3_client():
+    # small pages so that pagination is exercised
+    s3_client = LocalS3Client(max_keys_per_page=7)
+    s3_client.create_bucket(Bucket=s3_src_bucket)
+    for day in range(5):
+        for idx in range(20):
+            s3_client.put_object(Bucket=s3_src_bucket, Key='source/day-{}/video-{}.mp4'.format(day, idx), Body=b'0' * idx)
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/index.jpg', Body=b'12345')
+    s3_client.put_object(Bucket=s3_src_bucket, Key='source/notes.txt', Body=b'12345')
+    s3_client.put_object(Bucket=s3_src_bucket, Key='other/video.mp4', Body=b'12345')
+    return s3_client
+
+def test_list_s3_objects_returns_all_pages(s3_client):
+
+    keys = [s3_object['Key'] for s3_object in list_s3_objects(s3_client, s3_src_bucket, 'source/')]
+    assert len(keys) == 102
+    assert 'other/video.mp4' not in keys
+
+def test_list_s3_objects_empty_prefix_yields_nothing(s3_client):
+
+    assert list(list_s3_objects(s3_client, s3_src_bucket, 'does-not-exist/')) == []
+
+def test_find_s3_shards_splits_on_common_prefixes(s3_client):
+
+    shards = []
+    objects = [s3_object for page in find_s3_shards(s3_client, s3_src_bucket, 'source/', shards) for s3_object in page]
+    assert sorted(s3_object['Key'] for s3_object in objects) == ['source/index.jpg', 'source/notes.txt']
+    assert [(shard.prefix, shard.start_after) for shard in shards] == [('source/day-{}/'.format(day), None) for day in range(5)]
+
+def test_list_s3_objects_sharded_matches_sequential_listing(s3_client):
+
+    sequential = sorted(s3_object['Key'] for s3_object in list_s3_objects(s3_client, s3_src_bucket, 'source/'))
+    sharded = sorted(s3_object['Key'] for s3_object in list_s3_objects_sharded(s3_client, s3_src_bucket, 'source/', max_workers=3))
+    assert sharded == sequential
+
+def test_flat_key_space_is_split_into_key_ranges():
+
+    # setup: 600 objects directly under the source path, listed 7 at a time
+    s3_client = LocalS3Client(max_keys_per_page=7)
+    s3_client.create_bucket(Bucket=s3_src_bucket)
+    for idx in range(600):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='flat/{:04x}.jpg'.format(idx * 97), Body=b'0')
+
+    # test: only the first page is listed before the key ranges
+    shards = []
+    assert len([s3_object for page in find_s3_shards(s3_client, s3_src_bucket, 'flat/', shards) for s3_object in page]) == 7
+    assert s3_client.request_counts['ListObjectsV2'] == 1
+    assert len(shards) > 10 and all(shard.start_after is not None for shard in shards)
+    sequential = [s3_object['Key'] for s3_object in list_s3_objects(s3_client, s3_src_bucket, 'flat/')]
+    sharded = sorted(s3_object['Key'] for s3_object in list_s3_objects_sharded(s3_client, s3_src_bucket, 'flat/', max_workers=4))
+    assert sharded == sequential
+
+def test_key_ranges_skip_the_common_prefixes_already_sharded():
+
+    # setup: objects and directories interleaved, more than a page of them
+    s3_client = LocalS3Client(max_keys_per_page=7)
+    s3_client.create_bucket(Bucket=s3_src_bucket)
+    for idx in range(40):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='mixed/{:02d}.jpg'.format(idx), Body=b'0')
+        s3_client.put_object(Bucket=s3_src_bucket, Key='mixed/{:02d}/a.jpg'.format(idx), Body=b'0')
+        s3_client.put_object(Bucket=s3_src_bucket, Key='mixed/{:02d}/b/c.jpg'.format(idx), Body=b'0')
+
+    # test
+    sequential = [s3_object['Key'] for s3_object in list_s3_objects(s3_client, s3_src_bucket, 'mixed/')]
+    for shard_depth in [1, 2]:
+        sharded = sorted(s3_object['Key'] for s3_object in list_s3_objects_sharded(s3_client, s3_src_bucket, 'mixed/', shard_depth=shard_depth))
+        assert sharded == sequential
+
+def test_list_s3_objects_sharded_propagates_errors(s3_client):
+
+    with pytest.raises(Exception):
+        list(list_s3_objects_sharded(s3_client, 'no-such-bucket', 'source/'))
+
+def test_split_work_consumes_listing_generator(s3_client):
+
+    s3_objects = list_s3_objects_sharded(s3_client, s3_src_bucket, 'source/', max_workers=3)
+    catalog = s3_objects_to_catalog(s3_objects, s3_src_bucket, 'source/', S3RoutingTable(s3_copy_config['target_s3_config']))
+    works = S3CopyOrchestrator().split_work(catalog, 2, 1024)
+    copied_files = [file for work in works for payload in work.work_list for file in payload.s3_file_list]
+    assert len(copied_files) == 101
+    assert {'videos/day-0/video-1.mp4', 'images/index.jpg'} <= {file.target_s3_path for file in copied_files}
+
+def test_synthetic_bucket_listing_is_sorted_and_consistent():
+
+    # setup
+    s3_client = LocalS3Client(max_keys_per_page=100)
+    s3_client.create_synthetic_bucket(Bucket=s3_src_bucket, num_objects=2500, prefix='source/', objects_per_directory=300)
+
+    # test
+    s3_objects = list(list_s3_objects(s3_client, s3_src_bucket, 'source/'))
+    keys = [s3_object['Key'] for s3_object in s3_objects]
+    assert len(keys) == 2500 and keys == sorted(keys)
+    assert sorted(s3_object['Key'] for s3_object in list_s3_objects_sharded(s3_client, s3_src_bucket, 'source/')) == keys
+    assert s3_client.head_object(Bucket=s3_src_bucket, Key=keys[42])['ContentLength'] == s3_objects[42]['Size']
+    assert {key.rsplit('.', 1)[-1] for key in keys} == {'jpg', 'zip', 'mp4'}
@@ -0,0 +1,74 @@
+from utils.s3_manifest import encode_payload_files, decode_payload_files
+import s3_copy_orchestrator
+import s3_copy_worker
+import json
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_manifest_bucket = 's3-serverless-parallel-copy-manifests'
+
+def s3_copy_config():
+    return {
+        'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+        'target_s3_config': [{'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'}]
+    }
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    s3_client.create_bucket(Bucket=s3_manifest_bucket)
+    monkeypatch.setenv('ManifestS3Bucket', s3_manifest_bucket)
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    return s3_client
+
+def test_payload_files_round_trip():
+
+    payload_files = [
+        {'source_s3_bucket': 'src', 'source_s3_path': 'source/day-1/a.mp4', 'target_s3_bucket': 'trg',
+         'target_s3_path': 'videos/day-1/a.mp4', 'file_size_in_mb': 1.5},
+        {'source_s3_bucket': 'src', 'source_s3_path': 'b.mp4', 'target_s3_bucket': 'trg',
+         'target_s3_path': 'videos/renamed.mp4', 'file_size_in_mb': 2048, 'sync_action': 'copy'},
+        {'source_s3_bucket': 'src', 'source_s3_path': 'source/c.mp4', 'target_s3_bucket': 'trg', 'target_s3_path': 'videos/c.mp4',
+         'file_size_in_mb': 1024, 'upload_id': 'upload-1', 'part_number': 2, 'byte_range': 'bytes=1073741824-2147483647'}
+    ]
+    assert decode_payload_files(encode_payload_files(payload_files)) == payload_files
+
+def test_manifest_is_smaller_than_inline_payload_files():
+
+    payload_files = [{'source_s3_bucket': s3_src_bucket, 'source_s3_path': 'source/day-{}/{}.jpg'.format(idx % 10, idx),
+                      'target_s3_bucket': s3_trg_bucket, 'target_s3_path': 'images/day-{}/{}.jpg'.format(idx % 10, idx),
+                      'file_size_in_mb': 0.1} for idx in range(10000)]
+    assert len(encode_payload_files(payload_files)) * 10 < len(json.dumps(payload_files))
+
+def test_work_state_size_does_not_depend_on_number_of_files(s3_client):
+
+    # setup
+    state_sizes = []
+    for num_files in [100, 2000]:
+        for idx in range(num_files):
+            s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}/{}.jpg'.format(num_files, idx), Body=b'1')
+
+        # test
+        s3_copy_config_for_prefix = s3_copy_config()
+        s3_copy_config_for_prefix['source_s3_config']['s3_path'] = 'source/{}/'.format(num_files)
+        work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config_for_prefix}, None)
+        state_sizes.append(len(json.dumps(work_config)))
+    assert abs(state_sizes[0] - state_sizes[1]) < 100
+
+@pytest.mark.parametrize('worker_mode', ['payload', 'time-budget'])
+def test_workers_copy_files_read_from_manifests(s3_client, lambda_context, monkeypatch, worker_mode):
+
+    # setup
+    monkeypatch.setenv('WorkerMode', worker_mode)
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '1')
+    for idx in range(50):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.jpg'.format(idx), Body=b'0' * 100000)
+
+    # test
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config()}, None)
+    assert work_config['s3_work_1']['num_payloads'] > 1
+    for work_id in ['s3_work_1', 's3_work_2']:
+        result = {'status': 'processing', work_id: work_config[work_id]}
+        while result['status'] == 'processing':
+            result = s3_copy_worker.handler([result[work_id]], None if worker_mode == 'payload' else lambda_context())
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 50
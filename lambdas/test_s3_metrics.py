@@ -0,0 +1,90 @@
+from utils.s3_metrics import S3MetricsRecorder, merge_metrics, instrument_s3_client, reset_metrics_recorder, get_metrics_recorder
+import s3_copy_worker
+from botocore.hooks import HierarchicalEmitter
+import json
+import types
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    return s3_client
+
+def work(num_files, file_size):
+    return {'work_id': 's3_work_1', 'cur_payload': 0, 'num_payloads': 1, 'payloads': [{
+        'payload_size_in_mb': num_files * file_size / (1024 * 1024),
+        'payload_files': [{'source_s3_bucket': s3_src_bucket, 'source_s3_path': 'source/{}.mp4'.format(idx),
+                           'target_s3_bucket': s3_trg_bucket, 'target_s3_path': 'target/{}.mp4'.format(idx),
+                           'file_size_in_mb': file_size / (1024 * 1024)} for idx in range(num_files)]}]}
+
+def test_recorder_measures_requests_and_errors():
+
+    # setup
+    metrics_recorder = S3MetricsRecorder()
+
+    # test
+    with metrics_recorder.measure('CopyObject', 2 * 1024 * 1024):
+        pass
+    with pytest.raises(ValueError):
+        with metrics_recorder.measure('CopyObject', 1024):
+            raise ValueError('boom')
+    stats = metrics_recorder.to_json()['CopyObject']
+    assert stats['num_requests'] == 2 and stats['num_errors'] == 1
+    assert stats['size_in_mb'] == 2
+
+def test_emf_record_is_a_single_json_line():
+
+    # setup
+    metrics_recorder = S3MetricsRecorder()
+    metrics_recorder.record('HeadObject', 0.01)
+    metrics_recorder.record('CopyObject', 0.5, 50 * 1024 * 1024)
+
+    # test
+    emf_line = metrics_recorder.to_emf({'S3OperationType': 'copy-files'}, {'work_id': 's3_work_1'})
+    assert '\n' not in emf_line
+    record = json.loads(emf_line)
+    assert record['CopyObjectThroughput'] == pytest.approx(100)
+    assert record['HeadObjectRequests'] == 1
+    metric_names = {metric['Name'] for metric in record['_aws']['CloudWatchMetrics'][0]['Metrics']}
+    assert {'CopyObjectLatency', 'HeadObjectLatency', 'CopyObjectThroughput'} <= metric_names
+    assert 'HeadObjectThroughput' not in metric_names
+
+def test_merge_metrics_sums_counts_and_keeps_max_latency():
+
+    merged_metrics = merge_metrics({'CopyObject': {'num_requests': 2, 'max_latency_in_sec': 3.0}},
+                                   {'CopyObject': {'num_requests': 1, 'max_latency_in_sec': 1.0}, 'HeadObject': {'num_requests': 4}})
+    assert merged_metrics == {'CopyObject': {'num_requests': 3, 'max_latency_in_sec': 3.0}, 'HeadObject': {'num_requests': 4}}
+
+def test_client_hooks_count_retries_and_throttles():
+
+    # setup: a client whose events only reach the metrics hooks
+    s3_client = instrument_s3_client(types.SimpleNamespace(meta=types.SimpleNamespace(events=HierarchicalEmitter())))
+    copy_object_model = types.SimpleNamespace(name='CopyObject')
+    metrics_recorder = reset_metrics_recorder()
+
+    # test
+    s3_client.meta.events.emit('needs-retry.s3.CopyObject', response=(None, {'Error': {'Code': 'SlowDown'}}), operation=copy_object_model)
+    s3_client.meta.events.emit('needs-retry.s3.CopyObject', response=(None, {'Error': {'Code': 'AccessDenied'}}), operation=copy_object_model)
+    s3_client.meta.events.emit('after-call.s3.CopyObject', parsed={'ResponseMetadata': {'RetryAttempts': 2}}, model=copy_object_model)
+    assert get_metrics_recorder() is metrics_recorder
+    assert metrics_recorder.to_json()['CopyObject']['num_throttles'] == 1
+    assert metrics_recorder.to_json()['CopyObject']['num_retries'] == 2
+
+def test_worker_aggregates_metrics_into_work_result(s3_client, capsys):
+
+    # setup
+    for idx in range(5):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=b'0' * 1024)
+
+    # test
+    result = s3_copy_worker.handler([work(5, 1024)], None)
+    metrics = result['s3_work_1']['metrics']
+    assert metrics['CopyObject']['num_requests'] == 5
+    assert metrics['CopyObject']['size_in_mb'] == pytest.approx(5 * 1024 / (1024 * 1024))
+    # 5 sources + 5 missing targets, missing targets are not errors
+    assert metrics['HeadObject']['num_requests'] == 10 and metrics['HeadObject']['num_errors'] == 0
+    emf_lines = [line for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+    assert len(emf_lines) == 1
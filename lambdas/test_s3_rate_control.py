@@ -0,0 +1,178 @@
+from utils.local_s3 import LocalS3Client, _client_error
+from utils.s3_rate_control import S3RateController, S3RateControllers, track_s3_throttles, reset_rate_controllers, get_rate_controllers
+from utils import s3_utils, s3_rate_control
+from botocore.exceptions import ClientError
+from botocore.hooks import HierarchicalEmitter
+from boto3.s3.transfer import TransferConfig
+import threading
+import time
+import types
+import pytest
+
+s3_bucket = 's3-serverless-parallel-copy-source'
+
+def slow_down():
+    return _client_error('SlowDown', 'Please reduce your request rate.', 'DeleteObject', 503)
+
+@pytest.fixture(autouse=True)
+def empty_rate_controllers(monkeypatch):
+    monkeypatch.setattr(s3_rate_control, '_rate_controllers', S3RateControllers(8))
+
+class ThrottlingS3Client(LocalS3Client):
+
+    def __init__(self, num_throttles):
+        super().__init__()
+        self.num_throttles = num_throttles
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        if self.num_throttles > 0:
+            self.num_throttles -= 1
+            raise slow_down()
+        return super().delete_object(Bucket=Bucket, Key=Key, **kwargs)
+
+def test_throttling_cuts_concurrency_and_paces_requests():
+
+    # setup
+    controller = S3RateController(8)
+
+    # test
+    with pytest.raises(ClientError):
+        with controller.request():
+            raise slow_down()
+    assert controller.concurrency_limit == 4
+    assert controller.rate_limit_per_sec is not None
+    assert controller.to_json()['num_decreases'] == 1
+
+def test_successful_requests_raise_limits_back():
+
+    # setup
+    controller = S3RateController(8, rate_increase_per_sec=100)
+    controller.on_throttle(time.time())
+    rate_limit_per_sec = controller.rate_limit_per_sec
+
+    # test
+    for _ in range(20):
+        with controller.request():
+            pass
+    assert 4 < controller.concurrency_limit <= 8
+    assert controller.rate_limit_per_sec > rate_limit_per_sec
+
+def test_burst_of_throttles_decreases_once():
+
+    # setup: requests started before the first throttle was reported
+    controller = S3RateController(16)
+    start_time = time.time()
+    time.sleep(0.001)
+
+    # test
+    for _ in range(5):
+        controller.on_throttle(start_time)
+    assert controller.concurrency_limit == 8
+    assert controller.to_json()['num_decreases'] == 1 and controller.to_json()['num_throttles'] == 5
+
+def test_requests_in_flight_are_capped():
+
+    # setup
+    controller = S3RateController(2)
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, max
+    def request():
+        with controller.request():
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+
+    # test
+    threads = [threading.Thread(target=request) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight[1] == 2
+
+def test_requests_taking_several_slots_wait_for_them():
+
+    # setup
+    controller = S3RateController(4)
+    controller.acquire(3)
+    started = threading.Event()
+    def request():
+        with controller.request(2):
+            started.set()
+
+    # test: waits for the 3 slots taken, while a request larger than the limit starts alone
+    thread = threading.Thread(target=request)
+    thread.start()
+    assert not started.wait(0.05)
+    controller.release(time.time(), num_requests=3)
+    thread.join()
+    assert started.is_set() and controller.num_requests == 5
+    with controller.request(6):
+        assert controller.in_flight == 6
+
+def test_copies_take_a_slot_per_request_in_flight(monkeypatch):
+
+    # setup: copies of 3 parts of 5MB above an 8MB threshold, 2 parts at a time
+    s3_client = LocalS3Client()
+    s3_client.create_bucket(Bucket=s3_bucket)
+    s3_client.put_object(Bucket=s3_bucket, Key='source/small.jpg', Body=b'0' * 10)
+    s3_client.put_object(Bucket=s3_bucket, Key='source/large.jpg', Body=b'0' * 12 * 1024 * 1024)
+    monkeypatch.setattr(s3_utils, 's3', s3_client)
+    rate_controllers = reset_rate_controllers(8)
+    transfer_config = TransferConfig(multipart_chunksize=5 * 1024 * 1024, max_concurrency=2)
+
+    # test: a small file is copied with a single CopyObject
+    s3_utils.s3_copy({'bucket': s3_bucket, 'key': 'source/small.jpg'}, {'bucket': s3_bucket, 'key': 'target/small.jpg'}, transfer_config, 10)
+    assert s3_client.request_counts['CopyObject'] == 1
+    assert rate_controllers.get(s3_bucket, 'target/').num_requests == 1
+    s3_utils.s3_copy({'bucket': s3_bucket, 'key': 'source/large.jpg'}, {'bucket': s3_bucket, 'key': 'target/large.jpg'}, transfer_config,
+        12 * 1024 * 1024)
+    assert rate_controllers.get(s3_bucket, 'target/').num_requests == 1 + 2
+    assert s3_utils.get_num_part_copies_in_flight(12 * 1024 * 1024) == 2
+
+def test_controllers_are_kept_per_prefix_and_forgotten_once_recovered():
+
+    # setup
+    rate_controllers = S3RateControllers(4)
+    rate_controllers.on_throttle(s3_bucket, '2024/01/01/a.jpg', time.time())
+    with rate_controllers.request(s3_bucket, '2024/01/02/a.jpg'):
+        pass
+
+    # test
+    assert rate_controllers.get(s3_bucket, '2024/01/01/b.jpg').is_throttled
+    assert list(rate_controllers.to_json()) == ['s3://{}/2024/01/01/'.format(s3_bucket)]
+    rate_controllers.reset()
+    assert len(rate_controllers.controllers) == 1
+
+def test_client_hook_reports_retried_throttles():
+
+    # setup: a client whose events only reach the rate control hooks
+    rate_controllers = reset_rate_controllers(4)
+    s3_client = track_s3_throttles(types.SimpleNamespace(meta=types.SimpleNamespace(events=HierarchicalEmitter())))
+    context = {}
+
+    # test
+    s3_client.meta.events.emit('before-parameter-build.s3.CopyObject', params={'Bucket': s3_bucket, 'Key': 'hot/a.jpg'}, context=context)
+    time.sleep(0.001)
+    s3_client.meta.events.emit('needs-retry.s3.CopyObject', response=(None, {'Error': {'Code': 'SlowDown'}}), request_dict={'context': context})
+    assert rate_controllers.get(s3_bucket, 'hot/b.jpg').concurrency_limit == 2
+    assert get_rate_controllers() is rate_controllers
+
+def test_throttled_deletes_slow_down_the_prefix(monkeypatch):
+
+    # setup
+    s3_client = ThrottlingS3Client(1)
+    s3_client.create_bucket(Bucket=s3_bucket)
+    s3_client.put_object(Bucket=s3_bucket, Key='hot/a.jpg', Body=b'0')
+    monkeypatch.setattr(s3_utils, 's3', s3_client)
+    rate_controllers = reset_rate_controllers(8)
+
+    # test
+    with pytest.raises(ClientError):
+        s3_utils.s3_delete({'bucket': s3_bucket, 'key': 'hot/a.jpg'})
+    rate_control = rate_controllers.to_json()['s3://{}/hot/'.format(s3_bucket)]
+    assert rate_control['num_throttles'] == 1 and rate_control['num_requests'] == 1
+    assert rate_control['concurrency_limit'] == 4
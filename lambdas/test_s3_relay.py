@@ -0,0 +1,123 @@
+from utils.local_s3 import LocalS3Client
+from utils.s3_relay import RelayBufferPool, S3StreamingRelay, _S3RangeReader
+from utils import s3_utils, s3_relay, s3_metrics, s3_rate_control
+from utils.s3_metrics import S3MetricsRecorder
+from utils.s3_rate_control import S3RateControllers
+from s3_copy_orchestrator import S3CopyOrchestrator, S3FileInfo, S3MultipartCopyPlanner, s3_work_to_json, A_MB
+import s3_copy_worker
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+large_file_size = 23 * A_MB + 17
+large_file_body = bytes(range(256)) * (large_file_size // 256) + b'x' * (large_file_size % 256)
+
+# source and target buckets served by separate clients (eg, accounts)
+@pytest.fixture
+def s3_clients():
+    source_s3_client = LocalS3Client()
+    source_s3_client.create_bucket(Bucket=s3_src_bucket)
+    source_s3_client.put_object(Bucket=s3_src_bucket, Key='source/large.mp4', Body=large_file_body)
+    source_s3_client.put_object(Bucket=s3_src_bucket, Key='source/small.mp4', Body=b'1234567890')
+    source_s3_client.put_object(Bucket=s3_src_bucket, Key='source/empty.mp4', Body=b'')
+    target_s3_client = LocalS3Client()
+    target_s3_client.create_bucket(Bucket=s3_trg_bucket)
+    return source_s3_client, target_s3_client
+
+def test_large_file_is_relayed_through_a_fixed_buffer_pool(s3_clients):
+
+    # setup
+    source_s3_client, target_s3_client = s3_clients
+    relay = S3StreamingRelay(RelayBufferPool(3, 5 * A_MB))
+
+    # test
+    relay.relay(source_s3_client, s3_src_bucket, 'source/large.mp4', target_s3_client, s3_trg_bucket, 'target/large.mp4', large_file_size)
+    assert target_s3_client.buckets[s3_trg_bucket].objects['target/large.mp4'].body == large_file_body
+    assert source_s3_client.request_counts['GetObject'] == 5
+    assert target_s3_client.request_counts['UploadPart'] == 5 and target_s3_client.request_counts['CompleteMultipartUpload'] == 1
+    assert relay.buffer_pool.max_in_use <= 3 and relay.buffer_pool.num_in_use == 0
+
+def test_small_files_are_relayed_with_a_single_put(s3_clients):
+
+    # setup
+    source_s3_client, target_s3_client = s3_clients
+    relay = S3StreamingRelay(RelayBufferPool(1, 5 * A_MB))
+
+    # test
+    relay.relay(source_s3_client, s3_src_bucket, 'source/small.mp4', target_s3_client, s3_trg_bucket, 'target/small.mp4', 10)
+    relay.relay(source_s3_client, s3_src_bucket, 'source/empty.mp4', target_s3_client, s3_trg_bucket, 'target/empty.mp4', 0)
+    assert target_s3_client.buckets[s3_trg_bucket].objects['target/small.mp4'].body == b'1234567890'
+    assert target_s3_client.buckets[s3_trg_bucket].objects['target/empty.mp4'].body == b''
+    assert target_s3_client.request_counts == {'PutObject': 2}
+
+def test_parts_larger_than_a_buffer_are_streamed(s3_clients):
+
+    # setup
+    source_s3_client, target_s3_client = s3_clients
+    relay = S3StreamingRelay(RelayBufferPool(1, 5 * A_MB))
+    reader = _S3RangeReader(relay, source_s3_client, s3_src_bucket, 'source/large.mp4', 100, 12 * A_MB, relay.buffer_pool.acquire()[1])
+
+    # test: read twice (retried request)
+    assert reader.read() == large_file_body[100:12 * A_MB + 1]
+    reader.seek(0)
+    assert reader.read(1000) == large_file_body[100:1100]
+    upload_id = target_s3_client.create_multipart_upload(Bucket=s3_trg_bucket, Key='target/large.mp4')['UploadId']
+    relay.buffer_pool.release(0)
+    relay.relay_part(source_s3_client, s3_src_bucket, 'source/large.mp4', target_s3_client, s3_trg_bucket, 'target/large.mp4',
+                     upload_id, 1, 0, large_file_size - 1)
+    assert target_s3_client.multipart_uploads[upload_id]['Parts'][1].body == large_file_body
+
+def test_relay_of_a_changed_file_is_aborted(s3_clients):
+
+    # setup
+    source_s3_client, target_s3_client = s3_clients
+    relay = S3StreamingRelay(RelayBufferPool(2, 5 * A_MB))
+
+    # test
+    with pytest.raises(IOError):
+        relay.relay(source_s3_client, s3_src_bucket, 'source/large.mp4', target_s3_client, s3_trg_bucket, 'target/large.mp4', large_file_size + 1)
+    assert target_s3_client.multipart_uploads == {} and target_s3_client.request_counts['AbortMultipartUpload'] == 1
+    assert 'target/large.mp4' not in target_s3_client.buckets[s3_trg_bucket].objects
+
+def test_workers_relay_files_and_parts(s3_clients, monkeypatch):
+
+    # setup
+    s3_client, _ = s3_clients
+    s3_client.create_bucket(Bucket=s3_trg_bucket)
+    monkeypatch.setattr(s3_utils, 's3', s3_client)
+    monkeypatch.setattr(s3_relay, '_relay', S3StreamingRelay(RelayBufferPool(2, 5 * A_MB)))
+    monkeypatch.setenv('TransferMode', 'relay')
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    planner = S3MultipartCopyPlanner(s3_client, 12)
+    works = S3CopyOrchestrator().split_work(planner.split([
+        S3FileInfo(s3_src_bucket, 'source/large.mp4', s3_trg_bucket, 'target/large.mp4', large_file_size/A_MB),
+        S3FileInfo(s3_src_bucket, 'source/small.mp4', s3_trg_bucket, 'target/small.mp4', 10/A_MB)
+    ]), 2, 12)
+    work_config = s3_work_to_json(works, planner.multipart_uploads)
+
+    # test
+    for work_id in ['s3_work_1', 's3_work_2']:
+        result = {'status': 'processing', work_id: work_config[work_id]}
+        while result['status'] == 'processing':
+            result = s3_copy_worker.handler([result[work_id]], None)
+    s3_copy_worker.complete_multipart_handler(work_config['multipart_uploads'], None)
+    assert s3_client.buckets[s3_trg_bucket].objects['target/large.mp4'].body == large_file_body
+    assert s3_client.buckets[s3_trg_bucket].objects['target/small.mp4'].body == b'1234567890'
+    assert 'CopyObject' not in s3_client.request_counts and 'UploadPartCopy' not in s3_client.request_counts
+
+def test_relayed_files_are_measured_and_take_a_slot_per_write(s3_clients, monkeypatch):
+
+    # setup
+    s3_client, _ = s3_clients
+    s3_client.create_bucket(Bucket=s3_trg_bucket)
+    monkeypatch.setattr(s3_utils, 's3', s3_client)
+    monkeypatch.setattr(s3_metrics, '_metrics_recorder', S3MetricsRecorder())
+    monkeypatch.setattr(s3_rate_control, '_rate_controllers', S3RateControllers(8))
+    relay = S3StreamingRelay(RelayBufferPool(3, 5 * A_MB))
+
+    # test: the large file is written with 5 parts, 3 at a time
+    s3_utils.s3_relay({'bucket': s3_src_bucket, 'key': 'source/large.mp4'}, {'bucket': s3_trg_bucket, 'key': 'target/large.mp4'}, large_file_size, relay)
+    s3_utils.s3_relay({'bucket': s3_src_bucket, 'key': 'source/small.mp4'}, {'bucket': s3_trg_bucket, 'key': 'target/small.mp4'}, 10, relay)
+    metrics = s3_metrics.get_metrics_recorder().to_json()['RelayObject']
+    assert metrics['num_requests'] == 2 and metrics['size_in_mb'] == pytest.approx((large_file_size + 10) / A_MB)
+    assert s3_rate_control.get_rate_controllers().get(s3_trg_bucket, 'target/').num_requests == 3 + 1
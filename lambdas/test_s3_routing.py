@@ -0,0 +1,137 @@
+from utils.s3_routing import S3RoutingTable, get_source_s3_configs
+from s3_copy_orchestrator import s3_objects_to_catalog
+import s3_copy_orchestrator
+import s3_copy_worker
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_backup_bucket = 's3-serverless-parallel-copy-backup'
+A_MB = 1024 * 1024
+
+def s3_objects(keys_and_sizes_in_mb):
+    return [{'Key': 'source/{}'.format(key), 'Size': int(size_in_mb * A_MB)} for key, size_in_mb in keys_and_sizes_in_mb]
+
+def test_extension_rules_route_like_file_types():
+
+    # setup
+    routing_table = S3RoutingTable([
+        {'file_types': ['mp4'], 's3_bucket': s3_trg_bucket, 's3_path': 'videos/'},
+        {'file_types': ['jpg', 'png'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'}
+    ])
+
+    # test
+    catalog = s3_objects_to_catalog(s3_objects([('a/1.mp4', 1), ('b.c/2.png', 1), ('feed.mrss', 1), ('README', 1), ('dir/', 0)]),
+                                    s3_src_bucket, 'source/', routing_table)
+    assert [(file['source_s3_path'], file['target_s3_path']) for file in map(catalog.file_to_json, range(len(catalog)))] == [
+        ('source/a/1.mp4', 'videos/a/1.mp4'), ('source/b.c/2.png', 'images/b.c/2.png')]
+    assert [target['num_files'] for target in routing_table.to_json()['num_files_per_target']] == [1, 1]
+    assert routing_table.to_json()['num_unmatched_files'] == 2
+    assert routing_table.to_json()['unmatched_samples'] == ['feed.mrss', 'README']
+
+def test_first_matching_rule_wins():
+
+    # setup: large raw files, then other raw files, then anything left
+    routing_table = S3RoutingTable([
+        {'key_patterns': ['raw/*'], 'min_size_in_mb': 100, 's3_bucket': s3_trg_bucket, 's3_path': 'large-raw/'},
+        {'file_types': ['mp4'], 'key_regex': r'raw/\d{4}/', 's3_bucket': s3_trg_bucket, 's3_path': 'raw/'},
+        {'s3_bucket': s3_trg_bucket, 's3_path': 'other/'}
+    ])
+
+    # test
+    rules = routing_table.classify(['raw/2018/a.mp4', 'raw/2018/b.mp4', 'raw/x/c.mp4', 'notes'], [200, 1, 1, 1])
+    assert [rule.s3_path for rule in rules] == ['large-raw/', 'raw/', 'other/', 'other/']
+    assert routing_table.num_files_per_rule == [1, 1, 2]
+
+def test_first_config_listing_an_extension_wins():
+
+    # setup: two configs list 'jpg' (the last one used to win when configs were indexed by extension)
+    routing_table = S3RoutingTable([
+        {'file_types': ['jpg', 'png'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'},
+        {'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'photos/'}
+    ])
+
+    # test
+    assert [rule.s3_path for rule in routing_table.classify(['a.jpg', 'b.png'], [1, 1])] == ['images/', 'images/']
+    assert routing_table.num_files_per_rule == [2, 0]
+
+def test_size_ranges_are_half_open():
+
+    # setup
+    routing_table = S3RoutingTable([
+        {'file_types': ['zip'], 'max_size_in_mb': 16, 's3_bucket': s3_trg_bucket, 's3_path': 'small/'},
+        {'file_types': ['zip'], 'min_size_in_mb': 16, 's3_bucket': s3_trg_bucket, 's3_path': 'large/'}
+    ])
+
+    # test
+    assert [rule.s3_path for rule in routing_table.classify(['a.zip', 'b.zip', 'c.zip'], [15.9, 16, 17])] == ['small/', 'large/', 'large/']
+
+def test_invalid_rules_are_rejected():
+
+    with pytest.raises(ValueError):
+        S3RoutingTable([{'key_regex': '(', 's3_bucket': s3_trg_bucket, 's3_path': ''}])
+    with pytest.raises(ValueError):
+        S3RoutingTable([{'file_types': ['jpg'], 's3_path': ''}])
+
+def test_rule_with_several_targets_routes_files_to_each_of_them():
+
+    # setup
+    routing_table = S3RoutingTable([
+        {'file_types': ['mp4'], 's3_bucket': s3_trg_bucket, 's3_path': 'videos/', 'targets': [{'s3_bucket': s3_backup_bucket, 's3_path': 'backup/'}]},
+        {'file_types': ['jpg'], 'targets': [{'s3_bucket': s3_trg_bucket, 's3_path': 'images/'}]}
+    ])
+
+    # test
+    catalog = s3_objects_to_catalog(s3_objects([('a.mp4', 1), ('b.jpg', 1)]), s3_src_bucket, 'source/', routing_table)
+    assert [(file['target_s3_bucket'], file['target_s3_path']) for file in map(catalog.file_to_json, range(len(catalog)))] == [
+        (s3_trg_bucket, 'videos/a.mp4'), (s3_backup_bucket, 'backup/a.mp4'), (s3_trg_bucket, 'images/b.jpg')]
+    assert [target['num_files'] for target in routing_table.to_json()['num_files_per_target']] == [1, 1, 1]
+    assert routing_table.has_fan_out and routing_table.classify(['c.mp4'], [1]) == [routing_table.rules[0]]
+
+def test_sources_are_routed_by_their_own_or_the_copy_target_configs():
+
+    # setup
+    target_s3_config = [{'s3_bucket': s3_trg_bucket, 's3_path': 'target/'}]
+    source_target_s3_config = [{'s3_bucket': s3_trg_bucket, 's3_path': 'archive/'}]
+
+    # test
+    sources = get_source_s3_configs({'source_s3_config': [{'s3_bucket': s3_src_bucket, 's3_path': '2018/'},
+        {'s3_bucket': s3_src_bucket, 's3_path': '2019/', 'target_s3_config': source_target_s3_config}], 'target_s3_config': target_s3_config})
+    assert [source['target_s3_config'] for source in sources] == [target_s3_config, source_target_s3_config]
+    assert get_source_s3_configs({'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': ''}, 'target_s3_config': target_s3_config})[0]['s3_path'] == ''
+    with pytest.raises(ValueError):
+        get_source_s3_configs({'source_s3_config': [{'s3_bucket': s3_src_bucket, 's3_path': '2018/'},
+            {'s3_bucket': s3_src_bucket, 's3_path': '2018/01/'}], 'target_s3_config': target_s3_config})
+    with pytest.raises(ValueError):
+        get_source_s3_configs({'source_s3_config': [{'s3_bucket': s3_src_bucket, 's3_path': '2018/'}]})
+
+def test_sources_and_targets_are_planned_in_a_single_execution(s3_client, monkeypatch):
+
+    # setup: two sources, the files of the first one copied to two targets
+    s3_client.create_bucket(Bucket=s3_backup_bucket)
+    for year, num_files in [(2018, 6), (2019, 4)]:
+        for idx in range(num_files):
+            s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}/{}.jpg'.format(year, idx), Body=b'0' * 100000)
+    monkeypatch.setenv('NumCopyLambdaWorkers', '2')
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    s3_copy_config = {
+        'source_s3_config': [
+            {'s3_bucket': s3_src_bucket, 's3_path': 'source/2018/'},
+            {'s3_bucket': s3_src_bucket, 's3_path': 'source/2019/', 'target_s3_config': [{'s3_bucket': s3_trg_bucket, 's3_path': 'archive/2019/'}]}
+        ],
+        'target_s3_config': [{'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/2018/',
+                              'targets': [{'s3_bucket': s3_backup_bucket, 's3_path': 'backup/2018/'}]}]
+    }
+
+    # test: the 16 files are balanced across the workers
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
+    assert [sum(payload['num_files'] for payload in work_config[work_id]['payloads']) for work_id in ['s3_work_1', 's3_work_2']] == [8, 8]
+    for work_id in ['s3_work_1', 's3_work_2']:
+        result = {'status': 'processing', work_id: work_config[work_id]}
+        while result['status'] == 'processing':
+            result = s3_copy_worker.handler([result[work_id]], None)
+    assert sorted(s3_client.buckets[s3_trg_bucket].objects) == ['archive/2019/{}.jpg'.format(idx) for idx in range(4)] + ['images/2018/{}.jpg'.format(idx) for idx in range(6)]
+    assert sorted(s3_client.buckets[s3_backup_bucket].objects) == ['backup/2018/{}.jpg'.format(idx) for idx in range(6)]
+    monkeypatch.setenv('S3OperationType', 'move-files')
+    with pytest.raises(ValueError):
+        s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
@@ -0,0 +1,74 @@
+from utils.s3_sync import S3TargetIndex, S3SyncFilter, is_s3_object_up_to_date
+import s3_copy_orchestrator
+import s3_copy_worker
+import datetime
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_copy_config = {
+    'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+    'target_s3_config': [{'file_types': ['mp4'], 's3_bucket': s3_trg_bucket, 's3_path': 'target/'}],
+    'incremental_sync': True
+}
+
+@pytest.fixture
+def s3_client(s3_client):
+    for idx in range(100):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=b'1234567890')
+    # 95 files already synced, 5 of them changed after the last sync
+    for idx in range(95):
+        s3_client.copy({'Bucket': s3_src_bucket, 'Key': 'source/{}.mp4'.format(idx)}, s3_trg_bucket, 'target/{}.mp4'.format(idx))
+    for idx in range(5):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=b'0987654321')
+    s3_client.request_counts.clear()
+    return s3_client
+
+def planned_files(work_config):
+    return [file for work_id, work in work_config.items() if work_id.startswith('s3_work_')
+            for payload in work['payloads'] for file in payload['payload_files']]
+
+def test_s3_object_up_to_date():
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    source_s3_object = {'Key': 'a.mp4', 'Size': 10, 'ETag': '"abc"', 'LastModified': now}
+    assert is_s3_object_up_to_date(source_s3_object, (10, '"abc"', now))
+    assert not is_s3_object_up_to_date(source_s3_object, (11, '"abc"', now))
+    assert not is_s3_object_up_to_date(source_s3_object, (10, '"def"', now))
+    assert not is_s3_object_up_to_date(source_s3_object, (10, '"abc"', now - datetime.timedelta(seconds=1)))
+    # multipart ETags cannot be compared
+    assert is_s3_object_up_to_date(source_s3_object, (10, '"def-2"', now))
+
+def test_sync_filter_actions():
+
+    target_index = S3TargetIndex()
+    target_index.add_s3_object(s3_trg_bucket, {'Key': 'target/a.mp4', 'Size': 10})
+    assert S3SyncFilter(target_index, 'copy-files').get_sync_action({'Size': 10}, s3_trg_bucket, 'target/a.mp4') is None
+    assert S3SyncFilter(target_index, 'move-files').get_sync_action({'Size': 10}, s3_trg_bucket, 'target/a.mp4') == 'delete'
+    assert S3SyncFilter(target_index, 'copy-files').get_sync_action({'Size': 10}, s3_trg_bucket, 'target/b.mp4') == 'copy'
+
+def test_incremental_sync_plans_only_missing_or_changed_files(s3_client, monkeypatch):
+
+    # setup
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+
+    # test
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
+    files = planned_files(work_config)
+    assert sorted(file['source_s3_path'] for file in files) == sorted('source/{}.mp4'.format(idx) for idx in list(range(5)) + list(range(95, 100)))
+    assert all(file['sync_action'] == 'copy' for file in files)
+    for work_id in ['s3_work_1', 's3_work_2']:
+        s3_copy_worker.handler([work_config[work_id]], None)
+    assert s3_client.request_counts.get('HeadObject', 0) == 0
+    assert s3_client.request_counts['CopyObject'] == 10
+    assert s3_client.buckets[s3_trg_bucket].objects['target/0.mp4'].body == b'0987654321'
+
+def test_incremental_sync_deletes_up_to_date_files_when_moving(s3_client, monkeypatch):
+
+    monkeypatch.setenv('S3OperationType', 'move-files')
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
+    assert len([file for file in planned_files(work_config) if file['sync_action'] == 'delete']) == 90
+    for work_id in ['s3_work_1', 's3_work_2']:
+        s3_copy_worker.handler([work_config[work_id]], None)
+    assert s3_client.buckets[s3_src_bucket].objects == {}
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 100
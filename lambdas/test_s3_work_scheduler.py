@@ -0,0 +1,70 @@
+from utils.s3_work_scheduler import S3CopyCostModel, LptScheduler, KarmarkarKarpScheduler, MultifitScheduler, BestOfSchedulers, \
+    new_work_scheduler, get_work_loads, get_predicted_makespan
+from s3_copy_orchestrator import S3CopyOrchestrator, S3FileInfo, s3_work_to_json
+import random
+import pytest
+
+all_schedulers = [LptScheduler(), KarmarkarKarpScheduler(), MultifitScheduler(), BestOfSchedulers()]
+
+def thumbnails_and_videos():
+    # many tiny thumbnails and a few multi-GB videos
+    rnd = random.Random(7)
+    return [rnd.uniform(0.01, 0.1) for _ in range(2000)] + [rnd.uniform(2048, 8192) for _ in range(5)]
+
+@pytest.mark.parametrize('scheduler', all_schedulers)
+def test_scheduler_assigns_every_file_once(scheduler):
+
+    costs = thumbnails_and_videos()
+    assignment = scheduler.assign(costs, 4)
+    assert len(assignment) == 4
+    assert sorted(idx for file_indexes in assignment for idx in file_indexes) == list(range(len(costs)))
+
+@pytest.mark.parametrize('scheduler', all_schedulers)
+def test_scheduler_handles_no_files(scheduler):
+
+    assert scheduler.assign([], 3) == [[], [], []]
+
+@pytest.mark.parametrize('scheduler', all_schedulers)
+def test_scheduler_balances_equal_costs(scheduler):
+
+    assignment = scheduler.assign([1.0] * 12, 4)
+    assert get_work_loads([1.0] * 12, assignment) == [3.0] * 4
+
+def test_karmarkar_karp_beats_lpt_on_known_instance():
+
+    # LPT ends up with {8,5,4}/{7,6} (17/13), differencing with {7,5,4}/{8,6} (16/14)
+    costs = [8, 7, 6, 5, 4]
+    assert get_predicted_makespan(costs, LptScheduler().assign(costs, 2)) == 17
+    assert get_predicted_makespan(costs, KarmarkarKarpScheduler().assign(costs, 2)) == 16
+
+def test_best_of_schedulers_is_never_worse_than_any_scheduler():
+
+    costs = thumbnails_and_videos()
+    best = get_predicted_makespan(costs, BestOfSchedulers().assign(costs, 3))
+    for scheduler in [LptScheduler(), KarmarkarKarpScheduler(), MultifitScheduler()]:
+        assert best <= get_predicted_makespan(costs, scheduler.assign(costs, 3))
+
+def test_cost_model_accounts_for_per_file_latency():
+
+    cost_model = S3CopyCostModel(per_file_latency_in_sec=0.05, throughput_in_mb_per_sec=50, copy_concurrency=2)
+    assert cost_model.file_cost(100) == pytest.approx((0.05 + 2) / 2)
+    assert cost_model.file_cost(0) == pytest.approx(0.025)
+
+def test_invalid_work_scheduler_raises_exception():
+
+    with pytest.raises(ValueError):
+        new_work_scheduler('round-robin')
+
+def test_split_work_balances_on_predicted_time_not_bytes():
+
+    # setup: 1 large file vs many small ones where latency dominates
+    s3_files = [S3FileInfo('src', 'big.mp4', 'trg', 'big.mp4', 1000)] + \
+        [S3FileInfo('src', '{}.jpg'.format(idx), 'trg', '{}.jpg'.format(idx), 0.01) for idx in range(1000)]
+    cost_model = S3CopyCostModel(per_file_latency_in_sec=0.1, throughput_in_mb_per_sec=100)
+
+    # test
+    works = S3CopyOrchestrator(LptScheduler(), cost_model).split_work(s3_files, 2, 10240)
+    work_config = s3_work_to_json(works)
+    durations = sorted(work_config[work_id]['predicted_duration_in_sec'] for work_id in ['s3_work_1', 's3_work_2'])
+    assert durations[1] - durations[0] < 0.2
+    assert work_config['predicted_makespan_in_sec'] == durations[1]
@@ -0,0 +1,135 @@
+from utils.local_dynamodb import LocalDynamoDBClient
+from utils.speculation import S3ProgressBoard, find_stragglers
+from utils import speculation
+from utils.s3_utils import s3_move_if_not_in_destination
+from botocore.exceptions import ParamValidationError
+import s3_copy_orchestrator
+import s3_copy_worker
+import time
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_speculation_bucket = 's3-serverless-parallel-copy-speculation'
+claims_table = 's3-serverless-parallel-copy-claims'
+s3_copy_config = {
+    'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+    'target_s3_config': [{'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'}]
+}
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    s3_client.create_bucket(Bucket=s3_speculation_bucket)
+    for idx in range(20):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.jpg'.format(idx), Body=b'0' * 100000)
+    monkeypatch.setenv('SpeculationS3Bucket', s3_speculation_bucket)
+    monkeypatch.setenv('SpeculationClaimsTable', claims_table)
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '1')
+    monkeypatch.setenv('NumCopyLambdaWorkers', '2')
+    monkeypatch.setenv('MinStragglerRemainingInSec', '0')
+    return s3_client
+
+@pytest.fixture
+def dynamodb_client(monkeypatch):
+    dynamodb_client = LocalDynamoDBClient()
+    dynamodb_client.create_table(TableName=claims_table, KeySchema=[{'AttributeName': 'claim_id', 'KeyType': 'HASH'}])
+    monkeypatch.setattr(speculation, 'get_dynamodb_client', lambda: dynamodb_client)
+    return dynamodb_client
+
+def progress(predicted_done, predicted_current, predicted_remaining, updated_at, done=False):
+    return {'cur_payload': 0, 'cur_file': 0, 'done': done, 'predicted_done_in_sec': predicted_done,
+            'predicted_current_in_sec': predicted_current, 'predicted_remaining_in_sec': predicted_remaining, 'updated_at': updated_at}
+
+def test_stragglers_are_works_far_behind_their_predicted_duration():
+
+    # setup: 200 secs into the execution, payloads of 60 secs
+    works_progress = {
+        'on_time': {'on_time': progress(120, 60, 120, 170)},
+        'reports_once_per_payload': {'reports_once_per_payload': progress(60, 60, 180, 90)},
+        'straggler': {'straggler': progress(30, 30, 210, 150)},
+        'slower_straggler': {'slower_straggler': progress(0, 60, 240, 60)},
+        'duplicated_straggler': {'duplicated_straggler': progress(0, 60, 240, 60), 'on_time': progress(180, 60, 60, 190)},
+        'done': {'done': progress(0, 60, 240, 60), 'on_time': progress(240, 0, 0, 150, done=True)},
+        'almost_done': {'almost_done': progress(0, 10, 10, 0)}
+    }
+
+    # test
+    stragglers = find_stragglers(works_progress, started_at=0, now=200, slowdown=2, min_remaining_in_sec=30)
+    assert [work_id for work_id, _ in stragglers] == ['slower_straggler', 'straggler']
+
+def test_a_work_is_claimed_once(s3_client, dynamodb_client):
+
+    board = S3ProgressBoard(s3_client, s3_speculation_bucket, 'speculation/execution/', claims_table)
+    assert board.claim('s3_work_1', 's3_work_2')
+    assert not board.claim('s3_work_1', 's3_work_3')
+    assert board.claim('s3_work_2', 's3_work_3')
+    # the works of another execution are claimed separately
+    assert S3ProgressBoard(s3_client, s3_speculation_bucket, 'speculation/other_execution/', claims_table).claim('s3_work_1', 's3_work_3')
+    claim = dynamodb_client.get_item(TableName=claims_table, Key={'claim_id': {'S': s3_speculation_bucket + '/speculation/execution/s3_work_1'}})['Item']
+    assert claim['runner_id'] == {'S': 's3_work_2'}
+
+def test_s3_conditional_writes_are_rejected_by_the_pinned_sdk(s3_client):
+
+    # the local S3 client rejects the parameters the packaged botocore does not know, as it does
+    with pytest.raises(ParamValidationError):
+        s3_client.put_object(Bucket=s3_speculation_bucket, Key='claims/s3_work_1.json', Body=b'{}', IfNoneMatch='*')
+
+def test_speculation_requires_a_claims_table(s3_client, monkeypatch):
+
+    monkeypatch.delenv('SpeculationClaimsTable')
+    with pytest.raises(ValueError):
+        s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
+    with pytest.raises(ValueError):
+        S3ProgressBoard(s3_client, s3_speculation_bucket, 'speculation/execution/').claim('s3_work_1', 's3_work_2')
+
+@pytest.mark.parametrize('s3_operation_type', ['copy-files', 'move-files'])
+def test_idle_worker_duplicates_a_straggler_and_the_first_to_finish_wins(s3_client, dynamodb_client, monkeypatch, s3_operation_type):
+
+    # setup: worker 1 is stuck on its first payload while worker 2 is done with its work
+    monkeypatch.setenv('S3OperationType', s3_operation_type)
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config}, None)
+    work_1, work_2 = work_config['s3_work_1'], work_config['s3_work_2']
+    assert work_1['progress_board']['s3_bucket'] == s3_speculation_bucket and work_1['progress_board']['claims_table'] == claims_table
+    work_2['progress_board']['started_at'] = time.time() - 100
+    result = {'status': 'processing', 's3_work_2': work_2}
+    while 'speculative_work' not in result['s3_work_2']:
+        result = s3_copy_worker.handler([result['s3_work_2']], None)
+        assert result['status'] == 'processing'
+    assert result['s3_work_2']['speculative_work']['work_id'] == 's3_work_1'
+
+    # test: worker 2 copies the files of work 1, worker 1 stops once it sees it
+    while result['status'] == 'processing':
+        result = s3_copy_worker.handler([result['s3_work_2']], None)
+    assert result['s3_work_2']['speculative_work_ids'] == ['s3_work_1']
+    assert 'speculative_work' not in result['s3_work_2'] and result['s3_work_2']['throughput_stats'] is not None
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 20
+    num_copies = s3_client.request_counts['CopyObject']
+    result = s3_copy_worker.handler([work_1], None)
+    assert result['status'] == 'done' and result['s3_work_1']['cur_payload'] == work_1['num_payloads']
+    assert s3_client.request_counts['CopyObject'] == num_copies
+    if s3_operation_type == 'move-files':
+        assert s3_client.buckets[s3_src_bucket].objects == {}
+
+@pytest.mark.parametrize('target_matches', [True, False])
+def test_a_file_moved_by_the_other_runner_meanwhile_counts_as_moved(s3_client, monkeypatch, target_matches):
+
+    # setup: both runners found the file in the source, the other runner moves it first
+    source_s3_location = {'bucket': s3_src_bucket, 'key': 'source/0.jpg'}
+    target_s3_location = {'bucket': s3_trg_bucket, 'key': 'images/0.jpg'}
+    copy = s3_client.copy
+    def copy_after_the_other_runner(CopySource, Bucket, Key, **kwargs):
+        copy(CopySource, Bucket, Key)
+        s3_client.delete_object(Bucket=CopySource['Bucket'], Key=CopySource['Key'])
+        if not target_matches:
+            s3_client.put_object(Bucket=Bucket, Key=Key, Body=b'0')
+        return copy(CopySource, Bucket, Key, **kwargs)
+    monkeypatch.setattr(s3_client, 'copy', copy_after_the_other_runner)
+
+    # test
+    if target_matches:
+        assert not s3_move_if_not_in_destination(source_s3_location, target_s3_location)
+        assert s3_client.buckets[s3_src_bucket].get('source/0.jpg') is None
+        assert s3_client.buckets[s3_trg_bucket].get('images/0.jpg').size == 100000
+    else:
+        with pytest.raises(Exception):
+            s3_move_if_not_in_destination(source_s3_location, target_s3_location)
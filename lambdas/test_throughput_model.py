@@ -0,0 +1,112 @@
+from utils.s3_work_scheduler import S3CopyCostModel
+from utils.throughput_model import S3ThroughputModel, add_observation, merge_throughput_stats, fit_copy_time, get_size_bucket
+import s3_copy_orchestrator
+from s3_copy_orchestrator import S3CopyOrchestrator, S3FileInfo
+import s3_copy_worker
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_model_bucket = 's3-serverless-parallel-copy-models'
+route = 'us-east-1>eu-west-1'
+
+def s3_copy_config():
+    return {
+        'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+        'target_s3_config': [{'file_types': ['mp4'], 's3_bucket': s3_trg_bucket, 's3_path': 'videos/'}]
+    }
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    s3_client.create_bucket(Bucket=s3_model_bucket)
+    monkeypatch.setenv('ThroughputModelS3Bucket', s3_model_bucket)
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    return s3_client
+
+def copy_time(num_files, size_in_mb):
+    return num_files * 0.05 + size_in_mb * 0.02
+
+def test_fit_recovers_per_file_and_per_mb_costs():
+
+    # setup: payloads of 30MB to 100MB files
+    throughput_stats = {}
+    for num_files, size_in_mb in [(10, 300), (20, 1000), (5, 400), (40, 2000)]:
+        add_observation(throughput_stats, route, num_files, size_in_mb, copy_time(num_files, size_in_mb))
+
+    # test
+    secs_per_file, secs_per_mb = fit_copy_time(throughput_stats[route]['16MB-256MB'])
+    assert secs_per_file == pytest.approx(0.05) and secs_per_mb == pytest.approx(0.02)
+
+def test_fit_of_alike_payloads_keeps_a_single_cost():
+
+    # setup: all payloads have the same file size, per file and per MB costs cannot be told apart
+    throughput_stats = {}
+    for num_files in [10, 20, 30]:
+        add_observation(throughput_stats, route, num_files, num_files * 50, copy_time(num_files, num_files * 50))
+
+    # test
+    secs_per_file, secs_per_mb = fit_copy_time(throughput_stats[route]['16MB-256MB'])
+    assert 0 in (secs_per_file, secs_per_mb)
+    assert secs_per_file + secs_per_mb * 50 == pytest.approx(copy_time(1, 50))
+
+def test_older_executions_weigh_less():
+
+    # setup
+    throughput_model = S3ThroughputModel()
+    for _ in range(2):
+        throughput_model.record(add_observation({}, route, 10, 500, 100))
+
+    # test
+    assert throughput_model.throughput_stats[route]['16MB-256MB']['weight'] == pytest.approx(1.8)
+    assert merge_throughput_stats({}, {route: {'lt-1MB': {'weight': 1}}})[route]['lt-1MB']['weight'] == 1
+    assert get_size_bucket(10, 5) == 'lt-1MB' and get_size_bucket(1, 1024) == 'ge-256MB'
+
+def test_learned_model_sizes_payloads_to_target_duration():
+
+    # setup: 0.1 secs per MB, files of the last size bucket
+    throughput_model = S3ThroughputModel()
+    for num_files in [1, 2, 3]:
+        throughput_model.record(add_observation({}, route, num_files, num_files * 1024, num_files * 102.4), decay=1.0)
+
+    # test
+    cost_model = throughput_model.new_cost_model({route}, S3CopyCostModel())
+    assert cost_model.is_fitted
+    assert cost_model.max_payload_size_in_mb(180) == pytest.approx(1800)
+    # size buckets without observations fall back to the configured cost model
+    assert cost_model.file_cost(1) == S3CopyCostModel().file_cost(1)
+    assert not throughput_model.new_cost_model({'us-east-1>us-east-1'}, S3CopyCostModel()).is_fitted
+
+def test_split_work_closes_payloads_at_max_duration():
+
+    # setup: 1.01 secs per file
+    s3_files = [S3FileInfo(s3_src_bucket, 'source/{}.mp4'.format(idx), s3_trg_bucket, 'videos/{}.mp4'.format(idx), 1) for idx in range(100)]
+    cost_model = S3CopyCostModel(per_file_latency_in_sec=1)
+
+    # test
+    works = S3CopyOrchestrator(cost_model=cost_model).split_work(s3_files, 1, 1024, max_payload_duration=10)
+    assert len(works[0].work_list) == 12
+    assert all(payload.predicted_duration <= 10 for payload in works[0].work_list)
+
+def test_copy_times_are_recorded_and_size_the_next_payloads(s3_client, monkeypatch):
+
+    # setup
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '1024')
+    monkeypatch.setenv('TargetPayloadDurationInSec', '1')
+    for idx in range(30):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.mp4'.format(idx), Body=b'0' * 100000)
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config()}, None)
+    assert work_config['s3_work_1']['num_payloads'] == 1
+    assert work_config['s3_work_1']['payloads'][0]['route'] == 'local>local'
+
+    # test: record slow copies (1 sec per file) of a few executions
+    throughput_stats = []
+    for _ in range(3):
+        result = s3_copy_worker.handler([dict(work_config['s3_work_1'], cur_payload=0)], None)
+        stats = result['s3_work_1']['throughput_stats']
+        for size_bucket_stats in stats['local>local'].values():
+            size_bucket_stats['files_time'] = size_bucket_stats['files_files']
+            size_bucket_stats['size_time'] = size_bucket_stats['files_size']
+        throughput_stats.append(stats)
+    assert s3_copy_orchestrator.record_throughput_handler(throughput_stats, None)['status'] == 'done'
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config()}, None)
+    assert all(payload['num_files'] == 1 for payload in work_config['s3_work_1']['payloads'])
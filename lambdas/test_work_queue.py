@@ -0,0 +1,238 @@
+from utils.work_queue import LocalWorkQueue, SqsWorkQueue
+import s3_copy_orchestrator
+from botocore.exceptions import ClientError
+import s3_copy_worker
+import threading
+import pytest
+
+s3_src_bucket = 's3-serverless-parallel-copy-source'
+s3_trg_bucket = 's3-serverless-parallel-copy-target'
+s3_manifest_bucket = 's3-serverless-parallel-copy-manifests'
+
+def s3_copy_config(num_workers):
+    return {
+        'source_s3_config': {'s3_bucket': s3_src_bucket, 's3_path': 'source/'},
+        'target_s3_config': [{'file_types': ['jpg'], 's3_bucket': s3_trg_bucket, 's3_path': 'images/'}],
+        'num_workers': num_workers
+    }
+
+@pytest.fixture
+def s3_client(s3_client, monkeypatch):
+    s3_client.create_bucket(Bucket=s3_manifest_bucket)
+    monkeypatch.setenv('ExecutionMode', 'queue')
+    monkeypatch.setenv('S3OperationType', 'copy-files')
+    monkeypatch.setenv('MaxPayloadSizePerLambdaExecutionInMB', '1')
+    return s3_client
+
+@pytest.fixture
+def work_queue(monkeypatch):
+    work_queue = LocalWorkQueue()
+    monkeypatch.setattr(s3_copy_orchestrator, 'get_work_queue', lambda: work_queue)
+    monkeypatch.setattr(s3_copy_worker, 'get_work_queue', lambda: work_queue)
+    return work_queue
+
+def put_source_files(s3_client, num_files, file_size=100000):
+    for idx in range(num_files):
+        s3_client.put_object(Bucket=s3_src_bucket, Key='source/{}.jpg'.format(idx), Body=b'0' * file_size)
+
+def run_worker(worker, context):
+    while worker['status'] == 'processing':
+        worker = s3_copy_worker.queue_handler(worker, context)
+    return worker
+
+def test_local_work_queue_redelivers_released_messages():
+
+    # setup
+    work_queue = LocalWorkQueue()
+    work_queue.send_messages([{'work_id': 'a'}, {'work_id': 'b'}])
+
+    # test
+    message = work_queue.receive_message()
+    assert message.body == {'work_id': 'a'}
+    assert not work_queue.is_drained()
+    work_queue.release_message(message)
+    assert work_queue.receive_message().body == {'work_id': 'a'}
+    work_queue.delete_message(work_queue.receive_message())
+    assert not work_queue.is_drained()  # 'a' still in flight
+
+# Records the batches sent, rejected as SQS would reject them
+class RecordingSqsClient:
+
+    def __init__(self):
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if len(Entries) > 10:
+            raise ClientError({'Error': {'Code': 'TooManyEntriesInBatchRequest', 'Message': 'Too many entries'}}, 'SendMessageBatch')
+        if sum(len(entry['MessageBody'].encode('utf-8')) for entry in Entries) > 256 * 1024:
+            raise ClientError({'Error': {'Code': 'BatchRequestTooLong', 'Message': 'Batch requests cannot be longer than 262144 bytes'}}, 'SendMessageBatch')
+        self.batches.append(Entries)
+        return {'Successful': Entries}
+
+def test_sqs_work_queue_sends_messages_in_batches():
+
+    # setup
+    sqs_client = RecordingSqsClient()
+
+    # test
+    SqsWorkQueue(sqs_client, 'https://sqs/queue').send_messages([{'work_id': str(idx)} for idx in range(23)])
+    assert [len(batch) for batch in sqs_client.batches] == [10, 10, 3]
+
+def test_sqs_work_queue_batches_stay_within_the_request_size_limit():
+
+    # setup: messages of ~100KB
+    sqs_client = RecordingSqsClient()
+    work_queue = SqsWorkQueue(sqs_client, 'https://sqs/queue')
+
+    # test
+    work_queue.send_messages([{'work_id': str(idx), 'padding': 'x' * 100000} for idx in range(5)])
+    assert [len(batch) for batch in sqs_client.batches] == [2, 2, 1]
+    with pytest.raises(ValueError):
+        work_queue.send_messages([{'work_id': 'too-large', 'padding': 'x' * 300000}])
+
+def test_queued_payloads_with_long_keys_fit_in_sqs_messages():
+
+    # setup: 500 files whose paths take ~500 bytes each
+    payload_files = [{'source_s3_bucket': 'src', 'source_s3_path': 'source/{}/{}.jpg'.format('d' * 220, idx), 'target_s3_bucket': 'trg',
+                      'target_s3_path': 'images/{}/{}.jpg'.format('d' * 220, idx), 'file_size_in_mb': 0.1} for idx in range(500)]
+    work_set_dict = {'s3_work_1': {'work_id': 's3_work_1', 'payloads': [
+        {'payload_size_in_mb': 50, 'predicted_duration_in_sec': 10, 'num_files': 500, 'payload_files': payload_files}]}}
+    sqs_client = RecordingSqsClient()
+
+    # test
+    queued_payloads = s3_copy_orchestrator.s3_work_to_queue_messages(work_set_dict)
+    assert len(queued_payloads) > 1 and sum(queued_payload['num_files'] for queued_payload in queued_payloads) == 500
+    SqsWorkQueue(sqs_client, 'https://sqs/queue').send_messages(queued_payloads)
+    assert sum(len(batch) for batch in sqs_client.batches) == len(queued_payloads)
+
+def test_queued_payloads_are_ordered_longest_first_and_split():
+
+    # setup
+    work_set_dict = {
+        's3_work_1': {'work_id': 's3_work_1', 'payloads': [
+            {'payload_size_in_mb': 1, 'predicted_duration_in_sec': 1, 'num_files': 1, 'payload_files': [{'file_size_in_mb': 1}]}]},
+        's3_work_2': {'work_id': 's3_work_2', 'payloads': [
+            {'payload_size_in_mb': 5, 'predicted_duration_in_sec': 5, 'num_files': 1, 'payload_files': [{'file_size_in_mb': 5}]},
+            {'payload_size_in_mb': 0, 'predicted_duration_in_sec': 0, 'num_files': 0, 'payload_files': []}]},
+        's3_work_3': {'work_id': 's3_work_3', 'payloads': [
+            {'payload_size_in_mb': 12, 'predicted_duration_in_sec': 12, 'num_files': 1200,
+             'payload_files': [{'file_size_in_mb': 0.01}] * 1200}]},
+        'multipart_uploads': [],
+        'predicted_makespan_in_sec': 12
+    }
+
+    # test
+    queued_payloads = s3_copy_orchestrator.s3_work_to_queue_messages(work_set_dict)
+    assert [queued_payload['work_id'] for queued_payload in queued_payloads] == [
+        's3_work_2_payload_1', 's3_work_3_payload_1_1', 's3_work_3_payload_1_2', 's3_work_3_payload_1_3', 's3_work_1_payload_1']
+    assert [queued_payload['num_files'] for queued_payload in queued_payloads] == [1, 500, 500, 200, 1]
+    assert queued_payloads[1]['predicted_duration_in_sec'] == pytest.approx(5)
+
+@pytest.mark.parametrize('manifest_s3_bucket', ['', s3_manifest_bucket])
+def test_queue_workers_copy_all_files(s3_client, work_queue, lambda_context, monkeypatch, manifest_s3_bucket):
+
+    # setup
+    monkeypatch.setenv('ManifestS3Bucket', manifest_s3_bucket)
+    put_source_files(s3_client, 60)
+
+    # test
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config(num_workers=3)}, None)
+    assert len(work_config['queue_workers']) == 3
+    assert work_config['num_queued_payloads'] > 3
+    threads = [threading.Thread(target=run_worker, args=(worker, lambda_context())) for worker in work_config['queue_workers']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 60
+    assert work_queue.is_drained()
+
+def test_idle_worker_takes_over_payloads_of_slow_worker(s3_client, work_queue, lambda_context):
+
+    # setup: the first worker stops after one payload (deadline reached), the second keeps pulling
+    put_source_files(s3_client, 20)
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config(num_workers=2)}, None)
+    slow_worker, fast_worker = work_config['queue_workers']
+
+    # test
+    slow_worker = s3_copy_worker.queue_handler(slow_worker, lambda_context(remaining_time_in_millis=29000))
+    assert slow_worker['status'] == 'processing' and slow_worker['num_payloads'] == 1
+    fast_worker = run_worker(fast_worker, lambda_context())
+    assert fast_worker['num_payloads'] == work_config['num_queued_payloads'] - 1
+    assert s3_copy_worker.queue_handler(slow_worker, lambda_context())['status'] == 'done'
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 20
+
+def test_failed_payload_stays_in_queue(s3_client, work_queue, lambda_context):
+
+    # setup
+    work_queue.send_messages([{'work_id': 'missing', 'payload_size_in_mb': 1, 'predicted_duration_in_sec': 1, 'num_files': 1, 'payload_files': [{
+        'source_s3_bucket': s3_src_bucket, 'source_s3_path': 'source/missing.jpg',
+        'target_s3_bucket': s3_trg_bucket, 'target_s3_path': 'images/missing.jpg', 'file_size_in_mb': 1, 'sync_action': 'copy'}]}])
+
+    # test
+    with pytest.raises(Exception):
+        s3_copy_worker.queue_handler({'worker_id': 's3_queue_worker_1', 'status': 'processing'}, lambda_context())
+    assert len(work_queue.in_flight) == 1
+
+def test_workers_drop_payloads_of_other_executions(s3_client, work_queue, lambda_context):
+
+    # setup: a payload left in the queue by a failed execution
+    work_queue.send_messages([{'work_id': 'stale', 'execution_id': 'failed-execution', 'payload_size_in_mb': 1, 'predicted_duration_in_sec': 1,
+                               'num_files': 1, 'payload_files': []}])
+    put_source_files(s3_client, 10)
+    work_config = s3_copy_orchestrator.handler({'s3_copy_config': s3_copy_config(num_workers=1)}, None)
+
+    # test
+    worker = run_worker(work_config['queue_workers'][0], lambda_context())
+    assert worker['execution_id'] == work_config['execution_id']
+    assert worker['num_payloads'] == work_config['num_queued_payloads']
+    assert len(s3_client.buckets[s3_trg_bucket].objects) == 10
+    assert work_queue.is_drained()
+
+def test_worker_fails_before_payload_goes_to_dead_letter_queue(s3_client, work_queue, lambda_context, monkeypatch):
+
+    # setup: the deadline is too close to start the second payload
+    monkeypatch.setenv('WorkQueueMaxReceiveCount', '2')
+    work_queue.send_messages([{'work_id': 'small', 'payload_size_in_mb': 0, 'predicted_duration_in_sec': 0, 'num_files': 0, 'payload_files': []},
+                              {'work_id': 'large', 'payload_size_in_mb': 1000, 'predicted_duration_in_sec': 1000, 'num_files': 0, 'payload_files': []},
+                              {'work_id': 'small', 'payload_size_in_mb': 0, 'predicted_duration_in_sec': 0, 'num_files': 0, 'payload_files': []}])
+    worker = {'worker_id': 's3_queue_worker_1', 'status': 'processing'}
+
+    # test: released once, the second time it would reach the dead-letter queue
+    worker = s3_copy_worker.queue_handler(worker, lambda_context(remaining_time_in_millis=29000))
+    assert worker['status'] == 'processing' and worker['num_payloads'] == 1
+    work_queue.messages.rotate(-1)  # 'small' first
+    with pytest.raises(Exception, match='received 2 times'):
+        s3_copy_worker.queue_handler(worker, lambda_context(remaining_time_in_millis=29000))
+
+def test_purge_queue_handler_empties_the_queue(work_queue):
+
+    # setup
+    work_queue.send_messages([{'work_id': 'a'}, {'work_id': 'b'}])
+    work_queue.receive_message()
+
+    # test
+    assert s3_copy_worker.purge_queue_handler({}, None) == {'status': 'purged'}
+    assert work_queue.is_drained()
+
+class PurgingSqsClient:
+
+    def __init__(self, error_code=None):
+        self.error_code = error_code
+
+    def purge_queue(self, QueueUrl):
+        if self.error_code is not None:
+            raise ClientError({'Error': {'Code': self.error_code, 'Message': 'Purge failed'}}, 'PurgeQueue')
+        return {}
+
+    def receive_message(self, QueueUrl, **kwargs):
+        return {'Messages': [{'ReceiptHandle': 'receipt-1', 'Body': '{"work_id": "a"}', 'Attributes': {'ApproximateReceiveCount': '4'}}]}
+
+def test_sqs_work_queue_skips_purge_in_progress():
+
+    # test
+    assert SqsWorkQueue(PurgingSqsClient(), 'https://sqs/queue').purge()
+    assert not SqsWorkQueue(PurgingSqsClient('AWS.SimpleQueueService.PurgeQueueInProgress'), 'https://sqs/queue').purge()
+    with pytest.raises(ClientError):
+        SqsWorkQueue(PurgingSqsClient('AccessDenied'), 'https://sqs/queue').purge()
+    assert SqsWorkQueue(PurgingSqsClient(), 'https://sqs/queue').receive_message().receive_count == 4
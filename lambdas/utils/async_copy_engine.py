@@ -0,0 +1,74 @@
+# ------------------------------------------------------------------------------
+# Copy engine running the files of an execution as coroutines on a single event
+# loop instead of a thread pool (see utils/copy_engine.py). Up to
+# 'max_concurrency' files are in flight, typically many more than there would
+# be threads: a file waiting on S3 only holds a coroutine, not a thread and its
+# stack. Results are collected per file and returned in order, source files of
+# moves are deleted in batches once the files are copied, as with the threads.
+# ------------------------------------------------------------------------------
+
+import asyncio
+import logging
+from utils.copy_engine import S3CopyResult, record_delete_errors
+from utils.s3_async_utils import S3AsyncClients, S3AsyncDeleteBatcher
+
+logger = logging.getLogger()
+default_async_copy_concurrency = 64
+
+
+class S3AsyncCopyEngine:
+
+    # s3_operation is a coroutine function called with the async S3 clients of the run, each
+    # payload file (dict) and the delete batcher (moves), it returns whether the file was
+    # actually copied. s3_client: default (sync) S3 client, see S3AsyncClients.
+    def __init__(self, s3_operation, max_concurrency=default_async_copy_concurrency, s3_client=None, batch_deletes=False):
+        assert max_concurrency > 0
+        self.s3_operation = s3_operation
+        self.max_concurrency = max_concurrency
+        self.s3_client = s3_client
+        self.batch_deletes = batch_deletes
+
+    async def _process_file(self, s3_clients, file, delete_batcher, results, idx):
+        try:
+            copied = await self.s3_operation(s3_clients, file, delete_batcher)
+            results[idx] = S3CopyResult(file, copied=bool(copied))
+        except Exception as e:
+            logger.error('Failed to process S3 file s3://{}/{}: {}'.format(file['source_s3_bucket'], file['source_s3_path'], e))
+            results[idx] = S3CopyResult(file, error=str(e))
+
+    async def _run(self, files, should_continue):
+        results = []
+        async with S3AsyncClients(self.s3_client) as s3_clients:
+            delete_batcher = S3AsyncDeleteBatcher(s3_clients) if self.batch_deletes else None
+            in_flight = set()
+            for file in files:
+                # only start a new file once a slot is available
+                if len(in_flight) >= self.max_concurrency:
+                    _, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                if should_continue is not None and not should_continue(file):
+                    break
+                in_flight.add(asyncio.ensure_future(self._process_file(s3_clients, file, delete_batcher, results, len(results))))
+                results.append(None)
+            if in_flight:
+                await asyncio.wait(in_flight)
+            if delete_batcher is not None:
+                await delete_batcher.flush()
+                record_delete_errors(results, delete_batcher)
+        return results
+
+    # Processes the files (payload file dicts, any iterable) on a new event loop and returns their
+    # results in the same order. Given should_continue, files are only started while it returns
+    # True for them, so only the results of the files that were started are returned. The loop is
+    # set as the current one (asyncio.run needs Python 3.7+, the Lambda runtime is 3.6) so locks and
+    # futures created by the coroutines bind to it.
+    def run(self, files, should_continue=None):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(self._run(files, should_continue))
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def __repr__(self):
+        return f'S3AsyncCopyEngine({self.max_concurrency!r})'
@@ -0,0 +1,86 @@
+# ------------------------------------------------------------------------------
+# Concurrent copy engine used by the S3 copy worker. A bounded thread pool keeps
+# up to 'max_concurrency' S3 files in flight within a single Lambda execution
+# and collects a result (or an error) per file, so one failing file does not
+# prevent the remaining files of the payload from being processed. Source files
+# queued for deletion (moves) are deleted in batches once the files are copied.
+# ------------------------------------------------------------------------------
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger()
+default_copy_concurrency = 8
+
+
+class S3CopyResult:
+
+    def __init__(self, file, copied=False, error=None):
+        self.file = file
+        self.copied = copied
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f'S3CopyResult({self.file!r}, {self.copied!r}, {self.error!r})'
+
+
+# Files whose source could not be deleted (batched deletes) are failed
+def record_delete_errors(results, delete_batcher):
+    for result in results:
+        if result.succeeded:
+            error = delete_batcher.get_error({'bucket': result.file['source_s3_bucket'], 'key': result.file['source_s3_path']})
+            if error is not None:
+                result.error = 'Failed to delete source file: {}'.format(error)
+
+
+class S3CopyEngine:
+
+    # s3_operation is called with each payload file (dict) and returns whether
+    # the file was actually copied
+    def __init__(self, s3_operation, max_concurrency=default_copy_concurrency, delete_batcher=None):
+        assert max_concurrency > 0
+        self.s3_operation = s3_operation
+        self.max_concurrency = max_concurrency
+        self.delete_batcher = delete_batcher
+
+    def _process_file(self, file):
+        try:
+            copied = self.s3_operation(file)
+            return S3CopyResult(file, copied=bool(copied))
+        except Exception as e:
+            logger.error('Failed to process S3 file s3://{}/{}: {}'.format(file['source_s3_bucket'], file['source_s3_path'], e))
+            return S3CopyResult(file, error=str(e))
+
+    # Processes the files (payload file dicts, any iterable) and returns their results in the
+    # same order. Given should_continue, files are only submitted while it returns True for
+    # them, so only the results of the files that were submitted are returned.
+    def run(self, files, should_continue=None):
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            in_flight = {}
+            for file in files:
+                # only submit a new file once a slot is available
+                if len(in_flight) >= self.max_concurrency:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results[in_flight.pop(future)] = future.result()
+                if should_continue is not None and not should_continue(file):
+                    break
+                in_flight[executor.submit(self._process_file, file)] = len(results)
+                results.append(None)
+            for future, idx in in_flight.items():
+                results[idx] = future.result()
+        if self.delete_batcher is not None:
+            self._flush_deletes(results)
+        return results
+
+    def _flush_deletes(self, results):
+        self.delete_batcher.flush()
+        record_delete_errors(results, self.delete_batcher)
+
+    def __repr__(self):
+        return f'S3CopyEngine({self.max_concurrency!r})'
@@ -0,0 +1,280 @@
+# ------------------------------------------------------------------------------
+# Discrete-event simulator of a copy execution, so that the number of workers
+# (num_copy_lambda_workers) and the payload size (MaxPayloadSizePerLambdaExecutionInMB)
+# can be picked offline rather than by redeploying the stack until a copy runs
+# well. The works planned by the orchestrator (S3CopyOrchestrator.split_work)
+# go through a model of the state machine (cloudformation/cfn_template.jinja2):
+# - 'static': one Parallel branch per work, looping over its Task (a worker
+#   execution copies one payload) and Choice states until the work is done
+# - 'queue': a Map of queue workers, each execution pulling payloads from the
+#   queue (longest first) until its time budget runs out
+# Within an execution, payload files are copied by CopyConcurrency threads, a
+# file taking the latency of its S3 requests plus its size over the copy
+# bandwidth. A branch (or queue worker) pays a cold start on its first execution
+# and every state entered costs a state transition. The result is the makespan,
+# the cost (Lambda GB-secs and requests, state transitions) and the utilisation
+# of the workers and of their copy threads.
+# ------------------------------------------------------------------------------
+
+import heapq
+from collections import deque
+from utils.s3_sync import SYNC_ACTION_DELETE
+from utils.s3_work_scheduler import S3CopyCostModel
+from utils.time_budget import default_safety_margin_in_sec
+
+execution_valid_modes = ['static', 'queue']
+# us-east-1 on-demand prices (USD)
+default_lambda_gb_sec_price = 0.0000166667
+default_lambda_request_price = 0.0000002
+default_state_transition_price = 0.000025
+
+
+class CopySimulationConfig:
+
+    # request_latency_in_sec: latency of a single S3 request
+    # requests_per_file: S3 requests per copied file (HEAD of the target and copy), parts take one (UploadPartCopy)
+    # bandwidth_in_mb_per_sec: copy throughput of a single file
+    # cold_start_in_sec: extra time of the first execution of a branch (or queue worker)
+    # state_transition_in_sec: time it takes Step Functions to enter a state
+    # orchestrator_duration_in_sec: time the orchestrator takes to plan the copy (listing, split)
+    def __init__(self, request_latency_in_sec=0.02, requests_per_file=2, bandwidth_in_mb_per_sec=100, copy_concurrency=8,
+                 cold_start_in_sec=1.0, state_transition_in_sec=0.05, orchestrator_duration_in_sec=0,
+                 lambda_memory_in_mb=512, lambda_timeout_in_sec=300, safety_margin_in_sec=default_safety_margin_in_sec,
+                 lambda_gb_sec_price=default_lambda_gb_sec_price, lambda_request_price=default_lambda_request_price,
+                 state_transition_price=default_state_transition_price):
+        assert request_latency_in_sec >= 0 and bandwidth_in_mb_per_sec > 0 and copy_concurrency > 0
+        self.request_latency_in_sec = request_latency_in_sec
+        self.requests_per_file = requests_per_file
+        self.bandwidth_in_mb_per_sec = bandwidth_in_mb_per_sec
+        self.copy_concurrency = copy_concurrency
+        self.cold_start_in_sec = cold_start_in_sec
+        self.state_transition_in_sec = state_transition_in_sec
+        self.orchestrator_duration_in_sec = orchestrator_duration_in_sec
+        self.lambda_memory_in_mb = lambda_memory_in_mb
+        self.lambda_timeout_in_sec = lambda_timeout_in_sec
+        self.safety_margin_in_sec = safety_margin_in_sec
+        self.lambda_gb_sec_price = lambda_gb_sec_price
+        self.lambda_request_price = lambda_request_price
+        self.state_transition_price = state_transition_price
+
+    # Time (in secs) a copy thread spends on a file
+    def file_duration(self, file_size_in_mb, num_requests):
+        return num_requests * self.request_latency_in_sec + file_size_in_mb / self.bandwidth_in_mb_per_sec
+
+    # Cost model the orchestrator should plan with to match the simulated copies
+    def new_cost_model(self):
+        return S3CopyCostModel(self.requests_per_file * self.request_latency_in_sec, self.bandwidth_in_mb_per_sec, self.copy_concurrency)
+
+    def __repr__(self):
+        return f'CopySimulationConfig({self.request_latency_in_sec!r}, {self.requests_per_file!r}, {self.bandwidth_in_mb_per_sec!r}, {self.copy_concurrency!r}, {self.cold_start_in_sec!r}, {self.state_transition_in_sec!r})'
+
+
+class CopySimulationResult:
+
+    def __init__(self, execution_mode, num_workers, num_payloads):
+        self.execution_mode = execution_mode
+        self.num_workers = num_workers
+        self.num_payloads = num_payloads
+        self.makespan_in_sec = 0
+        self.copy_duration_in_sec = 0
+        self.num_executions = 0
+        self.num_cold_starts = 0
+        self.num_timeouts = 0
+        self.num_state_transitions = 0
+        # time spent by worker executions (billed), and by their copy threads copying files
+        self.execution_time_in_sec = 0
+        self.file_copy_time_in_sec = 0
+        self.helper_execution_time_in_sec = 0
+        # (time, number of workers running an execution) whenever it changes
+        self.busy_workers = []
+
+    def get_lambda_gb_sec(self, config):
+        return (self.execution_time_in_sec + self.helper_execution_time_in_sec) * config.lambda_memory_in_mb / 1024
+
+    def get_cost(self, config):
+        return self.get_lambda_gb_sec(config) * config.lambda_gb_sec_price \
+            + self.num_executions * config.lambda_request_price + self.num_state_transitions * config.state_transition_price
+
+    # Share of the copy phase the workers spent running an execution
+    @property
+    def worker_utilisation(self):
+        available_time = self.num_workers * self.copy_duration_in_sec
+        return self.execution_time_in_sec / available_time if available_time > 0 else 0
+
+    # Share of the execution time the copy threads spent copying files
+    def get_thread_utilisation(self, config):
+        available_time = self.execution_time_in_sec * config.copy_concurrency
+        return self.file_copy_time_in_sec / available_time if available_time > 0 else 0
+
+    def to_json(self, config):
+        return {
+            'execution_mode': self.execution_mode,
+            'num_workers': self.num_workers,
+            'num_payloads': self.num_payloads,
+            'makespan_in_sec': self.makespan_in_sec,
+            'copy_duration_in_sec': self.copy_duration_in_sec,
+            'num_executions': self.num_executions,
+            'num_cold_starts': self.num_cold_starts,
+            'num_timeouts': self.num_timeouts,
+            'num_state_transitions': self.num_state_transitions,
+            'lambda_gb_sec': self.get_lambda_gb_sec(config),
+            'cost': self.get_cost(config),
+            'worker_utilisation': self.worker_utilisation,
+            'thread_utilisation': self.get_thread_utilisation(config)
+        }
+
+    def __repr__(self):
+        return f'CopySimulationResult({self.execution_mode!r}, {self.num_workers!r}, {self.makespan_in_sec!r}, {self.num_executions!r})'
+
+
+class _EventQueue:
+
+    def __init__(self):
+        self.events = []
+        self.num_events = 0
+        self.time = 0
+
+    def schedule(self, time, callback):
+        heapq.heappush(self.events, (time, self.num_events, callback))
+        self.num_events += 1
+
+    def run(self):
+        while self.events:
+            self.time, _, callback = heapq.heappop(self.events)
+            callback()
+        return self.time
+
+
+class CopySimulator:
+
+    def __init__(self, config=None):
+        self.config = config or CopySimulationConfig()
+
+    def _file_duration(self, catalog, file_idx):
+        if catalog.parts and file_idx in catalog.parts:
+            num_requests = 1
+        elif catalog.sync_action(file_idx) == SYNC_ACTION_DELETE:
+            # source deletes are batched (DeleteObjects)
+            num_requests = 0
+        else:
+            num_requests = self.config.requests_per_file
+        return self.config.file_duration(catalog.file_sizes[file_idx], num_requests)
+
+    # Copy threads take the payload files in order, each file going to the first thread available.
+    # Returns the time it takes to copy the payload and the time spent copying its files.
+    def _copy_payload(self, file_durations):
+        threads_min_heap = [0] * min(self.config.copy_concurrency, max(len(file_durations), 1))
+        for file_duration in file_durations:
+            heapq.heapreplace(threads_min_heap, threads_min_heap[0] + file_duration)
+        return max(threads_min_heap), sum(file_durations)
+
+    def _payload_files_durations(self, work, max_files_per_message=None):
+        for payload in work.work_list:
+            file_durations = [self._file_duration(work.catalog, file_idx) for file_idx in payload.file_indexes]
+            if max_files_per_message is None or len(file_durations) <= max_files_per_message:
+                yield payload.cur_payload_size, file_durations
+                continue
+            # large payloads are split across queue messages
+            for first_idx in range(0, len(file_durations), max_files_per_message):
+                chunk_indexes = payload.file_indexes[first_idx:first_idx + max_files_per_message]
+                yield sum(work.catalog.file_sizes[file_idx] for file_idx in chunk_indexes), file_durations[first_idx:first_idx + max_files_per_message]
+
+    # Simulates the copy of the works (S3CopyWork list from S3CopyOrchestrator.split_work). In the
+    # queue mode, num_workers queue workers copy the payloads of all works.
+    def simulate(self, works, execution_mode='static', num_workers=None, num_multipart_uploads=0, max_files_per_message=None):
+        if execution_mode not in execution_valid_modes:
+            raise ValueError('Invalid execution mode: {}. Expecting one of {}.'.format(execution_mode, execution_valid_modes))
+        config = self.config
+        events = _EventQueue()
+        if execution_mode == 'static':
+            payloads_per_worker = [deque(self._payload_files_durations(work)) for work in works]
+            result = CopySimulationResult(execution_mode, len(works), sum(len(payloads) for payloads in payloads_per_worker))
+        else:
+            queued_payloads = [payload for work in works for payload in self._payload_files_durations(work, max_files_per_message)]
+            # longest predicted payloads first (see s3_work_to_queue_messages)
+            queued_payloads.sort(key=lambda payload: sum(payload[1]), reverse=True)
+            queue = deque(queued_payloads)
+            num_workers = num_workers or len(works)
+            payloads_per_worker = [queue] * num_workers
+            result = CopySimulationResult(execution_mode, num_workers, len(queued_payloads))
+        busy_workers = [0]
+
+        def transition():
+            result.num_state_transitions += 1
+            return config.state_transition_in_sec
+
+        def set_busy(time, delta):
+            busy_workers[0] += delta
+            result.busy_workers.append((time, busy_workers[0]))
+
+        # A worker execution starts (once the worker Task state is entered)
+        def start_execution(worker_idx, start_time, is_cold):
+            result.num_executions += 1
+            set_busy(start_time, 1)
+            init_time = config.cold_start_in_sec if is_cold else 0
+            result.num_cold_starts += 1 if is_cold else 0
+            execution = {'worker_idx': worker_idx, 'start_time': start_time, 'copy_start_time': start_time + init_time,
+                         'copied_size_in_mb': 0, 'num_payloads': 0}
+            if execution_mode == 'static':
+                payload_size, file_durations = payloads_per_worker[worker_idx].popleft()
+                copy_duration, file_copy_time = self._copy_payload(file_durations)
+                result.file_copy_time_in_sec += file_copy_time
+                events.schedule(execution['copy_start_time'] + copy_duration,
+                                lambda: end_execution(execution, events.time, bool(payloads_per_worker[worker_idx])))
+            else:
+                events.schedule(execution['copy_start_time'], lambda: next_queued_payload(execution))
+
+        # A queue worker execution takes the next payload while its time budget allows (see LambdaTimeBudget)
+        def next_queued_payload(execution):
+            elapsed_time = events.time - execution['copy_start_time']
+            queue = payloads_per_worker[execution['worker_idx']]
+            if not queue:
+                end_execution(execution, events.time, False)
+                return
+            payload_size, file_durations = queue[0]
+            if execution['num_payloads'] > 0 and execution['copied_size_in_mb'] > 0 and elapsed_time > 0:
+                remaining_time = config.lambda_timeout_in_sec - config.safety_margin_in_sec - (events.time - execution['start_time'])
+                if payload_size / (execution['copied_size_in_mb'] / elapsed_time) >= remaining_time:
+                    end_execution(execution, events.time, True)
+                    return
+            queue.popleft()
+            copy_duration, file_copy_time = self._copy_payload(file_durations)
+            result.file_copy_time_in_sec += file_copy_time
+            execution['num_payloads'] += 1
+            execution['copied_size_in_mb'] += payload_size
+            events.schedule(events.time + copy_duration, lambda: next_queued_payload(execution))
+
+        # The execution returns, the Choice state loops back to the Task state while there is work left
+        def end_execution(execution, end_time, has_more_work):
+            set_busy(end_time, -1)
+            duration = end_time - execution['start_time']
+            result.execution_time_in_sec += duration
+            if duration > config.lambda_timeout_in_sec:
+                result.num_timeouts += 1
+            choice_time = end_time + transition()
+            if has_more_work:
+                start_execution(execution['worker_idx'], choice_time + transition(), False)
+            else:
+                # Succeed state
+                result.copy_duration_in_sec = max(result.copy_duration_in_sec, choice_time + transition() - copy_start_time)
+
+        # Orchestrate S3 Copy Work (Task), Copy S3 Files (Parallel / Map)
+        result.num_executions += 1
+        result.num_cold_starts += 1
+        result.helper_execution_time_in_sec += config.cold_start_in_sec + config.orchestrator_duration_in_sec
+        copy_start_time = transition() + config.cold_start_in_sec + config.orchestrator_duration_in_sec + transition()
+        for worker_idx in range(len(payloads_per_worker)):
+            events.schedule(copy_start_time + transition(), lambda worker_idx=worker_idx: start_execution(worker_idx, events.time, True))
+        events.run()
+        # Record Copy Throughput and Complete Multipart Copies (Task) states
+        helpers_time = 0
+        for helper_duration in [0, num_multipart_uploads * config.request_latency_in_sec]:
+            result.num_executions += 1
+            result.num_cold_starts += 1
+            result.helper_execution_time_in_sec += config.cold_start_in_sec + helper_duration
+            helpers_time += transition() + config.cold_start_in_sec + helper_duration
+        result.makespan_in_sec = copy_start_time + result.copy_duration_in_sec + helpers_time
+        return result
+
+    def __repr__(self):
+        return f'CopySimulator({self.config!r})'
@@ -0,0 +1,67 @@
+# ------------------------------------------------------------------------------
+# In-process stand-in for the subset of the boto3 DynamoDB client API used by
+# the Lambda functions: the conditional writes that claim the duplicates of
+# straggler works (see utils/speculation.py). Items live in memory, tables are
+# keyed by a single (hash) attribute.
+# ------------------------------------------------------------------------------
+
+import re
+import threading
+
+from botocore.exceptions import ClientError
+
+_attribute_not_exists = re.compile(r'^attribute_not_exists\((\w+)\)$')
+
+
+def _client_error(code, message, operation_name, status_code=400):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status_code, 'RetryAttempts': 0}
+    }, operation_name)
+
+
+class LocalDynamoDBClient:
+
+    def __init__(self):
+        self.tables = {}
+        self.key_attributes = {}
+        self.lock = threading.Lock()
+        self.request_counts = {}
+
+    def _count(self, operation_name):
+        with self.lock:
+            self.request_counts[operation_name] = self.request_counts.get(operation_name, 0) + 1
+
+    def _table(self, table_name, operation_name):
+        if table_name not in self.tables:
+            raise _client_error('ResourceNotFoundException', 'Requested resource not found', operation_name)
+        return self.tables[table_name]
+
+    def create_table(self, TableName, KeySchema, **kwargs):
+        self.tables.setdefault(TableName, {})
+        self.key_attributes[TableName] = next(key['AttributeName'] for key in KeySchema if key['KeyType'] == 'HASH')
+        return {}
+
+    # ConditionExpression: only 'attribute_not_exists(<attribute>)' (the item does not exist yet)
+    def put_item(self, TableName, Item, ConditionExpression=None, **kwargs):
+        self._count('PutItem')
+        with self.lock:
+            table = self._table(TableName, 'PutItem')
+            key = Item[self.key_attributes[TableName]]['S']
+            if ConditionExpression is not None:
+                match = _attribute_not_exists.match(ConditionExpression)
+                if match is None:
+                    raise ValueError('Local DynamoDB client cannot evaluate condition: {}'.format(ConditionExpression))
+                if key in table and match.group(1) in table[key]:
+                    raise _client_error('ConditionalCheckFailedException', 'The conditional request failed', 'PutItem')
+            table[key] = dict(Item)
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        self._count('GetItem')
+        table = self._table(TableName, 'GetItem')
+        item = table.get(Key[self.key_attributes[TableName]]['S'])
+        return {} if item is None else {'Item': dict(item)}
+
+    def __repr__(self):
+        return f'LocalDynamoDBClient({list(self.tables)!r})'
@@ -0,0 +1,479 @@
+# ------------------------------------------------------------------------------
+# In-process stand-in for the subset of the boto3 S3 client API used by the
+# Lambda functions. Objects live in memory so that listing, planning and copy
+# logic can be exercised offline (tests, benchmarks) without real buckets.
+# Request latency and bandwidth can be injected to mimic S3 response times, and
+# synthetic buckets generate (read-only) listings of millions of objects
+# without holding them in memory. An async counterpart of the client serves the
+# same buckets to coroutines (asyncio copy engine).
+# ------------------------------------------------------------------------------
+
+import asyncio
+import bisect
+import copy
+import datetime
+import hashlib
+import io
+import itertools
+import threading
+import time
+
+from botocore.exceptions import ClientError, ParamValidationError
+
+# Request parameters that the botocore version the Lambda functions are packaged with
+# (lambda-requirements.txt) does not know yet, and rejects before sending the request
+_unsupported_params = {
+    'PutObject': ['IfNoneMatch', 'IfMatch']
+}
+
+
+def _check_params(operation_name, params):
+    for param_name in _unsupported_params.get(operation_name, []):
+        if param_name in params:
+            raise ParamValidationError(report='Unknown parameter in input: "{}"'.format(param_name))
+
+
+def _client_error(code, message, operation_name, status_code=400):
+    return ClientError({
+        'Error': {'Code': code, 'Message': message},
+        'ResponseMetadata': {'HTTPStatusCode': status_code, 'RetryAttempts': 0}
+    }, operation_name)
+
+
+# Request bodies are bytes-like or file-like objects (copied, callers may reuse their buffers)
+def _read_body(body):
+    return body.read() if hasattr(body, 'read') else body
+
+
+class LocalS3Object:
+
+    def __init__(self, body, last_modified=None):
+        self.body = bytes(body)
+        self.etag = '"{}"'.format(hashlib.md5(self.body).hexdigest())
+        self.last_modified = last_modified or datetime.datetime.now(datetime.timezone.utc)
+
+    @property
+    def size(self):
+        return len(self.body)
+
+
+class LocalS3Bucket:
+
+    def __init__(self, name):
+        self.name = name
+        self.objects = {}
+        self.sorted_keys = []
+
+    def put(self, key, s3_object):
+        if key not in self.objects:
+            bisect.insort(self.sorted_keys, key)
+        self.objects[key] = s3_object
+
+    def delete(self, key):
+        if key in self.objects:
+            del self.objects[key]
+            self.sorted_keys.pop(bisect.bisect_left(self.sorted_keys, key))
+
+    def get(self, key):
+        return self.objects.get(key)
+
+    # keys are accessed through their position in the sorted key space (see SyntheticS3Bucket)
+    def num_keys(self):
+        return len(self.sorted_keys)
+
+    def key_at(self, idx):
+        return self.sorted_keys[idx]
+
+    def bisect_left(self, key):
+        return bisect.bisect_left(self.sorted_keys, key)
+
+    def bisect_right(self, key):
+        return bisect.bisect_right(self.sorted_keys, key)
+
+    # A page of ListObjectsV2 results: (contents, common prefixes, is truncated, last key)
+    def list_page(self, prefix, delimiter, max_keys, start_after):
+        idx = self.bisect_right(start_after) if start_after else 0
+        idx = max(idx, self.bisect_left(prefix))
+        num_keys = self.num_keys()
+        contents = []
+        common_prefixes = []
+        last_key = None
+        while idx < num_keys and len(contents) + len(common_prefixes) < max_keys:
+            key = self.key_at(idx)
+            if not key.startswith(prefix):
+                break
+            if delimiter and delimiter in key[len(prefix):]:
+                common_prefix = key[:key.index(delimiter, len(prefix)) + len(delimiter)]
+                common_prefixes.append({'Prefix': common_prefix})
+                # skip every key rolled up into the common prefix
+                last_key = common_prefix + '\U0010ffff'
+                idx = self.bisect_left(last_key)
+                continue
+            s3_object = self.get(key)
+            contents.append({
+                'Key': key,
+                'Size': s3_object.size,
+                'ETag': s3_object.etag,
+                'LastModified': s3_object.last_modified
+            })
+            last_key = key
+            idx += 1
+        is_truncated = idx < num_keys and self.key_at(idx).startswith(prefix)
+        return contents, common_prefixes, is_truncated, last_key
+
+
+class SyntheticS3Object:
+
+    def __init__(self, size, etag, last_modified):
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def body(self):
+        return bytes(self.size)
+
+
+# Read-only bucket whose objects are generated from their position in the key space:
+# '{prefix}{directory:05d}/{idx:09d}.{extension}', keys being sorted like their index.
+# Sizes follow a mix of small images, medium files and large videos (log-uniform within
+# each class), derived from a hash of the index so that listings are reproducible.
+class SyntheticS3Bucket(LocalS3Bucket):
+
+    # (share of objects, extension, min size, max size)
+    default_size_classes = [
+        (0.70, 'jpg', 10 * 1024, 500 * 1024),
+        (0.25, 'zip', 1024 * 1024, 50 * 1024 * 1024),
+        (0.05, 'mp4', 100 * 1024 * 1024, 5 * 1024 * 1024 * 1024)
+    ]
+
+    def __init__(self, name, num_objects, prefix='', objects_per_directory=10000, size_classes=None, seed=0):
+        super().__init__(name)
+        self.num_objects = num_objects
+        self.prefix = prefix
+        self.objects_per_directory = objects_per_directory
+        self.size_classes = size_classes or self.default_size_classes
+        self.seed = seed
+        self.last_modified = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+
+    # uniform value in [0, 1) hashed from the object index (murmur3 finalizer)
+    def _uniform(self, idx, salt):
+        h = (idx * 0x9e3779b1 + self.seed * 0x85ebca77 + salt * 0xc2b2ae3d) & 0xffffffff
+        h = ((h ^ (h >> 16)) * 0x85ebca6b) & 0xffffffff
+        h = ((h ^ (h >> 13)) * 0xc2b2ae35) & 0xffffffff
+        return (h ^ (h >> 16)) / 4294967296
+
+    def _size_class(self, idx):
+        share = self._uniform(idx, 1)
+        for size_class in self.size_classes:
+            share -= size_class[0]
+            if share < 0:
+                return size_class
+        return self.size_classes[-1]
+
+    def key_at(self, idx):
+        return '{}{:05d}/{:09d}.{}'.format(self.prefix, idx // self.objects_per_directory, idx, self._size_class(idx)[1])
+
+    def _index_of(self, key):
+        if not key.startswith(self.prefix):
+            return None
+        directory, _, name = key[len(self.prefix):].partition('/')
+        try:
+            idx = int(name.split('.', 1)[0])
+        except ValueError:
+            return None
+        if 0 <= idx < self.num_objects and self.key_at(idx) == key:
+            return idx
+        return None
+
+    def get(self, key):
+        idx = self._index_of(key)
+        if idx is None:
+            return None
+        _, _, min_size, max_size = self._size_class(idx)
+        size = int(min_size * (max_size / min_size) ** self._uniform(idx, 2))
+        return SyntheticS3Object(size, '"{:032x}"'.format(idx), self.last_modified)
+
+    def num_keys(self):
+        return self.num_objects
+
+    def _bisect(self, key, is_right):
+        low, high = 0, self.num_objects
+        while low < high:
+            mid = (low + high) // 2
+            mid_key = self.key_at(mid)
+            if mid_key < key or (is_right and mid_key == key):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def bisect_left(self, key):
+        return self._bisect(key, False)
+
+    def bisect_right(self, key):
+        return self._bisect(key, True)
+
+    def put(self, key, s3_object):
+        raise _client_error('AccessDenied', 'Synthetic buckets are read-only', 'PutObject', 403)
+
+    def delete(self, key):
+        raise _client_error('AccessDenied', 'Synthetic buckets are read-only', 'DeleteObject', 403)
+
+
+class _LocalPaginator:
+
+    def __init__(self, method, input_token, output_token):
+        self.method = method
+        self.input_token = input_token
+        self.output_token = output_token
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                break
+            kwargs[self.input_token] = page[self.output_token]
+
+
+class LocalS3Client:
+
+    # request_latency_in_sec: time spent by every request, bandwidth_in_mb_per_sec: transfer rate of
+    # the bytes read or written by a request (no limit if None)
+    def __init__(self, max_keys_per_page=1000, request_latency_in_sec=0, bandwidth_in_mb_per_sec=None):
+        self.buckets = {}
+        self.max_keys_per_page = max_keys_per_page
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self.multipart_uploads = {}
+        self.upload_ids = itertools.count(1)
+        self.request_latency_in_sec = request_latency_in_sec
+        self.bandwidth_in_mb_per_sec = bandwidth_in_mb_per_sec
+
+    def _count(self, operation_name):
+        with self.lock:
+            self.request_counts[operation_name] = self.request_counts.get(operation_name, 0) + 1
+        if self.request_latency_in_sec > 0:
+            time.sleep(self.request_latency_in_sec)
+
+    def _transfer(self, num_bytes):
+        if self.bandwidth_in_mb_per_sec:
+            time.sleep(num_bytes / (self.bandwidth_in_mb_per_sec * 1024 * 1024))
+
+    def _bucket(self, bucket_name, operation_name):
+        if bucket_name not in self.buckets:
+            raise _client_error('NoSuchBucket', 'The specified bucket does not exist', operation_name, 404)
+        return self.buckets[bucket_name]
+
+    def create_bucket(self, Bucket, **kwargs):
+        self.buckets.setdefault(Bucket, LocalS3Bucket(Bucket))
+        return {}
+
+    # Adds a read-only bucket of num_objects generated objects (see SyntheticS3Bucket)
+    def create_synthetic_bucket(self, Bucket, num_objects, **kwargs):
+        self.buckets[Bucket] = SyntheticS3Bucket(Bucket, num_objects, **kwargs)
+        return {}
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        _check_params('PutObject', kwargs)
+        self._count('PutObject')
+        s3_object = LocalS3Object(_read_body(Body))
+        self._transfer(s3_object.size)
+        with self.lock:
+            self._bucket(Bucket, 'PutObject').put(Key, s3_object)
+        return {'ETag': s3_object.etag}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._count('HeadObject')
+        s3_object = self._bucket(Bucket, 'HeadObject').get(Key)
+        if s3_object is None:
+            raise _client_error('404', 'Not Found', 'HeadObject', 404)
+        return {
+            'ContentLength': s3_object.size,
+            'ETag': s3_object.etag,
+            'LastModified': s3_object.last_modified,
+            'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0}
+        }
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self._count('GetObject')
+        s3_object = self._bucket(Bucket, 'GetObject').get(Key)
+        if s3_object is None:
+            raise _client_error('NoSuchKey', 'The specified key does not exist', 'GetObject', 404)
+        body = s3_object.body
+        response = {}
+        if Range:
+            first_byte, last_byte = Range.replace('bytes=', '').split('-')
+            body = body[int(first_byte):int(last_byte) + 1 if last_byte else None]
+            response['ContentRange'] = 'bytes {}-{}/{}'.format(first_byte, int(first_byte) + len(body) - 1, s3_object.size)
+        self._transfer(len(body))
+        response.update({
+            'Body': io.BytesIO(body),
+            'ContentLength': len(body),
+            'ETag': s3_object.etag,
+            'LastModified': s3_object.last_modified,
+            'ResponseMetadata': {'HTTPStatusCode': 206 if Range else 200, 'RetryAttempts': 0}
+        })
+        return response
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._count('DeleteObject')
+        with self.lock:
+            self._bucket(Bucket, 'DeleteObject').delete(Key)
+        return {'ResponseMetadata': {'HTTPStatusCode': 204, 'RetryAttempts': 0}}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        self._count('DeleteObjects')
+        if len(Delete['Objects']) > 1000:
+            raise _client_error('MalformedXML', 'The XML you provided was not well-formed', 'DeleteObjects')
+        bucket = self._bucket(Bucket, 'DeleteObjects')
+        with self.lock:
+            for s3_object in Delete['Objects']:
+                bucket.delete(s3_object['Key'])
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': 0}}
+        if not Delete.get('Quiet', False):
+            response['Deleted'] = [{'Key': s3_object['Key']} for s3_object in Delete['Objects']]
+        return response
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, Callback=None, SourceClient=None, Config=None):
+        self._count('CopyObject')
+        source_bucket = self._bucket(CopySource['Bucket'], 'CopyObject')
+        source_object = source_bucket.get(CopySource['Key'])
+        if source_object is None:
+            raise _client_error('404', 'Not Found', 'HeadObject', 404)
+        self._transfer(source_object.size)
+        with self.lock:
+            self._bucket(Bucket, 'CopyObject').put(Key, LocalS3Object(source_object.body))
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        self.copy(CopySource, Bucket, Key)
+        return {'CopyObjectResult': {'ETag': self.buckets[Bucket].get(Key).etag}}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, MaxKeys=None, ContinuationToken=None, StartAfter=None, **kwargs):
+        self._count('ListObjectsV2')
+        bucket = self._bucket(Bucket, 'ListObjectsV2')
+        max_keys = min(MaxKeys or self.max_keys_per_page, self.max_keys_per_page)
+        start_after = ContinuationToken or StartAfter or ''
+        with self.lock:
+            contents, common_prefixes, is_truncated, last_key = bucket.list_page(Prefix, Delimiter, max_keys, start_after)
+        page = {'Name': Bucket, 'Prefix': Prefix, 'KeyCount': len(contents) + len(common_prefixes), 'IsTruncated': is_truncated}
+        if contents:
+            page['Contents'] = contents
+        if common_prefixes:
+            page['CommonPrefixes'] = common_prefixes
+        if is_truncated:
+            page['NextContinuationToken'] = last_key
+        return page
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._count('CreateMultipartUpload')
+        self._bucket(Bucket, 'CreateMultipartUpload')
+        with self.lock:
+            upload_id = 'upload-{}'.format(next(self.upload_ids))
+            self.multipart_uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def _multipart_upload(self, Bucket, Key, UploadId, operation_name):
+        multipart_upload = self.multipart_uploads.get(UploadId)
+        if multipart_upload is None or multipart_upload['Bucket'] != Bucket or multipart_upload['Key'] != Key:
+            raise _client_error('NoSuchUpload', 'The specified upload does not exist', operation_name, 404)
+        return multipart_upload
+
+    def upload_part_copy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange=None, **kwargs):
+        self._count('UploadPartCopy')
+        multipart_upload = self._multipart_upload(Bucket, Key, UploadId, 'UploadPartCopy')
+        source_object = self._bucket(CopySource['Bucket'], 'UploadPartCopy').get(CopySource['Key'])
+        if source_object is None:
+            raise _client_error('NoSuchKey', 'The specified key does not exist', 'UploadPartCopy', 404)
+        body = source_object.body
+        if CopySourceRange:
+            first_byte, last_byte = CopySourceRange.replace('bytes=', '').split('-')
+            body = body[int(first_byte):int(last_byte) + 1]
+        self._transfer(len(body))
+        part = LocalS3Object(body)
+        with self.lock:
+            multipart_upload['Parts'][PartNumber] = part
+        return {'CopyPartResult': {'ETag': part.etag, 'LastModified': part.last_modified}}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body=b'', **kwargs):
+        self._count('UploadPart')
+        multipart_upload = self._multipart_upload(Bucket, Key, UploadId, 'UploadPart')
+        part = LocalS3Object(_read_body(Body))
+        self._transfer(part.size)
+        with self.lock:
+            multipart_upload['Parts'][PartNumber] = part
+        return {'ETag': part.etag}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0, MaxParts=1000, **kwargs):
+        self._count('ListParts')
+        multipart_upload = self._multipart_upload(Bucket, Key, UploadId, 'ListParts')
+        part_numbers = sorted(part_number for part_number in multipart_upload['Parts'] if part_number > PartNumberMarker)
+        page_part_numbers = part_numbers[:min(MaxParts, self.max_keys_per_page)]
+        page = {
+            'Parts': [{'PartNumber': part_number, 'ETag': multipart_upload['Parts'][part_number].etag,
+                       'Size': multipart_upload['Parts'][part_number].size} for part_number in page_part_numbers],
+            'IsTruncated': len(page_part_numbers) < len(part_numbers)
+        }
+        if page['IsTruncated']:
+            page['NextPartNumberMarker'] = page_part_numbers[-1]
+        return page
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        self._count('CompleteMultipartUpload')
+        multipart_upload = self._multipart_upload(Bucket, Key, UploadId, 'CompleteMultipartUpload')
+        body = bytearray()
+        for part in MultipartUpload['Parts']:
+            uploaded_part = multipart_upload['Parts'].get(part['PartNumber'])
+            if uploaded_part is None or uploaded_part.etag != part['ETag']:
+                raise _client_error('InvalidPart', 'One or more of the specified parts could not be found', 'CompleteMultipartUpload')
+            body.extend(uploaded_part.body)
+        s3_object = LocalS3Object(body)
+        with self.lock:
+            self._bucket(Bucket, 'CompleteMultipartUpload').put(Key, s3_object)
+            del self.multipart_uploads[UploadId]
+        return {'Bucket': Bucket, 'Key': Key, 'ETag': s3_object.etag}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self._count('AbortMultipartUpload')
+        self._multipart_upload(Bucket, Key, UploadId, 'AbortMultipartUpload')
+        with self.lock:
+            del self.multipart_uploads[UploadId]
+        return {}
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'list_objects_v2':
+            return _LocalPaginator(self.list_objects_v2, 'ContinuationToken', 'NextContinuationToken')
+        if operation_name == 'list_parts':
+            return _LocalPaginator(self.list_parts, 'PartNumberMarker', 'NextPartNumberMarker')
+        raise ValueError('Local S3 client cannot paginate operation: {}'.format(operation_name))
+
+    # Async counterpart of the client, serving the same buckets (see AsyncLocalS3Client)
+    def async_client(self):
+        return AsyncLocalS3Client(self)
+
+    def __repr__(self):
+        return f'LocalS3Client({list(self.buckets)!r})'
+
+
+# Coroutine version of a local S3 client (its requests are awaited, as with aiobotocore) sharing
+# its buckets and request counts. The injected request latency is awaited rather than slept, so
+# concurrent requests overlap on a single thread (bandwidth is not injected).
+class AsyncLocalS3Client:
+
+    def __init__(self, s3_client):
+        self.request_latency_in_sec = s3_client.request_latency_in_sec
+        self.s3_client = copy.copy(s3_client)
+        self.s3_client.request_latency_in_sec = 0
+        self.s3_client.bandwidth_in_mb_per_sec = None
+
+    def __getattr__(self, name):
+        method = getattr(self.s3_client, name)
+        async def request(**kwargs):
+            if self.request_latency_in_sec > 0:
+                await asyncio.sleep(self.request_latency_in_sec)
+            return method(**kwargs)
+        return request
+
+    def __repr__(self):
+        return f'AsyncLocalS3Client({self.s3_client!r})'
@@ -0,0 +1,213 @@
+# ------------------------------------------------------------------------------
+# Durable progress journal of a copy job, so that an execution that failed
+# partway (eg, a worker timed out) can be re-run without copying (or checking)
+# again the files that were already done. Copies are identified by a job_id
+# (s3_copy_config) shared by the executions of the same job. Workers append a
+# record per completed file and flush them, a batch at a time, as a new
+# immutable journal segment (gzipped JSON lines): a segment is written at once
+# (a single PUT, or a rename for local files) so it is either complete or
+# missing, and concurrent workers never write the same segment. When re-run,
+# the orchestrator reads all the segments of the job and drops the completed
+# files from the plan (moves of completed files whose source is still there
+# only delete the source).
+# Segments are kept in an S3 bucket (JournalS3Bucket) or in a local directory
+# (JournalLocalPath, for tests and offline runs).
+# ------------------------------------------------------------------------------
+
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from utils.s3_listing import list_s3_objects, iterate_concurrently, default_listing_concurrency
+from utils.s3_clients import get_s3_client_for_bucket
+
+logger = logging.getLogger()
+journal_format_version = 1
+journal_segment_suffix = '.journal.gz'
+default_journal_s3_path = 'journal/'
+# records per segment, and max time (in secs) records wait before being flushed
+default_flush_size = 1000
+default_flush_interval_in_sec = 30
+
+
+class S3JournalStore:
+
+    def __init__(self, s3_client, s3_bucket, s3_path=default_journal_s3_path):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_path = s3_path
+
+    def _job_s3_path(self, job_id):
+        return '{}{}/'.format(self.s3_path, job_id)
+
+    def put_segment(self, job_id, segment_name, body):
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=self._job_s3_path(job_id) + segment_name, Body=body)
+
+    def list_segments(self, job_id):
+        job_s3_path = self._job_s3_path(job_id)
+        return [s3_object['Key'][len(job_s3_path):] for s3_object in list_s3_objects(self.s3_client, self.s3_bucket, job_s3_path)
+                if s3_object['Key'].endswith(journal_segment_suffix)]
+
+    def get_segment(self, job_id, segment_name):
+        return self.s3_client.get_object(Bucket=self.s3_bucket, Key=self._job_s3_path(job_id) + segment_name)['Body'].read()
+
+    def __repr__(self):
+        return f'S3JournalStore({self.s3_bucket!r}, {self.s3_path!r})'
+
+
+class LocalJournalStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _job_directory(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    # written into a temp file renamed once complete, so readers never see a partial segment
+    def put_segment(self, job_id, segment_name, body):
+        job_directory = self._job_directory(job_id)
+        os.makedirs(job_directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=job_directory, prefix='.', delete=False) as segment_file:
+            segment_file.write(body)
+        os.replace(segment_file.name, os.path.join(job_directory, segment_name))
+
+    def list_segments(self, job_id):
+        job_directory = self._job_directory(job_id)
+        if not os.path.isdir(job_directory):
+            return []
+        return sorted(name for name in os.listdir(job_directory) if name.endswith(journal_segment_suffix))
+
+    def get_segment(self, job_id, segment_name):
+        with open(os.path.join(self._job_directory(job_id), segment_name), 'rb') as segment_file:
+            return segment_file.read()
+
+    def __repr__(self):
+        return f'LocalJournalStore({self.directory!r})'
+
+
+# Journal store configured for the function (None if jobs are not journaled)
+def get_journal_store(s3_client):
+    if os.environ.get('JournalS3Bucket'):
+        journal_s3_bucket = os.environ['JournalS3Bucket']
+        journal_s3_path = os.environ['JournalS3Path'] if 'JournalS3Path' in os.environ else default_journal_s3_path
+        return S3JournalStore(get_s3_client_for_bucket(journal_s3_bucket, s3_client), journal_s3_bucket, journal_s3_path)
+    if os.environ.get('JournalLocalPath'):
+        return LocalJournalStore(os.environ['JournalLocalPath'])
+    return None
+
+
+def encode_segment(records):
+    lines = [json.dumps({'version': journal_format_version, 'num_records': len(records)})]
+    lines.extend(json.dumps(record, separators=(',', ':')) for record in records)
+    return gzip.compress('\n'.join(lines).encode('utf-8'))
+
+
+def decode_segment(body):
+    lines = gzip.decompress(body).decode('utf-8').split('\n')
+    header = json.loads(lines[0])
+    if header['version'] != journal_format_version:
+        raise ValueError('Unsupported journal format version: {}'.format(header['version']))
+    records = [json.loads(line) for line in lines[1:] if line]
+    if len(records) != header['num_records']:
+        raise ValueError('Corrupted journal segment: {} records out of {}'.format(len(records), header['num_records']))
+    return records
+
+
+class ProgressJournal:
+
+    def __init__(self, store, job_id, writer_id, flush_size=default_flush_size, flush_interval_in_sec=default_flush_interval_in_sec):
+        self.store = store
+        self.job_id = job_id
+        self.writer_id = writer_id
+        self.flush_size = flush_size
+        self.flush_interval_in_sec = flush_interval_in_sec
+        self.records = []
+        self.num_records = 0
+        self.num_segments = 0
+        self.last_flush_time = time.time()
+        self.lock = threading.Lock()
+
+    # Records a completed file (payload file dict), called concurrently by the copy threads. The
+    # pending records are swapped out under the lock and written after releasing it, so other
+    # threads keep recording while a segment is written.
+    def record(self, file):
+        with self.lock:
+            self.records.append([file['source_s3_bucket'], file['source_s3_path'], file['target_s3_bucket'], file['target_s3_path'], file['file_size_in_mb']])
+            if len(self.records) < self.flush_size and time.time() - self.last_flush_time < self.flush_interval_in_sec:
+                return
+            records = self._take_records()
+        self._write_segment(records)
+
+    def flush(self):
+        with self.lock:
+            records = self._take_records()
+        self._write_segment(records)
+
+    def _take_records(self):
+        self.last_flush_time = time.time()
+        records = self.records
+        self.records = []
+        return records
+
+    def _write_segment(self, records):
+        if not records:
+            return
+        segment_name = '{}-{}{}'.format(self.writer_id, uuid.uuid4().hex, journal_segment_suffix)
+        try:
+            self.store.put_segment(self.job_id, segment_name, encode_segment(records))
+        except Exception:
+            # kept for the next flush
+            with self.lock:
+                self.records = records + self.records
+            raise
+        with self.lock:
+            self.num_records += len(records)
+            self.num_segments += 1
+
+    def __repr__(self):
+        return f'ProgressJournal({self.store!r}, {self.job_id!r}, {self.writer_id!r})'
+
+
+def new_progress_journal(s3_client, job_id, writer_id):
+    if not job_id:
+        return None
+    store = get_journal_store(s3_client)
+    return ProgressJournal(store, job_id, writer_id) if store is not None else None
+
+
+# Files completed by previous executions of a job, by (source bucket, source path, target bucket, target path)
+class S3CompletedFiles:
+
+    def __init__(self, records=()):
+        self.file_sizes = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size_in_mb = record
+        self.file_sizes[(source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path)] = file_size_in_mb
+
+    # Whether the file was completed (and has not changed size since)
+    def is_completed(self, source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size_in_mb):
+        completed_file_size_in_mb = self.file_sizes.get((source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path))
+        return completed_file_size_in_mb is not None and abs(completed_file_size_in_mb - file_size_in_mb) < 1e-9
+
+    def __len__(self):
+        return len(self.file_sizes)
+
+    def __repr__(self):
+        return f'S3CompletedFiles({len(self.file_sizes)!r} files)'
+
+
+def load_completed_files(store, job_id, max_workers=default_listing_concurrency):
+    segment_names = store.list_segments(job_id)
+    completed_files = S3CompletedFiles()
+    for record in iterate_concurrently([lambda segment_name=segment_name: [decode_segment(store.get_segment(job_id, segment_name))]
+                                        for segment_name in segment_names], max_workers):
+        completed_files.add(record)
+    logger.info('Read {} completed files of job \'{}\' from {} journal segments'.format(len(completed_files), job_id, len(segment_names)))
+    return completed_files
@@ -0,0 +1,245 @@
+# ------------------------------------------------------------------------------
+# Coroutine counterparts of the S3 operations of utils/s3_utils.py, used by the
+# 'asyncio' copy engine (see utils/async_copy_engine.py). Requests are sent by
+# aiobotocore clients on the event loop of the execution, so hundreds of them
+# can be in flight on a single thread: payloads of many small files, whose copy
+# time is mostly request latency, are no longer bound by the number of copy
+# threads. Files larger than a CopyObject allows are copied with concurrent
+# UploadPartCopy requests. aiobotocore is optional (eg, from a Lambda layer).
+# ------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import time
+from botocore.exceptions import ClientError
+from utils.s3_metrics import get_metrics_recorder, instrument_s3_client
+from utils.s3_clients import get_bucket_region, new_s3_client_config_options
+from utils.s3_utils import S3DeleteBatcher, MAX_DELETE_BATCH_SIZE, is_not_found_error
+
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+except ImportError:
+    get_session = None
+
+logger = logging.getLogger()
+A_MB = 1024 * 1024
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * A_MB  # larger files need a multipart copy
+multipart_copy_part_size = 512 * A_MB
+
+
+# Async S3 clients of an execution (clients are bound to its event loop), one per bucket region.
+# s3_client: default (sync) client, used to look up bucket regions. Clients of the local S3
+# stand-in provide their own async counterpart (async_client) serving every bucket.
+class S3AsyncClients:
+
+    def __init__(self, s3_client):
+        self.s3_client = s3_client
+        self.client_contexts = []
+        self.clients = {}
+        self.bucket_regions = {}
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    # Closes the aiobotocore clients in the reverse order they were created (no AsyncExitStack, which
+    # needs Python 3.7+)
+    async def __aexit__(self, *exc_info):
+        while self.client_contexts:
+            await self.client_contexts.pop().__aexit__(None, None, None)
+
+    async def _new_client(self, region_name):
+        if hasattr(self.s3_client, 'async_client'):
+            return self.s3_client.async_client()
+        if get_session is None:
+            raise ValueError('The asyncio copy engine requires aiobotocore, which is not installed')
+        client_context = get_session().create_client('s3', region_name=region_name, config=AioConfig(**new_s3_client_config_options()))
+        s3_client = await client_context.__aenter__()
+        self.client_contexts.append(client_context)
+        return instrument_s3_client(s3_client)
+
+    # The region of a bucket may take a (blocking) GetBucketLocation request: it is looked up on
+    # the default executor, not on the event loop
+    async def region_for(self, s3_bucket):
+        if hasattr(self.s3_client, 'async_client'):
+            return None
+        if s3_bucket not in self.bucket_regions:
+            self.bucket_regions[s3_bucket] = await asyncio.get_event_loop().run_in_executor(None, get_bucket_region, s3_bucket, self.s3_client)
+        return self.bucket_regions[s3_bucket]
+
+    async def client_for(self, s3_bucket):
+        region_name = await self.region_for(s3_bucket)
+        if region_name not in self.clients:
+            async with self.lock:
+                if region_name not in self.clients:
+                    self.clients[region_name] = await self._new_client(region_name)
+        return self.clients[region_name]
+
+    def __repr__(self):
+        return f'S3AsyncClients({list(self.clients)!r})'
+
+
+async def get_s3_file_size(s3_clients, s3_location):
+    start_time = time.time()
+    try:
+        s3_client = await s3_clients.client_for(s3_location['bucket'])
+        response = await s3_client.head_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+        get_metrics_recorder().record('HeadObject', time.time() - start_time)
+        if 'DeleteMarker' in response and response['DeleteMarker']:
+            return -1
+        return response['ContentLength']
+    except Exception as e:
+        # a missing file is an expected outcome, not an error
+        get_metrics_recorder().record('HeadObject', time.time() - start_time, error=not is_not_found_error(e))
+        return -1
+
+
+# file_size: size of the copied file in bytes, files larger than a CopyObject allows are copied in parts
+async def s3_copy(s3_clients, source_s3_location, target_s3_location, file_size=0):
+    if file_size > MAX_COPY_OBJECT_SIZE:
+        await s3_multipart_copy(s3_clients, source_s3_location, target_s3_location, file_size)
+        return
+    copy_source = {
+        'Bucket': source_s3_location['bucket'],
+        'Key': source_s3_location['key']
+    }
+    logger.debug('Copying S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
+        source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    s3_client = await s3_clients.client_for(target_s3_location['bucket'])
+    with get_metrics_recorder().measure('CopyObject', file_size):
+        await s3_client.copy_object(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'], CopySource=copy_source)
+
+
+# Copies a byte range (eg, 'bytes=0-1048575') of the source file as one part of a multipart upload
+async def s3_copy_part(s3_clients, source_s3_location, target_s3_location, upload_id, part_number, byte_range):
+    copy_source = {
+        'Bucket': source_s3_location['bucket'],
+        'Key': source_s3_location['key']
+    }
+    logger.debug('Copying part {} ({}) of S3 file s3://{}/{} into s3://{}/{}'.format(part_number, byte_range,
+        source_s3_location['bucket'], source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    first_byte, last_byte = byte_range.replace('bytes=', '').split('-')
+    s3_client = await s3_clients.client_for(target_s3_location['bucket'])
+    with get_metrics_recorder().measure('UploadPartCopy', int(last_byte) - int(first_byte) + 1):
+        response = await s3_client.upload_part_copy(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'],
+            UploadId=upload_id, PartNumber=part_number, CopySource=copy_source, CopySourceRange=byte_range)
+    return response['CopyPartResult']['ETag']
+
+
+# Copies a whole file with a multipart upload whose parts are copied concurrently
+async def s3_multipart_copy(s3_clients, source_s3_location, target_s3_location, file_size):
+    s3_client = await s3_clients.client_for(target_s3_location['bucket'])
+    upload_id = (await s3_client.create_multipart_upload(Bucket=target_s3_location['bucket'], Key=target_s3_location['key']))['UploadId']
+    part_copies = [asyncio.ensure_future(s3_copy_part(s3_clients, source_s3_location, target_s3_location, upload_id, part_idx + 1,
+                                                      'bytes={}-{}'.format(first_byte, min(first_byte + multipart_copy_part_size, file_size) - 1)))
+                   for part_idx, first_byte in enumerate(range(0, file_size, multipart_copy_part_size))]
+    try:
+        etags = await asyncio.gather(*part_copies)
+        with get_metrics_recorder().measure('CompleteMultipartUpload'):
+            await s3_client.complete_multipart_upload(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'], UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': part_idx + 1, 'ETag': etag} for part_idx, etag in enumerate(etags)]})
+    except Exception:
+        # a part failed, the parts still in flight are dropped
+        for part_copy in part_copies:
+            part_copy.cancel()
+        logger.warning('Aborting the multipart copy of S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
+            source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+        await s3_client.abort_multipart_upload(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'], UploadId=upload_id)
+        raise
+
+
+# Copy if file not in destination (source and target are checked concurrently)
+async def s3_copy_if_not_in_destination(s3_clients, source_s3_location, target_s3_location):
+    src_file_size, trg_file_size = await asyncio.gather(get_s3_file_size(s3_clients, source_s3_location),
+                                                        get_s3_file_size(s3_clients, target_s3_location))
+    file_copied = False
+    # file exists in source
+    if src_file_size >= 0:
+        # files differ, trigger the copy
+        if src_file_size != trg_file_size:
+            await s3_copy(s3_clients, source_s3_location, target_s3_location, src_file_size)
+            file_copied = True
+    else:
+        raise Exception('File {}/{} does not exist and cannot be copied to {}/{}'.format(
+            source_s3_location['bucket'], source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    return file_copied
+
+
+async def s3_delete(s3_clients, s3_location):
+    logger.debug('Deleting S3 file s3://{}/{}'.format(s3_location['bucket'], s3_location['key']))
+    s3_client = await s3_clients.client_for(s3_location['bucket'])
+    with get_metrics_recorder().measure('DeleteObject'):
+        await s3_client.delete_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+
+
+# Batched deletes (DeleteObjects) of the files deleted by coroutines: add and flush are coroutines,
+# a full batch is deleted by the coroutine that filled it
+class S3AsyncDeleteBatcher(S3DeleteBatcher):
+
+    def __init__(self, s3_clients, batch_size=MAX_DELETE_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.s3_clients = s3_clients
+
+    async def add(self, s3_location):
+        keys = self.pending_keys.setdefault(s3_location['bucket'], [])
+        keys.append(s3_location['key'])
+        if len(keys) >= self.batch_size:
+            await self._delete_batch(s3_location['bucket'], self.pending_keys.pop(s3_location['bucket']))
+
+    async def flush(self):
+        pending_keys = self.pending_keys
+        self.pending_keys = {}
+        await asyncio.gather(*[self._delete_batch(s3_bucket, keys) for s3_bucket, keys in pending_keys.items()])
+
+    async def _delete_batch(self, s3_bucket, keys):
+        logger.debug('Deleting {} S3 files from s3://{}'.format(len(keys), s3_bucket))
+        start_time = time.time()
+        try:
+            s3_client = await self.s3_clients.client_for(s3_bucket)
+            response = await s3_client.delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+            errors = {(s3_bucket, error['Key']): '{}: {}'.format(error.get('Code'), error.get('Message')) for error in response.get('Errors', [])}
+        except Exception as e:
+            errors = {(s3_bucket, key): str(e) for key in keys}
+        get_metrics_recorder().record('DeleteObjects', time.time() - start_time, error=len(errors) == len(keys))
+        if errors:
+            logger.warning('Failed to delete {} out of {} S3 files from s3://{}'.format(len(errors), len(keys), s3_bucket))
+        self.errors.update(errors)
+        self.num_deleted += len(keys) - len(errors)
+
+    def __repr__(self):
+        return f'S3AsyncDeleteBatcher({self.batch_size!r}, {self.num_deleted!r}, {len(self.errors)!r})'
+
+
+# The source file is deleted right away or, given a delete batcher, queued for a batched delete
+async def s3_delete_now_or_later(s3_clients, s3_location, delete_batcher=None):
+    if delete_batcher is not None:
+        await delete_batcher.add(s3_location)
+    else:
+        await s3_delete(s3_clients, s3_location)
+
+
+async def s3_move_if_not_in_destination(s3_clients, source_s3_location, target_s3_location, delete_batcher=None):
+    src_file_size, trg_file_size = await asyncio.gather(get_s3_file_size(s3_clients, source_s3_location),
+                                                        get_s3_file_size(s3_clients, target_s3_location))
+    file_moved = False
+    # file exists in source
+    if src_file_size >= 0:
+        # file not in target or files differ, trigger the copy
+        if src_file_size != trg_file_size:
+            try:
+                await s3_copy(s3_clients, source_s3_location, target_s3_location, src_file_size)
+            except ClientError as e:
+                # moved by another runner of the file in the meantime (see utils/s3_utils.py)
+                if not is_not_found_error(e) or await get_s3_file_size(s3_clients, target_s3_location) != src_file_size:
+                    raise
+                logger.info('S3 file s3://{}/{} was moved by another runner'.format(target_s3_location['bucket'], target_s3_location['key']))
+                return False
+            file_moved = True
+        # delete from source in either case (only reached once the copy succeeded)
+        await s3_delete_now_or_later(s3_clients, source_s3_location, delete_batcher)
+    # trying to move a file that neither exist in the source nor the target
+    elif trg_file_size == -1:
+        raise Exception('File {}/{} does not exist and cannot be moved to {}/{}'.format(
+            source_s3_location['bucket'], source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    return file_moved
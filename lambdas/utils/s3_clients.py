@@ -0,0 +1,150 @@
+# ------------------------------------------------------------------------------
+# Factory of the S3 clients shared by the Lambda functions. Clients are cached
+# per region for the life of the container and configured for many concurrent
+# requests: connection pool sized for the copy concurrency, explicit timeouts
+# and adaptive retries (client-side rate limiting on throttling). Requests on
+# a bucket are sent to a client of the bucket's region (memoized) so that
+# cross-region buckets do not pay a redirect per request.
+# Buckets of other accounts can be given a role to assume (S3BucketRoleArns),
+# their requests are then sent with the credentials of that role.
+# All settings can be overridden with environment variables. boto3 is imported
+# and clients are created on first use (LazyS3Client), not when the Lambda
+# functions are imported, to keep their cold starts short.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from utils.s3_metrics import instrument_s3_client
+from utils.s3_rate_control import track_s3_throttles
+
+logger = logging.getLogger()
+default_max_pool_connections = 64  # copy concurrency (8) x transfer concurrency (4) plus headroom
+default_connect_timeout_in_sec = 5
+default_read_timeout_in_sec = 60
+default_retry_mode = 'adaptive'
+default_max_attempts = 10
+assumed_role_session_name = 's3-serverless-parallel-copy'
+# assumed role credentials are renewed when they expire within this time
+assumed_role_renewal_margin_in_sec = 600
+
+_s3_clients = {}
+_bucket_regions = {}
+_bucket_role_arns = None
+# (region, role ARN) -> (client, expiration time of the role credentials)
+_assumed_role_s3_clients = {}
+_lock = threading.Lock()
+
+
+# Options of the S3 client config (also used by the async clients, see utils/s3_async_utils.py)
+def new_s3_client_config_options():
+    config_options = {
+        'max_pool_connections': int(os.environ['S3MaxPoolConnections']) if 'S3MaxPoolConnections' in os.environ else default_max_pool_connections,
+        'connect_timeout': float(os.environ['S3ConnectTimeoutInSec']) if 'S3ConnectTimeoutInSec' in os.environ else default_connect_timeout_in_sec,
+        'read_timeout': float(os.environ['S3ReadTimeoutInSec']) if 'S3ReadTimeoutInSec' in os.environ else default_read_timeout_in_sec,
+        'retries': {
+            'mode': os.environ['S3RetryMode'] if 'S3RetryMode' in os.environ else default_retry_mode,
+            'max_attempts': int(os.environ['S3MaxAttempts']) if 'S3MaxAttempts' in os.environ else default_max_attempts
+        }
+    }
+    return config_options
+
+
+def new_s3_client_config():
+    from botocore.config import Config
+    return Config(**new_s3_client_config_options())
+
+
+# Cached S3 client of a region (None: the region of the Lambda function)
+def get_s3_client(region_name=None):
+    with _lock:
+        if region_name not in _s3_clients:
+            import boto3
+            s3_client = boto3.client('s3', region_name=region_name, config=new_s3_client_config())
+            _s3_clients[region_name] = track_s3_throttles(instrument_s3_client(s3_client))
+        return _s3_clients[region_name]
+
+
+# Cached S3 client of a region with the credentials of an assumed role
+def get_s3_client_for_role(role_arn, region_name=None):
+    with _lock:
+        s3_client, expiration_time = _assumed_role_s3_clients.get((region_name, role_arn), (None, 0))
+        if expiration_time - time.time() < assumed_role_renewal_margin_in_sec:
+            import boto3
+            credentials = boto3.client('sts').assume_role(RoleArn=role_arn, RoleSessionName=assumed_role_session_name)['Credentials']
+            s3_client = boto3.client('s3', region_name=region_name, config=new_s3_client_config(), aws_access_key_id=credentials['AccessKeyId'],
+                aws_secret_access_key=credentials['SecretAccessKey'], aws_session_token=credentials['SessionToken'])
+            s3_client = track_s3_throttles(instrument_s3_client(s3_client))
+            _assumed_role_s3_clients[(region_name, role_arn)] = (s3_client, credentials['Expiration'].timestamp())
+        return s3_client
+
+
+# S3 client of a region created on first use: stands for the client at module level without
+# importing boto3 and creating the client when the module is imported
+class LazyS3Client:
+
+    def __init__(self, region_name=None):
+        self.region_name = region_name
+        self._s3_client = None
+
+    def get(self):
+        if self._s3_client is None:
+            self._s3_client = get_s3_client(self.region_name)
+        return self._s3_client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __repr__(self):
+        return f'LazyS3Client({self.region_name!r})'
+
+
+# Roles to assume per bucket (S3BucketRoleArns: JSON object of bucket name -> role ARN)
+def get_bucket_role_arns():
+    global _bucket_role_arns
+    if _bucket_role_arns is None:
+        _bucket_role_arns = json.loads(os.environ.get('S3BucketRoleArns') or '{}')
+    return _bucket_role_arns
+
+
+def _lookup_bucket_region(s3_client, s3_bucket):
+    try:
+        response = s3_client.head_bucket(Bucket=s3_bucket)
+    except ClientError as e:
+        # redirects and access errors still tell the bucket region
+        response = e.response
+    region_name = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('x-amz-bucket-region')
+    if region_name is None:
+        region_name = s3_client.get_bucket_location(Bucket=s3_bucket).get('LocationConstraint') or 'us-east-1'
+    return region_name
+
+
+# Region of a bucket, looked up once per container
+def get_bucket_region(s3_bucket, s3_client=None):
+    if s3_bucket not in _bucket_regions:
+        region_name = _lookup_bucket_region(s3_client or get_s3_client(), s3_bucket)
+        with _lock:
+            _bucket_regions[s3_bucket] = region_name
+    return _bucket_regions[s3_bucket]
+
+
+# Client to send the requests on a bucket to: the default client unless the bucket is in another
+# region or has a role to assume. Clients that are not bound to a region (eg, the local S3
+# stand-in) serve every bucket.
+def get_s3_client_for_bucket(s3_bucket, default_s3_client=None):
+    default_s3_client = default_s3_client or get_s3_client()
+    default_region_name = getattr(getattr(default_s3_client, 'meta', None), 'region_name', None)
+    if default_region_name is None:
+        return default_s3_client
+    region_name = get_bucket_region(s3_bucket, default_s3_client)
+    role_arn = get_bucket_role_arns().get(s3_bucket)
+    if role_arn:
+        return get_s3_client_for_role(role_arn, region_name)
+    if region_name == default_region_name:
+        return default_s3_client
+    return get_s3_client(region_name)
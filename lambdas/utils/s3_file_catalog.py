@@ -0,0 +1,118 @@
+# ------------------------------------------------------------------------------
+# Compact catalog of the files planned by the orchestrator. At millions of
+# files, one object (and dict) per file no longer fits the orchestrator's
+# memory, so files are stored as rows of typed arrays instead:
+# - locations: (source bucket, source prefix, target bucket, target prefix)
+#   interned once and referenced by index, since routed files share a few of them
+# - keys: the key relative to the prefixes (source path = source prefix + key,
+#   target path = target prefix + key), UTF-8 encoded into one shared buffer and
+#   referenced by offsets
+# - sizes (in MB) and sync actions (interned) per file
+# Multipart copy parts are rows too, their upload details are kept in a dict
+# since only a few large files are split. The orchestrator plans on row
+# indexes and only builds file dicts when emitting the works.
+# ------------------------------------------------------------------------------
+
+from array import array
+
+
+class _Interner:
+
+    def __init__(self, values=()):
+        self.values = []
+        self.indexes = {}
+        for value in values:
+            self.intern(value)
+
+    def intern(self, value):
+        idx = self.indexes.get(value)
+        if idx is None:
+            idx = self.indexes[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+
+def _common_suffix_length(source_s3_path, target_s3_path):
+    max_length = min(len(source_s3_path), len(target_s3_path))
+    length = 0
+    while length < max_length and source_s3_path[-1 - length] == target_s3_path[-1 - length]:
+        length += 1
+    return length
+
+
+class S3FileCatalog:
+
+    def __init__(self):
+        self.locations = _Interner()
+        self.sync_actions = _Interner([None])
+        self.file_locations = array('I')
+        self.key_offsets = array('Q', [0])
+        self.key_buffer = bytearray()
+        self.file_sizes = array('d')
+        self.file_sync_actions = array('B')
+        # row index -> (upload_id, part_number, byte_range)
+        self.parts = {}
+
+    def __len__(self):
+        return len(self.file_sizes)
+
+    # Adds a file whose source and target paths share the relative key, returns its row index
+    def add(self, source_s3_bucket, source_s3_prefix, target_s3_bucket, target_s3_prefix, relative_key, file_size, sync_action=None):
+        self.file_locations.append(self.locations.intern((source_s3_bucket, source_s3_prefix, target_s3_bucket, target_s3_prefix)))
+        self.key_buffer += relative_key.encode('utf-8')
+        self.key_offsets.append(len(self.key_buffer))
+        self.file_sizes.append(file_size)
+        self.file_sync_actions.append(self.sync_actions.intern(sync_action))
+        return len(self.file_sizes) - 1
+
+    # Adds a file given its full source and target paths
+    def add_file(self, source_s3_bucket, source_s3_path, target_s3_bucket, target_s3_path, file_size, sync_action=None):
+        suffix_length = _common_suffix_length(source_s3_path, target_s3_path)
+        return self.add(source_s3_bucket, source_s3_path[:len(source_s3_path) - suffix_length], target_s3_bucket,
+            target_s3_path[:len(target_s3_path) - suffix_length], source_s3_path[len(source_s3_path) - suffix_length:], file_size, sync_action)
+
+    # Adds a multipart copy part (byte range) of the file at file_idx
+    def add_part(self, file_idx, file_size, upload_id, part_number, byte_range):
+        source_s3_bucket, source_s3_prefix, target_s3_bucket, target_s3_prefix = self.locations.values[self.file_locations[file_idx]]
+        part_idx = self.add(source_s3_bucket, source_s3_prefix, target_s3_bucket, target_s3_prefix, self.relative_key(file_idx), file_size)
+        self.parts[part_idx] = (upload_id, part_number, byte_range)
+        return part_idx
+
+    def relative_key(self, idx):
+        return self.key_buffer[self.key_offsets[idx]:self.key_offsets[idx + 1]].decode('utf-8')
+
+    def source_s3_bucket(self, idx):
+        return self.locations.values[self.file_locations[idx]][0]
+
+    def target_s3_bucket(self, idx):
+        return self.locations.values[self.file_locations[idx]][2]
+
+    def sync_action(self, idx):
+        return self.sync_actions.values[self.file_sync_actions[idx]]
+
+    # Payload file of the works (as read by the workers)
+    def file_to_json(self, idx):
+        source_s3_bucket, source_s3_prefix, target_s3_bucket, target_s3_prefix = self.locations.values[self.file_locations[idx]]
+        key_offsets = self.key_offsets
+        relative_key = self.key_buffer[key_offsets[idx]:key_offsets[idx + 1]].decode('utf-8')
+        file_dict = {
+            'source_s3_bucket': source_s3_bucket,
+            'source_s3_path': source_s3_prefix + relative_key,
+            'target_s3_bucket': target_s3_bucket,
+            'target_s3_path': target_s3_prefix + relative_key,
+            'file_size_in_mb': self.file_sizes[idx]
+        }
+        sync_action_idx = self.file_sync_actions[idx]
+        if sync_action_idx:
+            file_dict['sync_action'] = self.sync_actions.values[sync_action_idx]
+        if self.parts and idx in self.parts:
+            file_dict['upload_id'], file_dict['part_number'], file_dict['byte_range'] = self.parts[idx]
+        return file_dict
+
+    # Approximate memory (in bytes) held by the catalog
+    def get_size_in_bytes(self):
+        return sum(column.itemsize * len(column) for column in [self.file_locations, self.key_offsets, self.file_sizes, self.file_sync_actions]) \
+            + len(self.key_buffer)
+
+    def __repr__(self):
+        return f'S3FileCatalog({len(self)!r} files, {len(self.locations.values)!r} locations)'
@@ -0,0 +1,155 @@
+# ------------------------------------------------------------------------------
+# S3 Inventory as the source of the files to copy. Listing a bucket of hundreds
+# of millions of keys takes a LIST request per 1,000 keys, whereas S3 Inventory
+# delivers the same listing as a few data files (CSV.gz, ORC or Parquet) once a
+# day or week. The inventory manifest (manifest.json) tells the format, the
+# columns and the data files, which are parsed concurrently as streams: each
+# data file yields its rows as pages of S3 objects (same fields as a
+# ListObjectsV2 listing) filtered by prefix, so rows are never all held in
+# memory. CSV keys are URL-encoded, ORC and Parquet keys are not. ORC and
+# Parquet data files need pyarrow (optional) and are spooled to a temp file
+# since their footers are read first.
+# ------------------------------------------------------------------------------
+
+import csv
+import datetime
+import gzip
+import io
+import json
+import logging
+import shutil
+import tempfile
+from urllib.parse import unquote_plus
+from utils.s3_listing import iterate_concurrently, default_listing_concurrency
+
+try:
+    import pyarrow.orc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger()
+inventory_valid_formats = ['CSV', 'ORC', 'Parquet']
+default_page_size = 1000
+# inventory fields used to plan the copy, by CSV field (fileSchema) and by ORC/Parquet column
+csv_inventory_fields = {'Key': 'key', 'Size': 'size', 'LastModifiedDate': 'last_modified', 'ETag': 'etag',
+                        'IsLatest': 'is_latest', 'IsDeleteMarker': 'is_delete_marker'}
+columnar_inventory_fields = {'key': 'key', 'size': 'size', 'last_modified_date': 'last_modified', 'e_tag': 'etag',
+                             'is_latest': 'is_latest', 'is_delete_marker': 'is_delete_marker'}
+
+
+def read_inventory_manifest(s3_client, s3_bucket, s3_path):
+    manifest = json.loads(s3_client.get_object(Bucket=s3_bucket, Key=s3_path)['Body'].read())
+    if manifest.get('fileFormat') not in inventory_valid_formats:
+        raise ValueError('Invalid S3 Inventory format: {}. Expecting one of {}.'.format(manifest.get('fileFormat'), inventory_valid_formats))
+    if manifest['fileFormat'] != 'CSV' and pyarrow is None:
+        raise ValueError('S3 Inventory format {} requires pyarrow, which is not installed'.format(manifest['fileFormat']))
+    return manifest
+
+
+# Bucket the data files of the inventory are delivered to (eg, 'arn:aws:s3:::inventory-bucket')
+def get_inventory_data_s3_bucket(manifest):
+    return manifest['destinationBucket'].rsplit(':', 1)[-1]
+
+
+def _parse_last_modified(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value / 1000, datetime.timezone.utc)
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
+
+
+def _is_true(value):
+    return value is True or value == 'true'
+
+
+# Turns an inventory row (dict of inventory fields) into a listed S3 object, None if it is not the
+# current version of an object under the prefix
+def _to_s3_object(row, s3_prefix):
+    if not row['key'].startswith(s3_prefix):
+        return None
+    if _is_true(row.get('is_delete_marker')) or row.get('is_latest') in (False, 'false'):
+        return None
+    s3_object = {'Key': row['key'], 'Size': int(row.get('size') or 0), 'LastModified': _parse_last_modified(row.get('last_modified'))}
+    if row.get('etag'):
+        # listings return quoted ETags
+        s3_object['ETag'] = row['etag'] if row['etag'].startswith('"') else '"{}"'.format(row['etag'])
+    return s3_object
+
+
+def _iterate_csv_rows(data_file, field_names):
+    with gzip.GzipFile(fileobj=data_file) as gzip_file:
+        for values in csv.reader(io.TextIOWrapper(gzip_file, encoding='utf-8', newline='')):
+            row = {field_name: value for field_name, value in zip(field_names, values) if field_name is not None}
+            row['key'] = unquote_plus(row['key'])
+            yield row
+
+
+def _iterate_columnar_rows(record_batches, column_names):
+    for record_batch in record_batches:
+        columns = record_batch.to_pydict()
+        field_names = [columnar_inventory_fields[column_name] for column_name in column_names if column_name in columns]
+        for values in zip(*(columns[column_name] for column_name in column_names if column_name in columns)):
+            yield dict(zip(field_names, values))
+
+
+def _iterate_orc_record_batches(data_file, column_names):
+    orc_file = pyarrow.orc.ORCFile(data_file)
+    columns = [column_name for column_name in column_names if column_name in orc_file.schema.names]
+    for stripe_idx in range(orc_file.nstripes):
+        yield orc_file.read_stripe(stripe_idx, columns=columns)
+
+
+def _iterate_parquet_record_batches(data_file, column_names, batch_size=default_page_size):
+    parquet_file = pyarrow.parquet.ParquetFile(data_file)
+    columns = [column_name for column_name in column_names if column_name in parquet_file.schema_arrow.names]
+    yield from parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+
+
+# Pages of the S3 objects under s3_prefix found in an inventory data file
+def list_inventory_data_file(s3_client, manifest, data_file_key, s3_prefix='', page_size=default_page_size):
+    response = s3_client.get_object(Bucket=get_inventory_data_s3_bucket(manifest), Key=data_file_key)
+    if manifest['fileFormat'] == 'CSV':
+        field_names = [csv_inventory_fields.get(field_name.strip()) for field_name in manifest['fileSchema'].split(',')]
+        rows = _iterate_csv_rows(response['Body'], field_names)
+        yield from _paginate(rows, s3_prefix, page_size)
+        return
+    column_names = list(columnar_inventory_fields)
+    with tempfile.TemporaryFile() as data_file:
+        shutil.copyfileobj(response['Body'], data_file)
+        data_file.seek(0)
+        if manifest['fileFormat'] == 'ORC':
+            record_batches = _iterate_orc_record_batches(data_file, column_names)
+        else:
+            record_batches = _iterate_parquet_record_batches(data_file, column_names, page_size)
+        yield from _paginate(_iterate_columnar_rows(record_batches, column_names), s3_prefix, page_size)
+
+
+def _paginate(rows, s3_prefix, page_size):
+    page = []
+    for row in rows:
+        s3_object = _to_s3_object(row, s3_prefix)
+        if s3_object is not None:
+            page.append(s3_object)
+            if len(page) >= page_size:
+                yield page
+                page = []
+    if page:
+        yield page
+
+
+# Yields the S3 objects of the source bucket under s3_prefix listed by an S3 Inventory, data
+# files are parsed concurrently
+def list_s3_objects_from_inventory(s3_client, manifest_s3_bucket, manifest_s3_path, s3_bucket, s3_prefix='',
+        max_workers=default_listing_concurrency):
+    manifest = read_inventory_manifest(s3_client, manifest_s3_bucket, manifest_s3_path)
+    if manifest.get('sourceBucket') != s3_bucket:
+        raise ValueError('S3 Inventory s3://{}/{} lists bucket {}, not {}'.format(manifest_s3_bucket, manifest_s3_path, manifest.get('sourceBucket'), s3_bucket))
+    logger.info('Reading {} S3 Inventory data files ({}) of s3://{}/{}'.format(len(manifest['files']), manifest['fileFormat'], s3_bucket, s3_prefix))
+    yield from iterate_concurrently(
+        [lambda data_file=data_file: list_inventory_data_file(s3_client, manifest, data_file['key'], s3_prefix) for data_file in manifest['files']],
+        max_workers
+    )
@@ -0,0 +1,175 @@
+# ------------------------------------------------------------------------------
+# Helpers to list the S3 objects under a bucket/path. Listing is paginated
+# (ListObjectsV2) so there is no limit on the number of keys, and the key space
+# can be sharded by common prefixes, or by key ranges where it is flat, so that
+# shards are listed concurrently by a pool of threads. Objects are yielded as
+# pages arrive rather than collected.
+# Several sources (bucket/paths) can also be listed at once.
+# ------------------------------------------------------------------------------
+
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+logger = logging.getLogger()
+default_listing_concurrency = 8
+default_batch_size = 1000
+_end_of_shard = object()
+# first characters of the key ranges a flat key space is split into
+key_range_split_chars = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def list_s3_objects(s3_client, s3_bucket, s3_path):
+    for page in list_s3_pages(s3_client, s3_bucket, s3_path):
+        yield from page
+
+
+def list_s3_pages(s3_client, s3_bucket, s3_path):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3_bucket, Prefix=s3_path):
+        # empty prefixes come back without a 'Contents' entry
+        contents = page.get('Contents', [])
+        if contents:
+            yield contents
+
+
+# Part of the key space of a listing: every key under prefix or, for a key range, only the keys
+# under prefix after start_after up to end_key (included). Key ranges are listed without a
+# delimiter, keys of every level at once.
+class S3KeyRange:
+
+    def __init__(self, prefix, start_after=None, end_key=None):
+        self.prefix = prefix
+        self.start_after = start_after
+        self.end_key = end_key
+
+    def list_pages(self, s3_client, s3_bucket):
+        if self.start_after is None:
+            yield from list_s3_pages(s3_client, s3_bucket, self.prefix)
+            return
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=self.prefix, StartAfter=self.start_after):
+            contents = page.get('Contents', [])
+            if self.end_key is not None and contents and contents[-1]['Key'] > self.end_key:
+                contents = [s3_object for s3_object in contents if s3_object['Key'] <= self.end_key]
+                if contents:
+                    yield contents
+                return
+            if contents:
+                yield contents
+
+    def __repr__(self):
+        return f'S3KeyRange({self.prefix!r}, {self.start_after!r}, {self.end_key!r})'
+
+
+# Splits the keys under prefix after start_after into ranges starting at each of the split
+# characters (eg, 'prefix/0', 'prefix/1', ...), listed concurrently
+def split_s3_key_range(prefix, start_after):
+    boundaries = [boundary for boundary in (prefix + split_char for split_char in key_range_split_chars) if boundary > start_after]
+    return [S3KeyRange(prefix, range_start, range_end)
+            for range_start, range_end in zip([start_after] + boundaries, boundaries + [None])]
+
+
+# Lists the first page of s3_path, and of the common prefixes found down to shard_depth levels,
+# with a delimiter. Yields the pages of objects found on the way and appends to shards the parts
+# of the key space left to list: the common prefixes below shard_depth, and key ranges for the
+# levels of more than a page (eg, a flat key space) rather than listing them page after page.
+def find_s3_shards(s3_client, s3_bucket, s3_path, shards, delimiter='/', shard_depth=1):
+    prefixes = [s3_path]
+    for _ in range(shard_depth):
+        next_prefixes = []
+        for prefix in prefixes:
+            page = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix=prefix, Delimiter=delimiter)
+            contents = page.get('Contents', [])
+            common_prefixes = [common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])]
+            if contents:
+                yield contents
+            next_prefixes.extend(common_prefixes)
+            if page.get('IsTruncated'):
+                # resume after the last key of the page, or past every key rolled up into its last common prefix
+                last_keys = [contents[-1]['Key']] if contents else []
+                last_keys += [common_prefixes[-1] + '\U0010ffff'] if common_prefixes else []
+                shards.extend(split_s3_key_range(prefix, max(last_keys)))
+        prefixes = next_prefixes
+        if not prefixes:
+            break
+    shards.extend(S3KeyRange(prefix) for prefix in prefixes)
+
+
+def iterate_concurrently(page_iterator_factories, max_workers=default_listing_concurrency, max_queued_pages=64):
+    # Runs every page iterator factory in a thread pool and yields the items of
+    # each page in arrival order. The bounded queue provides back pressure so
+    # producers never get far ahead of the consumer.
+    if not page_iterator_factories:
+        return
+    pages = queue.Queue(maxsize=max_queued_pages)
+    stopped = threading.Event()
+
+    def _put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(page_iterator_factory):
+        try:
+            for page in page_iterator_factory():
+                if not _put(page):
+                    return
+            _put(_end_of_shard)
+        except Exception as e:
+            _put(e)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(page_iterator_factories)))
+    try:
+        for page_iterator_factory in page_iterator_factories:
+            executor.submit(_produce, page_iterator_factory)
+        pending_shards = len(page_iterator_factories)
+        while pending_shards > 0:
+            page = pages.get()
+            if page is _end_of_shard:
+                pending_shards -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield from page
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
+
+
+def list_s3_objects_sharded(s3_client, s3_bucket, s3_path, delimiter='/', shard_depth=1,
+        max_workers=default_listing_concurrency):
+    shards = []
+    for page in find_s3_shards(s3_client, s3_bucket, s3_path, shards, delimiter, shard_depth):
+        yield from page
+    logger.info('Listing s3://{}/{} using {} shards'.format(s3_bucket, s3_path, len(shards)))
+    yield from iterate_concurrently(
+        [lambda shard=shard: shard.list_pages(s3_client, s3_bucket) for shard in shards],
+        max_workers
+    )
+
+
+def _iterate_batches(source_idx, s3_objects, batch_size):
+    s3_objects = iter(s3_objects)
+    while True:
+        batch = list(islice(s3_objects, batch_size))
+        if not batch:
+            return
+        # a page of a single item: the batch and the source it comes from
+        yield [(source_idx, batch)]
+
+
+# Lists several sources at once, given a listing factory per source (eg, list_s3_objects_sharded
+# of each source bucket/path). Yields (source index, batch of objects) in arrival order.
+def list_s3_sources_concurrently(listing_factories, max_workers=default_listing_concurrency, batch_size=default_batch_size):
+    yield from iterate_concurrently(
+        [lambda source_idx=source_idx, listing_factory=listing_factory: _iterate_batches(source_idx, listing_factory(), batch_size)
+         for source_idx, listing_factory in enumerate(listing_factories)],
+        max_workers
+    )
@@ -0,0 +1,132 @@
+# ------------------------------------------------------------------------------
+# Compact work manifests. Instead of passing every file of a work through the
+# Step Functions state (limited to 256KB), the orchestrator writes one manifest
+# object per work to S3 and the state only carries a reference to it and the
+# byte range of each payload within it. Each payload is stored as a separate
+# gzip block holding the payload files in columnar form where S3 buckets and
+# paths ('directories') are dictionary-encoded, so that workers can read just
+# the block of the payload they are processing (ranged GET).
+# ------------------------------------------------------------------------------
+
+import gzip
+import json
+import logging
+
+logger = logging.getLogger()
+manifest_format_version = 1
+# optional file attributes, stored as sparse columns (row index -> value)
+sparse_file_attributes = ['sync_action', 'upload_id', 'part_number', 'byte_range']
+
+
+class _DictionaryEncoder:
+
+    def __init__(self):
+        self.values = []
+        self.indexes = {}
+
+    def encode(self, value):
+        idx = self.indexes.get(value)
+        if idx is None:
+            idx = self.indexes[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+
+def _split_s3_path(s3_path):
+    separator_idx = s3_path.rfind('/') + 1
+    return s3_path[:separator_idx], s3_path[separator_idx:]
+
+
+# payload_files: any iterable of file dicts
+def encode_payload_files(payload_files):
+    buckets = _DictionaryEncoder()
+    directories = _DictionaryEncoder()
+    columns = {
+        'source_bucket': [], 'source_directory': [], 'source_name': [],
+        'target_bucket': [], 'target_directory': [], 'target_name': [],
+        'file_size_in_mb': []
+    }
+    sparse_columns = {}
+    num_files = 0
+    for row, file in enumerate(payload_files):
+        num_files += 1
+        source_directory, source_name = _split_s3_path(file['source_s3_path'])
+        target_directory, target_name = _split_s3_path(file['target_s3_path'])
+        columns['source_bucket'].append(buckets.encode(file['source_s3_bucket']))
+        columns['source_directory'].append(directories.encode(source_directory))
+        columns['source_name'].append(source_name)
+        columns['target_bucket'].append(buckets.encode(file['target_s3_bucket']))
+        columns['target_directory'].append(directories.encode(target_directory))
+        # most files keep their name, only store it when it differs
+        columns['target_name'].append(None if target_name == source_name else target_name)
+        columns['file_size_in_mb'].append(file['file_size_in_mb'])
+        for attribute in sparse_file_attributes:
+            if attribute in file:
+                sparse_columns.setdefault(attribute, {})[row] = file[attribute]
+    block = {
+        'version': manifest_format_version,
+        'num_files': num_files,
+        'buckets': buckets.values,
+        'directories': directories.values,
+        'columns': columns,
+        'sparse_columns': sparse_columns
+    }
+    return gzip.compress(json.dumps(block, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_payload_files(block_bytes):
+    block = json.loads(gzip.decompress(block_bytes).decode('utf-8'))
+    if block['version'] != manifest_format_version:
+        raise ValueError('Unsupported manifest format version: {}'.format(block['version']))
+    buckets = block['buckets']
+    directories = block['directories']
+    columns = block['columns']
+    sparse_columns = {attribute: {int(row): value for row, value in values.items()} for attribute, values in block['sparse_columns'].items()}
+    payload_files = []
+    for row in range(block['num_files']):
+        source_name = columns['source_name'][row]
+        file = {
+            'source_s3_bucket': buckets[columns['source_bucket'][row]],
+            'source_s3_path': directories[columns['source_directory'][row]] + source_name,
+            'target_s3_bucket': buckets[columns['target_bucket'][row]],
+            'target_s3_path': directories[columns['target_directory'][row]] + (columns['target_name'][row] or source_name),
+            'file_size_in_mb': columns['file_size_in_mb'][row]
+        }
+        for attribute, values in sparse_columns.items():
+            if row in values:
+                file[attribute] = values[row]
+        payload_files.append(file)
+    return payload_files
+
+
+class S3ManifestWriter:
+
+    def __init__(self, s3_client, s3_bucket, s3_path):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_path = s3_path
+
+    # Writes the manifest of a work (list of payloads, each a list of file dicts) and returns
+    # its reference along with the byte range ([offset, length]) of each payload block
+    def write_work(self, work_id, work_payloads_files):
+        blocks = [encode_payload_files(payload_files) for payload_files in work_payloads_files]
+        payload_ranges = []
+        offset = 0
+        for block in blocks:
+            payload_ranges.append([offset, len(block)])
+            offset += len(block)
+        manifest_s3_path = '{}{}.manifest'.format(self.s3_path, work_id)
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=manifest_s3_path, Body=b''.join(blocks))
+        logger.info('Wrote manifest of work \'{}\' ({} payloads, {} bytes) into s3://{}/{}'.format(
+            work_id, len(blocks), offset, self.s3_bucket, manifest_s3_path))
+        return {'s3_bucket': self.s3_bucket, 's3_path': manifest_s3_path}, payload_ranges
+
+    def __repr__(self):
+        return f'S3ManifestWriter({self.s3_bucket!r}, {self.s3_path!r})'
+
+
+def read_manifest_payload_files(s3_client, manifest, payload_range):
+    offset, length = payload_range
+    response = s3_client.get_object(Bucket=manifest['s3_bucket'], Key=manifest['s3_path'],
+        Range='bytes={}-{}'.format(offset, offset + length - 1))
+    return decode_payload_files(response['Body'].read())
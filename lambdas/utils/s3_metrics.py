@@ -0,0 +1,180 @@
+# ------------------------------------------------------------------------------
+# Telemetry of the S3 requests made by a worker execution. Latency, bytes and
+# errors are recorded per S3 operation (HeadObject, CopyObject, ...) and kept
+# as aggregates only, so that the cost of instrumenting a file does not depend
+# on the size of the payload. Retries and throttled attempts are counted by a
+# hook on the boto3 client events, since managed copies (s3.copy) do not return
+# the responses of the requests they make. At the end of an execution metrics
+# are emitted as a single CloudWatch Embedded Metric Format (EMF) record and
+# merged into the work result.
+# ------------------------------------------------------------------------------
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+A_MB = 1024 * 1024
+metrics_namespace = 'S3ServerlessParallelCopy'
+throttling_error_codes = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', '503'}
+
+
+def is_throttling_error(error_code):
+    return error_code in throttling_error_codes
+
+
+class S3OperationStats:
+
+    def __init__(self):
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_throttles = 0
+        self.num_retries = 0
+        self.total_latency_in_sec = 0.0
+        self.max_latency_in_sec = 0.0
+        self.num_bytes = 0
+
+    def record(self, latency_in_sec, num_bytes=0, error=False):
+        self.num_requests += 1
+        self.total_latency_in_sec += latency_in_sec
+        self.max_latency_in_sec = max(self.max_latency_in_sec, latency_in_sec)
+        self.num_bytes += num_bytes
+        self.num_errors += 1 if error else 0
+
+    def to_json(self):
+        return {
+            'num_requests': self.num_requests,
+            'num_errors': self.num_errors,
+            'num_throttles': self.num_throttles,
+            'num_retries': self.num_retries,
+            'total_latency_in_sec': self.total_latency_in_sec,
+            'max_latency_in_sec': self.max_latency_in_sec,
+            'size_in_mb': self.num_bytes / A_MB
+        }
+
+    def __repr__(self):
+        return f'S3OperationStats({self.num_requests!r}, {self.total_latency_in_sec!r}, {self.num_bytes!r})'
+
+
+class S3MetricsRecorder:
+
+    def __init__(self):
+        self.operations = {}
+        self.lock = threading.Lock()
+
+    def _stats(self, operation_name):
+        if operation_name not in self.operations:
+            self.operations[operation_name] = S3OperationStats()
+        return self.operations[operation_name]
+
+    def record(self, operation_name, latency_in_sec, num_bytes=0, error=False):
+        with self.lock:
+            self._stats(operation_name).record(latency_in_sec, num_bytes, error)
+
+    def record_retries(self, operation_name, num_retries):
+        with self.lock:
+            self._stats(operation_name).num_retries += num_retries
+
+    def record_throttle(self, operation_name):
+        with self.lock:
+            self._stats(operation_name).num_throttles += 1
+
+    # Times the S3 request(s) made within the block (throttled attempts are counted by the client
+    # hook, see instrument_s3_client), eg:
+    # with metrics.measure('CopyObject', num_bytes):
+    #     s3.copy(...)
+    @contextmanager
+    def measure(self, operation_name, num_bytes=0):
+        start_time = time.time()
+        try:
+            yield
+        except Exception:
+            self.record(operation_name, time.time() - start_time, 0, error=True)
+            raise
+        self.record(operation_name, time.time() - start_time, num_bytes)
+
+    def to_json(self):
+        with self.lock:
+            return {operation_name: stats.to_json() for operation_name, stats in self.operations.items()}
+
+    # Single-line CloudWatch EMF record, one metric per operation and statistic (eg, CopyObjectLatency)
+    def to_emf(self, dimensions, properties=None):
+        metrics = []
+        values = {}
+        for operation_name, stats in sorted(self.to_json().items()):
+            operation_metrics = [
+                ('Requests', stats['num_requests'], 'Count'),
+                ('Errors', stats['num_errors'], 'Count'),
+                ('Throttles', stats['num_throttles'], 'Count'),
+                ('Retries', stats['num_retries'], 'Count'),
+                ('Latency', 1000 * stats['total_latency_in_sec'] / max(stats['num_requests'], 1), 'Milliseconds'),
+                ('MaxLatency', 1000 * stats['max_latency_in_sec'], 'Milliseconds')
+            ]
+            if stats['size_in_mb'] > 0 and stats['total_latency_in_sec'] > 0:
+                operation_metrics.append(('Throughput', stats['size_in_mb'] / stats['total_latency_in_sec'], 'Megabytes/Second'))
+            for metric_name, value, unit in operation_metrics:
+                values[operation_name + metric_name] = value
+                metrics.append({'Name': operation_name + metric_name, 'Unit': unit})
+        record = dict(properties or {})
+        record.update(dimensions)
+        record.update(values)
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': metrics_namespace, 'Dimensions': [sorted(dimensions)], 'Metrics': metrics}]
+        }
+        return json.dumps(record, separators=(',', ':'), default=str)
+
+    def __repr__(self):
+        return f'S3MetricsRecorder({sorted(self.operations)!r})'
+
+
+# Sums the metrics of an execution into the metrics accumulated by previous executions
+def merge_metrics(accumulated_metrics, metrics):
+    merged_metrics = {operation_name: dict(stats) for operation_name, stats in (accumulated_metrics or {}).items()}
+    for operation_name, stats in metrics.items():
+        if operation_name not in merged_metrics:
+            merged_metrics[operation_name] = dict(stats)
+            continue
+        for stat_name, value in stats.items():
+            if stat_name == 'max_latency_in_sec':
+                merged_metrics[operation_name][stat_name] = max(merged_metrics[operation_name].get(stat_name, 0), value)
+            else:
+                merged_metrics[operation_name][stat_name] = merged_metrics[operation_name].get(stat_name, 0) + value
+    return merged_metrics
+
+
+_metrics_recorder = S3MetricsRecorder()
+
+
+def get_metrics_recorder():
+    return _metrics_recorder
+
+
+# Starts recording the metrics of a new (Lambda) execution
+def reset_metrics_recorder():
+    global _metrics_recorder
+    _metrics_recorder = S3MetricsRecorder()
+    return _metrics_recorder
+
+
+def _on_after_call(model=None, parsed=None, **kwargs):
+    num_retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    if num_retries and model is not None:
+        get_metrics_recorder().record_retries(model.name, num_retries)
+
+
+def _on_needs_retry(operation=None, response=None, **kwargs):
+    if response is not None and operation is not None:
+        error_code = response[1].get('Error', {}).get('Code')
+        if is_throttling_error(error_code) or response[1].get('ResponseMetadata', {}).get('HTTPStatusCode') == 503:
+            get_metrics_recorder().record_throttle(operation.name)
+
+
+# Counts the retries and throttled attempts of the requests made by a boto3 S3 client
+# (clients without boto3 events, eg the local S3 stand-in, are left as they are)
+def instrument_s3_client(s3_client):
+    events = getattr(getattr(s3_client, 'meta', None), 'events', None)
+    if events is not None:
+        events.register('after-call.s3', _on_after_call)
+        events.register('needs-retry.s3', _on_needs_retry)
+    return s3_client
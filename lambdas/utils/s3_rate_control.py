@@ -0,0 +1,264 @@
+# ------------------------------------------------------------------------------
+# Adaptive (AIMD) control of the S3 requests made by a worker. S3 scales its
+# request rate per prefix and answers with SlowDown (503) while a hot prefix
+# is being scaled up; retrying at the same pace only makes throughput collapse.
+# A controller per bucket and prefix (the 'directory' of the key) caps the
+# requests in flight and, once throttled, paces their start times. Throttling
+# cuts both the in-flight limit and the request rate (multiplicative decrease),
+# every request that succeeds raises them again a little (additive increase),
+# so the request rate settles just below the throttling point. Only requests
+# started after the last decrease can trigger another one, so a burst of
+# throttled requests counts once. Throttles are seen both by the client hook
+# (throttled attempts retried by botocore) and by the controlled request itself
+# (retries exhausted). Controllers are kept for the life of the container, so
+# warm executions start from the rate learnt by the previous ones.
+# ------------------------------------------------------------------------------
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from botocore.exceptions import ClientError
+from utils.s3_metrics import is_throttling_error
+from utils.copy_engine import default_copy_concurrency
+
+logger = logging.getLogger()
+default_decrease_factor = 0.5
+default_rate_increase_per_sec = 5  # requests/sec gained per second without throttles
+default_min_rate_per_sec = 1
+# S3 supports 3,500 PUT/COPY/POST/DELETE requests per second per prefix, no pacing above it
+default_max_rate_per_sec = 3500
+rate_window_in_sec = 5
+max_reported_prefixes = 10
+
+
+def is_throttling_response(response):
+    return is_throttling_error(response.get('Error', {}).get('Code')) or \
+        response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 503
+
+
+def get_key_prefix(s3_key):
+    return s3_key[:s3_key.rfind('/') + 1]
+
+
+class S3RateController:
+
+    def __init__(self, max_concurrency, decrease_factor=default_decrease_factor, rate_increase_per_sec=default_rate_increase_per_sec):
+        assert max_concurrency > 0 and 0 < decrease_factor < 1
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.rate_increase_per_sec = rate_increase_per_sec
+        self.concurrency_limit = float(max_concurrency)
+        # requests are not paced until throttled
+        self.rate_limit_per_sec = None
+        self.in_flight = 0
+        self.next_start_time = 0
+        self.last_decrease_time = 0
+        self.start_times = deque()
+        self.condition = threading.Condition()
+        self.reset_counters()
+
+    # Counters are kept per execution, limits are kept across executions
+    def reset_counters(self):
+        with self.condition:
+            self.counters_start_time = time.time()
+            self.num_requests = 0
+            self.num_throttles = 0
+            self.num_decreases = 0
+
+    @property
+    def is_throttled(self):
+        return self.rate_limit_per_sec is not None or self.concurrency_limit < self.max_concurrency
+
+    def _trim_start_times(self, now):
+        while self.start_times and self.start_times[0] < now - rate_window_in_sec:
+            self.start_times.popleft()
+
+    # Rate at which requests were started over the last few seconds
+    def _observed_rate_per_sec(self, now):
+        self._trim_start_times(now)
+        if not self.start_times:
+            return default_min_rate_per_sec
+        return len(self.start_times) / max(min(now - self.start_times[0], rate_window_in_sec), 1)
+
+    # Waits for num_requests in-flight slots (requests sent at once, eg the parts of a managed copy)
+    # and for the paced start time, returns the request start time. Requests that take more slots
+    # than the limit allows are started alone.
+    def acquire(self, num_requests=1):
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + num_requests > int(self.concurrency_limit):
+                self.condition.wait()
+            self.in_flight += num_requests
+            now = time.time()
+            start_time = now
+            if self.rate_limit_per_sec is not None:
+                start_time = max(now, self.next_start_time)
+                self.next_start_time = start_time + num_requests / self.rate_limit_per_sec
+            self._trim_start_times(now)
+            self.start_times.extend([start_time] * num_requests)
+        if start_time > now:
+            time.sleep(start_time - now)
+        return start_time
+
+    def release(self, start_time, throttled=False, num_requests=1):
+        with self.condition:
+            self.in_flight -= num_requests
+            self.num_requests += num_requests
+            if throttled:
+                self._decrease(start_time)
+            else:
+                for _ in range(num_requests):
+                    self._increase()
+            self.condition.notify_all()
+
+    # Throttling signal of a request started at start_time
+    def on_throttle(self, start_time):
+        with self.condition:
+            self._decrease(start_time)
+
+    def _decrease(self, start_time):
+        self.num_throttles += 1
+        if start_time < self.last_decrease_time:
+            return
+        now = time.time()
+        rate_limit_per_sec = self._observed_rate_per_sec(now) * self.decrease_factor
+        if self.rate_limit_per_sec is not None:
+            rate_limit_per_sec = min(rate_limit_per_sec, self.rate_limit_per_sec * self.decrease_factor)
+        self.rate_limit_per_sec = max(rate_limit_per_sec, default_min_rate_per_sec)
+        self.concurrency_limit = max(self.concurrency_limit * self.decrease_factor, 1)
+        self.last_decrease_time = now
+        self.num_decreases += 1
+        logger.warning('S3 throttled requests, slowing down to {:.1f} requests/sec ({} in flight)'.format(
+            self.rate_limit_per_sec, int(self.concurrency_limit)))
+
+    # One more request in flight per round of requests, rate_increase_per_sec more requests per second
+    def _increase(self):
+        self.concurrency_limit = min(self.concurrency_limit + 1 / self.concurrency_limit, self.max_concurrency)
+        if self.rate_limit_per_sec is not None:
+            self.rate_limit_per_sec += self.rate_increase_per_sec / self.rate_limit_per_sec
+            if self.rate_limit_per_sec >= default_max_rate_per_sec:
+                self.rate_limit_per_sec = None
+
+    @contextmanager
+    def request(self, num_requests=1):
+        start_time = self.acquire(num_requests)
+        throttled = False
+        try:
+            yield
+        except ClientError as e:
+            throttled = is_throttling_response(e.response)
+            raise
+        finally:
+            self.release(start_time, throttled, num_requests)
+
+    def to_json(self):
+        with self.condition:
+            elapsed_time = time.time() - self.counters_start_time
+            return {
+                'concurrency_limit': int(self.concurrency_limit),
+                'rate_limit_per_sec': self.rate_limit_per_sec,
+                # effective rate the requests settled on
+                'request_rate_per_sec': self.num_requests / elapsed_time if elapsed_time > 0 else 0,
+                'num_requests': self.num_requests,
+                'num_throttles': self.num_throttles,
+                'num_decreases': self.num_decreases
+            }
+
+    def __repr__(self):
+        return f'S3RateController({self.max_concurrency!r}, {self.concurrency_limit!r}, {self.rate_limit_per_sec!r})'
+
+
+# Rate controllers of the buckets and prefixes a worker sends requests to
+class S3RateControllers:
+
+    def __init__(self, max_concurrency, enabled=True):
+        self.max_concurrency = max_concurrency
+        self.enabled = enabled
+        self.controllers = {}
+        self.lock = threading.Lock()
+
+    def get(self, s3_bucket, s3_key):
+        controller_key = (s3_bucket, get_key_prefix(s3_key))
+        with self.lock:
+            if controller_key not in self.controllers:
+                self.controllers[controller_key] = S3RateController(self.max_concurrency)
+            return self.controllers[controller_key]
+
+    # Controls the S3 request(s) made within the block on the key's prefix, num_requests being the
+    # number of requests the block keeps in flight, eg:
+    # with rate_controllers.request(bucket, key):
+    #     s3.delete_object(...)
+    @contextmanager
+    def request(self, s3_bucket, s3_key, num_requests=1):
+        if not self.enabled:
+            yield
+            return
+        with self.get(s3_bucket, s3_key).request(num_requests):
+            yield
+
+    def on_throttle(self, s3_bucket, s3_key, start_time):
+        if self.enabled:
+            self.get(s3_bucket, s3_key).on_throttle(start_time)
+
+    # Starts a new (Lambda) execution, prefixes that are not throttled are forgotten
+    def reset(self, max_concurrency=None):
+        with self.lock:
+            self.max_concurrency = max_concurrency or self.max_concurrency
+            self.controllers = {controller_key: controller for controller_key, controller in self.controllers.items() if controller.is_throttled}
+            controllers = list(self.controllers.values())
+        for controller in controllers:
+            controller.reset_counters()
+
+    # Rates settled on by the most throttled prefixes of the execution
+    def to_json(self):
+        with self.lock:
+            controllers = [(controller_key, controller) for controller_key, controller in self.controllers.items() if controller.num_throttles > 0]
+        controllers.sort(key=lambda item: item[1].num_throttles, reverse=True)
+        return {'s3://{}/{}'.format(*controller_key): controller.to_json() for controller_key, controller in controllers[:max_reported_prefixes]}
+
+    def __repr__(self):
+        return f'S3RateControllers({self.max_concurrency!r}, {self.enabled!r}, {len(self.controllers)!r})'
+
+
+_rate_controllers = S3RateControllers(default_copy_concurrency)
+
+
+def get_rate_controllers():
+    return _rate_controllers
+
+
+# Starts controlling the requests of a new (Lambda) execution with up to max_concurrency requests in flight per prefix
+def reset_rate_controllers(max_concurrency):
+    _rate_controllers.enabled = os.environ.get('AdaptiveS3Concurrency', 'true').lower() == 'true'
+    _rate_controllers.reset(max_concurrency)
+    return _rate_controllers
+
+
+def _on_before_parameter_build(params=None, context=None, **kwargs):
+    if params is None or context is None or 'Bucket' not in params:
+        return
+    s3_key = params.get('Key')
+    if s3_key is None:
+        objects = params.get('Delete', {}).get('Objects', [])
+        s3_key = objects[0]['Key'] if objects else ''
+    context['rate_control'] = (params['Bucket'], s3_key, time.time())
+
+
+def _on_needs_retry(response=None, request_dict=None, **kwargs):
+    if response is None or request_dict is None:
+        return
+    rate_control = request_dict.get('context', {}).get('rate_control')
+    if rate_control is not None and is_throttling_response(response[1]):
+        get_rate_controllers().on_throttle(*rate_control)
+
+
+# Reports the throttled attempts of the requests made by a boto3 S3 client to the rate
+# controllers (clients without boto3 events, eg the local S3 stand-in, are left as they are)
+def track_s3_throttles(s3_client):
+    events = getattr(getattr(s3_client, 'meta', None), 'events', None)
+    if events is not None:
+        events.register('before-parameter-build.s3', _on_before_parameter_build)
+        events.register('needs-retry.s3', _on_needs_retry)
+    return s3_client
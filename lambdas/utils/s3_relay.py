@@ -0,0 +1,284 @@
+# ------------------------------------------------------------------------------
+# Streaming relay of S3 files for copies that cannot be done server-side
+# (CopyObject / UploadPartCopy need a single set of credentials allowed to read
+# the source and write the target: no cross-account copies without shared
+# credentials, no copies across partitions) or that are slow that way (some
+# cross-region copies). The bytes of a file are read with ranged GETs by the
+# source client and written with UploadPart (PutObject for small files) by a
+# separate target client.
+# Chunks are read into a fixed pool of reusable buffers (a single bytearray
+# handed out as memoryview slices, nothing is allocated per chunk) and each
+# buffer is uploaded as soon as it is full while other buffers are being read,
+# so reads and writes are pipelined. The memory used by the relay is that of
+# the pool, whatever the size of the files, and it is shared by all the files
+# copied concurrently by a worker: a chunk waits for a free buffer.
+# ------------------------------------------------------------------------------
+
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from utils.s3_metrics import get_metrics_recorder
+
+logger = logging.getLogger()
+A_MB = 1024 * 1024
+MIN_PART_SIZE = 5 * A_MB
+MAX_NUM_PARTS = 10000
+default_relay_buffer_size_in_mb = 8
+default_relay_num_buffers = 16
+
+
+class RelayBufferPool:
+
+    def __init__(self, num_buffers=default_relay_num_buffers, buffer_size=default_relay_buffer_size_in_mb * A_MB):
+        assert num_buffers > 0 and buffer_size >= MIN_PART_SIZE
+        self.num_buffers = num_buffers
+        self.buffer_size = buffer_size
+        self.memory = memoryview(bytearray(num_buffers * buffer_size))
+        self.free_buffers = queue.LifoQueue()
+        for buffer_idx in range(num_buffers):
+            self.free_buffers.put(buffer_idx)
+        self.num_in_use = 0
+        self.max_in_use = 0
+        self.lock = threading.Lock()
+
+    # Index and memoryview of a free buffer (blocks until one is released)
+    def acquire(self):
+        buffer_idx = self.free_buffers.get()
+        with self.lock:
+            self.num_in_use += 1
+            self.max_in_use = max(self.max_in_use, self.num_in_use)
+        return buffer_idx, self.memory[buffer_idx * self.buffer_size:(buffer_idx + 1) * self.buffer_size]
+
+    def release(self, buffer_idx):
+        with self.lock:
+            self.num_in_use -= 1
+        self.free_buffers.put(buffer_idx)
+
+    def get_size_in_bytes(self):
+        return self.num_buffers * self.buffer_size
+
+    def __repr__(self):
+        return f'RelayBufferPool({self.num_buffers!r}, {self.buffer_size!r})'
+
+
+# Seekable reader of (a slice of) a pooled buffer, used as request body so the buffer is
+# sent as it is (and re-sent on retries) without being copied
+class _BufferReader(io.RawIOBase):
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        num_bytes = min(len(b), len(self.view) - self.position)
+        b[:num_bytes] = self.view[self.position:self.position + num_bytes]
+        self.position += num_bytes
+        return num_bytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = min(max(offset, 0), len(self.view))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def __len__(self):
+        return len(self.view)
+
+
+# Reads a body (GET response stream) into a buffer, returns the number of bytes read
+def _read_into(body, view):
+    num_bytes = 0
+    while num_bytes < len(view):
+        num_bytes_read = body.readinto(view[num_bytes:])
+        if not num_bytes_read:
+            break
+        num_bytes += num_bytes_read
+    return num_bytes
+
+
+# Body of a part larger than a buffer: the byte range is streamed through one buffer, a
+# chunk at a time. Seeking back to the start (retries) reads the range again from the source.
+class _S3RangeReader(io.RawIOBase):
+
+    def __init__(self, relay, source_s3_client, source_s3_bucket, source_s3_key, first_byte, last_byte, view, file_size=None):
+        self.relay = relay
+        self.file_size = file_size
+        self.source_s3_client = source_s3_client
+        self.source_s3_bucket = source_s3_bucket
+        self.source_s3_key = source_s3_key
+        self.first_byte = first_byte
+        self.size = last_byte - first_byte + 1
+        self.view = view
+        self.body = None
+        self.position = 0
+        self.chunk_start = 0
+        self.chunk_end = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        if self.position >= self.size:
+            return 0
+        if self.position >= self.chunk_end:
+            if self.body is None:
+                self.body = self.relay.get_range(self.source_s3_client, self.source_s3_bucket, self.source_s3_key,
+                    self.first_byte + self.position, self.first_byte + self.size - 1, self.file_size)
+            chunk_size = _read_into(self.body, self.view[:min(len(self.view), self.size - self.position)])
+            if chunk_size == 0:
+                raise IOError('S3 file s3://{}/{} ended {} bytes before the end of the relayed range'.format(
+                    self.source_s3_bucket, self.source_s3_key, self.size - self.position))
+            self.chunk_start, self.chunk_end = self.position, self.position + chunk_size
+        num_bytes = min(len(b), self.chunk_end - self.position)
+        chunk_offset = self.position - self.chunk_start
+        b[:num_bytes] = self.view[chunk_offset:chunk_offset + num_bytes]
+        self.position += num_bytes
+        return num_bytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        offset = min(max(offset, 0), self.size)
+        if offset == self.position:
+            return offset
+        if not self.chunk_start <= offset <= self.chunk_end:
+            # outside of the buffered chunk, read again from there
+            self.body = None
+            self.chunk_start = self.chunk_end = offset
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def __len__(self):
+        return self.size
+
+
+class S3StreamingRelay:
+
+    # buffer_pool: buffers shared by the files relayed concurrently, part uploads are run by
+    # as many threads as there are buffers
+    def __init__(self, buffer_pool=None):
+        self.buffer_pool = buffer_pool or RelayBufferPool()
+        self.executor = ThreadPoolExecutor(max_workers=self.buffer_pool.num_buffers, thread_name_prefix='s3-relay')
+
+    # Body (stream) of a byte range of an S3 file. Given the size of the file, the range is only
+    # read if the file still has that size (it could have changed since it was listed).
+    def get_range(self, s3_client, s3_bucket, s3_key, first_byte, last_byte, file_size=None):
+        start_time = time.time()
+        response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key, Range='bytes={}-{}'.format(first_byte, last_byte))
+        get_metrics_recorder().record('GetObject', time.time() - start_time, last_byte - first_byte + 1)
+        content_range = response.get('ContentRange')
+        if file_size is not None and content_range and int(content_range.rsplit('/', 1)[1]) != file_size:
+            response['Body'].close()
+            raise IOError('S3 file s3://{}/{} has changed: {} bytes instead of {}'.format(s3_bucket, s3_key, content_range.rsplit('/', 1)[1], file_size))
+        return response['Body']
+
+    def _read_range(self, s3_client, s3_bucket, s3_key, first_byte, last_byte, view, file_size=None):
+        body = self.get_range(s3_client, s3_bucket, s3_key, first_byte, last_byte, file_size)
+        num_bytes = _read_into(body, view[:last_byte - first_byte + 1])
+        if num_bytes != last_byte - first_byte + 1:
+            raise IOError('Read {} out of {} bytes of S3 file s3://{}/{} (bytes={}-{})'.format(
+                num_bytes, last_byte - first_byte + 1, s3_bucket, s3_key, first_byte, last_byte))
+        return view[:num_bytes]
+
+    # Relays a byte range of the source as a part of a multipart upload of the target, returns its ETag
+    def relay_part(self, source_s3_client, source_s3_bucket, source_s3_key, target_s3_client, target_s3_bucket, target_s3_key,
+                   upload_id, part_number, first_byte, last_byte, file_size=None):
+        buffer_idx, view = self.buffer_pool.acquire()
+        try:
+            if last_byte - first_byte + 1 <= len(view):
+                body = _BufferReader(self._read_range(source_s3_client, source_s3_bucket, source_s3_key, first_byte, last_byte, view, file_size))
+            else:
+                body = _S3RangeReader(self, source_s3_client, source_s3_bucket, source_s3_key, first_byte, last_byte, view, file_size)
+            with get_metrics_recorder().measure('UploadPart', last_byte - first_byte + 1):
+                response = target_s3_client.upload_part(Bucket=target_s3_bucket, Key=target_s3_key, UploadId=upload_id,
+                    PartNumber=part_number, Body=body, ContentLength=last_byte - first_byte + 1)
+            return response['ETag']
+        finally:
+            self.buffer_pool.release(buffer_idx)
+
+    # Parts are as large as a buffer, unless the file has too many parts
+    def get_part_size(self, file_size):
+        return max(self.buffer_pool.buffer_size, -(-file_size // MAX_NUM_PARTS))
+
+    # Number of writes (PutObject or UploadPart) on the target the relay of a file keeps in flight
+    def get_num_writes_in_flight(self, file_size):
+        if file_size <= self.buffer_pool.buffer_size:
+            return 1
+        return min(-(-file_size // self.get_part_size(file_size)), self.buffer_pool.num_buffers)
+
+    # Relays a whole file of file_size bytes: with a single PutObject if it fits in a buffer,
+    # otherwise with a multipart upload whose parts are relayed concurrently
+    def relay(self, source_s3_client, source_s3_bucket, source_s3_key, target_s3_client, target_s3_bucket, target_s3_key, file_size):
+        if file_size <= self.buffer_pool.buffer_size:
+            buffer_idx, view = self.buffer_pool.acquire()
+            try:
+                if file_size > 0:
+                    view = self._read_range(source_s3_client, source_s3_bucket, source_s3_key, 0, file_size - 1, view, file_size)
+                body = _BufferReader(view[:file_size])
+                with get_metrics_recorder().measure('PutObject', file_size):
+                    target_s3_client.put_object(Bucket=target_s3_bucket, Key=target_s3_key, Body=body, ContentLength=file_size)
+            finally:
+                self.buffer_pool.release(buffer_idx)
+            return
+        part_size = self.get_part_size(file_size)
+        upload_id = target_s3_client.create_multipart_upload(Bucket=target_s3_bucket, Key=target_s3_key)['UploadId']
+        try:
+            futures = [self.executor.submit(self.relay_part, source_s3_client, source_s3_bucket, source_s3_key, target_s3_client,
+                           target_s3_bucket, target_s3_key, upload_id, part_idx + 1, first_byte, min(first_byte + part_size, file_size) - 1, file_size)
+                       for part_idx, first_byte in enumerate(range(0, file_size, part_size))]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+            if not_done:
+                # a part failed, parts not started yet are dropped
+                for future in not_done:
+                    future.cancel()
+                wait(not_done)
+                raise next(future.exception() for future in done if future.exception() is not None)
+            parts = [{'PartNumber': part_idx + 1, 'ETag': future.result()} for part_idx, future in enumerate(futures)]
+            with get_metrics_recorder().measure('CompleteMultipartUpload'):
+                target_s3_client.complete_multipart_upload(Bucket=target_s3_bucket, Key=target_s3_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+        except Exception:
+            logger.warning('Aborting the relay of S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_bucket, source_s3_key, target_s3_bucket, target_s3_key))
+            target_s3_client.abort_multipart_upload(Bucket=target_s3_bucket, Key=target_s3_key, UploadId=upload_id)
+            raise
+
+    def __repr__(self):
+        return f'S3StreamingRelay({self.buffer_pool!r})'
+
+
+_relay = None
+_relay_lock = threading.Lock()
+
+
+# Relay of the Lambda container, its buffers are allocated once and reused by every execution
+def get_s3_relay():
+    global _relay
+    with _relay_lock:
+        if _relay is None:
+            buffer_size_in_mb = int(os.environ['RelayBufferSizeInMB']) if 'RelayBufferSizeInMB' in os.environ else default_relay_buffer_size_in_mb
+            num_buffers = int(os.environ['RelayNumBuffers']) if 'RelayNumBuffers' in os.environ else default_relay_num_buffers
+            _relay = S3StreamingRelay(RelayBufferPool(num_buffers, buffer_size_in_mb * A_MB))
+        return _relay
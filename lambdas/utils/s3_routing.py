@@ -0,0 +1,162 @@
+# ------------------------------------------------------------------------------
+# Routing of the source files to their target location (target_s3_config). Each
+# target config is a routing rule that matches files by extension (file_types),
+# by globs on the key relative to the source path (key_patterns, eg '2018/*/raw/*'),
+# by a regex (key_regex, matched from the start of the relative key) and/or by
+# size range (min_size_in_mb inclusive, max_size_in_mb exclusive). All the
+# conditions of a rule must hold; a rule without conditions matches every file.
+# Rules are tried in order and the first match wins. A rule can route its files
+# to several targets (targets: list of s3_bucket/s3_path), the files are then
+# listed and routed once and copied to each of them.
+#
+# A copy can have several sources (source_s3_config as a list of s3_bucket/
+# s3_path), each with its own target configs or those of the copy.
+#
+# The rules are compiled once into a table of candidate rules per extension, cut
+# at the first rule that needs no further check, so most keys are routed by a
+# single dict lookup. Keys are classified in batches. Each rule counts the files
+# it routed and files matching no rule are counted (with a few samples) instead
+# of being logged one by one.
+# ------------------------------------------------------------------------------
+
+import fnmatch
+import re
+
+# unmatched keys kept as samples for the routing summary
+max_unmatched_samples = 5
+
+
+class S3RoutingRule:
+
+    # additional_targets: (s3_bucket, s3_path) of the targets the files are copied to besides s3_bucket/s3_path
+    def __init__(self, rule_idx, s3_bucket, s3_path, file_types=None, key_patterns=None, key_regex=None, min_size_in_mb=None, max_size_in_mb=None,
+                 additional_targets=None):
+        self.rule_idx = rule_idx
+        self.s3_bucket = s3_bucket
+        self.s3_path = s3_path
+        self.targets = [(s3_bucket, s3_path)] + [tuple(target) for target in additional_targets or []]
+        self.file_types = frozenset(file_types) if file_types is not None else None
+        self.key_patterns = list(key_patterns or [])
+        self.key_regex = key_regex
+        self.min_size_in_mb = min_size_in_mb
+        self.max_size_in_mb = max_size_in_mb
+        self._key_pattern_match = re.compile('|'.join(fnmatch.translate(key_pattern) for key_pattern in self.key_patterns)).match if self.key_patterns else None
+        try:
+            self._key_regex_match = re.compile(key_regex).match if key_regex is not None else None
+        except re.error as e:
+            raise ValueError('Invalid key_regex \'{}\' of target {}: {}'.format(key_regex, rule_idx, e))
+        # no condition left to check once the extension matched
+        self.is_unconditional = self._key_pattern_match is None and self._key_regex_match is None and min_size_in_mb is None and max_size_in_mb is None
+
+    # Conditions other than the extension, on the key relative to the source path
+    def matches(self, relative_key, file_size_in_mb):
+        if self.min_size_in_mb is not None and file_size_in_mb < self.min_size_in_mb:
+            return False
+        if self.max_size_in_mb is not None and file_size_in_mb >= self.max_size_in_mb:
+            return False
+        if self._key_pattern_match is not None and self._key_pattern_match(relative_key) is None:
+            return False
+        return self._key_regex_match is None or self._key_regex_match(relative_key) is not None
+
+    def __repr__(self):
+        return f'S3RoutingRule({self.rule_idx!r}, {self.s3_bucket!r}, {self.s3_path!r}, {sorted(self.file_types) if self.file_types is not None else None!r}, {self.key_patterns!r}, {self.key_regex!r}, {self.min_size_in_mb!r}, {self.max_size_in_mb!r}, {self.targets[1:]!r})'
+
+
+# Target locations (s3_bucket, s3_path) of a target config: its s3_bucket/s3_path and/or its targets
+def get_target_s3_locations(target_s3_config, rule_idx=0):
+    targets = [target_s3_config] if 's3_bucket' in target_s3_config or 's3_path' in target_s3_config else []
+    targets.extend(target_s3_config.get('targets', []))
+    if not targets or any('s3_bucket' not in target or 's3_path' not in target for target in targets):
+        raise ValueError('Target {} of target_s3_config needs an s3_bucket and an s3_path (or targets with one)'.format(rule_idx))
+    return [(target['s3_bucket'], target['s3_path']) for target in targets]
+
+
+# Sources of a copy (source_s3_config: a source or a list of sources), each with the target configs
+# routing its files (its own target_s3_config or that of the copy). Sources of a bucket cannot
+# overlap, their files would be copied twice.
+def get_source_s3_configs(s3_copy_config):
+    source_s3_configs = s3_copy_config['source_s3_config']
+    if isinstance(source_s3_configs, dict):
+        source_s3_configs = [source_s3_configs]
+    if not source_s3_configs:
+        raise ValueError('Invalid source_s3_config: no source given')
+    sources = []
+    for source_idx, source_s3_config in enumerate(source_s3_configs):
+        if 's3_bucket' not in source_s3_config or 's3_path' not in source_s3_config:
+            raise ValueError('Source {} of source_s3_config needs an s3_bucket and an s3_path'.format(source_idx))
+        target_s3_config = source_s3_config.get('target_s3_config', s3_copy_config.get('target_s3_config'))
+        if not target_s3_config:
+            raise ValueError('Source {} of source_s3_config has no target_s3_config'.format(source_idx))
+        for other_source in sources:
+            if other_source['s3_bucket'] == source_s3_config['s3_bucket'] and (
+                    other_source['s3_path'].startswith(source_s3_config['s3_path']) or source_s3_config['s3_path'].startswith(other_source['s3_path'])):
+                raise ValueError('Invalid source_s3_config: s3://{}/{} overlaps s3://{}/{}'.format(
+                    source_s3_config['s3_bucket'], source_s3_config['s3_path'], other_source['s3_bucket'], other_source['s3_path']))
+        sources.append(dict(source_s3_config, target_s3_config=target_s3_config))
+    return sources
+
+
+# Candidate rules in order, up to the first one that always matches
+def _compile_candidates(rules):
+    candidates = []
+    for rule in rules:
+        candidates.append(rule)
+        if rule.is_unconditional:
+            break
+    return tuple(candidates)
+
+
+class S3RoutingTable:
+
+    def __init__(self, target_s3_configs):
+        self.rules = []
+        for rule_idx, target_s3_config in enumerate(target_s3_configs):
+            targets = get_target_s3_locations(target_s3_config, rule_idx)
+            self.rules.append(S3RoutingRule(rule_idx, targets[0][0], targets[0][1],
+                target_s3_config.get('file_types'), target_s3_config.get('key_patterns'), target_s3_config.get('key_regex'),
+                target_s3_config.get('min_size_in_mb'), target_s3_config.get('max_size_in_mb'), targets[1:]))
+        file_types = {file_type for rule in self.rules if rule.file_types is not None for file_type in rule.file_types}
+        self._candidates_by_file_type = {file_type: _compile_candidates(rule for rule in self.rules if rule.file_types is None or file_type in rule.file_types)
+                                         for file_type in file_types}
+        # files without an extension, or with one that no rule lists
+        self._default_candidates = _compile_candidates(rule for rule in self.rules if rule.file_types is None)
+        self.num_files_per_rule = [0] * len(self.rules)
+        self.num_unmatched_files = 0
+        self.unmatched_samples = []
+
+    # Routing rule (None if none matches) of each of the keys (relative to the source path) and file sizes
+    def classify(self, relative_keys, file_sizes_in_mb):
+        candidates_by_file_type = self._candidates_by_file_type
+        default_candidates = self._default_candidates
+        num_files_per_rule = self.num_files_per_rule
+        rules = []
+        for relative_key, file_size_in_mb in zip(relative_keys, file_sizes_in_mb):
+            dot_idx = relative_key.rfind('.', relative_key.rfind('/') + 1)
+            candidates = candidates_by_file_type.get(relative_key[dot_idx + 1:], default_candidates) if dot_idx >= 0 else default_candidates
+            for rule in candidates:
+                if rule.is_unconditional or rule.matches(relative_key, file_size_in_mb):
+                    num_files_per_rule[rule.rule_idx] += 1
+                    rules.append(rule)
+                    break
+            else:
+                self.num_unmatched_files += 1
+                if len(self.unmatched_samples) < max_unmatched_samples:
+                    self.unmatched_samples.append(relative_key)
+                rules.append(None)
+        return rules
+
+    # Whether a rule routes its files to several targets
+    @property
+    def has_fan_out(self):
+        return any(len(rule.targets) > 1 for rule in self.rules)
+
+    def to_json(self):
+        return {
+            'num_files_per_target': [{'s3_bucket': s3_bucket, 's3_path': s3_path, 'num_files': num_files}
+                                     for rule, num_files in zip(self.rules, self.num_files_per_rule) for s3_bucket, s3_path in rule.targets],
+            'num_unmatched_files': self.num_unmatched_files,
+            'unmatched_samples': self.unmatched_samples
+        }
+
+    def __repr__(self):
+        return f'S3RoutingTable({self.rules!r})'
@@ -0,0 +1,88 @@
+# ------------------------------------------------------------------------------
+# Incremental sync support. The target S3 prefixes are listed once into an
+# in-memory index (size, ETag and last-modified per target key) which is then
+# used to plan only the source files that are missing or changed in the target.
+# Planned files are marked with a 'sync action' so that workers do not need to
+# HEAD the source and target files again.
+# ------------------------------------------------------------------------------
+
+import logging
+from utils.s3_listing import list_s3_objects_sharded, default_listing_concurrency
+from utils.s3_clients import get_s3_client_for_bucket
+from utils.s3_routing import get_source_s3_configs, get_target_s3_locations
+
+logger = logging.getLogger()
+SYNC_ACTION_COPY = 'copy'      # file missing or changed in the target, copy it (no checks needed)
+SYNC_ACTION_DELETE = 'delete'  # file already in the target, only delete it from the source (move)
+
+
+class S3TargetIndex:
+
+    def __init__(self):
+        self.objects = {}
+
+    def add_s3_object(self, s3_bucket, s3_object):
+        self.objects[(s3_bucket, s3_object['Key'])] = (s3_object['Size'], s3_object.get('ETag'), s3_object.get('LastModified'))
+
+    def add_s3_path(self, s3_client, s3_bucket, s3_path, max_workers=default_listing_concurrency):
+        for s3_object in list_s3_objects_sharded(s3_client, s3_bucket, s3_path, max_workers=max_workers):
+            self.add_s3_object(s3_bucket, s3_object)
+        return self
+
+    def get(self, s3_bucket, s3_path):
+        return self.objects.get((s3_bucket, s3_path))
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __repr__(self):
+        return f'S3TargetIndex({len(self.objects)!r} objects)'
+
+
+def new_s3_target_index(s3_client, s3_copy_config, max_workers=default_listing_concurrency):
+    target_index = S3TargetIndex()
+    target_s3_locations = {target_s3_location for source in get_source_s3_configs(s3_copy_config)
+                           for target_s3_config in source['target_s3_config'] for target_s3_location in get_target_s3_locations(target_s3_config)}
+    # skip paths that are already covered by a shorter path of the same bucket
+    for s3_bucket, s3_path in sorted(target_s3_locations):
+        if not any(bucket == s3_bucket and s3_path.startswith(path) and path != s3_path for bucket, path in target_s3_locations):
+            logger.info('Indexing target files in s3://{}/{}...'.format(s3_bucket, s3_path))
+            target_index.add_s3_path(get_s3_client_for_bucket(s3_bucket, s3_client), s3_bucket, s3_path, max_workers)
+    logger.info('Indexed {} target files'.format(len(target_index)))
+    return target_index
+
+
+def is_s3_object_up_to_date(source_s3_object, target_entry):
+    target_size, target_etag, target_last_modified = target_entry
+    if source_s3_object['Size'] != target_size:
+        return False
+    # source was modified after it was copied into the target
+    if source_s3_object.get('LastModified') and target_last_modified and source_s3_object['LastModified'] > target_last_modified:
+        return False
+    # ETags of multipart uploads are not content hashes so only those of single part uploads can be compared
+    source_etag = source_s3_object.get('ETag')
+    if source_etag and target_etag and '-' not in source_etag and '-' not in target_etag and source_etag != target_etag:
+        return False
+    return True
+
+
+class S3SyncFilter:
+
+    def __init__(self, target_index, s3_operation_type):
+        self.target_index = target_index
+        self.s3_operation_type = s3_operation_type
+        self.num_files_to_copy = 0
+        self.num_files_up_to_date = 0
+
+    # Returns the sync action for the source object or None if there is nothing to do
+    def get_sync_action(self, source_s3_object, target_s3_bucket, target_s3_path):
+        target_entry = self.target_index.get(target_s3_bucket, target_s3_path)
+        if target_entry is None or not is_s3_object_up_to_date(source_s3_object, target_entry):
+            self.num_files_to_copy += 1
+            return SYNC_ACTION_COPY
+        self.num_files_up_to_date += 1
+        # moving files always deletes them from the source
+        return SYNC_ACTION_DELETE if self.s3_operation_type == 'move-files' else None
+
+    def __repr__(self):
+        return f'S3SyncFilter({self.target_index!r}, {self.s3_operation_type!r}, {self.num_files_to_copy!r}, {self.num_files_up_to_date!r})'
@@ -6,40 +6,92 @@
 # This Lambda function is called by a AWS Step Functions state machine.
 # ------------------------------------------------------------------------------
 
-import boto3
 import logging
 import json
 import time
 import os
+import threading
+from botocore.exceptions import ClientError
+from utils.s3_metrics import get_metrics_recorder
+from utils.s3_clients import LazyS3Client, get_s3_client_for_bucket
+from utils.s3_rate_control import get_rate_controllers
 
-s3 = boto3.client('s3')
+s3 = LazyS3Client()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
+MAX_DELETE_BATCH_SIZE = 1000  # max number of keys per DeleteObjects request
+# defaults of the boto3 TransferConfig (copies without a transfer config)
+default_multipart_threshold = 8 * 1024 * 1024
+default_multipart_chunksize = 8 * 1024 * 1024
+default_transfer_concurrency = 10
+
+# Requests on a bucket are sent to a client of the bucket's region
+def s3_client_for(s3_bucket):
+    return get_s3_client_for_bucket(s3_bucket, s3)
+
+# Whether a request failed because its file does not exist (HEAD requests have no error code)
+def is_not_found_error(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
 
 def get_s3_file_size(s3_location):
+    start_time = time.time()
     try:
-        response = s3.head_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+        response = s3_client_for(s3_location['bucket']).head_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+        get_metrics_recorder().record('HeadObject', time.time() - start_time)
         if 'DeleteMarker' in response and response['DeleteMarker']:
             return -1
         return response['ContentLength']
-    except:
+    except Exception as e:
+        # a missing file is an expected outcome, not an error
+        get_metrics_recorder().record('HeadObject', time.time() - start_time, error=not is_not_found_error(e))
         return -1
 
-def s3_copy(source_s3_location, target_s3_location):
+# Number of UploadPartCopy requests the managed copy of a file keeps in flight (none below the
+# multipart threshold of the transfer config, where it sends a single CopyObject)
+def get_num_part_copies_in_flight(file_size, transfer_config=None):
+    multipart_threshold = transfer_config.multipart_threshold if transfer_config is not None else default_multipart_threshold
+    if file_size < multipart_threshold:
+        return 0
+    multipart_chunksize = transfer_config.multipart_chunksize if transfer_config is not None else default_multipart_chunksize
+    max_concurrency = transfer_config.max_concurrency if transfer_config is not None else default_transfer_concurrency
+    return min(-(-file_size // multipart_chunksize), max_concurrency)
+
+# file_size: size of the copied file in bytes (picks a single CopyObject or a managed multipart copy).
+# Given a relay (see utils/s3_relay.py), the file is streamed through the worker instead of copied
+# server-side.
+def s3_copy(source_s3_location, target_s3_location, transfer_config=None, file_size=0, relay=None):
+    if relay is not None:
+        s3_relay(source_s3_location, target_s3_location, file_size, relay)
+        return
     copy_source = {
         'Bucket': source_s3_location['bucket'],
         'Key': source_s3_location['key']
     }
-    logger.info('Copying S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
+    logger.debug('Copying S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
         source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
-    start_time = time.time()
-    s3.copy(copy_source, target_s3_location['bucket'], target_s3_location['key'])
-    elapsed_time = time.time() - start_time
-    logger.info('It took {} secs to copy S3 file s3://{}/{} into s3://{}/{}'.format(elapsed_time, source_s3_location['bucket'],
+    # copies are rate controlled on the target prefix (writes), one slot per request in flight
+    num_part_copies = get_num_part_copies_in_flight(file_size, transfer_config)
+    with get_rate_controllers().request(target_s3_location['bucket'], target_s3_location['key'], max(num_part_copies, 1)), \
+            get_metrics_recorder().measure('CopyObject', file_size):
+        if num_part_copies == 0:
+            s3_client_for(target_s3_location['bucket']).copy_object(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'],
+                CopySource=copy_source)
+        else:
+            s3_client_for(target_s3_location['bucket']).copy(copy_source, target_s3_location['bucket'], target_s3_location['key'],
+                Config=transfer_config, SourceClient=s3_client_for(source_s3_location['bucket']))
+
+# Reads the source with ranged GETs (source bucket client) and writes the target with uploads
+# (target bucket client), for buckets no single set of credentials can copy between
+def s3_relay(source_s3_location, target_s3_location, file_size, relay):
+    logger.debug('Relaying S3 file s3://{}/{} into s3://{}/{}'.format(source_s3_location['bucket'],
         source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    with get_rate_controllers().request(target_s3_location['bucket'], target_s3_location['key'], relay.get_num_writes_in_flight(file_size)), \
+            get_metrics_recorder().measure('RelayObject', file_size):
+        relay.relay(s3_client_for(source_s3_location['bucket']), source_s3_location['bucket'], source_s3_location['key'],
+            s3_client_for(target_s3_location['bucket']), target_s3_location['bucket'], target_s3_location['key'], file_size)
 
 # Copy if file not in destination
-def s3_copy_if_not_in_destination(source_s3_location, target_s3_location):
+def s3_copy_if_not_in_destination(source_s3_location, target_s3_location, transfer_config=None, relay=None):
     src_file_size = get_s3_file_size(source_s3_location)
     file_copied = False
     # file exists in source
@@ -47,7 +99,7 @@ def s3_copy_if_not_in_destination(source_s3_location, target_s3_location):
         trg_file_size = get_s3_file_size(target_s3_location)
         # files differ, trigger the copy
         if src_file_size != trg_file_size:
-            s3_copy(source_s3_location, target_s3_location)
+            s3_copy(source_s3_location, target_s3_location, transfer_config, src_file_size, relay)
             file_copied = True
     else:
         raise Exception('File {}/{} does not exist and cannot be copied to {}/{}'.format(
@@ -55,14 +107,118 @@ def s3_copy_if_not_in_destination(source_s3_location, target_s3_location):
     return file_copied
 
 def s3_delete(s3_location):
-    logger.info('Deleting S3 file s3://{}/{}'.format(s3_location['bucket'], s3_location['key']))
-    start_time = time.time()
-    s3.delete_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
-    elapsed_time = time.time() - start_time
-    logger.info('It took {} secs to delete S3 file s3://{}/{}'.format(elapsed_time, s3_location['bucket'],
-        s3_location['key']))
+    logger.debug('Deleting S3 file s3://{}/{}'.format(s3_location['bucket'], s3_location['key']))
+    with get_rate_controllers().request(s3_location['bucket'], s3_location['key']), get_metrics_recorder().measure('DeleteObject'):
+        s3_client_for(s3_location['bucket']).delete_object(Bucket=s3_location['bucket'], Key=s3_location['key'])
+
+# Copies a byte range (eg, 'bytes=0-1048575') of the source file as one part of a multipart upload
+# (relayed through the worker given a relay)
+def s3_copy_part(source_s3_location, target_s3_location, upload_id, part_number, byte_range, relay=None):
+    if relay is not None:
+        first_byte, last_byte = byte_range.replace('bytes=', '').split('-')
+        with get_rate_controllers().request(target_s3_location['bucket'], target_s3_location['key']):
+            return relay.relay_part(s3_client_for(source_s3_location['bucket']), source_s3_location['bucket'], source_s3_location['key'],
+                s3_client_for(target_s3_location['bucket']), target_s3_location['bucket'], target_s3_location['key'],
+                upload_id, part_number, int(first_byte), int(last_byte))
+    copy_source = {
+        'Bucket': source_s3_location['bucket'],
+        'Key': source_s3_location['key']
+    }
+    logger.debug('Copying part {} ({}) of S3 file s3://{}/{} into s3://{}/{}'.format(part_number, byte_range,
+        source_s3_location['bucket'], source_s3_location['key'], target_s3_location['bucket'], target_s3_location['key']))
+    first_byte, last_byte = byte_range.replace('bytes=', '').split('-')
+    with get_rate_controllers().request(target_s3_location['bucket'], target_s3_location['key']), \
+            get_metrics_recorder().measure('UploadPartCopy', int(last_byte) - int(first_byte) + 1):
+        response = s3_client_for(target_s3_location['bucket']).upload_part_copy(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'],
+            UploadId=upload_id, PartNumber=part_number, CopySource=copy_source, CopySourceRange=byte_range)
+    return response['CopyPartResult']['ETag']
+
+# Completes a multipart upload once all its parts have been copied (by any worker)
+def s3_complete_multipart_copy(target_s3_location, upload_id, num_parts):
+    parts = []
+    target_s3_client = s3_client_for(target_s3_location['bucket'])
+    paginator = target_s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'], UploadId=upload_id):
+        parts.extend({'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in page.get('Parts', []))
+    if len(parts) != num_parts:
+        raise Exception('Multipart copy into s3://{}/{} has {} out of {} parts and cannot be completed'.format(
+            target_s3_location['bucket'], target_s3_location['key'], len(parts), num_parts))
+    with get_metrics_recorder().measure('CompleteMultipartUpload'):
+        target_s3_client.complete_multipart_upload(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'],
+            UploadId=upload_id, MultipartUpload={'Parts': parts})
 
-def s3_move_if_not_in_destination(source_s3_location, target_s3_location):
+# Aborts a multipart copy so that its copied parts are no longer stored (and billed). Returns
+# False if there is no such upload anymore: completed or aborted by a previous execution.
+def s3_abort_multipart_copy(target_s3_location, upload_id):
+    try:
+        s3_client_for(target_s3_location['bucket']).abort_multipart_upload(Bucket=target_s3_location['bucket'], Key=target_s3_location['key'],
+            UploadId=upload_id)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+            raise
+        return False
+
+# Collects S3 files to be deleted and deletes them with DeleteObjects requests, a batch
+# at a time (thread-safe). Errors are kept per S3 file so that they can be reported
+# against the file that could not be deleted.
+class S3DeleteBatcher:
+
+    def __init__(self, batch_size=MAX_DELETE_BATCH_SIZE):
+        assert 0 < batch_size <= MAX_DELETE_BATCH_SIZE
+        self.batch_size = batch_size
+        self.pending_keys = {}
+        self.errors = {}
+        self.num_deleted = 0
+        self.lock = threading.Lock()
+
+    def add(self, s3_location):
+        full_batch = None
+        with self.lock:
+            keys = self.pending_keys.setdefault(s3_location['bucket'], [])
+            keys.append(s3_location['key'])
+            if len(keys) >= self.batch_size:
+                full_batch = self.pending_keys.pop(s3_location['bucket'])
+        if full_batch:
+            self._delete_batch(s3_location['bucket'], full_batch)
+
+    def flush(self):
+        with self.lock:
+            pending_keys = self.pending_keys
+            self.pending_keys = {}
+        for s3_bucket, keys in pending_keys.items():
+            self._delete_batch(s3_bucket, keys)
+
+    def get_error(self, s3_location):
+        return self.errors.get((s3_location['bucket'], s3_location['key']))
+
+    def _delete_batch(self, s3_bucket, keys):
+        logger.debug('Deleting {} S3 files from s3://{}'.format(len(keys), s3_bucket))
+        start_time = time.time()
+        try:
+            with get_rate_controllers().request(s3_bucket, keys[0]):
+                response = s3_client_for(s3_bucket).delete_objects(Bucket=s3_bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+            errors = {(s3_bucket, error['Key']): '{}: {}'.format(error.get('Code'), error.get('Message')) for error in response.get('Errors', [])}
+        except Exception as e:
+            errors = {(s3_bucket, key): str(e) for key in keys}
+        get_metrics_recorder().record('DeleteObjects', time.time() - start_time, error=len(errors) == len(keys))
+        if errors:
+            logger.warning('Failed to delete {} out of {} S3 files from s3://{}'.format(len(errors), len(keys), s3_bucket))
+        with self.lock:
+            self.errors.update(errors)
+            self.num_deleted += len(keys) - len(errors)
+
+    def __repr__(self):
+        return f'S3DeleteBatcher({self.batch_size!r}, {self.num_deleted!r}, {len(self.errors)!r})'
+
+# The source file is deleted right away or, given a delete batcher, queued for a batched delete
+def s3_delete_now_or_later(s3_location, delete_batcher=None):
+    if delete_batcher is not None:
+        delete_batcher.add(s3_location)
+    else:
+        s3_delete(s3_location)
+
+def s3_move_if_not_in_destination(source_s3_location, target_s3_location, transfer_config=None, delete_batcher=None, relay=None):
     src_file_size = get_s3_file_size(source_s3_location)
     trg_file_size = get_s3_file_size(target_s3_location)
     file_moved = False
@@ -70,10 +226,15 @@ def s3_move_if_not_in_destination(source_s3_location, target_s3_location):
     if src_file_size >= 0:
         # file not in target or files differ, trigger the copy
         if src_file_size != trg_file_size:
-            s3_copy(source_s3_location, target_s3_location)
+            try:
+                s3_copy(source_s3_location, target_s3_location, transfer_config, src_file_size, relay)
+            except ClientError as e:
+                if not is_moved_by_another_runner(e, target_s3_location, src_file_size):
+                    raise
+                return False
             file_moved = True
-        # delete from source in either case
-        s3_delete(source_s3_location)
+        # delete from source in either case (only reached once the copy succeeded)
+        s3_delete_now_or_later(source_s3_location, delete_batcher)
     # trying to move a file that neither exist in the source nor the target
     elif trg_file_size == -1:
         raise Exception('File {}/{} does not exist and cannot be moved to {}/{}'
@@ -81,4 +242,13 @@ def s3_move_if_not_in_destination(source_s3_location, target_s3_location):
                 source_s3_location['bucket'], source_s3_location['key'], 
                 target_s3_location['bucket'], target_s3_location['key'])
             )
-    return file_moved
\ No newline at end of file
+    return file_moved
+
+# Whether the copy of a file being moved failed because another runner of the file (duplicate of
+# a straggler work, see utils/speculation.py) moved it in the meantime: its source is gone and
+# the target now matches it. The file then counts as moved by the other runner.
+def is_moved_by_another_runner(e, target_s3_location, src_file_size):
+    if not is_not_found_error(e) or get_s3_file_size(target_s3_location) != src_file_size:
+        return False
+    logger.info('S3 file s3://{}/{} was moved by another runner'.format(target_s3_location['bucket'], target_s3_location['key']))
+    return True
\ No newline at end of file
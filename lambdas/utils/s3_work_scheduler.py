@@ -0,0 +1,178 @@
+# ------------------------------------------------------------------------------
+# Work schedulers used by the orchestrator to assign S3 files to works (Lambda
+# workers). Files are balanced on their predicted copy time (cost model) rather
+# than on their size only: with many small files the per-request latency, not
+# the bytes, dominates the time it takes a worker to go through its work.
+# A scheduler assigns costs to works and returns the file indexes per work.
+# ------------------------------------------------------------------------------
+
+import heapq
+import logging
+from operator import itemgetter
+
+logger = logging.getLogger()
+default_throughput_in_mb_per_sec = 100
+
+
+class S3CopyCostModel:
+
+    # per_file_latency_in_sec: fixed time spent per file regardless of its size (requests)
+    # throughput_in_mb_per_sec: copy throughput of a single file
+    # copy_concurrency: number of files copied concurrently by a worker
+    def __init__(self, per_file_latency_in_sec=0.0, throughput_in_mb_per_sec=default_throughput_in_mb_per_sec, copy_concurrency=1):
+        assert per_file_latency_in_sec >= 0 and throughput_in_mb_per_sec > 0 and copy_concurrency > 0
+        self.per_file_latency_in_sec = per_file_latency_in_sec
+        self.throughput_in_mb_per_sec = throughput_in_mb_per_sec
+        self.copy_concurrency = copy_concurrency
+
+    # Predicted worker time (in secs) spent copying a file
+    def file_cost(self, file_size_in_mb):
+        return (self.per_file_latency_in_sec + file_size_in_mb / self.throughput_in_mb_per_sec) / self.copy_concurrency
+
+    def __repr__(self):
+        return f'S3CopyCostModel({self.per_file_latency_in_sec!r}, {self.throughput_in_mb_per_sec!r}, {self.copy_concurrency!r})'
+
+
+def get_work_loads(costs, assignment):
+    return [sum(costs[idx] for idx in file_indexes) for file_indexes in assignment]
+
+
+def get_predicted_makespan(costs, assignment):
+    return max(get_work_loads(costs, assignment), default=0)
+
+
+def _sorted_by_cost(costs):
+    return sorted(range(len(costs)), key=lambda idx: costs[idx], reverse=True)
+
+
+# Greedy largest-first placement (Longest Processing Time): each file goes to the least loaded work
+class LptScheduler:
+
+    name = 'lpt'
+
+    def assign(self, costs, num_works):
+        assignment = [[] for _ in range(num_works)]
+        works_min_heap = [(0, work_idx) for work_idx in range(num_works)]
+        for idx in _sorted_by_cost(costs):
+            work_load, work_idx = works_min_heap[0]
+            assignment[work_idx].append(idx)
+            heapq.heapreplace(works_min_heap, (work_load + costs[idx], work_idx))
+        return assignment
+
+    def __repr__(self):
+        return 'LptScheduler()'
+
+
+# Karmarkar-Karp largest differencing method generalised to k works: partial partitions are
+# merged pairwise (largest subset of one with the smallest of the other), always merging the
+# partitions with the largest difference between their largest and smallest subsets first
+class KarmarkarKarpScheduler:
+
+    name = 'kk'
+
+    def assign(self, costs, num_works):
+        if not costs:
+            return [[] for _ in range(num_works)]
+        # a partition is a list of (subset cost, subset) sorted by decreasing cost where a subset
+        # is a tree of file indexes (nested tuples) so that merging subsets is O(1)
+        partitions_heap = []
+        for idx, cost in enumerate(costs):
+            partition = [(cost, idx)] + [(0, None)] * (num_works - 1)
+            partitions_heap.append((-cost, idx, partition))
+        heapq.heapify(partitions_heap)
+        tie_breaker = len(costs)
+        while len(partitions_heap) > 1:
+            _, _, partition1 = heapq.heappop(partitions_heap)
+            _, _, partition2 = heapq.heappop(partitions_heap)
+            merged = [(cost1 + cost2, (subset1, subset2))
+                      for (cost1, subset1), (cost2, subset2) in zip(partition1, reversed(partition2))]
+            merged.sort(key=itemgetter(0), reverse=True)
+            heapq.heappush(partitions_heap, (merged[-1][0] - merged[0][0], tie_breaker, merged))
+            tie_breaker += 1
+        return [self._flatten(subset) for _, subset in partitions_heap[0][2]]
+
+    def _flatten(self, subset):
+        file_indexes = []
+        stack = [subset]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, tuple):
+                stack.extend(node)
+            elif node is not None:
+                file_indexes.append(node)
+        return file_indexes
+
+    def __repr__(self):
+        return 'KarmarkarKarpScheduler()'
+
+
+# Multifit: binary search for the smallest work capacity for which first-fit decreasing
+# packs all files into the available works
+class MultifitScheduler:
+
+    name = 'multifit'
+
+    def __init__(self, num_iterations=16):
+        self.num_iterations = num_iterations
+
+    def _first_fit_decreasing(self, costs, sorted_indexes, num_works, capacity):
+        assignment = [[] for _ in range(num_works)]
+        work_loads = [0] * num_works
+        for idx in sorted_indexes:
+            for work_idx in range(num_works):
+                if work_loads[work_idx] + costs[idx] <= capacity:
+                    work_loads[work_idx] += costs[idx]
+                    assignment[work_idx].append(idx)
+                    break
+            else:
+                return None
+        return assignment
+
+    def assign(self, costs, num_works):
+        if not costs:
+            return [[] for _ in range(num_works)]
+        sorted_indexes = _sorted_by_cost(costs)
+        total_cost = sum(costs)
+        lower_bound = max(total_cost / num_works, costs[sorted_indexes[0]])
+        upper_bound = max(2 * total_cost / num_works, costs[sorted_indexes[0]])
+        best_assignment = None
+        for _ in range(self.num_iterations):
+            capacity = (lower_bound + upper_bound) / 2
+            assignment = self._first_fit_decreasing(costs, sorted_indexes, num_works, capacity)
+            if assignment is None:
+                lower_bound = capacity
+            else:
+                upper_bound = capacity
+                best_assignment = assignment
+        return best_assignment or self._first_fit_decreasing(costs, sorted_indexes, num_works, upper_bound) \
+            or LptScheduler().assign(costs, num_works)
+
+    def __repr__(self):
+        return f'MultifitScheduler({self.num_iterations!r})'
+
+
+# Runs every scheduler and keeps the plan with the smallest predicted makespan
+class BestOfSchedulers:
+
+    name = 'best'
+
+    def __init__(self, schedulers=None):
+        self.schedulers = schedulers or [LptScheduler(), KarmarkarKarpScheduler(), MultifitScheduler()]
+
+    def assign(self, costs, num_works):
+        plans = [(scheduler, scheduler.assign(costs, num_works)) for scheduler in self.schedulers]
+        scheduler, assignment = min(plans, key=lambda plan: get_predicted_makespan(costs, plan[1]))
+        logger.info('Using the \'{}\' work scheduler plan (predicted makespan: {:.2f} secs)'.format(scheduler.name, get_predicted_makespan(costs, assignment)))
+        return assignment
+
+    def __repr__(self):
+        return f'BestOfSchedulers({self.schedulers!r})'
+
+
+work_schedulers = {scheduler.name: scheduler for scheduler in [LptScheduler, KarmarkarKarpScheduler, MultifitScheduler, BestOfSchedulers]}
+
+
+def new_work_scheduler(name):
+    if name not in work_schedulers:
+        raise ValueError('Invalid work scheduler: {}. Expecting one of {}.'.format(name, sorted(work_schedulers)))
+    return work_schedulers[name]()
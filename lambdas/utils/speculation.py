@@ -0,0 +1,190 @@
+# ------------------------------------------------------------------------------
+# Speculative re-execution of straggler works (static execution mode). With a
+# static assignment, the slowest worker branch (throttled prefix, slow route)
+# decides when the whole Parallel state is over. Workers report the progress
+# of their work on a progress board (S3, one board per execution) and compare
+# it against the duration the planner predicted for each payload. A worker
+# done with its own work looks for a straggler: a work that took much longer
+# than predicted to get where it is, with enough left to be worth duplicating.
+# It claims the straggler (a conditional write to a DynamoDB table, so a work
+# has one duplicate at most) and copies its remaining files from the
+# straggler's last reported position. Duplicates are safe: files are copied if not in the destination
+# (sizes compared), so files copied by one runner are skipped by the other.
+# The first runner to finish the work wins, the other one stops at its next
+# execution.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+import os
+import time
+from botocore.exceptions import ClientError
+from utils.s3_listing import list_s3_objects
+from utils.s3_clients import get_s3_client_for_bucket
+
+logger = logging.getLogger()
+default_speculation_s3_path = 'speculation/'
+# a work is a straggler once it is this many times slower than predicted...
+default_straggler_slowdown = 2.0
+# ...and the predicted duration of its remaining files is at least this long (secs)
+default_min_straggler_remaining_in_sec = 30
+# claims are deleted by the table's TTL once they are this old (secs)
+claim_ttl_in_sec = 7 * 24 * 3600
+
+_dynamodb_client = None
+
+
+# DynamoDB client created on first use (the board is read and written with S3 clients)
+def get_dynamodb_client():
+    global _dynamodb_client
+    if _dynamodb_client is None:
+        import boto3
+        _dynamodb_client = boto3.client('dynamodb')
+    return _dynamodb_client
+
+
+class S3ProgressBoard:
+
+    # s3_path: prefix of the board of the execution (eg, 'speculation/[execution id]/'), claims_table:
+    # DynamoDB table (hash key 'claim_id') the duplicates of the works are claimed in
+    def __init__(self, s3_client, s3_bucket, s3_path, claims_table=None):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_path = s3_path
+        self.claims_table = claims_table
+
+    def _put_json(self, s3_key, value, **kwargs):
+        self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_path + s3_key, Body=json.dumps(value).encode('utf-8'),
+                                  ContentType='application/json', **kwargs)
+
+    def _get_json(self, s3_key):
+        return json.loads(self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_path + s3_key)['Body'].read())
+
+    # Work as planned by the orchestrator
+    def put_work(self, work):
+        self._put_json('works/{}.json'.format(work['work_id']), work)
+
+    def get_work(self, work_id):
+        return self._get_json('works/{}.json'.format(work_id))
+
+    # Progress of a work (see get_work_progress) by one of its runners: its worker or a duplicate
+    def put_progress(self, work_id, runner_id, progress):
+        self._put_json('progress/{}/{}.json'.format(work_id, runner_id), progress)
+
+    # Progress of the works reported so far: work_id -> runner_id -> progress
+    def get_progress(self, work_id=None):
+        progress_s3_path = self.s3_path + ('progress/' if work_id is None else 'progress/{}/'.format(work_id))
+        works_progress = {}
+        for s3_object in list_s3_objects(self.s3_client, self.s3_bucket, progress_s3_path):
+            progress_work_id, runner_file_name = s3_object['Key'][len(self.s3_path + 'progress/'):].split('/', 1)
+            works_progress.setdefault(progress_work_id, {})[runner_file_name[:-len('.json')]] = self._get_json(s3_object['Key'][len(self.s3_path):])
+        return works_progress
+
+    # Whether a runner other than runner_id finished the work
+    def is_done_by_another_runner(self, work_id, runner_id):
+        return any(progress['done'] for other_runner_id, progress in self.get_progress(work_id).get(work_id, {}).items() if other_runner_id != runner_id)
+
+    # Claims the duplicate of a work for runner_id, only one runner can claim a work. S3 conditional
+    # writes (IfNoneMatch) are not supported by the pinned botocore, the claim is a conditional
+    # DynamoDB write instead.
+    def claim(self, work_id, runner_id):
+        if not self.claims_table:
+            raise ValueError('Claiming the duplicate of a work requires a claims table (SpeculationClaimsTable)')
+        claimed_at = time.time()
+        try:
+            get_dynamodb_client().put_item(TableName=self.claims_table, Item={
+                'claim_id': {'S': self.s3_bucket + '/' + self.s3_path + work_id},
+                'runner_id': {'S': runner_id},
+                'claimed_at': {'N': str(claimed_at)},
+                'expires_at': {'N': str(int(claimed_at) + claim_ttl_in_sec)}
+            }, ConditionExpression='attribute_not_exists(claim_id)')
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+            return False
+
+    def __repr__(self):
+        return f'S3ProgressBoard({self.s3_bucket!r}, {self.s3_path!r}, {self.claims_table!r})'
+
+
+# Progress board of a work (None if the execution does not speculate). Works carry the location of
+# the board of their execution, its claims table and the time (epoch secs) it started copying.
+def new_progress_board(s3_client, work):
+    if 'progress_board' not in work:
+        return None
+    s3_bucket = work['progress_board']['s3_bucket']
+    return S3ProgressBoard(get_s3_client_for_bucket(s3_bucket, s3_client), s3_bucket, work['progress_board']['s3_path'],
+                           work['progress_board'].get('claims_table'))
+
+
+def _get_num_files(payload):
+    return payload['num_files'] if 'num_files' in payload else len(payload['payload_files'])
+
+
+# Progress of a work in terms of the predicted copy time of its payloads: done (up to its
+# cursor) and left, as well as what is left of the payload in progress
+def get_work_progress(work):
+    predicted_durations = [payload.get('predicted_duration_in_sec', 0) for payload in work['payloads']]
+    cur_payload = work['cur_payload']
+    predicted_done = sum(predicted_durations[:cur_payload])
+    predicted_current = 0
+    if cur_payload < work['num_payloads']:
+        num_files = _get_num_files(work['payloads'][cur_payload])
+        predicted_current_done = predicted_durations[cur_payload] * work.get('cur_file', 0) / num_files if num_files else 0
+        predicted_done += predicted_current_done
+        predicted_current = predicted_durations[cur_payload] - predicted_current_done
+    return {
+        'cur_payload': cur_payload,
+        'cur_file': work.get('cur_file', 0),
+        'done': cur_payload >= work['num_payloads'],
+        'predicted_done_in_sec': predicted_done,
+        'predicted_current_in_sec': predicted_current,
+        'predicted_remaining_in_sec': sum(predicted_durations) - predicted_done,
+        'updated_at': time.time()
+    }
+
+
+def get_straggler_slowdown():
+    return float(os.environ['StragglerSlowdown']) if 'StragglerSlowdown' in os.environ else default_straggler_slowdown
+
+
+def get_min_straggler_remaining_in_sec():
+    return float(os.environ['MinStragglerRemainingInSec']) if 'MinStragglerRemainingInSec' in os.environ else default_min_straggler_remaining_in_sec
+
+
+# Works (work_id, progress) that fell far behind their predicted duration, the latest predicted to
+# finish first. A work is credited with the payload in progress as if it had kept to the predicted
+# pace since its last report, so a work is not a straggler only because it reports once per payload.
+def find_stragglers(works_progress, started_at, now=None, slowdown=default_straggler_slowdown,
+                    min_remaining_in_sec=default_min_straggler_remaining_in_sec):
+    now = now if now is not None else time.time()
+    elapsed_time = now - started_at
+    stragglers = []
+    for work_id, runners_progress in works_progress.items():
+        if any(progress['done'] for progress in runners_progress.values()):
+            continue
+        # the runner furthest ahead
+        progress = max(runners_progress.values(), key=lambda progress: progress['predicted_done_in_sec'])
+        expected_time = progress['predicted_done_in_sec'] + min(max(now - progress['updated_at'], 0), progress['predicted_current_in_sec'])
+        if progress['predicted_remaining_in_sec'] >= min_remaining_in_sec and elapsed_time > slowdown * expected_time:
+            # time left at the pace observed so far
+            pace = elapsed_time / expected_time if expected_time > 0 else float('inf')
+            stragglers.append((progress['predicted_remaining_in_sec'] * pace, work_id, progress))
+    stragglers.sort(key=lambda straggler: straggler[0], reverse=True)
+    return [(work_id, progress) for _, work_id, progress in stragglers]
+
+
+# Duplicate of a straggler work claimed by runner_id, from the straggler's last reported position
+# (None if there is no straggler left to claim)
+def claim_straggler(board, runner_id, started_at):
+    works_progress = board.get_progress()
+    for work_id, progress in find_stragglers(works_progress, started_at, slowdown=get_straggler_slowdown(),
+                                             min_remaining_in_sec=get_min_straggler_remaining_in_sec()):
+        if work_id == runner_id or not board.claim(work_id, runner_id):
+            continue
+        planned_work = board.get_work(work_id)
+        logger.info('Work \'{}\' is a straggler ({:.1f} of {:.1f} predicted secs done), \'{}\' duplicates its remaining files'.format(
+            work_id, progress['predicted_done_in_sec'], progress['predicted_done_in_sec'] + progress['predicted_remaining_in_sec'], runner_id))
+        return dict(planned_work, cur_payload=progress['cur_payload'], cur_file=progress['cur_file'])
+    return None
@@ -0,0 +1,178 @@
+# ------------------------------------------------------------------------------
+# Throughput model learnt from the copies actually made, used by the
+# orchestrator to size payloads to a target Lambda execution duration instead
+# of a hand-tuned payload size. Workers time each payload they copy and add it,
+# as an observation (number of files, size, copy time), to the statistics of
+# its route (source region > target region) and size bucket (average file
+# size). A linear model copy_time = files * secs_per_file + size * secs_per_mb
+# is fitted per route and size bucket by least squares. Only the sums the fit
+# needs are kept, so the statistics of many payloads are a few numbers that can
+# be merged across workers and executions. Older executions weigh less (decay)
+# so the model follows changes in S3 or Lambda performance. The model is
+# persisted as a JSON object in S3.
+# ------------------------------------------------------------------------------
+
+import json
+import logging
+from botocore.exceptions import ClientError
+from utils.s3_clients import get_bucket_region
+
+logger = logging.getLogger()
+throughput_model_format_version = 1
+# upper bounds (in MB) of the average file size of a payload, the last bucket is unbounded
+size_bucket_bounds_in_mb = [1, 16, 256]
+size_bucket_names = ['lt-1MB', '1MB-16MB', '16MB-256MB', 'ge-256MB']
+# representative file size (in MB) of each size bucket
+size_bucket_file_sizes_in_mb = [0.25, 4, 64, 1024]
+stats_names = ['weight', 'files_files', 'files_size', 'size_size', 'files_time', 'size_time']
+# weight of the statistics recorded by previous executions when a new execution is recorded
+default_decay = 0.8
+# observations (weight) needed before a fitted size bucket is trusted
+min_fit_weight = 3
+
+
+def get_size_bucket(num_files, size_in_mb):
+    file_size_in_mb = size_in_mb / num_files if num_files > 0 else 0
+    for bucket_idx, bound_in_mb in enumerate(size_bucket_bounds_in_mb):
+        if file_size_in_mb < bound_in_mb:
+            return size_bucket_names[bucket_idx]
+    return size_bucket_names[-1]
+
+
+def get_region(s3_client, s3_bucket):
+    # clients that are not bound to a region (eg, the local S3 stand-in) serve every bucket
+    if getattr(getattr(s3_client, 'meta', None), 'region_name', None) is None:
+        return 'local'
+    return get_bucket_region(s3_bucket, s3_client)
+
+
+def get_copy_route(s3_client, source_s3_bucket, target_s3_bucket):
+    return '{}>{}'.format(get_region(s3_client, source_s3_bucket), get_region(s3_client, target_s3_bucket))
+
+
+# Adds a copied payload to the throughput statistics ({route: {size_bucket: stats}})
+def add_observation(throughput_stats, route, num_files, size_in_mb, copy_time_in_sec):
+    if route is None or num_files <= 0 or copy_time_in_sec <= 0:
+        return throughput_stats
+    stats = throughput_stats.setdefault(route, {}).setdefault(get_size_bucket(num_files, size_in_mb), dict.fromkeys(stats_names, 0))
+    stats['weight'] += 1
+    stats['files_files'] += num_files * num_files
+    stats['files_size'] += num_files * size_in_mb
+    stats['size_size'] += size_in_mb * size_in_mb
+    stats['files_time'] += num_files * copy_time_in_sec
+    stats['size_time'] += size_in_mb * copy_time_in_sec
+    return throughput_stats
+
+
+# Sums throughput statistics (eg, of all workers of an execution), older statistics weighted by decay
+def merge_throughput_stats(accumulated_stats, throughput_stats, decay=1.0):
+    merged_stats = {route: {size_bucket: {stat_name: value * decay for stat_name, value in stats.items()}
+                            for size_bucket, stats in route_stats.items()}
+                    for route, route_stats in (accumulated_stats or {}).items()}
+    for route, route_stats in (throughput_stats or {}).items():
+        for size_bucket, stats in route_stats.items():
+            merged = merged_stats.setdefault(route, {}).setdefault(size_bucket, dict.fromkeys(stats_names, 0))
+            for stat_name in stats_names:
+                merged[stat_name] += stats.get(stat_name, 0)
+    return merged_stats
+
+
+# Least squares fit of copy_time = files * secs_per_file + size * secs_per_mb, both non-negative
+def fit_copy_time(stats):
+    determinant = stats['files_files'] * stats['size_size'] - stats['files_size'] ** 2
+    if determinant > 1e-9 * stats['files_files'] * stats['size_size']:
+        secs_per_file = (stats['files_time'] * stats['size_size'] - stats['size_time'] * stats['files_size']) / determinant
+        secs_per_mb = (stats['size_time'] * stats['files_files'] - stats['files_time'] * stats['files_size']) / determinant
+        if secs_per_file >= 0 and secs_per_mb >= 0:
+            return secs_per_file, secs_per_mb
+    # payloads too alike to tell both apart (or a negative coefficient): fit the one that explains more
+    secs_per_mb = stats['size_time'] / stats['size_size'] if stats['size_size'] > 0 else 0
+    secs_per_file = stats['files_time'] / stats['files_files'] if stats['files_files'] > 0 else 0
+    size_residual = stats['size_size'] * secs_per_mb ** 2 - 2 * secs_per_mb * stats['size_time']
+    files_residual = stats['files_files'] * secs_per_file ** 2 - 2 * secs_per_file * stats['files_time']
+    return (0.0, secs_per_mb) if size_residual <= files_residual else (secs_per_file, 0.0)
+
+
+# Cost model (see S3CopyCostModel) fitted per size bucket, size buckets without enough
+# observations fall back to the configured cost model
+class S3LearnedCostModel:
+
+    def __init__(self, coefficients, fallback_cost_model):
+        self.coefficients = coefficients
+        self.fallback_cost_model = fallback_cost_model
+
+    @property
+    def is_fitted(self):
+        return len(self.coefficients) > 0
+
+    # Predicted worker time (in secs) spent copying a file
+    def file_cost(self, file_size_in_mb):
+        size_bucket = get_size_bucket(1, file_size_in_mb)
+        if size_bucket not in self.coefficients:
+            return self.fallback_cost_model.file_cost(file_size_in_mb)
+        secs_per_file, secs_per_mb = self.coefficients[size_bucket]
+        return secs_per_file + file_size_in_mb * secs_per_mb
+
+    # Largest payload (in MB) of the largest files seen that can be copied within the given duration
+    # (None if copies take no time according to the model)
+    def max_payload_size_in_mb(self, payload_duration_in_sec):
+        bucket_idx = max(size_bucket_names.index(size_bucket) for size_bucket in self.coefficients)
+        file_size_in_mb = size_bucket_file_sizes_in_mb[bucket_idx]
+        file_cost = self.file_cost(file_size_in_mb)
+        if file_cost <= 0:
+            return None
+        return payload_duration_in_sec * file_size_in_mb / file_cost
+
+    def __repr__(self):
+        return f'S3LearnedCostModel({self.coefficients!r}, {self.fallback_cost_model!r})'
+
+
+class S3ThroughputModel:
+
+    def __init__(self, throughput_stats=None):
+        self.throughput_stats = throughput_stats or {}
+
+    # Records the statistics of an execution, previous executions weigh less
+    def record(self, throughput_stats, decay=default_decay):
+        self.throughput_stats = merge_throughput_stats(self.throughput_stats, throughput_stats, decay)
+
+    def fit(self, route):
+        return {size_bucket: fit_copy_time(stats) for size_bucket, stats in self.throughput_stats.get(route, {}).items()
+                if stats['weight'] >= min_fit_weight}
+
+    # Cost model of the slowest of the routes, per size bucket
+    def new_cost_model(self, routes, fallback_cost_model):
+        coefficients = {}
+        for route in routes:
+            for size_bucket, (secs_per_file, secs_per_mb) in self.fit(route).items():
+                file_size_in_mb = size_bucket_file_sizes_in_mb[size_bucket_names.index(size_bucket)]
+                cost = secs_per_file + file_size_in_mb * secs_per_mb
+                if size_bucket not in coefficients or cost > coefficients[size_bucket][0] + file_size_in_mb * coefficients[size_bucket][1]:
+                    coefficients[size_bucket] = (secs_per_file, secs_per_mb)
+        return S3LearnedCostModel(coefficients, fallback_cost_model)
+
+    def to_json(self):
+        return {'version': throughput_model_format_version, 'throughput_stats': self.throughput_stats}
+
+    def __repr__(self):
+        return f'S3ThroughputModel({sorted(self.throughput_stats)!r})'
+
+
+def load_throughput_model(s3_client, s3_bucket, s3_path):
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=s3_path)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+            raise
+        logger.info('No throughput model found at s3://{}/{}, starting a new one'.format(s3_bucket, s3_path))
+        return S3ThroughputModel()
+    model_json = json.loads(response['Body'].read())
+    if model_json.get('version') != throughput_model_format_version:
+        logger.warning('Ignoring throughput model s3://{}/{} of unsupported version {}'.format(s3_bucket, s3_path, model_json.get('version')))
+        return S3ThroughputModel()
+    return S3ThroughputModel(model_json['throughput_stats'])
+
+
+def save_throughput_model(s3_client, s3_bucket, s3_path, throughput_model):
+    s3_client.put_object(Bucket=s3_bucket, Key=s3_path, Body=json.dumps(throughput_model.to_json()).encode('utf-8'),
+                         ContentType='application/json')
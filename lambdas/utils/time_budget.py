@@ -0,0 +1,50 @@
+# ------------------------------------------------------------------------------
+# Time budget of a Lambda execution. Used by workers that keep taking files
+# from their work until the Lambda deadline (minus a safety margin) gets close,
+# instead of processing a fixed-size payload per execution.
+# ------------------------------------------------------------------------------
+
+import threading
+import time
+
+default_safety_margin_in_sec = 30
+
+
+class LambdaTimeBudget:
+
+    # context: Lambda context (get_remaining_time_in_millis)
+    # copy_concurrency: number of files copied concurrently (to estimate the copy time of a single file)
+    def __init__(self, context, safety_margin_in_sec=default_safety_margin_in_sec, copy_concurrency=1):
+        self.context = context
+        self.safety_margin_in_sec = safety_margin_in_sec
+        self.copy_concurrency = copy_concurrency
+        self.start_time = time.time()
+        self.copied_size_in_mb = 0
+        self.num_files_started = 0
+        self.lock = threading.Lock()
+
+    def get_remaining_time_in_sec(self):
+        return self.context.get_remaining_time_in_millis() / 1000 - self.safety_margin_in_sec
+
+    def record_copied(self, file_size_in_mb):
+        with self.lock:
+            self.copied_size_in_mb += file_size_in_mb
+
+    # Predicted time it takes to copy a file based on the throughput observed so far
+    def get_predicted_copy_time_in_sec(self, file_size_in_mb):
+        elapsed_time = time.time() - self.start_time
+        if self.copied_size_in_mb <= 0 or elapsed_time <= 0:
+            return 0
+        throughput_per_file = self.copied_size_in_mb / elapsed_time / self.copy_concurrency
+        return file_size_in_mb / throughput_per_file
+
+    # A file is started if it is predicted to be copied before the safety margin is reached.
+    # The first file is always started so that each execution makes progress.
+    def can_start(self, file_size_in_mb):
+        if self.num_files_started > 0 and self.get_predicted_copy_time_in_sec(file_size_in_mb) >= self.get_remaining_time_in_sec():
+            return False
+        self.num_files_started += 1
+        return True
+
+    def __repr__(self):
+        return f'LambdaTimeBudget({self.safety_margin_in_sec!r}, {self.copy_concurrency!r}, {self.copied_size_in_mb!r})'
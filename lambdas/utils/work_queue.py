@@ -0,0 +1,159 @@
+# ------------------------------------------------------------------------------
+# Work queues used by the queue-driven execution mode. The orchestrator enqueues
+# payloads and a pool of workers keeps pulling payloads until the queue is
+# drained, so a slow worker no longer holds up a static share of the work.
+# SqsWorkQueue is backed by Amazon SQS; LocalWorkQueue is an in-process stand-in
+# with the same semantics (in-flight messages, acks, receive counts) used for
+# tests. Messages carry the id of the execution that enqueued them, workers drop
+# those of other (failed) executions.
+# ------------------------------------------------------------------------------
+
+import collections
+import itertools
+import json
+import logging
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+MAX_SQS_BATCH_SIZE = 10
+# max size (bytes) of a message, and of all the messages of a batch request
+MAX_SQS_MESSAGE_SIZE = 256 * 1024
+default_wait_time_in_sec = 2
+# the queue moves a message to its dead-letter queue once received more times than this
+default_max_receive_count = 10
+
+
+class WorkQueueMessage:
+
+    # receive_count: number of times the message was received, this time included
+    def __init__(self, receipt, body, receive_count=1):
+        self.receipt = receipt
+        self.body = body
+        self.receive_count = receive_count
+
+    def __repr__(self):
+        return f'WorkQueueMessage({self.receipt!r}, {self.body!r}, {self.receive_count!r})'
+
+
+class SqsWorkQueue:
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def _send_batch(self, batch):
+        response = self.sqs_client.send_message_batch(QueueUrl=self.queue_url, Entries=[
+            {'Id': str(idx), 'MessageBody': message_body} for idx, message_body in enumerate(batch)])
+        if response.get('Failed'):
+            raise Exception('Failed to enqueue {} work messages: {}'.format(len(response['Failed']), response['Failed']))
+
+    # Batches are filled up to the max number of messages and the max size of a batch request
+    def send_messages(self, bodies):
+        batch = []
+        batch_size = 0
+        for body in bodies:
+            message_body = json.dumps(body)
+            message_size = len(message_body.encode('utf-8'))
+            if message_size > MAX_SQS_MESSAGE_SIZE:
+                raise ValueError('Work message of {} bytes exceeds the SQS message size limit ({} bytes)'.format(message_size, MAX_SQS_MESSAGE_SIZE))
+            if batch and (len(batch) >= MAX_SQS_BATCH_SIZE or batch_size + message_size > MAX_SQS_MESSAGE_SIZE):
+                self._send_batch(batch)
+                batch = []
+                batch_size = 0
+            batch.append(message_body)
+            batch_size += message_size
+        if batch:
+            self._send_batch(batch)
+
+    def receive_message(self, wait_time_in_sec=default_wait_time_in_sec):
+        response = self.sqs_client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=wait_time_in_sec,
+            AttributeNames=['ApproximateReceiveCount'])
+        messages = response.get('Messages', [])
+        if not messages:
+            return None
+        return WorkQueueMessage(messages[0]['ReceiptHandle'], json.loads(messages[0]['Body']),
+            int(messages[0].get('Attributes', {}).get('ApproximateReceiveCount', 1)))
+
+    def delete_message(self, message):
+        self.sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message.receipt)
+
+    # Makes the message visible again (eg, not enough time left to process it)
+    def release_message(self, message):
+        self.sqs_client.change_message_visibility(QueueUrl=self.queue_url, ReceiptHandle=message.receipt, VisibilityTimeout=0)
+
+    # Deletes all messages, waiting or in flight. SQS allows one purge a minute: a purge requested
+    # meanwhile is skipped (returns False), workers drop the messages left of a failed execution.
+    def purge(self):
+        try:
+            self.sqs_client.purge_queue(QueueUrl=self.queue_url)
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'AWS.SimpleQueueService.PurgeQueueInProgress':
+                raise
+            return False
+
+    def __repr__(self):
+        return f'SqsWorkQueue({self.queue_url!r})'
+
+
+class LocalWorkQueue:
+
+    def __init__(self):
+        self.messages = collections.deque()
+        self.in_flight = {}
+        self.receipts = itertools.count(1)
+        self.lock = threading.Lock()
+
+    # messages are kept as [body, receive count]
+    def send_messages(self, bodies):
+        with self.lock:
+            # messages are serialized as they would be by SQS
+            self.messages.extend([json.dumps(body), 0] for body in bodies)
+
+    def receive_message(self, wait_time_in_sec=default_wait_time_in_sec):
+        with self.lock:
+            if not self.messages:
+                return None
+            receipt = 'receipt-{}'.format(next(self.receipts))
+            message = self.in_flight[receipt] = self.messages.popleft()
+            message[1] += 1
+            return WorkQueueMessage(receipt, json.loads(message[0]), message[1])
+
+    def delete_message(self, message):
+        with self.lock:
+            del self.in_flight[message.receipt]
+
+    def release_message(self, message):
+        with self.lock:
+            self.messages.appendleft(self.in_flight.pop(message.receipt))
+
+    def purge(self):
+        with self.lock:
+            self.messages.clear()
+            self.in_flight.clear()
+        return True
+
+    def is_drained(self):
+        with self.lock:
+            return not self.messages and not self.in_flight
+
+    def __repr__(self):
+        return f'LocalWorkQueue({len(self.messages)!r}, {len(self.in_flight)!r})'
+
+
+_work_queue = None
+
+
+def get_max_receive_count():
+    return int(os.environ['WorkQueueMaxReceiveCount']) if 'WorkQueueMaxReceiveCount' in os.environ else default_max_receive_count
+
+
+def get_work_queue():
+    global _work_queue
+    if _work_queue is None:
+        import boto3
+        _work_queue = SqsWorkQueue(boto3.client('sqs'), os.environ['WorkQueueUrl'])
+    return _work_queue
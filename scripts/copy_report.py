@@ -0,0 +1,193 @@
+# ------------------------------------------------------------------------------
+# Plan vs actual report of a state machine execution. Reads the execution
+# history (Step Functions API or a file saved with 'aws stepfunctions
+# get-execution-history'), and compares for each worker the load predicted by
+# the orchestrator with the time it actually took, the time spent copying and
+# the S3 telemetry (latency, throughput, throttles, retries) of its executions.
+# The verdict tells whether the copy was bound by S3, by Lambda (invocation and
+# state machine overhead) or by scheduling (unbalanced or mispredicted work).
+#
+# Sample invoke:
+# python scripts/copy_report.py --execution-arn arn:aws:states:us-east-1:123456789012:execution:dev-s3servcopy-state-machine:test
+# python scripts/copy_report.py --history-file history.json
+# ------------------------------------------------------------------------------
+
+import argparse
+import datetime
+import json
+
+orchestrator_state_name = 'Orchestrate S3 Copy Work'
+worker_state_prefixes = ('S3 Copy Worker', 'S3 Queue Worker')
+# a worker is considered a straggler when it takes this much longer than the average worker
+straggler_ratio = 1.25
+
+
+def parse_timestamp(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp.timestamp()
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    from dateutil import parser
+    return parser.parse(timestamp).timestamp()
+
+
+def load_history_events(execution_arn=None, history_file=None):
+    if history_file is not None:
+        with open(history_file) as f:
+            return json.load(f)['events']
+    import boto3
+    events = []
+    for page in boto3.client('stepfunctions').get_paginator('get_execution_history').paginate(executionArn=execution_arn):
+        events.extend(page['events'])
+    return events
+
+
+# The state of a worker is either a work ('static' execution mode) or a queue worker
+def get_worker_state(state):
+    if isinstance(state, list) and state:
+        state = state[0]
+    if not isinstance(state, dict):
+        return None
+    if 'worker_id' in state or 'work_id' in state:
+        return state
+    for value in state.values():
+        if isinstance(value, dict) and 'work_id' in value:
+            return value
+    return None
+
+
+def get_worker_id(worker_state):
+    return worker_state.get('worker_id') or worker_state.get('work_id')
+
+
+def get_workers(events):
+    plan = None
+    workers = {}
+    for event in events:
+        if event['type'] == 'TaskStateExited' and event['stateExitedEventDetails']['name'] == orchestrator_state_name:
+            plan = json.loads(event['stateExitedEventDetails']['output'])['work_config']
+            continue
+        details = event.get('stateEnteredEventDetails') if event['type'] == 'TaskStateEntered' else \
+            event.get('stateExitedEventDetails') if event['type'] == 'TaskStateExited' else None
+        if details is None or not details['name'].startswith(worker_state_prefixes):
+            continue
+        worker_state = get_worker_state(json.loads(details.get('input') or details.get('output') or 'null'))
+        # static workers have a state per branch (#N) but their first input is the whole execution
+        # state, queue workers share the same state name and are told apart by their worker id
+        if details['name'].startswith(worker_state_prefixes[0]):
+            worker_key = details['name']
+        elif worker_state is not None:
+            worker_key = get_worker_id(worker_state)
+        else:
+            continue
+        worker = workers.setdefault(worker_key, {'start_time': None, 'end_time': None, 'state': None})
+        timestamp = parse_timestamp(event['timestamp'])
+        if event['type'] == 'TaskStateEntered':
+            worker['start_time'] = timestamp if worker['start_time'] is None else min(worker['start_time'], timestamp)
+        else:
+            worker['end_time'] = timestamp if worker['end_time'] is None else max(worker['end_time'], timestamp)
+            worker['state'] = worker_state
+    return plan, {get_worker_id(worker['state']) if worker['state'] else worker_key: worker for worker_key, worker in workers.items()}
+
+
+def get_predicted_duration(plan, worker_id):
+    work = (plan or {}).get(worker_id)
+    if isinstance(work, dict) and 'predicted_duration_in_sec' in work:
+        return work['predicted_duration_in_sec']
+    # queue workers share all payloads, the makespan is the best available prediction
+    return (plan or {}).get('predicted_makespan_in_sec')
+
+
+def summarize_metrics(metrics):
+    summary = {'num_requests': 0, 'num_throttles': 0, 'num_retries': 0, 'num_errors': 0, 'total_latency_in_sec': 0, 'size_in_mb': 0}
+    transfer_latency_in_sec = 0
+    for stats in (metrics or {}).values():
+        for stat_name in summary:
+            summary[stat_name] += stats.get(stat_name, 0)
+        if stats.get('size_in_mb', 0) > 0:
+            transfer_latency_in_sec += stats.get('total_latency_in_sec', 0)
+    # throughput of a single request transferring data (copies, part copies)
+    summary['mb_per_sec'] = summary['size_in_mb'] / transfer_latency_in_sec if transfer_latency_in_sec > 0 else 0
+    return summary
+
+
+def build_report(plan, workers):
+    rows = []
+    for worker_id, worker in sorted(workers.items()):
+        state = worker['state'] or {}
+        duration = (worker['end_time'] or 0) - (worker['start_time'] or 0)
+        copy_time = state.get('copy_time_in_sec', 0)
+        rows.append({
+            'worker_id': worker_id,
+            'predicted_in_sec': get_predicted_duration(plan, worker_id),
+            'duration_in_sec': duration,
+            'copy_time_in_sec': copy_time,
+            # time spent outside of the copies: Lambda invocations, cold starts, state transitions
+            'overhead_in_sec': max(duration - copy_time, 0),
+            'num_executions': state.get('num_executions', 0),
+            'metrics': summarize_metrics(state.get('metrics')),
+            # request rates the worker settled on for the S3 prefixes that throttled it
+            'rate_control': state.get('rate_control', {})
+        })
+    return rows
+
+
+def get_verdict(rows):
+    if not rows:
+        return 'no worker executions found'
+    durations = [row['duration_in_sec'] for row in rows]
+    mean_duration = sum(durations) / len(durations)
+    total_duration = sum(durations)
+    total_overhead = sum(row['overhead_in_sec'] for row in rows)
+    total_throttles = sum(row['metrics']['num_throttles'] for row in rows)
+    total_requests = sum(row['metrics']['num_requests'] for row in rows)
+    reasons = []
+    if total_requests and total_throttles / total_requests > 0.01:
+        reasons.append('S3-bound: {} throttled requests out of {}'.format(total_throttles, total_requests))
+    if total_duration and total_overhead / total_duration > 0.25:
+        reasons.append('Lambda-bound: {:.0%} of the worker time is spent outside of the copies'.format(total_overhead / total_duration))
+    if mean_duration and max(durations) / mean_duration > straggler_ratio:
+        predicted = [row['predicted_in_sec'] for row in rows if row['predicted_in_sec']]
+        predicted_imbalance = max(predicted) / (sum(predicted) / len(predicted)) if predicted else 1
+        reasons.append('scheduling-bound: the slowest worker took {:.2f}x the average ({})'.format(
+            max(durations) / mean_duration, 'planned unbalanced' if predicted_imbalance > straggler_ratio else 'mispredicted costs'))
+    if not reasons:
+        reasons.append('S3-bound: workers are balanced and mostly busy copying (throughput is set by S3)')
+    return '; '.join(reasons)
+
+
+def print_report(plan, rows):
+    if plan is not None:
+        print('Predicted makespan: {:.1f} secs'.format(plan.get('predicted_makespan_in_sec', 0)))
+    print('{:<22} {:>10} {:>10} {:>10} {:>10} {:>6} {:>9} {:>9} {:>8} {:>8}'.format(
+        'worker', 'predicted', 'actual', 'copying', 'overhead', 'execs', 'requests', 'MB/sec', 'throttle', 'retries'))
+    for row in rows:
+        print('{:<22} {:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>6} {:>9} {:>9.1f} {:>8} {:>8}'.format(
+            row['worker_id'], '{:.1f}'.format(row['predicted_in_sec']) if row['predicted_in_sec'] is not None else '-',
+            row['duration_in_sec'], row['copy_time_in_sec'], row['overhead_in_sec'], row['num_executions'],
+            row['metrics']['num_requests'], row['metrics']['mb_per_sec'], row['metrics']['num_throttles'], row['metrics']['num_retries']))
+    for row in rows:
+        for s3_prefix, rate_control in sorted(row['rate_control'].items()):
+            print('{} throttled on {}: settled on {:.1f} requests/sec ({} in flight)'.format(
+                row['worker_id'], s3_prefix, rate_control['request_rate_per_sec'], rate_control['concurrency_limit']))
+    print('Verdict: {}'.format(get_verdict(rows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan vs actual report of an S3 copy state machine execution')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--execution-arn')
+    source.add_argument('--history-file', help='output of \'aws stepfunctions get-execution-history\'')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    plan, workers = get_workers(load_history_events(args.execution_arn, args.history_file))
+    rows = build_report(plan, workers)
+    if args.json:
+        print(json.dumps({'rows': rows, 'verdict': get_verdict(rows)}, indent=2))
+    else:
+        print_report(plan, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,9 +32,26 @@ pack_dist_dir="${pack_root_dir}/dist"
         EnvType="$env_type" \
         SourceS3Bucket="$source_s3_bucket" \
         TargetS3Bucket="$target_s3_bucket" \
+        ManifestS3Bucket="$manifest_s3_bucket" \
         S3OperationType="$s3_operation_type" \
         NumCopyLambdaWorkers="$num_copy_lambda_workers" \
         MaxPayloadSizePerLambdaExecutionInMB="$max_payload_size_per_lambda_execution_in_mb" \
+        CopyConcurrency="$copy_concurrency" \
+        AdaptiveS3Concurrency="$adaptive_s3_concurrency" \
+        WorkerMode="$worker_mode" \
+        WorkScheduler="$work_scheduler" \
+        PerFileLatencyInSec="$per_file_latency_in_sec" \
+        ThroughputInMBPerSec="$throughput_in_mb_per_sec" \
+        ThroughputModelS3Bucket="$throughput_model_s3_bucket" \
+        TargetPayloadDurationInSec="$target_payload_duration_in_sec" \
+        InventoryS3Bucket="$inventory_s3_bucket" \
+        JournalS3Bucket="$journal_s3_bucket" \
+        WorkQueueMaxReceiveCount="$work_queue_max_receive_count" \
+        TransferMode="$transfer_mode" \
+        SpeculationS3Bucket="$speculation_s3_bucket" \
+        S3BucketRoleArns="$s3_bucket_role_arns" \
+        S3MaxPoolConnections="$s3_max_pool_connections" \
+        S3RetryMode="$s3_retry_mode" \
     --capabilities \
         CAPABILITY_IAM
 )
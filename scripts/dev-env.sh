@@ -3,10 +3,10 @@
 # Environment name (eg, dev, qa, prod)
 export env_type="dev"
 
-# Python virtual environment location for packaging
-if [ -z "$virtual_env_location" ]; then
-    virtual_env_location=`pipenv --venv`
-fi
+# Whether the Lambda package bundles boto3 (lambda-requirements.txt, trimmed to the
+# AWS services called) or uses the one of the Lambda runtime ("false", a smaller
+# package but an older boto3 without adaptive retries)
+export package_boto3="true"
 
 # S3 operation type: "move-files" or "copy-files"
 export s3_operation_type="move-files"
@@ -16,18 +16,92 @@ export s3_operation_type="move-files"
 # in the state machine.
 export num_copy_lambda_workers=3
 
+# Execution mode: "static" (each worker copies a fixed share of the files,
+# one state machine branch per worker) or "queue" (the orchestrator enqueues
+# payloads into an SQS queue and workers pull them until the queue is
+# drained; the number of workers is set per execution with "num_workers"
+# in s3_copy_config, defaulting to num_copy_lambda_workers)
+export execution_mode="static"
+
+# Number of times a payload can be received from the work queue (queue
+# execution mode) before it is moved to the dead-letter queue
+export work_queue_max_receive_count=10
+
 # Maximum payload size in MB that can be handled by a single Lambda worker 
 # execution. We can use a very large number since Lambda timeouts will be
 # handled by re-triggering the Lambda to continue the work where it stopped.
 # For reference: Same-region => ~10-15GB, Cross-region: 1GB?
 export max_payload_size_per_lambda_execution_in_mb=1024
 
+# Number of S3 files a single Lambda worker execution copies concurrently
+# within its payload (server-side copies are mostly waiting on S3)
+export copy_concurrency=8
+
+# Whether workers back off (fewer requests in flight, paced) on an S3 prefix
+# that throttles them (SlowDown/503) and speed up again once it stops
+export adaptive_s3_concurrency="true"
+
+# Worker mode: "payload" (one payload per Lambda worker execution) or 
+# "time-budget" (workers keep copying files, across payloads, until their
+# execution is about to time out, so payload sizes need not be conservative)
+export worker_mode="payload"
+
+# How files are balanced across workers: "lpt" (largest first), "kk" 
+# (Karmarkar-Karp), "multifit" or "best" (smallest predicted makespan).
+# Files are balanced on their predicted copy time: a fixed latency per
+# file (requests) plus the file size over the copy throughput.
+export work_scheduler="lpt"
+export per_file_latency_in_sec=0.0
+export throughput_in_mb_per_sec=100
+
+# Throughput model: workers record how long their payloads take per route
+# (source/target regions) and file size, and the model learnt from previous
+# copies (kept in this S3 bucket, empty to disable) replaces the settings
+# above and sizes payloads to take target_payload_duration_in_sec (0 to keep
+# max_payload_size_per_lambda_execution_in_mb)
+export throughput_model_s3_bucket=""
+export target_payload_duration_in_sec=180
+
+# S3 clients: connection pool size (should cover copy_concurrency times the
+# transfer concurrency of each copy) and retry mode ("adaptive" slows down
+# requests client-side when S3 throttles them, "standard" or "legacy")
+export s3_max_pool_connections=64
+export s3_retry_mode="adaptive"
+
 # S3 bucket where file will be copied from
 export source_s3_bucket="serverless-s3-parallel-copy-source"
 
 # S3 bucket where file will be copied to
 export target_s3_bucket="serverless-s3-parallel-copy-target"
 
+# S3 bucket where the orchestrator writes work manifests (compact list of
+# files per worker). Leave empty to pass the files through the state machine
+# instead, which limits a copy to a few thousand files (256KB state limit)
+export manifest_s3_bucket="aws-s3-serverless-parallel-copy"
+
+# S3 bucket the S3 Inventory of the source bucket is delivered to. Copies
+# given an "inventory_manifest" read the source files from the inventory
+# instead of listing them (leave empty if not used)
+export inventory_s3_bucket=""
+
+# S3 bucket where workers journal the files they complete, so that a failed
+# copy given a "job_id" can be re-run without redoing the completed files
+# (leave empty to disable)
+export journal_s3_bucket=""
+
+# How workers transfer files: 'server-side' (S3 copies them) or 'relay' (workers
+# stream them with ranged GETs and uploads, for buckets no single set of
+# credentials can copy between, eg another account's target bucket)
+export transfer_mode="server-side"
+
+# Roles to assume per S3 bucket, as JSON (eg, '{"target-bucket": "arn:aws:iam::123456789012:role/s3-copy-target"}'),
+# leave empty if the Lambda functions' role can access all buckets
+export s3_bucket_role_arns=""
+
+# S3 bucket of the progress boards of the workers (static execution mode): idle
+# workers duplicate the remaining files of stragglers, leave empty to disable
+export speculation_s3_bucket=""
+
 # S3 bucket to store packaged Lambdas
 export lambda_package_s3_bucket="aws-s3-serverless-parallel-copy"
 
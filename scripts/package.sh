@@ -20,17 +20,29 @@ env_type=$1
 
 . "./scripts/${env_type}-env.sh"
 
-if [ -z "$virtual_env_location" ]; then
-    virtual_env_location=`pipenv --venv`
-fi
-
 pack_root_dir="/tmp/${app_name}"
 pack_dist_dir="${pack_root_dir}/dist"
+# AWS services called by the Lambda functions (the API models of the others are not packaged)
+botocore_services="s3 sts sqs dynamodb"
 
 rm -rf "$pack_root_dir"
 mkdir -p $pack_dist_dir
-cp -R . $pack_dist_dir/
-cp -R "${virtual_env_location}/lib/python3.6/site-packages/" "${pack_dist_dir}/lambdas"
+
+# Only the Lambda functions and the template are packaged, without tests and compiled files
+cp -R cloudformation lambdas $pack_dist_dir/
+find "${pack_dist_dir}/lambdas" \( -name '__pycache__' -o -name '.pytest_cache' \) -prune -exec rm -rf {} +
+find "${pack_dist_dir}/lambdas" \( -name 'test_*.py' -o -name 'conftest.py' \) -delete
+
+# Runtime dependencies only (lambda-requirements.txt, not the dev packages of the virtual
+# environment). The Lambda runtime provides a boto3 of its own, package_boto3="false" uses it.
+if [ "${package_boto3:-true}" == "true" ]; then
+    python -m pip install --quiet --no-deps --no-compile --target "${pack_dist_dir}/lambdas" -r lambda-requirements.txt
+    rm -rf "${pack_dist_dir}/lambdas/bin"
+    for service_dir in "${pack_dist_dir}"/lambdas/botocore/data/*/; do
+        [[ " ${botocore_services} " == *" $(basename "$service_dir") "* ]] || rm -rf "$service_dir"
+    done
+fi
+echo "Lambda package size: $(du -sh "${pack_dist_dir}/lambdas" | cut -f1)"
 
 # resolve jinja2 template into sam cfn template
 ( export cfn_template_dir="${pack_dist_dir}/cloudformation/" &&
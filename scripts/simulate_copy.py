@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------------
+# Simulates a copy across a grid of number of workers and max payload sizes
+# before deploying (see lambdas/utils/copy_simulator.py). The source listing is
+# either a synthetic bucket (--num-objects) or a real one saved with
+# 'aws s3api list-objects-v2 --output json' or as 'key,size' CSV lines. Files
+# are routed with the S3 copy config, large files split into parts and the
+# works planned by the orchestrator exactly as in a real execution; then each
+# plan runs through the simulated state machine. Makespan, cost and
+# utilisation are printed per grid point (and optionally saved as JSON),
+# fastest and cheapest plans being flagged.
+#
+# Sample invoke (from the project root):
+# python scripts/simulate_copy.py --num-objects 100000 --num-workers 5 10 20 40 --max-payload-size-in-mb 256 1024 4096
+# python scripts/simulate_copy.py --listing-file listing.json --s3-copy-config s3_copy_config.json --execution-mode queue --output grid.json
+# ------------------------------------------------------------------------------
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas'))
+
+from utils.local_s3 import LocalS3Client
+from utils.s3_listing import list_s3_objects
+from utils.s3_routing import S3RoutingTable, get_source_s3_configs, get_target_s3_locations
+from utils.s3_work_scheduler import new_work_scheduler
+from utils.copy_simulator import CopySimulator, CopySimulationConfig
+from s3_copy_orchestrator import S3CopyOrchestrator, S3MultipartCopyPlanner, s3_objects_to_catalog, max_files_per_queue_message
+
+default_s3_copy_config = {
+    'source_s3_config': {'s3_bucket': 'simulated-source', 's3_path': ''},
+    'target_s3_config': [{'s3_bucket': 'simulated-target', 's3_path': ''}]
+}
+
+
+def load_listing(listing_file):
+    with open(listing_file) as f:
+        if listing_file.endswith('.csv'):
+            return [{'Key': row[0], 'Size': int(row[1])} for row in csv.reader(f) if row]
+        listing = json.load(f)
+    return listing['Contents'] if isinstance(listing, dict) else listing
+
+
+# S3 objects of each source of the copy (a synthetic listing of num_objects per source)
+def load_s3_objects(s3_client, s3_copy_config, num_objects=None, listing_file=None):
+    sources = get_source_s3_configs(s3_copy_config)
+    if listing_file is not None:
+        listing = load_listing(listing_file)
+        return [[s3_object for s3_object in listing if s3_object['Key'].startswith(source['s3_path'])] for source in sources]
+    sources_s3_objects = []
+    for source in sources:
+        s3_client.create_synthetic_bucket(Bucket=source['s3_bucket'], num_objects=num_objects, prefix=source['s3_path'])
+        sources_s3_objects.append(list(list_s3_objects(s3_client, source['s3_bucket'], source['s3_path'])))
+    return sources_s3_objects
+
+
+# Catalog of the files to copy and the indexes of the files (and parts) to plan for a max payload size
+def new_copy_catalog(sources_s3_objects, s3_copy_config, max_payload_size_in_mb):
+    # multipart uploads are created in an in-process S3 (target buckets are empty, so all large files are split)
+    s3_client = LocalS3Client()
+    sources = get_source_s3_configs(s3_copy_config)
+    for source in sources:
+        for target_s3_config in source['target_s3_config']:
+            for s3_bucket, _ in get_target_s3_locations(target_s3_config):
+                s3_client.create_bucket(Bucket=s3_bucket)
+    # the files of all sources are planned together
+    catalog = None
+    for source, s3_objects in zip(sources, sources_s3_objects):
+        catalog = s3_objects_to_catalog(s3_objects, source['s3_bucket'], source['s3_path'], S3RoutingTable(source['target_s3_config']), catalog=catalog)
+    multipart_copy_planner = S3MultipartCopyPlanner(s3_client, max_payload_size_in_mb)
+    file_indexes = multipart_copy_planner.split_catalog(catalog)
+    return catalog, file_indexes, len(multipart_copy_planner.multipart_uploads)
+
+
+def simulate_grid(sources_s3_objects, s3_copy_config, config, execution_mode, num_workers_list, max_payload_sizes_in_mb, work_scheduler_name='lpt'):
+    simulator = CopySimulator(config)
+    grid = []
+    for max_payload_size_in_mb in max_payload_sizes_in_mb:
+        catalog, file_indexes, num_multipart_uploads = new_copy_catalog(sources_s3_objects, s3_copy_config, max_payload_size_in_mb)
+        for num_workers in num_workers_list:
+            start_time = time.perf_counter()
+            orchestrator = S3CopyOrchestrator(new_work_scheduler(work_scheduler_name), config.new_cost_model())
+            # queue workers pull payloads planned as in the static mode
+            works = orchestrator.split_work(catalog, num_workers, max_payload_size_in_mb, file_indexes=file_indexes)
+            planning_time = time.perf_counter() - start_time
+            result = simulator.simulate(works, execution_mode, num_workers, num_multipart_uploads, max_files_per_queue_message)
+            grid.append(dict(result.to_json(config), max_payload_size_in_mb=max_payload_size_in_mb,
+                num_files=len(file_indexes), num_multipart_uploads=num_multipart_uploads, planning_time_in_sec=planning_time))
+    return grid
+
+
+def print_grid(grid):
+    fastest = min(grid, key=lambda point: point['makespan_in_sec'])
+    cheapest = min(grid, key=lambda point: point['cost'])
+    print('{:>8} {:>14} {:>9} {:>14} {:>11} {:>9} {:>10} {:>9} {:>8}  {}'.format('workers', 'payload (MB)', 'payloads', 'makespan (s)',
+        'cost (USD)', 'workers%', 'threads%', 'timeouts', 'execs', ''))
+    for point in grid:
+        flags = ' '.join(flag for flag, flagged_point in [('fastest', fastest), ('cheapest', cheapest)] if flagged_point is point)
+        print('{:>8} {:>14} {:>9} {:>14.1f} {:>11.4f} {:>9.0%} {:>10.0%} {:>9} {:>8}  {}'.format(point['num_workers'], point['max_payload_size_in_mb'],
+            point['num_payloads'], point['makespan_in_sec'], point['cost'], point['worker_utilisation'], point['thread_utilisation'],
+            point['num_timeouts'], point['num_executions'], flags))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates an S3 copy across numbers of workers and max payload sizes')
+    parser.add_argument('--num-objects', type=int, default=10000, help='size of the synthetic source listing (without --listing-file)')
+    parser.add_argument('--listing-file', help='source listing (list-objects-v2 JSON output, or key,size CSV lines)')
+    parser.add_argument('--s3-copy-config', help='JSON file with the S3 copy config (source_s3_config, target_s3_config)')
+    parser.add_argument('--execution-mode', default='static', choices=['static', 'queue'])
+    parser.add_argument('--work-scheduler', default='lpt')
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[5, 10, 20, 40])
+    parser.add_argument('--max-payload-size-in-mb', type=float, nargs='+', default=[256, 1024, 4096])
+    parser.add_argument('--request-latency-in-sec', type=float, default=0.02)
+    parser.add_argument('--requests-per-file', type=int, default=2)
+    parser.add_argument('--bandwidth-in-mb-per-sec', type=float, default=100)
+    parser.add_argument('--copy-concurrency', type=int, default=8)
+    parser.add_argument('--cold-start-in-sec', type=float, default=1.0)
+    parser.add_argument('--state-transition-in-sec', type=float, default=0.05)
+    parser.add_argument('--orchestrator-duration-in-sec', type=float, default=0)
+    parser.add_argument('--lambda-memory-in-mb', type=int, default=512)
+    parser.add_argument('--lambda-timeout-in-sec', type=int, default=300)
+    parser.add_argument('--output', help='JSON file where the grid results are saved')
+    args = parser.parse_args()
+
+    s3_copy_config = default_s3_copy_config
+    if args.s3_copy_config:
+        with open(args.s3_copy_config) as f:
+            s3_copy_config = json.load(f)
+    sources_s3_objects = load_s3_objects(LocalS3Client(), s3_copy_config, args.num_objects, args.listing_file)
+    config = CopySimulationConfig(request_latency_in_sec=args.request_latency_in_sec, requests_per_file=args.requests_per_file,
+        bandwidth_in_mb_per_sec=args.bandwidth_in_mb_per_sec, copy_concurrency=args.copy_concurrency, cold_start_in_sec=args.cold_start_in_sec,
+        state_transition_in_sec=args.state_transition_in_sec, orchestrator_duration_in_sec=args.orchestrator_duration_in_sec,
+        lambda_memory_in_mb=args.lambda_memory_in_mb, lambda_timeout_in_sec=args.lambda_timeout_in_sec)
+    print('Simulating the copy of {} S3 objects ({})'.format(sum(len(s3_objects) for s3_objects in sources_s3_objects), config))
+    grid = simulate_grid(sources_s3_objects, s3_copy_config, config, args.execution_mode, args.num_workers, args.max_payload_size_in_mb, args.work_scheduler)
+    print_grid(grid)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(config), 'grid': grid}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()